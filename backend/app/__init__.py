@@ -22,6 +22,27 @@ from . import models_extended
 from . import models_analytics  
 from . import models_security
 from . import models_gallery_extended
+from . import models_tags
+from . import models_related
+from . import models_cache
+from . import models_uploads
+from . import models_jobs
+from . import models_email
+
+# Register search, tag index, related-content and comment-path maintenance hooks
+from .utils import story_search
+from .utils import tag_index
+from .utils import related_content
+from .utils import comment_tree
+from .utils.counter_buffer import counter_buffer
+from .utils.analytics_buffer import analytics_buffer
+from .utils.analytics_dashboard import dashboard_snapshots
+from .utils.response_cache import response_cache
+from .utils.image_derivatives import image_derivatives
+from .utils.video_processing import video_processor
+
+# Register background task handlers for the job queue
+from . import tasks
 
 def create_app(config_name=None):
     app = Flask(__name__)
@@ -40,6 +61,12 @@ def create_app(config_name=None):
     db.init_app(app)
     migrate.init_app(app, db)
     oauth.init_app(app)
+    counter_buffer.init_app(app)
+    analytics_buffer.init_app(app)
+    dashboard_snapshots.init_app(app)
+    response_cache.init_app(app)
+    image_derivatives.init_app(app)
+    video_processor.init_app(app)
     
     # Enhanced CORS configuration with debugging
     cors_origins = app.config.get('CORS_ORIGINS', [])
@@ -47,7 +74,7 @@ def create_app(config_name=None):
     
     cors.init_app(app, 
         origins=cors_origins,
-        methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'HEAD'],
+        methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'HEAD'],
         allow_headers=[
             'Content-Type', 
             'Authorization', 
@@ -56,10 +83,15 @@ def create_app(config_name=None):
             'Accept',
             'Origin',
             'Access-Control-Request-Method',
-            'Access-Control-Request-Headers'
+            'Access-Control-Request-Headers',
+            'Tus-Resumable',
+            'Upload-Length',
+            'Upload-Metadata',
+            'Upload-Offset'
         ],
         supports_credentials=True,
-        expose_headers=['Content-Range', 'X-Content-Range'],
+        expose_headers=['Content-Range', 'X-Content-Range', 'Location', 'Tus-Resumable', 'Tus-Version',
+                        'Tus-Extension', 'Tus-Max-Size', 'Upload-Offset', 'Upload-Length', 'Upload-Expires'],
         max_age=86400
     )
     
@@ -18,6 +18,7 @@ from .routes.bulk_routes import bulk_bp
 from .routes.story_bulk import story_extra_bp
 from .routes.book_routes import book_bp
 from .routes.contact_routes import contact_bp
+from .routes.upload_routes import upload_bp
 # Register all blueprints
 api_bp.register_blueprint(auth_bp, url_prefix='/auth')
 api_bp.register_blueprint(user_bp, url_prefix='/users')
@@ -32,6 +33,7 @@ api_bp.register_blueprint(system_bp, url_prefix='/system')
 api_bp.register_blueprint(bulk_bp, url_prefix='/bulk')
 api_bp.register_blueprint(book_bp, url_prefix='/books')
 api_bp.register_blueprint(contact_bp, url_prefix='/contact')
+api_bp.register_blueprint(upload_bp, url_prefix='/uploads')
 story_bp.register_blueprint(story_extra_bp)
 
 # Import and register new admin routes
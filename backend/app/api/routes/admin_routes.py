@@ -3,7 +3,6 @@ from flask_login import login_required, current_user
 from datetime import datetime, timedelta
 import logging
 import os
-import subprocess
 import json
 from werkzeug.utils import secure_filename
 
@@ -13,49 +12,22 @@ from ...models_book import Book, Author
 from ...models_page_content import PageContent
 from ...models_i18n import Language, Translation, TranslationTemplate
 from ...auth.utils import TokenManager
+from ...utils.tag_index import TagIndex
+from ...utils.pagination import paginate_listing, InvalidCursor
+from ...utils.counter_buffer import counter_buffer
+from ...utils.like_counters import LikeCounters
+from ...utils.response_cache import response_cache
+from ...utils.conditional import conditional_get
+from ...utils.image_derivatives import image_derivatives
+from ...utils.video_processing import video_processor
+from ...utils.media_store import MediaStore, delete_gallery_item
+from ...utils.job_queue import JobQueue
+from ...models_jobs import Job
+from ..serializers import story_list_options, gallery_list_options, serialize_stories, serialize_gallery_items
 
 admin_bp = Blueprint('admin', __name__)
 logger = logging.getLogger(__name__)
 
-def generate_video_thumbnail(video_path, output_dir):
-    """
-    Generate a thumbnail for a video file using ffmpeg
-    Returns the relative path to the thumbnail file
-    """
-    try:
-        # Generate thumbnail filename
-        video_name = os.path.splitext(os.path.basename(video_path))[0]
-        thumbnail_filename = f"{video_name}_thumb.jpg"
-        thumbnail_path = os.path.join(output_dir, thumbnail_filename)
-        
-        # Use ffmpeg to extract thumbnail at 1 second mark
-        cmd = [
-            'ffmpeg',
-            '-i', video_path,
-            '-ss', '00:00:01',  # Extract at 1 second
-            '-vframes', '1',    # Only 1 frame
-            '-q:v', '2',        # High quality
-            '-y',               # Overwrite output file
-            thumbnail_path
-        ]
-        
-        # Run ffmpeg command
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode == 0 and os.path.exists(thumbnail_path):
-            # Return relative path for database storage
-            return f'uploads/gallery/{thumbnail_filename}'
-        else:
-            logger.error(f"FFmpeg failed: {result.stderr}")
-            return None
-            
-    except subprocess.TimeoutExpired:
-        logger.error("FFmpeg timeout - video might be corrupted")
-        return None
-    except Exception as e:
-        logger.error(f"Video thumbnail generation failed: {e}")
-        return None
-
 # Get admin dashboard data
 @admin_bp.route('/dashboard', methods=['GET'])
 @login_required
@@ -108,7 +80,7 @@ def get_dashboard():
                 'event_type': event.event_type,
                 'ip_address': event.ip_address,
                 'details': event.details,
-                'timestamp': event.timestamp.isoformat()
+                'timestamp': event.timestamp.isoformat() if event.timestamp else None
             })
         
         return jsonify({
@@ -143,19 +115,17 @@ def admin_list_stories():
             return jsonify({'success': False, 'message': 'Access denied'}), 403
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
-        q = Story.query.order_by(Story.created_at.desc())
-        pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-        items = [s.to_dict() for s in pagination.items]
+        q = Story.query.options(*story_list_options()).order_by(Story.created_at.desc())
+        pagination = paginate_listing(q, Story.created_at, Story.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
+        items = serialize_stories(pagination.items)
         return jsonify({
             'success': True,
             'data': items,
-            'meta': {
-                'total': pagination.total,
-                'page': page,
-                'pages': pagination.pages,
-                'per_page': per_page
-            }
+            'meta': pagination.meta()
         }), 200
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Admin list stories error: {str(e)}")
         return jsonify({'success': False, 'message': 'Failed to list stories'}), 500
@@ -404,23 +374,74 @@ def admin_list_gallery():
             return jsonify({'success': False, 'message': 'Access denied'}), 403
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
-        q = GalleryItem.query.order_by(GalleryItem.created_at.desc())
-        pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-        items = [g.to_dict() for g in pagination.items]
+        q = GalleryItem.query.options(*gallery_list_options()).order_by(GalleryItem.created_at.desc())
+        pagination = paginate_listing(q, GalleryItem.created_at, GalleryItem.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
+        items = serialize_gallery_items(pagination.items)
         return jsonify({
             'success': True,
             'data': items,
-            'meta': {
-                'total': pagination.total,
-                'page': page,
-                'pages': pagination.pages,
-                'per_page': per_page
-            }
+            'meta': pagination.meta()
         }), 200
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Admin list gallery error: {str(e)}")
         return jsonify({'success': False, 'message': 'Failed to list gallery'}), 500
 
+def create_gallery_item(stored, original_name, file_type, mime_type, metadata):
+    """
+    Create and commit the gallery record for a file saved in the media store
+    (``stored`` comes from ``MediaStore.save``/``adopt``). Used by direct and
+    resumable uploads. New videos are saved as ``processing`` and
+    probed/thumbnailed in the background; a file that is already stored
+    reuses the sizes, variants and thumbnail of an item that has it.
+    """
+    # Handle tags conversion
+    tags = metadata.get('tags', '')
+    if isinstance(tags, list):
+        tags = ', '.join(tags)
+
+    gallery_item = GalleryItem(
+        title=metadata['title'],
+        description=metadata.get('description', ''),
+        file_path=stored.path,
+        file_name=secure_filename(original_name) or stored.path.rsplit('/', 1)[-1],
+        file_size=stored.size,
+        file_type=file_type,
+        mime_type=mime_type or 'application/octet-stream',
+        category=metadata.get('category') or 'general',
+        tags=tags,
+        photographer=metadata.get('photographer'),
+        location=metadata.get('location'),
+        user_id=current_user.id,
+        # 🎬 Videos stay hidden until their thumbnail and metadata are ready
+        status='processing' if file_type == 'video' else 'active',
+        album_id=metadata['album_id'] if metadata.get('album_id') else None
+    )
+
+    twin = None
+    if stored.existing:
+        twin = GalleryItem.query.filter(GalleryItem.file_path == stored.path,
+                                        GalleryItem.status != 'processing').first()
+        if twin is not None:
+            gallery_item.width, gallery_item.height = twin.width, twin.height
+            gallery_item.image_variants = twin.image_variants
+            gallery_item.duration, gallery_item.thumbnail = twin.duration, twin.thumbnail
+            gallery_item.video_renditions = twin.video_renditions
+            if file_type == 'video':
+                gallery_item.status = 'active'
+
+    db.session.add(gallery_item)
+    db.session.commit()
+    if twin is not None and (twin.image_variants or file_type != 'image'):
+        return gallery_item
+    if file_type == 'image':
+        image_derivatives.schedule('gallery', gallery_item.id, stored.file_path, stored.path[len('uploads/'):])
+    elif file_type == 'video':
+        video_processor.schedule('gallery', gallery_item.id, stored.file_path, gallery_item.file_path)
+    return gallery_item
+
 # =============================================================================
 # 🎨 GALLERY UPLOAD ENDPOINT - ADMIN ONLY
 # =============================================================================
@@ -449,6 +470,7 @@ def admin_upload_gallery():
     logger.info(f"📡 Request method: {request.method}")
     logger.info(f"🔗 Request URL: {request.url}")
     
+    stored = None
     try:
         # 🔐 Verify admin access
         current_user_obj = User.query.get(current_user.id)
@@ -514,30 +536,9 @@ def admin_upload_gallery():
         
         logger.info(f"📝 Metadata: {metadata}")
 
-        # 🗂️ Setup upload directory structure
-        upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
-        gallery_dir = os.path.join(upload_root, 'gallery')
-        os.makedirs(gallery_dir, exist_ok=True)
-        logger.info(f"📂 Upload directory: {gallery_dir}")
-
-        # 🔒 Generate secure filename with timestamp
-        original_filename = secure_filename(file.filename)
-        base_name, ext = os.path.splitext(original_filename)
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        filename = f"{base_name}_{timestamp}{ext}"
-        file_path = os.path.join(gallery_dir, filename)
-        
-        # 🔄 Handle potential filename conflicts
-        counter = 1
-        while os.path.exists(file_path):
-            filename = f"{base_name}_{timestamp}_{counter}{ext}"
-            file_path = os.path.join(gallery_dir, filename)
-            counter += 1
-
-        # 💾 Save file to filesystem
-        file.save(file_path)
-        file_size = os.path.getsize(file_path)
-        logger.info(f"💾 File saved: {filename} ({file_size} bytes)")
+        # 💾 Save file to the media store, named by its content hash
+        stored = MediaStore.save(file.stream, file_ext, file.content_type)
+        logger.info(f"💾 File saved: {stored.path} ({stored.size} bytes{', already stored' if stored.existing else ''})")
 
         # 🏷️ Determine file type category
         if file_ext in ALLOWED_EXTENSIONS['images']:
@@ -547,42 +548,8 @@ def admin_upload_gallery():
         else:
             file_type = 'document'
 
-        # 🎬 Generate video thumbnail if it's a video
-        thumbnail_path = None
-        if file_type == 'video':
-            try:
-                thumbnail_path = generate_video_thumbnail(file_path, gallery_dir)
-                logger.info(f"🎬 Video thumbnail generated: {thumbnail_path}")
-            except Exception as e:
-                logger.warning(f"⚠️ Failed to generate video thumbnail: {e}")
-                thumbnail_path = None
-
         # 🗄️ Create database record
-        # Handle tags conversion
-        tags = metadata['tags']
-        if isinstance(tags, list):
-            tags = ', '.join(tags)
-        
-        gallery_item = GalleryItem(
-            title=metadata['title'],
-            description=metadata['description'],
-            file_path=f'uploads/gallery/{filename}',
-            file_name=filename,
-            file_size=file_size,
-            file_type=file_type,
-            mime_type=file.content_type,
-            thumbnail=thumbnail_path,
-            category=metadata['category'],
-            tags=tags,
-            photographer=metadata.get('photographer'),
-            location=metadata.get('location'),
-            user_id=current_user.id,
-            status='active',
-            album_id=metadata['album_id'] if metadata['album_id'] else None
-        )
-
-        db.session.add(gallery_item)
-        db.session.commit()
+        gallery_item = create_gallery_item(stored, file.filename, file_type, file.content_type, metadata)
 
         # 🎉 Success logging
         logger.info(f"✅ Gallery item created successfully: {gallery_item.id}")
@@ -600,6 +567,8 @@ def admin_upload_gallery():
         logger.error(f"💥 Gallery upload error: {str(e)}")
         logger.error(f"🔍 Error type: {type(e).__name__}")
         db.session.rollback()
+        if stored is not None:
+            MediaStore.discard(stored)
         
         return jsonify({
             'success': False,
@@ -614,6 +583,8 @@ def admin_upload_gallery():
 
 # Public gallery list (no auth required)
 @admin_bp.route('/public/gallery', methods=['GET'])
+@conditional_get((GalleryItem, GalleryItem.status == 'active'))
+@response_cache.cached('gallery')
 def public_list_gallery():
     """Get gallery items for public viewing (no auth required)"""
     try:
@@ -621,14 +592,18 @@ def public_list_gallery():
         per_page = request.args.get('per_page', 12, type=int)
         category = request.args.get('category', '')
         search = request.args.get('search', '')
+        tag = request.args.get('tag', '').strip()
         
         # Build query
-        q = GalleryItem.query.filter(GalleryItem.status == 'active')
+        q = GalleryItem.query.options(*gallery_list_options()).filter(GalleryItem.status == 'active')
         
         # Apply filters
         if category and category != 'all':
             q = q.filter(GalleryItem.category == category)
         
+        if tag:
+            q = TagIndex.filter_by_tag(q, 'gallery_item', tag)
+        
         if search:
             q = q.filter(
                 db.or_(
@@ -641,32 +616,26 @@ def public_list_gallery():
         # Order by creation date
         q = q.order_by(GalleryItem.created_at.desc())
         
-        # Paginate
-        pagination = q.paginate(page=page, per_page=per_page, error_out=False)
-        items = []
-        for g in pagination.items:
-            item_dict = g.to_dict()
-            print(f"🔍 Public gallery item {g.id}:")
-            print(f"  📁 file_path: {g.file_path}")
-            print(f"  🔗 file_url: {item_dict.get('file_url')}")
-            items.append(item_dict)
+        # Paginate (?cursor= switches to keyset pages)
+        pagination = paginate_listing(q, GalleryItem.created_at, GalleryItem.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
+        items = serialize_gallery_items(pagination.items)
         
         return jsonify({
             'success': True,
             'data': items,
-            'meta': {
-                'total': pagination.total,
-                'page': page,
-                'pages': pagination.pages,
-                'per_page': per_page
-            }
+            'meta': pagination.meta()
         }), 200
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Public gallery list error: {str(e)}")
         return jsonify({'success': False, 'message': 'Failed to load gallery'}), 500
 
 # Public gallery categories (no auth required)
 @admin_bp.route('/public/gallery/categories', methods=['GET'])
+@conditional_get((GalleryItem, GalleryItem.status == 'active'))
+@response_cache.cached('gallery')
 def public_get_gallery_categories():
     """Get available gallery categories (no auth required)"""
     try:
@@ -688,6 +657,20 @@ def public_get_gallery_categories():
             'data': ['general', 'facilities', 'grooming', 'training', 'events']
         }), 200
 
+# Public gallery tag cloud (no auth required)
+@admin_bp.route('/public/gallery/tags', methods=['GET'])
+def public_get_gallery_tags():
+    """Get the most used tags on active gallery items (no auth required)"""
+    try:
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        return jsonify({
+            'success': True,
+            'data': TagIndex.tag_counts('gallery_item', GalleryItem.status == 'active', limit=limit)
+        }), 200
+    except Exception as e:
+        logger.error(f"Public gallery tags error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to load tags'}), 500
+
 # Public gallery item view (no auth required)
 @admin_bp.route('/public/gallery/<int:item_id>', methods=['GET'])
 def public_get_gallery_item(item_id):
@@ -717,14 +700,12 @@ def public_get_gallery_item(item_id):
 def public_toggle_gallery_like(item_id):
     """Toggle like for gallery item (no auth required) - uses IP-based tracking with database"""
     try:
-        from ...models import GalleryLike
-        
-        item = GalleryItem.query.filter(
+        item_exists = db.session.query(GalleryItem.id).filter(
             GalleryItem.id == item_id,
             GalleryItem.status == 'active'
         ).first()
         
-        if not item:
+        if not item_exists:
             return jsonify({
                 'success': False,
                 'message': 'Gallery item not found'
@@ -733,57 +714,16 @@ def public_toggle_gallery_like(item_id):
         # Get client IP for tracking
         client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('REMOTE_ADDR', 'unknown'))
         
-        # Check if this IP has already liked this item
-        try:
-            existing_like = GalleryLike.query.filter(
-                GalleryLike.gallery_item_id == item_id,
-                GalleryLike.ip_address == client_ip
-            ).first()
-        except Exception as db_error:
-            logger.warning(f"Database schema issue: {db_error}")
-            # Fallback: Simple increment without tracking
-            item.likes = (item.likes or 0) + 1
-            db.session.commit()
-            
-            logger.info(f"Gallery item {item_id} liked by IP {client_ip} (fallback mode)")
-            
-            return jsonify({
-                'success': True,
-                'message': 'Like added (fallback mode)',
-                'data': {'likes': item.likes, 'liked': True}
-            }), 200
+        # Delete-or-insert the like row and adjust the counter in SQL, in one transaction
+        liked, likes = LikeCounters.toggle_gallery_like(item_id, client_ip)
         
-        if existing_like:
-            # Unlike: Remove the like
-            db.session.delete(existing_like)
-            item.likes = max(0, (item.likes or 0) - 1)  # Ensure likes don't go below 0
-            db.session.commit()
-            
-            logger.info(f"Gallery item {item_id} unliked by IP {client_ip}")
-            
-            return jsonify({
-                'success': True,
-                'message': 'Like removed',
-                'data': {'likes': item.likes, 'liked': False}
-            }), 200
-        else:
-            # Like: Add the like
-            new_like = GalleryLike(
-                gallery_item_id=item_id,
-                ip_address=client_ip,
-                user_id=None  # Anonymous user
-            )
-            db.session.add(new_like)
-            item.likes = (item.likes or 0) + 1
-            db.session.commit()
-            
-            logger.info(f"Gallery item {item_id} liked by IP {client_ip}")
-            
-            return jsonify({
-                'success': True,
-                'message': 'Like added',
-                'data': {'likes': item.likes, 'liked': True}
-            }), 200
+        logger.info(f"Gallery item {item_id} {'liked' if liked else 'unliked'} by IP {client_ip}")
+        
+        return jsonify({
+            'success': True,
+            'message': 'Like added' if liked else 'Like removed',
+            'data': {'likes': likes, 'liked': liked}
+        }), 200
             
     except Exception as e:
         logger.error(f"Public gallery like error: {str(e)}")
@@ -828,7 +768,7 @@ def public_get_gallery_like_status(item_id):
 def public_increment_gallery_view(item_id):
     """Increment view count for gallery item (no auth required)"""
     try:
-        item = GalleryItem.query.filter(
+        item = db.session.query(GalleryItem.id, GalleryItem.views).filter(
             GalleryItem.id == item_id,
             GalleryItem.status == 'active'
         ).first()
@@ -839,21 +779,49 @@ def public_increment_gallery_view(item_id):
                 'message': 'Gallery item not found'
             }), 404
         
-        # Increment views
-        item.views = (item.views or 0) + 1
-        db.session.commit()
+        # Buffered increment, applied by the counter flusher as views = views + n
+        views = (item.views or 0) + counter_buffer.increment('gallery_views', item.id)
         
         return jsonify({
             'success': True,
             'message': 'View count updated',
-            'data': {'views': item.views}
+            'data': {'views': views}
         }), 200
     except Exception as e:
         logger.error(f"Public gallery view error: {str(e)}")
         return jsonify({'success': False, 'message': 'Failed to update view count'}), 500
 
+# Public gallery item download increment (no auth required)
+@admin_bp.route('/public/gallery/<int:item_id>/download', methods=['POST'])
+def public_increment_gallery_download(item_id):
+    """Increment download count for gallery item (no auth required)"""
+    try:
+        item = db.session.query(GalleryItem.id, GalleryItem.downloads).filter(
+            GalleryItem.id == item_id,
+            GalleryItem.status == 'active'
+        ).first()
+        
+        if not item:
+            return jsonify({
+                'success': False,
+                'message': 'Gallery item not found'
+            }), 404
+        
+        downloads = (item.downloads or 0) + counter_buffer.increment('gallery_downloads', item.id)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Download count updated',
+            'data': {'downloads': downloads}
+        }), 200
+    except Exception as e:
+        logger.error(f"Public gallery download error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to update download count'}), 500
+
 # Get homepage featured gallery items (public)
 @admin_bp.route('/public/gallery/homepage-featured', methods=['GET'])
+@conditional_get((GalleryItem, GalleryItem.status == 'active', GalleryItem.homepage_featured == True))
+@response_cache.cached('gallery')
 def public_get_homepage_featured():
     """Get homepage featured gallery items (no auth required)"""
     try:
@@ -1049,14 +1017,8 @@ def admin_delete_gallery_item(item_id):
                 'message': 'Item not found'
             }), 404
 
-        # Delete file from filesystem
-        if item.file_path:
-            file_path = os.path.join(current_app.root_path, item.file_path.lstrip('/'))
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-        # Delete from database
-        db.session.delete(item)
+        # The file and its derivatives go once no other item shares it
+        delete_gallery_item(item)
         db.session.commit()
 
         logger.info(f"Gallery item deleted: {item_id} by user {current_user.id}")
@@ -1375,8 +1337,9 @@ def admin_delete_album(album_id):
         
         album = GalleryAlbum.query.get_or_404(album_id)
         
-        # Delete all items in the album
-        GalleryItem.query.filter_by(album_id=album_id).delete()
+        # Delete all items in the album, releasing their files
+        for item in GalleryItem.query.filter_by(album_id=album_id).all():
+            delete_gallery_item(item)
         
         # Delete album views and likes
         AlbumView.query.filter_by(album_id=album_id).delete()
@@ -2038,12 +2001,9 @@ def get_security_events():
         # Order by timestamp (newest first)
         query = query.order_by(SecurityLog.timestamp.desc())
         
-        # Paginate
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
+        # Paginate (?cursor= switches to keyset pages)
+        pagination = paginate_listing(query, SecurityLog.timestamp, SecurityLog.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
         
         events = []
         for event in pagination.items:
@@ -2054,22 +2014,17 @@ def get_security_events():
                 'ip_address': event.ip_address,
                 'user_agent': event.user_agent,
                 'details': event.details,
-                'timestamp': event.timestamp.isoformat()
+                'timestamp': event.timestamp.isoformat() if event.timestamp else None
             })
         
         return jsonify({
             'success': True,
             'events': events,
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': pagination.total,
-                'pages': pagination.pages,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination.meta()
         }), 200
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Get security events error: {str(e)}")
         return jsonify({
@@ -2127,6 +2082,189 @@ def get_system_health():
             'message': 'Failed to get system health'
         }), 500
 
+# Public response cache statistics
+@admin_bp.route('/cache/stats', methods=['GET'])
+@login_required
+def get_cache_stats():
+    """Get response cache hit/miss counts per endpoint"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        return jsonify({
+            'success': True,
+            'data': response_cache.stats()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Get cache stats error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to get cache statistics'
+        }), 500
+
+# Invalidate response cache tags
+@admin_bp.route('/cache/invalidate', methods=['POST'])
+@login_required
+def invalidate_cache_tags():
+    """Invalidate cached public responses by tag, e.g. {"tags": ["gallery", "tour:12"]}"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        data = request.get_json() or {}
+        tags = [str(tag).strip() for tag in data.get('tags', []) if str(tag).strip()]
+        if not tags:
+            return jsonify({'success': False, 'message': 'No tags provided'}), 400
+
+        response_cache.invalidate(*tags)
+
+        return jsonify({
+            'success': True,
+            'message': f'Invalidated {len(tags)} cache tags'
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Invalidate cache error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to invalidate cache'
+        }), 500
+
+# Background job queue depth and throughput
+@admin_bp.route('/jobs/stats', methods=['GET'])
+@login_required
+def get_job_stats():
+    """Get job queue depth per queue and recent throughput"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        return jsonify({
+            'success': True,
+            'data': JobQueue.stats()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Get job stats error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to get job statistics'
+        }), 500
+
+# List jobs, e.g. the dead-letter jobs with ?status=dead
+@admin_bp.route('/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """List background jobs, newest first"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        per_page = min(request.args.get('per_page', 50, type=int), 200)
+        query = Job.query
+        if request.args.get('status'):
+            query = query.filter(Job.status == request.args['status'])
+        if request.args.get('queue'):
+            query = query.filter(Job.queue == request.args['queue'])
+        jobs = query.order_by(Job.id.desc()).limit(per_page).all()
+
+        return jsonify({
+            'success': True,
+            'data': [job.to_dict() for job in jobs]
+        }), 200
+
+    except Exception as e:
+        logger.error(f"List jobs error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to list jobs'
+        }), 500
+
+# Job status (the Location of 202 responses)
+@admin_bp.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """Get the status and result of a background job"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        job = db.session.get(Job, job_id)
+        if not job:
+            return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+        return jsonify({
+            'success': True,
+            'data': job.to_dict()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Get job error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to get job'
+        }), 500
+
+# Requeue a dead job
+@admin_bp.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+def retry_job(job_id):
+    """Give a dead-lettered job a fresh set of attempts"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+
+        job = db.session.get(Job, job_id)
+        if not job:
+            return jsonify({'success': False, 'message': 'Job not found'}), 404
+        if not JobQueue.retry(job):
+            return jsonify({'success': False, 'message': 'Only dead jobs can be retried'}), 409
+
+        return jsonify({
+            'success': True,
+            'message': 'Job requeued',
+            'data': job.to_dict()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Retry job error: {str(e)}")
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': 'Failed to retry job'
+        }), 500
+
 # =============================================================================
 # BOOK MANAGEMENT ROUTES
 # =============================================================================
@@ -2282,6 +2420,7 @@ def create_book():
         
         db.session.add(book)
         db.session.commit()
+        schedule_image_derivatives('book', book, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -2313,10 +2452,10 @@ def update_book(book_id):
         
         # Handle file upload
         image_file = request.files.get('image')
-        if image_file:
-            image_path = save_book_image(image_file)
-            if image_path:
-                book.image = image_path
+        image_path = save_book_image(image_file) if image_file else None
+        if image_path:
+            book.image = image_path
+            book.image_variants = None
         
         # Update English fields
         if 'title' in data:
@@ -2384,6 +2523,7 @@ def update_book(book_id):
         
         book.updated_at = datetime.utcnow()
         db.session.commit()
+        schedule_image_derivatives('book', book, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -2551,6 +2691,7 @@ def create_author():
         
         db.session.add(author)
         db.session.commit()
+        schedule_image_derivatives('author', author, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -2582,10 +2723,10 @@ def update_author(author_id):
         
         # Handle file upload
         image_file = request.files.get('image')
-        if image_file:
-            image_path = save_author_image(image_file)
-            if image_path:
-                author.image = image_path
+        image_path = save_author_image(image_file) if image_file else None
+        if image_path:
+            author.image = image_path
+            author.image_variants = None
         
         # Update English fields
         if 'name' in data:
@@ -2687,6 +2828,7 @@ def update_author(author_id):
         
         author.updated_at = datetime.utcnow()
         db.session.commit()
+        schedule_image_derivatives('author', author, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -2749,6 +2891,12 @@ def delete_author(author_id):
             'message': 'Failed to delete author'
         }), 500
 
+def schedule_image_derivatives(target, record, image_path):
+    """Queue resized copies of an image just saved under the upload folder"""
+    if image_path:
+        upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+        image_derivatives.schedule(target, record.id, os.path.join(upload_root, image_path), image_path)
+
 def save_book_image(image_file):
     """Save book image file and return the path."""
     logger.info(f"save_book_image called with: {image_file}")
@@ -2829,6 +2977,7 @@ def save_author_image(image_file):
 
 @admin_bp.route('/page-content', methods=['GET'])
 @login_required
+@conditional_get((PageContent, PageContent.is_active == True))
 def get_page_content():
     """Get all page content for editing"""
     try:
@@ -3138,12 +3287,21 @@ def get_translations():
         if needs_review is not None:
             query = query.filter_by(needs_review=needs_review)
         
-        translations = query.order_by(
-            Translation.page_name, 
-            Translation.section_name, 
-            Translation.content_key,
-            Translation.language_code
-        ).all()
+        meta = None
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            # Opt-in keyset pages for large catalogues; default is the full listing
+            pagination = paginate_listing(query, Translation.created_at, Translation.id, cursor=cursor,
+                                          per_page=request.args.get('per_page', 200, type=int))
+            translations = pagination.items
+            meta = pagination.meta()
+        else:
+            translations = query.order_by(
+                Translation.page_name, 
+                Translation.section_name, 
+                Translation.content_key,
+                Translation.language_code
+            ).all()
         
         # Group translations by page and section
         grouped_translations = {}
@@ -3157,11 +3315,16 @@ def get_translations():
             
             grouped_translations[trans.page_name][trans.section_name][trans.content_key][trans.language_code] = trans.to_dict()
         
-        return jsonify({
+        response = {
             'success': True,
             'translations': grouped_translations
-        })
+        }
+        if meta is not None:
+            response['meta'] = meta
+        return jsonify(response)
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Get translations error: {str(e)}")
         return jsonify({
@@ -3596,12 +3759,9 @@ def admin_get_users():
             else:
                 query = query.order_by(User.email.asc())
         
-        # Paginate results
-        pagination = query.paginate(
-            page=page,
-            per_page=per_page,
-            error_out=False
-        )
+        # Paginate results; ties on the sort column fall back to created_at, then id
+        pagination = paginate_listing(query, User.created_at, User.id, page=page, per_page=per_page,
+                                      cursor=request.args.get('cursor'), descending=sort_order == 'desc')
         
         # Format user data
         users = []
@@ -3621,16 +3781,11 @@ def admin_get_users():
         return jsonify({
             'success': True,
             'data': users,
-            'meta': {
-                'total': pagination.total,
-                'page': page,
-                'pages': pagination.pages,
-                'per_page': per_page,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'meta': pagination.meta()
         })
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Error getting users: {str(e)}")
         return jsonify({
@@ -1,7 +1,7 @@
 """
 Enhanced Analytics API Routes with comprehensive data tracking and analysis
 """
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta
 import logging
@@ -15,6 +15,14 @@ from ...models_analytics import (
 )
 from ...models import User, Story, GalleryItem, Tour, db
 from ...extensions import db as ext_db
+from ...utils.analytics_dashboard import dashboard_snapshots
+from ...utils.analytics_export import (
+    EXPORTS, FORMATS as EXPORT_FORMATS, resolve_columns, iter_rows,
+    csv_chunks, ndjson_chunks, json_chunks, gzip_chunks
+)
+from ...utils.analytics_buffer import (
+    analytics_buffer, event_row, pageview_records, interaction_row, performance_row
+)
 
 analytics_enhanced_bp = Blueprint('analytics_enhanced', __name__)
 logger = logging.getLogger(__name__)
@@ -28,75 +36,9 @@ def get_analytics_dashboard():
     try:
         days = int(request.args.get('days', 30))
         
-        # Basic metrics
-        total_users = AnalyticsCalculator.get_total_users(days)
-        active_users = AnalyticsCalculator.get_active_users(days)
-        total_sessions = AnalyticsCalculator.get_total_sessions(days)
-        bounce_rate = AnalyticsCalculator.get_bounce_rate(days)
-        avg_session_duration = AnalyticsCalculator.get_average_session_duration(days)
-        
-        # Content metrics
-        total_stories = Story.query.filter(
-            Story.created_at >= datetime.utcnow() - timedelta(days=days)
-        ).count()
-        
-        total_gallery_items = GalleryItem.query.filter(
-            GalleryItem.created_at >= datetime.utcnow() - timedelta(days=days)
-        ).count()
-        
-        total_tours = Tour.query.filter(
-            Tour.created_at >= datetime.utcnow() - timedelta(days=days)
-        ).count()
-        
-        # Popular content
-        popular_stories = ContentInteraction.get_popular_content('story', days, 5)
-        popular_gallery = ContentInteraction.get_popular_content('gallery_item', days, 5)
-        popular_tours = ContentInteraction.get_popular_content('tour', days, 5)
-        
-        # Conversion metrics
-        total_conversions = ConversionEvent.query.filter(
-            ConversionEvent.created_at >= datetime.utcnow() - timedelta(days=days)
-        ).count()
-        
-        conversion_rate = AnalyticsCalculator.get_conversion_rate(days=days)
-        
-        # Real-time stats
-        real_time = AnalyticsCalculator.get_real_time_stats()
-        
-        # Traffic sources
-        traffic_sources = AnalyticsCalculator.get_traffic_sources(days, 10)
-        
-        # Device breakdown
-        device_breakdown = AnalyticsCalculator.get_device_breakdown(days)
-        
-        # Geographic data
-        geographic_data = AnalyticsCalculator.get_geographic_breakdown(days, 10)
-        
         return jsonify({
             'success': True,
-            'data': {
-                'overview': {
-                    'total_users': total_users,
-                    'active_users': active_users,
-                    'total_sessions': total_sessions,
-                    'bounce_rate': bounce_rate,
-                    'avg_session_duration': avg_session_duration,
-                    'total_stories': total_stories,
-                    'total_gallery_items': total_gallery_items,
-                    'total_tours': total_tours,
-                    'total_conversions': total_conversions,
-                    'conversion_rate': conversion_rate
-                },
-                'popular_content': {
-                    'stories': [{'content_id': s[0], 'interactions': s[1], 'unique_users': s[2]} for s in popular_stories],
-                    'gallery': [{'content_id': g[0], 'interactions': g[1], 'unique_users': g[2]} for g in popular_gallery],
-                    'tours': [{'content_id': t[0], 'interactions': t[1], 'unique_users': t[2]} for t in popular_tours]
-                },
-                'real_time': real_time,
-                'traffic_sources': [{'source': t[0], 'sessions': t[1], 'users': t[2]} for t in traffic_sources],
-                'device_breakdown': [{'device': d[0], 'sessions': d[1], 'users': d[2]} for d in device_breakdown],
-                'geographic_data': [{'country': g[0], 'sessions': g[1], 'users': g[2]} for g in geographic_data]
-            }
+            'data': dashboard_snapshots.get(days)
         })
         
     except Exception as e:
@@ -324,284 +266,247 @@ def get_content_performance():
         }), 500
 
 # Event Tracking API
-@analytics_enhanced_bp.route('/track-event', methods=['POST'])
-def track_event():
-    """Track custom analytics events"""
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['event_type', 'event_category', 'event_action']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({
-                    'success': False,
-                    'message': f'{field} is required'
-                }), 400
-        
-        # Get user and session info
-        user_id = current_user.id if current_user.is_authenticated else None
-        session_id = data.get('session_id', 'anonymous')
-        
-        # Get request info
-        ip_address = request.remote_addr
-        user_agent = request.headers.get('User-Agent')
-        
-        # Create analytics event
-        event = AnalyticsEvent(
-            user_id=user_id,
-            session_id=session_id,
-            event_type=data['event_type'],
-            event_category=data['event_category'],
-            event_action=data['event_action'],
-            event_label=data.get('event_label'),
-            page_url=data.get('page_url'),
-            referrer_url=data.get('referrer_url'),
-            user_agent=user_agent,
-            ip_address=ip_address,
-            device_type=data.get('device_type'),
-            browser=data.get('browser'),
-            os=data.get('os'),
-            screen_resolution=data.get('screen_resolution'),
-            country=data.get('country'),
-            city=data.get('city'),
-            duration=data.get('duration'),
-            metadata=data.get('metadata')
-        )
-        
-        db.session.add(event)
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Event tracked successfully'
-        })
-        
-    except Exception as e:
-        logger.error(f"Event tracking error: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': 'Failed to track event'
-        }), 500
+#
+# Tracked records go through the analytics write-behind buffer: the request
+# only validates and appends, and the buffer bulk-inserts them in batches.
 
-# Page View Tracking
-@analytics_enhanced_bp.route('/track-pageview', methods=['POST'])
-def track_pageview():
-    """Track page views"""
+# Fields each tracked record must carry, by record type
+TRACKING_REQUIRED_FIELDS = {
+    'event': ('event_type', 'event_category', 'event_action'),
+    'pageview': ('page_url',),
+    'interaction': ('content_type', 'content_id', 'interaction_type'),
+    'performance': ('page_url',),
+}
+
+
+def _missing_tracking_field(record_type, data):
+    for field in TRACKING_REQUIRED_FIELDS[record_type]:
+        if not data.get(field):
+            return field
+    return None
+
+
+def _tracking_records(record_type, data):
+    """
+    Buffer records for one tracked item, stamped with the current user and
+    time. Raises ValueError if a field doesn't fit its column.
+    """
+    user_id = current_user.id if current_user.is_authenticated else None
+    created_at = datetime.utcnow()
+    if record_type == 'event':
+        return [('event', event_row(data, user_id, request.remote_addr,
+                                    request.headers.get('User-Agent'), created_at))]
+    if record_type == 'pageview':
+        return pageview_records(data, user_id, request.remote_addr,
+                                request.headers.get('User-Agent'), created_at)
+    if record_type == 'interaction':
+        return [('interaction', interaction_row(data, user_id, created_at))]
+    return [('performance', performance_row(data, created_at))]
+
+
+def _analytics_busy():
+    """503 for when the analytics buffer is full; beacons can simply be dropped"""
+    response = jsonify({
+        'success': False,
+        'message': 'Analytics are temporarily busy'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config.get('ANALYTICS_RETRY_AFTER', 5))
+    return response
+
+
+def _track(record_type, success_message, error_label, failure_message):
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         
-        if not data.get('page_url'):
+        missing = _missing_tracking_field(record_type, data)
+        if missing:
             return jsonify({
                 'success': False,
-                'message': 'page_url is required'
+                'message': f'{missing} is required'
             }), 400
         
-        user_id = current_user.id if current_user.is_authenticated else None
-        session_id = data.get('session_id', 'anonymous')
-        
-        # Create page view record
-        page_view = PageView(
-            user_id=user_id,
-            session_id=session_id,
-            page_url=data['page_url'],
-            page_title=data.get('page_title'),
-            referrer_url=data.get('referrer_url'),
-            time_on_page=data.get('time_on_page'),
-            device_info=data.get('device_info'),
-            location_info=data.get('location_info')
-        )
-        
-        db.session.add(page_view)
+        try:
+            records = _tracking_records(record_type, data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
         
-        # Update or create user session
-        session = UserSession.query.filter_by(session_id=session_id).first()
-        if session:
-            session.update_activity()
-            session.page_views += 1
-        else:
-            session = UserSession(
-                session_id=session_id,
-                user_id=user_id,
-                ip_address=request.remote_addr,
-                user_agent=request.headers.get('User-Agent'),
-                device_type=data.get('device_info', {}).get('type'),
-                browser=data.get('device_info', {}).get('browser'),
-                os=data.get('device_info', {}).get('os'),
-                landing_page=data['page_url'],
-                page_views=1
-            )
-            db.session.add(session)
-        
-        db.session.commit()
+        if not analytics_buffer.add(records):
+            return _analytics_busy()
         
         return jsonify({
             'success': True,
-            'message': 'Page view tracked successfully'
-        })
+            'message': success_message
+        }), 202
         
     except Exception as e:
-        logger.error(f"Page view tracking error: {str(e)}")
+        logger.error(f"{error_label} error: {str(e)}")
         return jsonify({
             'success': False,
-            'message': 'Failed to track page view'
+            'message': failure_message
         }), 500
 
+@analytics_enhanced_bp.route('/track-event', methods=['POST'])
+def track_event():
+    """Track custom analytics events"""
+    return _track('event', 'Event tracked successfully', 'Event tracking', 'Failed to track event')
+
+# Page View Tracking
+@analytics_enhanced_bp.route('/track-pageview', methods=['POST'])
+def track_pageview():
+    """Track page views and count them against the visitor's session"""
+    return _track('pageview', 'Page view tracked successfully', 'Page view tracking', 'Failed to track page view')
+
 # Content Interaction Tracking
 @analytics_enhanced_bp.route('/track-interaction', methods=['POST'])
 def track_content_interaction():
     """Track content interactions"""
-    try:
-        data = request.get_json()
-        
-        required_fields = ['content_type', 'content_id', 'interaction_type']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({
-                    'success': False,
-                    'message': f'{field} is required'
-                }), 400
-        
-        user_id = current_user.id if current_user.is_authenticated else None
-        session_id = data.get('session_id', 'anonymous')
-        
-        # Create content interaction record
-        interaction = ContentInteraction(
-            user_id=user_id,
-            content_type=data['content_type'],
-            content_id=data['content_id'],
-            interaction_type=data['interaction_type'],
-            session_id=session_id,
-            duration=data.get('duration'),
-            scroll_depth=data.get('scroll_depth'),
-            click_coordinates=data.get('click_coordinates'),
-            metadata=data.get('metadata')
-        )
-        
-        db.session.add(interaction)
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Interaction tracked successfully'
-        })
-        
-    except Exception as e:
-        logger.error(f"Interaction tracking error: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': 'Failed to track interaction'
-        }), 500
+    return _track('interaction', 'Interaction tracked successfully', 'Interaction tracking',
+                  'Failed to track interaction')
 
 # Performance Metrics
 @analytics_enhanced_bp.route('/track-performance', methods=['POST'])
 def track_performance():
     """Track performance metrics"""
+    return _track('performance', 'Performance metrics tracked successfully', 'Performance tracking',
+                  'Failed to track performance metrics')
+
+# Batched Tracking Beacon
+@analytics_enhanced_bp.route('/batch', methods=['POST'])
+def track_batch():
+    """
+    Track a batch of mixed records in one request. The body is a list (or
+    ``{"events": [...]}``) of objects with a ``type`` of event, pageview,
+    interaction or performance plus that type's fields. Items with missing
+    or malformed fields are skipped and counted in ``rejected``.
+    """
     try:
-        data = request.get_json()
-        
-        if not data.get('page_url'):
+        # navigator.sendBeacon posts JSON as text/plain
+        data = request.get_json(force=True, silent=True)
+        items = data.get('events') if isinstance(data, dict) else data
+        if not isinstance(items, list):
             return jsonify({
                 'success': False,
-                'message': 'page_url is required'
+                'message': 'events must be a list'
             }), 400
         
-        session_id = data.get('session_id', 'anonymous')
-        
-        # Create performance metric record
-        metric = PerformanceMetric(
-            session_id=session_id,
-            page_url=data['page_url'],
-            load_time=data.get('load_time'),
-            dom_content_loaded=data.get('dom_content_loaded'),
-            first_contentful_paint=data.get('first_contentful_paint'),
-            largest_contentful_paint=data.get('largest_contentful_paint'),
-            first_input_delay=data.get('first_input_delay'),
-            cumulative_layout_shift=data.get('cumulative_layout_shift'),
-            connection_type=data.get('connection_type'),
-            server_response_time=data.get('server_response_time')
-        )
-        
-        db.session.add(metric)
-        db.session.commit()
+        max_batch = current_app.config.get('ANALYTICS_BATCH_MAX', 100)
+        if len(items) > max_batch:
+            return jsonify({
+                'success': False,
+                'message': f'At most {max_batch} events per batch'
+            }), 413
+        
+        records = []
+        rejected = 0
+        for item in items:
+            record_type = item.get('type') if isinstance(item, dict) else None
+            if record_type not in TRACKING_REQUIRED_FIELDS or _missing_tracking_field(record_type, item):
+                rejected += 1
+                continue
+            try:
+                records.extend(_tracking_records(record_type, item))
+            except ValueError:
+                rejected += 1
+        
+        if records and not analytics_buffer.add(records):
+            return _analytics_busy()
         
         return jsonify({
             'success': True,
-            'message': 'Performance metrics tracked successfully'
-        })
+            'accepted': len(items) - rejected,
+            'rejected': rejected
+        }), 202
         
     except Exception as e:
-        logger.error(f"Performance tracking error: {str(e)}")
+        logger.error(f"Batch tracking error: {str(e)}")
         return jsonify({
             'success': False,
-            'message': 'Failed to track performance metrics'
+            'message': 'Failed to track events'
         }), 500
 
 # Export Analytics Data
+def _parse_export_time(value, end=False):
+    """An ISO date or datetime; a bare end date includes that whole day"""
+    moment = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        moment += timedelta(days=1)
+    return moment
+
 @analytics_enhanced_bp.route('/export', methods=['GET'])
 @login_required
 @admin_required()
 def export_analytics():
-    """Export analytics data to CSV/JSON"""
+    """
+    Stream analytics rows as CSV, NDJSON or JSON.
+    
+    Query args: ``type`` (events, pageviews, sessions, interactions),
+    ``format`` (json, csv, ndjson), ``days`` or ``from``/``to`` (ISO dates),
+    ``columns`` (comma-separated) and ``gzip=1``.
+    """
     try:
         export_type = request.args.get('type', 'events')  # events, pageviews, sessions, interactions
-        format_type = request.args.get('format', 'json')  # json, csv
-        days = int(request.args.get('days', 30))
+        format_type = request.args.get('format', 'json')  # json, csv, ndjson
         
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
+        if export_type not in EXPORTS:
+            return jsonify({
+                'success': False,
+                'message': 'Invalid export type'
+            }), 400
         
-        if export_type == 'events':
-            data = AnalyticsEvent.query.filter(
-                AnalyticsEvent.created_at >= cutoff_date
-            ).all()
-            export_data = [event.to_dict() for event in data]
-        
-        elif export_type == 'pageviews':
-            data = PageView.query.filter(
-                PageView.created_at >= cutoff_date
-            ).all()
-            export_data = [{'id': pv.id, 'user_id': pv.user_id, 'page_url': pv.page_url, 
-                          'time_on_page': pv.time_on_page, 'created_at': pv.created_at.isoformat()} 
-                         for pv in data]
-        
-        elif export_type == 'sessions':
-            data = UserSession.query.filter(
-                UserSession.started_at >= cutoff_date
-            ).all()
-            export_data = [{'session_id': s.session_id, 'user_id': s.user_id, 'device_type': s.device_type,
-                          'total_duration': s.total_duration, 'page_views': s.page_views,
-                          'is_bounce': s.is_bounce, 'started_at': s.started_at.isoformat()} 
-                         for s in data]
-        
-        elif export_type == 'interactions':
-            data = ContentInteraction.query.filter(
-                ContentInteraction.created_at >= cutoff_date
-            ).all()
-            export_data = [{'user_id': i.user_id, 'content_type': i.content_type, 
-                          'content_id': i.content_id, 'interaction_type': i.interaction_type,
-                          'duration': i.duration, 'created_at': i.created_at.isoformat()} 
-                         for i in data]
+        if format_type not in EXPORT_FORMATS:
+            return jsonify({
+                'success': False,
+                'message': 'Invalid export format'
+            }), 400
         
-        else:
+        try:
+            columns = resolve_columns(export_type, request.args.get('columns'))
+            if request.args.get('from'):
+                cutoff_date = _parse_export_time(request.args['from'])
+            else:
+                cutoff_date = datetime.utcnow() - timedelta(days=int(request.args.get('days', 30)))
+            end_date = _parse_export_time(request.args['to'], end=True) if request.args.get('to') else None
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'message': 'Invalid export type'
+                'message': str(e)
             }), 400
         
-        return jsonify({
-            'success': True,
-            'data': export_data,
-            'total_records': len(export_data),
-            'export_type': export_type,
-            'date_range': {
-                'from': cutoff_date.isoformat(),
-                'to': datetime.utcnow().isoformat()
-            }
-        })
+        rows = iter_rows(export_type, columns, cutoff_date, end_date,
+                         batch_size=current_app.config.get('ANALYTICS_EXPORT_BATCH_SIZE', 1000))
+        if format_type == 'csv':
+            chunks = csv_chunks(columns, rows)
+        elif format_type == 'ndjson':
+            chunks = ndjson_chunks(columns, rows)
+        else:
+            chunks = json_chunks(columns, rows, {
+                'export_type': export_type,
+                'columns': columns,
+                'date_range': {
+                    'from': cutoff_date.isoformat(),
+                    'to': (end_date or datetime.utcnow()).isoformat()
+                }
+            })
+        
+        mimetype, extension = EXPORT_FORMATS[format_type]
+        headers = {'X-Accel-Buffering': 'no'}  # Let nginx pass rows through as they come
+        if request.args.get('gzip', '').lower() in ('1', 'true'):
+            chunks = gzip_chunks(chunks)
+            mimetype = 'application/gzip'
+            extension += '.gz'
+        if format_type != 'json' or mimetype == 'application/gzip':
+            filename = f"analytics-{export_type}-{cutoff_date:%Y%m%d}.{extension}"
+            headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        
+        return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
         
     except Exception as e:
         logger.error(f"Analytics export error: {str(e)}")
         return jsonify({
             'success': False,
             'message': 'Failed to export analytics data'
-        }), 500
\ No newline at end of file
+        }), 500
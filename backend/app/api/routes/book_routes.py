@@ -12,6 +12,10 @@ from flask_login import login_required, current_user
 from app.models_book import Book, Author
 from app import db
 from app.auth.utils import TokenManager
+from app.utils.tag_index import TagIndex
+from app.utils.response_cache import response_cache
+from app.utils.conditional import conditional_get
+from app.utils.image_derivatives import image_derivatives
 
 # Create blueprint
 book_bp = Blueprint('book', __name__)
@@ -55,6 +59,11 @@ def save_book_image(file, book_id=None):
         return f'uploads/books/{filename}'
     return None
 
+def schedule_book_image_derivatives(target, record, image_path):
+    """Queue resized copies of an image saved by ``save_book_image``"""
+    if image_path:
+        image_derivatives.schedule(target, record.id, os.path.join(current_app.root_path, image_path), image_path)
+
 # ===== BOOK MANAGEMENT =====
 
 @book_bp.route('/books', methods=['GET'])
@@ -196,6 +205,7 @@ def create_book():
             print("🔧 Committing to database...")
             db.session.commit()
             print(f"✅ Book created successfully with ID: {book.id}")
+            schedule_book_image_derivatives('book', book, image_path)
             
         except Exception as db_error:
             print(f"❌ Database error: {db_error}")
@@ -238,10 +248,10 @@ def update_book(book_id):
         
         # Handle file upload
         image_file = request.files.get('image')
-        if image_file:
-            image_path = save_book_image(image_file, book_id)
-            if image_path:
-                book.image = image_path
+        image_path = save_book_image(image_file, book_id) if image_file else None
+        if image_path:
+            book.image = image_path
+            book.image_variants = None
         
         # Update fields
         if 'title' in data:
@@ -286,6 +296,7 @@ def update_book(book_id):
         
         book.updated_at = datetime.utcnow()
         db.session.commit()
+        schedule_book_image_derivatives('book', book, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -434,6 +445,7 @@ def create_author():
         
         db.session.add(author)
         db.session.commit()
+        schedule_book_image_derivatives('author', author, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -465,10 +477,10 @@ def update_author(author_id):
         
         # Handle file upload
         image_file = request.files.get('image')
-        if image_file:
-            image_path = save_book_image(image_file, author_id)
-            if image_path:
-                author.image = image_path
+        image_path = save_book_image(image_file, author_id) if image_file else None
+        if image_path:
+            author.image = image_path
+            author.image_variants = None
         
         # Update fields
         if 'name' in data:
@@ -518,6 +530,7 @@ def update_author(author_id):
         
         author.updated_at = datetime.utcnow()
         db.session.commit()
+        schedule_book_image_derivatives('author', author, image_path)
         
         # Log activity
         TokenManager.log_security_event(
@@ -542,6 +555,8 @@ def update_author(author_id):
 # ===== PUBLIC ENDPOINTS =====
 
 @book_bp.route('/public/books', methods=['GET'])
+@conditional_get((Book,))
+@response_cache.cached('books')
 def get_public_books():
     """Get books for public display with language support."""
     try:
@@ -550,7 +565,12 @@ def get_public_books():
         if language not in ['en', 'it']:
             language = 'en'
         
-        books = Book.query.order_by(Book.order_index.asc(), Book.created_at.desc()).all()
+        query = Book.query
+        tag = request.args.get('tag', '').strip()
+        if tag:
+            query = TagIndex.filter_by_tag(query, 'book', tag)
+        
+        books = query.order_by(Book.order_index.asc(), Book.created_at.desc()).all()
         books_data = [book.to_dict(language=language) for book in books]
         
         # Debug: Log the first book's content
@@ -573,6 +593,8 @@ def get_public_books():
         }), 500
 
 @book_bp.route('/public/authors', methods=['GET'])
+@conditional_get((Author, Author.active == True))
+@response_cache.cached('authors')
 def get_public_authors():
     """Get authors for public display with language support."""
     try:
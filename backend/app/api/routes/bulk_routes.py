@@ -4,13 +4,20 @@ Bulk operations routes for admin panel
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from app.models import User, Story, GalleryItem, Tour, db
-from app.auth.utils import TokenManager
+from app import tasks
+from app.utils.job_queue import job_accepted
 import logging
 
 logger = logging.getLogger(__name__)
 
 bulk_bp = Blueprint('bulk', __name__)
 
+
+def _client():
+    """The requesting admin's address and user agent, for the audit log of a queued action"""
+    return {'ip_address': request.remote_addr, 'user_agent': request.headers.get('User-Agent', '')}
+
+
 @bulk_bp.route('/gallery', methods=['POST'])
 @login_required
 def bulk_gallery_action():
@@ -30,41 +37,16 @@ def bulk_gallery_action():
         if not action or not item_ids:
             return jsonify({'success': False, 'message': 'Action and item IDs are required'}), 400
         
-        items = GalleryItem.query.filter(GalleryItem.id.in_(item_ids)).all()
-        if not items:
+        if len(item_ids) > current_app.config.get('BULK_INLINE_LIMIT', 100):
+            job = tasks.bulk_gallery_action.enqueue(
+                action=action, item_ids=item_ids, actor_id=current_user.id, client=_client(),
+                created_by=current_user.id)
+            return job_accepted(job, f'Bulk action "{action}" queued for {len(item_ids)} gallery items')
+        
+        if not db.session.query(GalleryItem.id).filter(GalleryItem.id.in_(item_ids)).first():
             return jsonify({'success': False, 'message': 'No gallery items found'}), 404
         
-        success_count = 0
-        for item in items:
-            try:
-                if action == 'activate':
-                    item.status = 'active'
-                elif action == 'deactivate':
-                    item.status = 'inactive'
-                elif action == 'delete':
-                    db.session.delete(item)
-                elif action == 'feature':
-                    # If GalleryItem model has featured field
-                    if hasattr(item, 'featured'):
-                        item.featured = True
-                elif action == 'unfeature':
-                    if hasattr(item, 'featured'):
-                        item.featured = False
-                else:
-                    continue
-                
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Bulk action error for gallery item {item.id}: {str(e)}")
-                continue
-        
-        db.session.commit()
-        
-        # Log the bulk action
-        TokenManager.log_security_event(
-            current_user.id, 'bulk_gallery_action',
-            f'Performed "{action}" on {success_count} gallery items'
-        )
+        success_count = tasks.bulk_gallery_action(action, item_ids, current_user.id)['affected_count']
         
         return jsonify({
             'success': True, 
@@ -96,41 +78,16 @@ def bulk_tour_action():
         if not action or not item_ids:
             return jsonify({'success': False, 'message': 'Action and item IDs are required'}), 400
         
-        tours = Tour.query.filter(Tour.id.in_(item_ids)).all()
-        if not tours:
+        if len(item_ids) > current_app.config.get('BULK_INLINE_LIMIT', 100):
+            job = tasks.bulk_tour_action.enqueue(
+                action=action, item_ids=item_ids, actor_id=current_user.id, client=_client(),
+                created_by=current_user.id)
+            return job_accepted(job, f'Bulk action "{action}" queued for {len(item_ids)} tours')
+        
+        if not db.session.query(Tour.id).filter(Tour.id.in_(item_ids)).first():
             return jsonify({'success': False, 'message': 'No tours found'}), 404
         
-        success_count = 0
-        for tour in tours:
-            try:
-                if action == 'activate':
-                    tour.status = 'active'
-                elif action == 'deactivate':
-                    tour.status = 'inactive'
-                elif action == 'delete':
-                    db.session.delete(tour)
-                elif action == 'feature':
-                    # If Tour model has featured field
-                    if hasattr(tour, 'featured'):
-                        tour.featured = True
-                elif action == 'unfeature':
-                    if hasattr(tour, 'featured'):
-                        tour.featured = False
-                else:
-                    continue
-                
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Bulk action error for tour {tour.id}: {str(e)}")
-                continue
-        
-        db.session.commit()
-        
-        # Log the bulk action
-        TokenManager.log_security_event(
-            current_user.id, 'bulk_tour_action',
-            f'Performed "{action}" on {success_count} tours'
-        )
+        success_count = tasks.bulk_tour_action(action, item_ids, current_user.id)['affected_count']
         
         return jsonify({
             'success': True, 
@@ -162,40 +119,16 @@ def bulk_user_action():
         if not action or not item_ids:
             return jsonify({'success': False, 'message': 'Action and item IDs are required'}), 400
         
-        users = User.query.filter(User.id.in_(item_ids)).all()
-        if not users:
+        if len(item_ids) > current_app.config.get('BULK_INLINE_LIMIT', 100):
+            job = tasks.bulk_user_action.enqueue(
+                action=action, item_ids=item_ids, actor_id=current_user.id, client=_client(),
+                created_by=current_user.id)
+            return job_accepted(job, f'Bulk action "{action}" queued for {len(item_ids)} users')
+        
+        if not db.session.query(User.id).filter(User.id.in_(item_ids)).first():
             return jsonify({'success': False, 'message': 'No users found'}), 404
         
-        success_count = 0
-        for target_user in users:
-            try:
-                # Prevent actions on super admins by other admins
-                if target_user.admin_level == 'super_admin' and target_user.id != current_user.id:
-                    continue
-                
-                if action == 'activate':
-                    target_user.is_active = True
-                elif action == 'deactivate':
-                    target_user.is_active = False
-                elif action == 'verify':
-                    target_user.email_verified = True
-                elif action == 'unverify':
-                    target_user.email_verified = False
-                else:
-                    continue
-                
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Bulk action error for user {target_user.id}: {str(e)}")
-                continue
-        
-        db.session.commit()
-        
-        # Log the bulk action
-        TokenManager.log_security_event(
-            current_user.id, 'bulk_user_action',
-            f'Performed "{action}" on {success_count} users'
-        )
+        success_count = tasks.bulk_user_action(action, item_ids, current_user.id)['affected_count']
         
         return jsonify({
             'success': True, 
@@ -4,8 +4,10 @@ from datetime import datetime
 import logging
 
 from ...models import User, db
+from ...models_email import EmailCampaign
 from ...auth.utils import TokenManager
 from ...email import send_email
+from ...utils.mail_outbox import MailOutbox
 
 communication_bp = Blueprint('communication', __name__)
 logger = logging.getLogger(__name__)
@@ -45,63 +47,88 @@ def send_bulk_email():
         message = data['message'].strip()
         recipients = data['recipients']  # 'all', 'active', 'verified', or list of user IDs
         
-        # Determine recipients
+        # Determine recipients; only the columns the outbox needs are loaded
+        query = User.query.with_entities(User.id, User.email, User.name)
         if recipients == 'all':
-            users = User.query.filter_by(is_active=True).all()
+            query = query.filter_by(is_active=True)
         elif recipients == 'active':
-            users = User.query.filter_by(is_active=True).all()
+            query = query.filter_by(is_active=True)
         elif recipients == 'verified':
-            users = User.query.filter_by(is_active=True, email_verified=True).all()
+            query = query.filter_by(is_active=True, email_verified=True)
         elif isinstance(recipients, list):
-            users = User.query.filter(
+            query = query.filter(
                 User.id.in_(recipients),
                 User.is_active == True
-            ).all()
+            )
         else:
             return jsonify({
                 'success': False,
                 'message': 'Invalid recipients parameter'
             }), 400
         
-        # Send emails
-        sent_count = 0
-        failed_count = 0
-        
-        for user in users:
-            try:
-                send_email(
-                    to=user.email,
-                    subject=subject,
-                    template='email/bulk_message.html',
-                    user=user,
-                    message=message
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send email to {user.email}: {str(e)}")
-                failed_count += 1
+        # Queue the campaign; the outbox worker delivers it
+        campaign = MailOutbox.create_campaign(
+            subject=subject,
+            template='bulk_message',
+            recipients=query.all(),
+            created_by=current_user_id,
+            message=message
+        )
         
         # Log bulk email action
         TokenManager.log_security_event(
             current_user_id, 'bulk_email_sent',
-            f'Sent bulk email to {sent_count} users, {failed_count} failed'
+            f'Queued bulk email campaign {campaign.id} to {campaign.recipient_count} users'
         )
         
         return jsonify({
             'success': True,
-            'message': f'Bulk email sent successfully',
-            'sent_count': sent_count,
-            'failed_count': failed_count,
-            'total_recipients': len(users)
-        }), 200
+            'message': 'Bulk email queued for delivery',
+            'campaign_id': campaign.id,
+            'total_recipients': campaign.recipient_count
+        }), 202
         
     except Exception as e:
         logger.error(f"Send bulk email error: {str(e)}")
+        db.session.rollback()
         return jsonify({
             'success': False,
             'message': 'Failed to send bulk email'
         }), 500
 
+# Bulk email delivery status (admin only)
+@communication_bp.route('/bulk-email/<int:campaign_id>', methods=['GET'])
+@login_required
+def get_bulk_email_status(campaign_id):
+    """Per-status recipient counts for a bulk email (admin only)"""
+    try:
+        current_user_obj = User.query.get(current_user.id)
+        
+        if not current_user_obj or not current_user_obj.is_admin_user():
+            return jsonify({
+                'success': False,
+                'message': 'Access denied'
+            }), 403
+        
+        campaign = EmailCampaign.query.get(campaign_id)
+        if not campaign:
+            return jsonify({
+                'success': False,
+                'message': 'Campaign not found'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'data': campaign.to_dict(MailOutbox.campaign_status(campaign_id))
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Get bulk email status error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to get bulk email status'
+        }), 500
+
 # Send notification to user (admin only)
 @communication_bp.route('/notify-user/<int:user_id>', methods=['POST'])
 @login_required
@@ -145,13 +172,14 @@ def notify_user(user_id):
         
         # Send email
         try:
-            send_email(
-                to=user.email,
+            if not send_email(
                 subject=subject,
-                template='email/admin_notification.html',
-                user=user,
+                recipients=user.email,
+                template='bulk_message',
+                recipient_name=user.name,
                 message=message
-            )
+            ):
+                raise RuntimeError('Email could not be queued')
             
             # Log notification
             TokenManager.log_security_event(
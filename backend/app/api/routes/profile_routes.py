@@ -12,6 +12,8 @@ import logging
 
 from ...models import User, Story, GalleryItem, TourBooking, Comment, StoryLike, SecurityLog, UserSession
 from ...extensions import db
+from ...utils.image_derivatives import image_derivatives
+from ...utils.video_processing import video_processor
 
 logger = logging.getLogger(__name__)
 profile_bp = Blueprint('profile', __name__)
@@ -29,47 +31,6 @@ def allowed_file(filename):
 def allowed_story_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in STORY_ALLOWED_EXTENSIONS
 
-def generate_story_video_thumbnail(video_path, output_dir):
-    """
-    Generate a thumbnail for a video file using ffmpeg
-    Returns the relative path to the thumbnail file
-    """
-    try:
-        import subprocess
-        
-        # Generate thumbnail filename
-        video_name = os.path.splitext(os.path.basename(video_path))[0]
-        thumbnail_filename = f"{video_name}_thumb.jpg"
-        thumbnail_path = os.path.join(output_dir, thumbnail_filename)
-        
-        # Use ffmpeg to extract thumbnail at 1 second mark
-        cmd = [
-            'ffmpeg',
-            '-i', video_path,
-            '-ss', '00:00:01',  # Extract at 1 second
-            '-vframes', '1',    # Only 1 frame
-            '-q:v', '2',        # High quality
-            '-y',               # Overwrite output file
-            thumbnail_path
-        ]
-        
-        # Run ffmpeg command
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode == 0 and os.path.exists(thumbnail_path):
-            # Return relative path for database storage
-            return f'uploads/story_submissions/{thumbnail_filename}'
-        else:
-            current_app.logger.error(f"FFmpeg failed: {result.stderr}")
-            return None
-            
-    except subprocess.TimeoutExpired:
-        current_app.logger.error("FFmpeg timeout - video might be corrupted")
-        return None
-    except Exception as e:
-        current_app.logger.error(f"Video thumbnail generation failed: {e}")
-        return None
-
 @profile_bp.route('/profile', methods=['GET'])
 @login_required
 def get_profile():
@@ -203,8 +164,10 @@ def upload_avatar():
         
         # Update user avatar path
         current_user.avatar_path = f"uploads/avatars/{filename}"
+        current_user.avatar_variants = None
         current_user.updated_at = datetime.utcnow()
         db.session.commit()
+        image_derivatives.schedule('avatar', current_user.id, file_path, f"avatars/{filename}")
         
         # Log the activity
         current_app.logger.info(f"Avatar uploaded by user {current_user.id}")
@@ -878,12 +841,9 @@ def submit_story():
                                     custom_thumbnail_path = f"uploads/story_submissions/{thumb_filename}"
                                     current_app.logger.info(f"Custom thumbnail saved: {thumb_filename}")
                             
-                            # Use custom thumbnail or generate one
-                            if not thumbnail_path:
-                                if custom_thumbnail_path:
-                                    thumbnail_path = custom_thumbnail_path
-                                else:
-                                    thumbnail_path = generate_story_video_thumbnail(file_path, story_media_dir)
+                            # Use the custom thumbnail; otherwise one is extracted in the background
+                            if not thumbnail_path and custom_thumbnail_path:
+                                thumbnail_path = custom_thumbnail_path
                         else:
                             file_type = 'other'
                         
@@ -899,6 +859,8 @@ def submit_story():
                         # Add thumbnail info for videos
                         if file_type == 'video' and i in thumbnail_map:
                             media_file_info['thumbnail_path'] = custom_thumbnail_path
+                        if file_type == 'video':
+                            media_file_info['processing'] = True
                         
                         media_files.append(media_file_info)
                         
@@ -924,6 +886,9 @@ def submit_story():
             
             db.session.add(story)
             db.session.commit()
+            if media_files:
+                image_derivatives.schedule_story_media(story.id, media_files, story_media_dir)
+                video_processor.schedule_story_media(story.id, media_files, story_media_dir)
             
             # Create response data with thumbnail URL and media files
             submission_data = {
@@ -15,6 +15,7 @@ from ...models_security import (
 )
 from ...models import User, db
 from ...extensions import db as ext_db
+from ...utils.pagination import paginate_listing, InvalidCursor
 
 security_enhanced_bp = Blueprint('security_enhanced', __name__)
 logger = logging.getLogger(__name__)
@@ -131,7 +132,8 @@ def get_security_logs():
         event_type = request.args.get('event_type')
         days = int(request.args.get('days', 7))
         
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
+        # Whole-minute cutoff so page turns share the cached total
+        cutoff_date = (datetime.utcnow() - timedelta(days=days)).replace(second=0, microsecond=0)
         
         query = SecurityLog.query.filter(SecurityLog.created_at >= cutoff_date)
         
@@ -140,21 +142,18 @@ def get_security_logs():
         if event_type:
             query = query.filter(SecurityLog.event_type == event_type)
         
-        logs = query.order_by(SecurityLog.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        logs = paginate_listing(query.order_by(SecurityLog.created_at.desc()),
+                                SecurityLog.created_at, SecurityLog.id, page=page,
+                                per_page=per_page, cursor=request.args.get('cursor'))
         
         return jsonify({
             'success': True,
             'data': [log.to_dict() for log in logs.items],
-            'meta': {
-                'page': page,
-                'pages': logs.pages,
-                'per_page': per_page,
-                'total': logs.total
-            }
+            'meta': logs.meta()
         })
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Security logs error: {str(e)}")
         return jsonify({
@@ -634,7 +633,8 @@ def get_audit_logs():
         user_id = request.args.get('user_id')
         days = int(request.args.get('days', 7))
         
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
+        # Whole-minute cutoff so page turns share the cached total
+        cutoff_date = (datetime.utcnow() - timedelta(days=days)).replace(second=0, microsecond=0)
         
         query = AuditLog.query.filter(AuditLog.created_at >= cutoff_date)
         
@@ -645,9 +645,9 @@ def get_audit_logs():
         if user_id:
             query = query.filter(AuditLog.user_id == user_id)
         
-        logs = query.order_by(AuditLog.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        logs = paginate_listing(query.order_by(AuditLog.created_at.desc()),
+                                AuditLog.created_at, AuditLog.id, page=page,
+                                per_page=per_page, cursor=request.args.get('cursor'))
         
         audit_data = []
         for log in logs.items:
@@ -669,14 +669,11 @@ def get_audit_logs():
         return jsonify({
             'success': True,
             'data': audit_data,
-            'meta': {
-                'page': page,
-                'pages': logs.pages,
-                'per_page': per_page,
-                'total': logs.total
-            }
+            'meta': logs.meta()
         })
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Audit logs error: {str(e)}")
         return jsonify({
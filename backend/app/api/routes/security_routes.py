@@ -5,6 +5,7 @@ import logging
 
 from ...models import User, SecurityLog, UserSession, db
 from ...auth.utils import TokenManager, SessionManager
+from ...utils.pagination import paginate_listing, InvalidCursor
 
 security_bp = Blueprint('security', __name__)
 logger = logging.getLogger(__name__)
@@ -35,7 +36,7 @@ def get_security_info():
                 'event_type': event.event_type,
                 'ip_address': event.ip_address,
                 'details': event.details,
-                'timestamp': event.timestamp.isoformat()
+                'timestamp': event.timestamp.isoformat() if event.timestamp else None
             })
         
         # Get active sessions
@@ -85,12 +86,9 @@ def get_user_security_events():
         # Order by timestamp (newest first)
         query = query.order_by(SecurityLog.timestamp.desc())
         
-        # Paginate
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
+        # Paginate (?cursor= switches to keyset pages)
+        pagination = paginate_listing(query, SecurityLog.timestamp, SecurityLog.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
         
         events = []
         for event in pagination.items:
@@ -100,22 +98,17 @@ def get_user_security_events():
                 'ip_address': event.ip_address,
                 'user_agent': event.user_agent,
                 'details': event.details,
-                'timestamp': event.timestamp.isoformat()
+                'timestamp': event.timestamp.isoformat() if event.timestamp else None
             })
         
         return jsonify({
             'success': True,
             'events': events,
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': pagination.total,
-                'pages': pagination.pages,
-                'has_next': pagination.has_next,
-                'has_prev': pagination.has_prev
-            }
+            'pagination': pagination.meta()
         }), 200
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Get user security events error: {str(e)}")
         return jsonify({
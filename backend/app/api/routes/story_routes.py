@@ -3,10 +3,26 @@ from flask_login import login_required, current_user
 from datetime import datetime
 import logging
 import os
+import json
+import shutil
 from werkzeug.utils import secure_filename
+from sqlalchemy import select, func, case, or_, and_
+from sqlalchemy.orm import aliased
 
 from ...models import Story, User, db, Comment, StoryLike
 from ...auth.utils import TokenManager
+from ...utils.story_search import StorySearchIndex
+from ...utils.tag_index import TagIndex
+from ...utils.related_content import RelatedContent
+from ...utils.pagination import paginate_listing, InvalidCursor
+from ...utils.counter_buffer import counter_buffer
+from ...utils.like_counters import LikeCounters
+from ...utils.comment_tree import CommentTree
+from ...utils.response_cache import response_cache
+from ...utils.conditional import conditional_get
+from ...utils.image_derivatives import image_derivatives, remove_derivatives
+from ...utils.video_processing import video_processor
+from ..serializers import story_list_options, serialize_stories
 
 # Story file handling constants and functions (from profile_routes.py)
 STORY_MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
@@ -16,26 +32,115 @@ def allowed_story_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'mp4', 'mov', 'avi', 'webm'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_story_video_thumbnail(video_path, output_dir):
-    """Generate thumbnail for video file (placeholder implementation)"""
-    # This is a placeholder - in a real implementation, you'd use ffmpeg or similar
-    # For now, return None to indicate no thumbnail was generated
-    current_app.logger.warning(f"Video thumbnail generation not implemented for: {video_path}")
-    return None
+def attach_story_media(story, source_path, original_name):
+    """
+    Move a finished upload into the story's media folder and append it to
+    ``media_files`` (the caller commits). The first image becomes the story
+    thumbnail if it has none; videos are marked ``processing`` for the caller
+    to hand to ``video_processor``, which sets a thumbnail once extracted.
+    """
+    upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+    story_media_dir = os.path.join(upload_root, 'stories', str(story.id))
+    os.makedirs(story_media_dir, exist_ok=True)
+
+    media_files_info = []
+    if story.media_files:
+        try:
+            media_files_info = json.loads(story.media_files)
+        except (json.JSONDecodeError, TypeError):
+            media_files_info = []
+
+    file_ext = original_name.rsplit('.', 1)[1].lower()
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    filename = f"story_{story.user_id}_{timestamp}_{len(media_files_info)}.{file_ext}"
+    file_path = os.path.join(story_media_dir, filename)
+    shutil.move(source_path, file_path)
+
+    file_type = 'image' if file_ext in ['png', 'jpg', 'jpeg', 'gif', 'webp'] else 'video'
+    if not story.thumbnail and file_type == 'image':
+        story.thumbnail = f"stories/{story.id}/{filename}"
+
+    media_info = {
+        'filename': filename,
+        'file_path': f"stories/{story.id}/{filename}",
+        'file_type': file_type,
+        'file_size': os.path.getsize(file_path),
+        'is_thumbnail': story.thumbnail == f"stories/{story.id}/{filename}",
+        'original_name': original_name
+    }
+    if file_type == 'video':
+        media_info['processing'] = True
+    media_files_info.append(media_info)
+    story.media_files = json.dumps(media_files_info)
+    return media_info
 
 story_bp = Blueprint('story', __name__)
 logger = logging.getLogger(__name__)
 
+def apply_story_search(query, search):
+    """Filter a story query by search text, ranked through the full-text index when available"""
+    hits = StorySearchIndex.search_subquery(search)
+    if hits is not None:
+        return query.join(hits, Story.id == hits.c.story_id).order_by(hits.c.rank), hits
+    
+    # No index on this database - fall back to LIKE matching
+    query = query.filter(
+        Story.title.ilike(f'%{search}%') | 
+        Story.content.ilike(f'%{search}%') |
+        Story.tags.ilike(f'%{search}%')
+    )
+    return query, None
+
+def apply_language_preference(query, language):
+    """
+    Restrict a story query to one language, with English as the fallback.
+    
+    Stories in ``language`` sort first, followed by English stories that have
+    no published translation into ``language``, so a story and its translation
+    are never listed together.
+    """
+    if language == 'en':
+        return query.filter(Story.language == 'en')
+    
+    translated = aliased(Story)
+    has_translation = select(translated.id).where(
+        translated.status == 'published',
+        translated.language == language,
+        or_(
+            translated.translation_of_id == func.coalesce(Story.translation_of_id, Story.id),
+            translated.id == Story.translation_of_id
+        )
+    ).exists()
+    return (query
+            .filter(or_(Story.language == language, and_(Story.language == 'en', ~has_translation)))
+            .order_by(case((Story.language == language, 0), else_=1)))
+
+def parse_translation_link(value, story_id=None):
+    """Validate a ``translation_of_id`` payload value; returns (id or None, error message)"""
+    if value in (None, '', 'null'):
+        return None, None
+    try:
+        source_id = int(value)
+    except (TypeError, ValueError):
+        return None, 'Invalid translation_of_id'
+    if source_id == story_id or not Story.query.get(source_id):
+        return None, 'Source story for translation not found'
+    return source_id, None
+
 # Get all stories
 @story_bp.route('/stories', methods=['GET'])
+@conditional_get((Story, Story.status == 'published'))
+@response_cache.cached('stories')
 def get_stories():
     """Get all published stories"""
     try:
         # Get query parameters
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 12, type=int)
+        cursor = request.args.get('cursor')
         search = request.args.get('search', '').strip()
         category = request.args.get('category', '').strip()
+        tag = request.args.get('tag', '').strip()
         author_id = request.args.get('author_id', type=int)
         language = request.args.get('lang', 'en').strip()  # Default to English
         
@@ -45,105 +150,50 @@ def get_stories():
         
         logger.info(f"🔍 Stories API - Fetching stories for language: {language}")
         
-        # Build query for published stories with language filter
-        query = Story.query.filter_by(status='published', language=language)
+        # Build query for published stories, requested language first then English fallbacks
+        query = apply_language_preference(
+            Story.query.options(*story_list_options()).filter(Story.status == 'published'),
+            language
+        )
+        search_hits = None
         
         if search:
-            query = query.filter(
-                Story.title.ilike(f'%{search}%') | 
-                Story.content.ilike(f'%{search}%') |
-                Story.tags.ilike(f'%{search}%')
-            )
+            query, search_hits = apply_story_search(query, search)
         
         if category:
             query = query.filter(Story.category == category)
         
+        if tag:
+            query = TagIndex.filter_by_tag(query, 'story', tag)
+        
         if author_id:
-            query = query.filter(Story.author_id == author_id)
+            query = query.filter(Story.user_id == author_id)
         
         # Order by creation date (newest first)
         query = query.order_by(Story.created_at.desc())
         
-        # Paginate
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
+        # Paginate (?cursor= switches to keyset pages)
+        pagination = paginate_listing(query, Story.created_at, Story.id,
+                                      page=page, per_page=per_page, cursor=cursor)
         
-        stories = []
-        total = 0
-        pages = 0
+        extra = {story.id: {'language_fallback': story.language != language} for story in pagination.items}
+        if search_hits is not None:
+            snippets = StorySearchIndex.snippets(list(extra), search)
+            for story_id, snippet in snippets.items():
+                extra[story_id]['search_snippet'] = snippet
+        stories = serialize_stories(pagination.items, author_summary=True, extra=extra)
         
-        # If no stories found for requested language and language is not English, fallback to English
-        if pagination.total == 0 and language != 'en':
-            logger.info(f"🔍 No stories found for language '{language}', falling back to English")
-            
-            # Build fallback query for English stories
-            fallback_query = Story.query.filter_by(status='published', language='en')
-            
-            if search:
-                fallback_query = fallback_query.filter(
-                    Story.title.ilike(f'%{search}%') | 
-                    Story.content.ilike(f'%{search}%') |
-                    Story.tags.ilike(f'%{search}%')
-                )
-            
-            if category:
-                fallback_query = fallback_query.filter(Story.category == category)
-            
-            if author_id:
-                fallback_query = fallback_query.filter(Story.author_id == author_id)
-            
-            fallback_query = fallback_query.order_by(Story.created_at.desc())
-            
-            # Paginate fallback query
-            fallback_pagination = fallback_query.paginate(
-                page=page, 
-                per_page=per_page, 
-                error_out=False
-            )
-            
-            if fallback_pagination.total > 0:
-                for story in fallback_pagination.items:
-                    story_data = story.to_dict()
-                    # Add author info
-                    if hasattr(story, 'author') and story.author:
-                        story_data['author'] = {
-                            'id': story.author.id,
-                            'name': story.author.name
-                        }
-                    stories.append(story_data)
-                total = fallback_pagination.total
-                pages = fallback_pagination.pages
-                logger.info(f"🔍 Fallback successful: Found {total} English stories")
-            else:
-                logger.info(f"🔍 No English stories found either")
-        elif pagination.total > 0:
-            # Process stories for the requested language
-            for story in pagination.items:
-                story_data = story.to_dict()
-                # Add author info
-                if hasattr(story, 'author') and story.author:
-                    story_data['author'] = {
-                        'id': story.author.id,
-                        'name': story.author.name
-                    }
-                stories.append(story_data)
-            total = pagination.total
-            pages = pagination.pages
+        meta = pagination.meta()
+        meta['language'] = language
         
         return jsonify({
             'success': True,
             'data': stories,
-            'meta': {
-                'page': page,
-                'per_page': per_page,
-                'total': total,
-                'pages': pages
-            }
+            'meta': meta
         }), 200
         
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Get stories error: {str(e)}")
         return jsonify({
@@ -151,6 +201,30 @@ def get_stories():
             'message': 'Failed to get stories'
         }), 500
 
+# Tag cloud for published stories
+@story_bp.route('/stories/tags', methods=['GET'])
+def get_story_tags():
+    """Get the most used tags on published stories"""
+    try:
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        language = request.args.get('lang', '').strip()
+        
+        filters = [Story.status == 'published']
+        if language in ['en', 'it']:
+            filters.append(Story.language == language)
+        
+        return jsonify({
+            'success': True,
+            'data': TagIndex.tag_counts('story', *filters, limit=limit)
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Get story tags error: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to get tags'
+        }), 500
+
 # Get story by ID
 @story_bp.route('/<int:story_id>', methods=['GET'])
 def get_story(story_id):
@@ -181,16 +255,8 @@ def get_story(story_id):
                 'name': story.author.name
             }
         
-        # Related stories (same category/tags), exclude current
-        related_query = Story.query.filter(Story.id != story.id, Story.status == 'published')
-        if story.category:
-            related_query = related_query.filter(Story.category == story.category)
-        if story.tags:
-            for tag in story.tags.split(','):
-                t = tag.strip()
-                if t:
-                    related_query = related_query.filter(Story.tags.ilike(f'%{t}%'))
-        related = related_query.order_by(Story.created_at.desc()).limit(6).all()
+        # Related stories come from the precomputed similarity graph
+        related = RelatedContent.related_stories(story.id)
         related_data = [s.to_dict() for s in related]
 
         return jsonify({
@@ -235,6 +301,10 @@ def create_story():
                     'message': f'{field.replace("_", " ").title()} is required'
                 }), 400
         
+        translation_of_id, link_error = parse_translation_link(data.get('translation_of_id'))
+        if link_error:
+            return jsonify({'success': False, 'message': link_error}), 400
+        
         # Create story
         tags_value = data.get('tags', '')
         if isinstance(tags_value, list):
@@ -248,7 +318,8 @@ def create_story():
             category=data.get('category', 'general'),
             tags=tags_value,
             is_featured=data.get('is_featured', 'false').lower() == 'true',
-            language=data.get('language', 'en')
+            language=data.get('language', 'en'),
+            translation_of_id=translation_of_id
         )
         
         db.session.add(story)
@@ -314,12 +385,9 @@ def create_story():
                                     custom_thumbnail_path = f"stories/{story.id}/{thumb_filename}"
                                     current_app.logger.info(f"Custom thumbnail saved: {thumb_filename}")
                             
-                            # Use custom thumbnail or generate one
-                            if not thumbnail_path:
-                                if custom_thumbnail_path:
-                                    thumbnail_path = custom_thumbnail_path
-                                else:
-                                    thumbnail_path = generate_story_video_thumbnail(file_path, story_media_dir)
+                            # Use the custom thumbnail; otherwise one is extracted in the background
+                            if not thumbnail_path and custom_thumbnail_path:
+                                thumbnail_path = custom_thumbnail_path
                         
                         # Store media file info in JSON format
                         media_info = {
@@ -333,6 +401,8 @@ def create_story():
                         
                         if custom_thumbnail_path:
                             media_info['thumbnail_path'] = custom_thumbnail_path
+                        if file_type == 'video':
+                            media_info['processing'] = True
                         
                         media_files_info.append(media_info)
                         
@@ -349,6 +419,10 @@ def create_story():
             story.media_files = json.dumps(media_files_info)
         
         db.session.commit()
+        if media_files_info:
+            image_derivatives.schedule_story_media(story.id, media_files_info, story_media_dir)
+        if media_files_info:
+            video_processor.schedule_story_media(story.id, media_files_info, story_media_dir)
         
         # Log story creation
         TokenManager.log_security_event(
@@ -451,7 +525,7 @@ def get_my_submissions():
         status = request.args.get('status', '').strip()
         
         # Build query
-        query = Story.query.filter_by(user_id=current_user_id)
+        query = Story.query.options(*story_list_options()).filter_by(user_id=current_user_id)
         
         if status:
             query = query.filter(Story.status == status)
@@ -466,7 +540,7 @@ def get_my_submissions():
             error_out=False
         )
         
-        submissions = [story.to_dict() for story in pagination.items]
+        submissions = serialize_stories(pagination.items)
         
         return jsonify({
             'success': True,
@@ -546,6 +620,12 @@ def update_story(story_id):
         if 'language' in data:
             story.language = data['language']
         
+        if 'translation_of_id' in data:
+            translation_of_id, link_error = parse_translation_link(data['translation_of_id'], story.id)
+            if link_error:
+                return jsonify({'success': False, 'message': link_error}), 400
+            story.translation_of_id = translation_of_id
+        
         story.updated_at = datetime.utcnow()
         
         # Handle media files if any (like profile/submit)
@@ -564,6 +644,7 @@ def update_story(story_id):
                             file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], media_info['file_path'])
                             if os.path.exists(file_path):
                                 os.remove(file_path)
+                            remove_derivatives(media_info, os.path.dirname(file_path))
                             if media_info.get('thumbnail_path'):
                                 thumb_path = os.path.join(current_app.config['UPLOAD_FOLDER'], media_info['thumbnail_path'])
                                 if os.path.exists(thumb_path):
@@ -628,12 +709,9 @@ def update_story(story_id):
                                     custom_thumbnail_path = f"stories/{story.id}/{thumb_filename}"
                                     current_app.logger.info(f"Custom thumbnail saved: {thumb_filename}")
                             
-                            # Use custom thumbnail or generate one
-                            if not thumbnail_path:
-                                if custom_thumbnail_path:
-                                    thumbnail_path = custom_thumbnail_path
-                                else:
-                                    thumbnail_path = generate_story_video_thumbnail(file_path, story_media_dir)
+                            # Use the custom thumbnail; otherwise one is extracted in the background
+                            if not thumbnail_path and custom_thumbnail_path:
+                                thumbnail_path = custom_thumbnail_path
                         
                         # Store media file info in JSON format
                         media_info = {
@@ -647,6 +725,8 @@ def update_story(story_id):
                         
                         if custom_thumbnail_path:
                             media_info['thumbnail_path'] = custom_thumbnail_path
+                        if file_type == 'video':
+                            media_info['processing'] = True
                         
                         media_files_info.append(media_info)
                         
@@ -663,6 +743,10 @@ def update_story(story_id):
                 story.media_files = json.dumps(media_files_info)
         
         db.session.commit()
+        if uploaded_files and media_files_info:
+            image_derivatives.schedule_story_media(story.id, media_files_info, story_media_dir)
+        if uploaded_files and media_files_info:
+            video_processor.schedule_story_media(story.id, media_files_info, story_media_dir)
         
         # Log story update
         TokenManager.log_security_event(
@@ -800,6 +884,24 @@ def publish_story(story_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': 'Failed to publish story'}), 500
 
+# Record a story view
+@story_bp.route('/<int:story_id>/view', methods=['POST'])
+def increment_story_view(story_id):
+    """Increment view count for a published story (no auth required)"""
+    try:
+        story = db.session.query(Story.id, Story.views).filter(
+            Story.id == story_id,
+            Story.status == 'published'
+        ).first()
+        if not story:
+            return jsonify({'success': False, 'message': 'Story not found'}), 404
+        
+        views = (story.views or 0) + counter_buffer.increment('story_views', story.id)
+        return jsonify({'success': True, 'data': {'views': views}}), 200
+    except Exception as e:
+        logger.error(f"Story view error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to update view count'}), 500
+
 # Comments: list
 @story_bp.route('/<int:story_id>/comments', methods=['GET'])
 def get_comments(story_id):
@@ -810,25 +912,46 @@ def get_comments(story_id):
 
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 20, type=int)
+        max_depth = min(request.args.get('max_depth', CommentTree.max_depth(), type=int), CommentTree.max_depth())
+        replies_per_thread = min(request.args.get('replies_per_thread', CommentTree.replies_per_thread(), type=int), 100)
 
-        # Only top-level comments, include nested replies in payload
+        # Page through top-level comments, then load their replies in one query
         query = Comment.query.filter_by(story_id=story_id, parent_id=None).order_by(Comment.created_at.desc())
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-        data = [c.to_dict(include_replies=True) for c in pagination.items]
+        pagination = paginate_listing(query, Comment.created_at, Comment.id, page=page,
+                                      per_page=per_page, cursor=request.args.get('cursor'))
+        data = CommentTree.threads(pagination.items, max_depth=max_depth, replies_per_thread=replies_per_thread)
         return jsonify({
             'success': True,
             'data': data,
-            'meta': {
-                'page': page,
-                'per_page': per_page,
-                'total': pagination.total,
-                'pages': pagination.pages
-            }
+            'meta': pagination.meta()
         }), 200
+    except InvalidCursor:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
     except Exception as e:
         logger.error(f"Get comments error: {str(e)}")
         return jsonify({'success': False, 'message': 'Failed to get comments'}), 500
 
+# Comments: more replies within a thread
+@story_bp.route('/<int:story_id>/comments/<int:comment_id>/replies', methods=['GET'])
+def get_comment_replies(story_id, comment_id):
+    try:
+        comment = Comment.query.filter_by(id=comment_id, story_id=story_id).first()
+        if not comment or not comment.path:
+            return jsonify({'success': False, 'message': 'Comment not found'}), 404
+
+        limit = min(request.args.get('limit', CommentTree.replies_per_thread(), type=int), 100)
+        max_depth = min(request.args.get('max_depth', CommentTree.max_depth(), type=int), CommentTree.max_depth())
+        page = CommentTree.replies(comment, after=request.args.get('after', type=int),
+                                   limit=limit, max_depth=max_depth)
+        return jsonify({
+            'success': True,
+            'data': page['replies'],
+            'meta': {'limit': limit, 'next_after': page['next_after']}
+        }), 200
+    except Exception as e:
+        logger.error(f"Get comment replies error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to get replies'}), 500
+
 # Comments: create (and reply via optional parent_id)
 @story_bp.route('/<int:story_id>/comments', methods=['POST'])
 @login_required
@@ -847,6 +970,8 @@ def add_comment(story_id):
             parent_comment = Comment.query.filter_by(id=parent_id, story_id=story_id).first()
             if not parent_comment:
                 return jsonify({'success': False, 'message': 'Parent comment not found'}), 404
+            if (parent_comment.depth or 0) + 1 > CommentTree.max_depth():
+                return jsonify({'success': False, 'message': 'Replies are nested too deeply'}), 400
 
         comment = Comment(
             content=content,
@@ -855,7 +980,8 @@ def add_comment(story_id):
             parent_id=parent_comment.id if parent_comment else None
         )
         db.session.add(comment)
-        story.comments_count = (story.comments_count or 0) + 1
+        db.session.flush()
+        LikeCounters.add_story_comment(story_id)
         db.session.commit()
         return jsonify({'success': True, 'data': comment.to_dict(include_replies=True)}), 201
     except Exception as e:
@@ -871,14 +997,8 @@ def like_story(story_id):
         story = Story.query.get(story_id)
         if not story:
             return jsonify({'success': False, 'message': 'Story not found'}), 404
-        existing = StoryLike.query.filter_by(user_id=current_user.id, story_id=story_id).first()
-        if existing:
-            return jsonify({'success': True, 'liked': True, 'likes_count': story.likes_count}), 200
-        like = StoryLike(user_id=current_user.id, story_id=story_id)
-        db.session.add(like)
-        story.likes_count = (story.likes_count or 0) + 1
-        db.session.commit()
-        return jsonify({'success': True, 'liked': True, 'likes_count': story.likes_count}), 200
+        likes_count = LikeCounters.like_story(story_id, current_user.id)
+        return jsonify({'success': True, 'liked': True, 'likes_count': likes_count}), 200
     except Exception as e:
         logger.error(f"Like story error: {str(e)}")
         db.session.rollback()
@@ -892,13 +1012,8 @@ def unlike_story(story_id):
         story = Story.query.get(story_id)
         if not story:
             return jsonify({'success': False, 'message': 'Story not found'}), 404
-        existing = StoryLike.query.filter_by(user_id=current_user.id, story_id=story_id).first()
-        if not existing:
-            return jsonify({'success': True, 'liked': False, 'likes_count': story.likes_count or 0}), 200
-        db.session.delete(existing)
-        story.likes_count = max(0, (story.likes_count or 0) - 1)
-        db.session.commit()
-        return jsonify({'success': True, 'liked': False, 'likes_count': story.likes_count}), 200
+        likes_count = LikeCounters.unlike_story(story_id, current_user.id)
+        return jsonify({'success': True, 'liked': False, 'likes_count': likes_count}), 200
     except Exception as e:
         logger.error(f"Unlike story error: {str(e)}")
         db.session.rollback()
@@ -5,6 +5,8 @@ import logging
 
 from ...models import Tour, User, db
 from ...auth.utils import TokenManager
+from ...utils.response_cache import response_cache
+from ...utils.conditional import conditional_get
 
 tour_routes = Blueprint('tour', __name__)
 logger = logging.getLogger(__name__)
@@ -22,6 +24,8 @@ def handle_preflight():
 
 # Get all tours
 @tour_routes.route('/', methods=['GET'])
+@conditional_get((Tour, Tour.status == 'active'))
+@response_cache.cached('tours')
 def get_tours():
     """Get all active tours with language support"""
     try:
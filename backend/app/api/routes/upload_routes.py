@@ -0,0 +1,234 @@
+"""
+Resumable upload routes (tus 1.0 core + creation and termination)
+
+    POST   /api/uploads                  create (Upload-Length, Upload-Metadata)
+    HEAD   /api/uploads/<id>             current Upload-Offset, to resume
+    PATCH  /api/uploads/<id>             append a chunk at Upload-Offset
+    DELETE /api/uploads/<id>             abandon the upload
+    POST   /api/uploads/<id>/finalize    create the gallery item / attach to a story
+"""
+import os
+import base64
+import binascii
+import shutil
+import logging
+
+from flask import Blueprint, request, jsonify, current_app
+from flask_login import login_required, current_user
+
+from ...models import User, Story, db
+from ...utils.resumable_upload import ResumableUploads, UploadError, TUS_VERSION
+from ...utils.image_derivatives import image_derivatives
+from ...utils.video_processing import video_processor
+from ...utils.media_store import MediaStore
+from .admin_routes import create_gallery_item
+from .story_routes import attach_story_media
+
+logger = logging.getLogger(__name__)
+
+upload_bp = Blueprint('uploads', __name__)
+
+
+def parse_upload_metadata(header):
+    """Decode a tus ``Upload-Metadata`` header (``key base64value`` pairs)"""
+    metadata = {}
+    for pair in filter(None, (part.strip() for part in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(f"Invalid Upload-Metadata value for {key}", code='INVALID_METADATA')
+    return metadata
+
+
+def upload_error_response(error):
+    response = jsonify({'success': False, 'message': error.message, 'code': error.code})
+    response.status_code = error.status
+    if error.offset is not None:
+        response.headers['Upload-Offset'] = str(error.offset)
+    return response
+
+
+def offset_headers(response, upload):
+    response.headers['Upload-Offset'] = str(upload.offset)
+    response.headers['Upload-Length'] = str(upload.length)
+    response.headers['Upload-Expires'] = upload.expires_at.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@upload_bp.after_request
+def add_tus_headers(response):
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    if request.method == 'OPTIONS':
+        response.headers['Tus-Version'] = TUS_VERSION
+        response.headers['Tus-Extension'] = 'creation,termination,expiration'
+        response.headers['Tus-Max-Size'] = str(ResumableUploads.max_size('gallery'))
+    return response
+
+
+# Create an upload
+@upload_bp.route('', methods=['POST'])
+@login_required
+def create_upload():
+    """Open a resumable upload; the file is described by tus headers or a JSON body"""
+    try:
+        if 'Upload-Length' in request.headers:
+            metadata = parse_upload_metadata(request.headers.get('Upload-Metadata'))
+            length = request.headers.get('Upload-Length', type=int)
+        else:
+            metadata = request.get_json(silent=True) or {}
+            try:
+                length = int(metadata.get('length'))
+            except (TypeError, ValueError):
+                length = None
+
+        user = User.query.get(current_user.id)
+        upload = ResumableUploads.create(
+            user,
+            purpose=metadata.get('purpose', 'story'),
+            filename=metadata.get('filename', ''),
+            length=length,
+            mime_type=metadata.get('filetype') or metadata.get('mime_type')
+        )
+
+        response = jsonify({'success': True, 'data': upload.to_dict()})
+        response.status_code = 201
+        response.headers['Location'] = f"{request.base_url.rstrip('/')}/{upload.id}"
+        return offset_headers(response, upload)
+
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Create upload error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Failed to create upload'}), 500
+
+
+# Upload status (HEAD for tus clients)
+@upload_bp.route('/<upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    """Get the current offset of an upload"""
+    try:
+        upload = ResumableUploads.get(upload_id, current_user)
+        return offset_headers(jsonify({'success': True, 'data': upload.to_dict()}), upload)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Get upload error: {str(e)}")
+        return jsonify({'success': False, 'message': 'Failed to get upload'}), 500
+
+
+# Append a chunk
+@upload_bp.route('/<upload_id>', methods=['PATCH'])
+@login_required
+def patch_upload(upload_id):
+    """Stream one chunk to disk at Upload-Offset"""
+    try:
+        if request.mimetype != 'application/offset+octet-stream':
+            raise UploadError('Content-Type must be application/offset+octet-stream', 415, 'INVALID_CONTENT_TYPE')
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None or offset < 0:
+            raise UploadError('Upload-Offset header is required', code='INVALID_OFFSET')
+
+        upload = ResumableUploads.get(upload_id, current_user)
+        ResumableUploads.append(upload, offset, request.stream, request.content_length)
+        return offset_headers(current_app.response_class(status=204), upload)
+
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Upload chunk error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Failed to store chunk'}), 500
+
+
+# Abandon an upload
+@upload_bp.route('/<upload_id>', methods=['DELETE'])
+@login_required
+def delete_upload(upload_id):
+    """Discard an upload and its partial file"""
+    try:
+        ResumableUploads.delete(ResumableUploads.get(upload_id, current_user))
+        return current_app.response_class(status=204)
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Delete upload error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Failed to delete upload'}), 500
+
+
+# Hand a finished upload to gallery/story creation
+@upload_bp.route('/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """
+    Turn a complete upload into content.
+
+    Gallery uploads take the admin upload form fields (title, description,
+    category, tags, album_id, ...) and create a gallery item. Story uploads
+    take ``story_id`` and are added to that story's media files.
+    """
+    try:
+        upload = ResumableUploads.get(upload_id, current_user)
+        data = request.get_json(silent=True) or {}
+        user = User.query.get(current_user.id)
+
+        story = None
+        if upload.purpose == 'story':
+            story = Story.query.get(data.get('story_id') or 0)
+            if not story:
+                return jsonify({'success': False, 'message': 'Story not found'}), 404
+            if story.user_id != user.id and not user.is_admin_user():
+                return jsonify({'success': False, 'message': 'Access denied'}), 403
+        elif not user.is_admin_user():
+            return jsonify({'success': False, 'message': 'Admin access required', 'code': 'ACCESS_DENIED'}), 403
+
+        source = ResumableUploads.claim(upload)
+        stored = None
+        try:
+            if story is not None:
+                media_info = attach_story_media(story, source, upload.filename)
+                db.session.commit()
+                media_dir = os.path.join(current_app.config.get('UPLOAD_FOLDER', 'uploads'), 'stories', str(story.id))
+                image_derivatives.schedule_story_media(story.id, [media_info], media_dir)
+                video_processor.schedule_story_media(story.id, [media_info], media_dir)
+                result = {'story': story.to_dict(), 'media_file': media_info}
+            else:
+                metadata = {
+                    'title': (data.get('title') or upload.filename).strip(),
+                    'description': (data.get('description') or '').strip(),
+                    'category': (data.get('category') or 'general').strip(),
+                    'tags': data.get('tags', ''),
+                    'photographer': data.get('photographer'),
+                    'location': data.get('location'),
+                    'album_id': data.get('album_id')
+                }
+                stored = MediaStore.adopt(source, upload.file_ext, upload.mime_type)
+                result = create_gallery_item(stored, upload.filename, upload.file_type,
+                                             upload.mime_type, metadata).to_dict()
+        except Exception:
+            db.session.rollback()
+            if stored and not stored.existing and os.path.exists(stored.file_path):
+                shutil.move(stored.file_path, source)
+            if os.path.exists(source):
+                ResumableUploads.release(upload, finalized=False)  # The client can retry
+            else:
+                ResumableUploads.delete(upload)
+            raise
+
+        ResumableUploads.release(upload, finalized=True)
+        return jsonify({
+            'success': True,
+            'message': 'Upload finalized',
+            'data': result
+        }), 201
+
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"Finalize upload error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Failed to finalize upload'}), 500
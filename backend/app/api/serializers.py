@@ -0,0 +1,52 @@
+"""
+Batch serializers for list endpoints.
+
+``Story.to_dict`` and ``GalleryItem.to_dict`` reach into their author, reviewer
+and uploader relationships. Serializing a page row by row therefore lazy-loads
+those users one SELECT at a time. List endpoints apply the loader options below
+to their query and hand the whole page to a ``serialize_*`` function. The
+related users then arrive in one extra query per relationship, and each user is
+serialized once per page.
+"""
+from sqlalchemy.orm import selectinload
+
+from ..models import Story, GalleryItem
+
+
+def story_list_options():
+    """Loader options for queries whose rows go through ``serialize_stories``"""
+    return (selectinload(Story.author), selectinload(Story.reviewer))
+
+
+def gallery_list_options():
+    """Loader options for queries whose rows go through ``serialize_gallery_items``"""
+    return (selectinload(GalleryItem.uploader),)
+
+
+def serialize_stories(stories, include_content=False, author_summary=False, extra=None):
+    """
+    Serialize a page of stories.
+
+    ``author_summary`` replaces the full author with ``{id, name}`` as the
+    public listing does; ``extra`` maps story id to additional fields to merge
+    (e.g. search snippets).
+    """
+    user_cache = {}
+    result = []
+    for story in stories:
+        data = story.to_dict(include_content=include_content, user_cache=user_cache)
+        if author_summary and story.author:
+            data['author'] = {
+                'id': story.author.id,
+                'name': story.author.name
+            }
+        if extra and story.id in extra:
+            data.update(extra[story.id])
+        result.append(data)
+    return result
+
+
+def serialize_gallery_items(items):
+    """Serialize a page of gallery items"""
+    user_cache = {}
+    return [item.to_dict(user_cache=user_cache) for item in items]
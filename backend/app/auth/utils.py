@@ -4,7 +4,7 @@ import hashlib
 import pyotp
 import requests
 from datetime import datetime, timedelta, timezone
-from flask import request, current_app, jsonify
+from flask import request, current_app, jsonify, has_request_context
 # JWT removed - using Flask-Login sessions only
 from werkzeug.security import check_password_hash
 from sqlalchemy import and_
@@ -529,14 +529,20 @@ class TokenManager:
             return False
     
     @staticmethod
-    def log_security_event(user_id, event_type, details=None):
-        """Log security events for monitoring"""
+    def log_security_event(user_id, event_type, details=None, ip_address=None, user_agent=None):
+        """
+        Log security events for monitoring. The client address and user agent
+        come from the current request unless given, as background jobs must.
+        """
         try:
+            if has_request_context():
+                ip_address = ip_address or request.remote_addr
+                user_agent = user_agent or request.headers.get('User-Agent', '')
             security_log = SecurityLog(
                 user_id=user_id,
                 event_type=event_type,
-                ip_address=request.remote_addr,
-                user_agent=request.headers.get('User-Agent', ''),
+                ip_address=ip_address,
+                user_agent=user_agent,
                 details=details,
                 timestamp=datetime.utcnow()
             )
@@ -1,44 +1,26 @@
-from flask import current_app, render_template
-from flask_mail import Message
-from threading import Thread
+from flask import current_app
 import secrets
 import os
 from datetime import datetime, timedelta
 
-def send_async_email(app, msg):
-    """Send email asynchronously"""
-    with app.app_context():
-        from .extensions import mail
-        try:
-            mail.send(msg)
-            app.logger.info(f"Email sent successfully to {msg.recipients}")
-        except Exception as e:
-            app.logger.error(f"Failed to send email to {msg.recipients}: {str(e)}")
+from .utils.mail_outbox import MailOutbox, render_email
 
 def send_email(subject, recipients, template=None, **kwargs):
-    """Send email with optional template rendering"""
+    """Queue an email, rendering the optional template now; delivery happens from the outbox"""
     try:
-        msg = Message(
-            subject=f"[DoggoDaily] {subject}",
-            sender=current_app.config.get('MAIL_DEFAULT_SENDER', 'noreply@doggodaily.com'),
-            recipients=recipients if isinstance(recipients, list) else [recipients]
-        )
-        
         if template:
-            # Render HTML template
-            try:
-                msg.html = render_template(f'email/{template}.html', **kwargs)
-            except:
-                # Fallback to text if HTML template not found
-                msg.body = render_template(f'email/{template}.txt', **kwargs)
+            html, body = render_email(template, subject=subject, **kwargs)
         else:
             # Use provided body
-            msg.body = kwargs.get('body', '')
-            msg.html = kwargs.get('html', '')
+            body = kwargs.get('body', '')
+            html = kwargs.get('html', '')
         
-        # Send email asynchronously
-        thread = Thread(target=send_async_email, args=(current_app._get_current_object(), msg))
-        thread.start()
+        MailOutbox.queue(
+            subject=subject,
+            recipients=recipients if isinstance(recipients, list) else [recipients],
+            html=html or None,
+            body=body or None
+        )
         
         return True
     except Exception as e:
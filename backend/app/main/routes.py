@@ -1,9 +1,18 @@
 
 from . import main_bp
 from flask import jsonify
-from flask import current_app, send_from_directory
+from flask import current_app, send_file, abort, Response
+from werkzeug.security import safe_join
+from urllib.parse import quote
+import mimetypes
 import os
 
+from ..utils.media_store import is_media_path
+
+# HLS playlists and segments (not in every platform's mime.types)
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
 # Import admin security decorator
 from ..admin_security import admin_required, PermissionLevel
 from flask_login import current_user
@@ -13,20 +22,37 @@ def home():
     return jsonify({'message': 'main home'})
 @main_bp.route('/uploads/<path:filename>')
 def serve_uploads(filename):
-    upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
-    upload_root_abs = os.path.abspath(upload_root)
-    
-    try:
-        return send_from_directory(upload_root_abs, filename)
-    except Exception as e:
-        # Fallback: try to serve the file directly
-        file_path = os.path.join(upload_root_abs, filename)
-        if os.path.exists(file_path):
-            from flask import send_file
-            return send_file(file_path)
-        else:
-            from flask import abort
-            abort(404)
+    """
+    Serve an uploaded file. With ``UPLOADS_OFFLOAD`` set, this only checks
+    the path and hands the transfer to the front server (nginx
+    ``X-Accel-Redirect`` or Apache/lighttpd ``X-Sendfile``), which also answers
+    Range requests. Otherwise the file is streamed here, with Range support.
+    """
+    upload_root_abs = os.path.abspath(current_app.config.get('UPLOAD_FOLDER', 'uploads'))
+    file_path = safe_join(upload_root_abs, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+
+    # Content-addressed media never changes behind its name
+    immutable = is_media_path(filename)
+    offload = current_app.config.get('UPLOADS_OFFLOAD')
+    if offload == 'x-accel':
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = current_app.config.get(
+            'UPLOADS_ACCEL_PREFIX', '/internal-uploads/').rstrip('/') + '/' + quote(filename)
+    elif offload == 'x-sendfile':
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Sendfile'] = file_path
+    else:
+        response = send_file(file_path, conditional=True,
+                             max_age=current_app.config.get('MEDIA_CACHE_MAX_AGE', 31536000) if immutable else None)
+
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('MEDIA_CACHE_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+    return response
 
 @main_bp.route('/admin/dashboard', methods=['GET'])
 @admin_required(permission_level=PermissionLevel.ADMIN.value)
@@ -0,0 +1,39 @@
+"""
+Database migration to add materialized paths to comments
+"""
+from sqlalchemy import inspect, text
+
+from ..extensions import db
+
+
+def run_migration():
+    """Add the comment path columns and indexes, then place existing comments"""
+    from ..utils.comment_tree import CommentTree
+
+    inspector = inspect(db.engine)
+    columns = [column['name'] for column in inspector.get_columns('comments')]
+    indexes = [index['name'] for index in inspector.get_indexes('comments')]
+
+    with db.engine.begin() as connection:
+        for name, ddl in (
+            ('path', "ALTER TABLE comments ADD COLUMN path VARCHAR(255)"),
+            ('thread_id', "ALTER TABLE comments ADD COLUMN thread_id INTEGER"),
+            ('depth', "ALTER TABLE comments ADD COLUMN depth INTEGER NOT NULL DEFAULT 0"),
+        ):
+            if name not in columns:
+                print(f"📋 Adding {name} column to comments...")
+                connection.execute(text(ddl))
+                print(f"✅ {name} column added")
+            else:
+                print(f"ℹ️  {name} column already exists")
+
+        for name, ddl in (
+            ('ix_comments_thread_path', "CREATE INDEX ix_comments_thread_path ON comments (thread_id, path)"),
+            ('ix_comments_path', "CREATE INDEX ix_comments_path ON comments (path)"),
+        ):
+            if name not in indexes:
+                connection.execute(text(ddl))
+                print(f"✅ {name} index created")
+
+    placed = CommentTree.backfill()
+    print(f"✅ {placed} existing comments placed in their threads")
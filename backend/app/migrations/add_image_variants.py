@@ -0,0 +1,32 @@
+"""
+Database migration to add the responsive image variant columns
+"""
+from sqlalchemy import inspect, text
+
+from ..extensions import db
+
+
+def run_migration():
+    """Add the image variant columns, then render derivatives for existing images"""
+    from ..utils.image_derivatives import image_derivatives
+
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as connection:
+        for table, column in (
+            ('gallery_items', 'image_variants'),
+            ('users', 'avatar_variants'),
+            ('books', 'image_variants'),
+            ('authors', 'image_variants'),
+        ):
+            columns = [existing['name'] for existing in inspector.get_columns(table)]
+            if column not in columns:
+                print(f"📋 Adding {column} column to {table}...")
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} TEXT"))
+                print(f"✅ {column} column added")
+            else:
+                print(f"ℹ️  {table}.{column} column already exists")
+
+    totals = image_derivatives.backfill()
+    for target, count in totals.items():
+        print(f"✅ {count} {target} images resized")
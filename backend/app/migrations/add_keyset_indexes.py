@@ -0,0 +1,34 @@
+"""
+Database migration to add the (created_at, id) indexes behind cursor pagination
+"""
+from sqlalchemy import inspect
+
+from ..extensions import db
+
+# table -> composite index declared in the model's __table_args__
+KEYSET_INDEXES = (
+    ('stories', 'ix_stories_created_at_id'),
+    ('comments', 'ix_comments_story_created_at_id'),
+    ('gallery_items', 'ix_gallery_items_created_at_id'),
+    ('security_logs', 'ix_security_logs_timestamp_id'),
+    ('enhanced_security_logs', 'ix_enhanced_security_logs_created_at_id'),
+    ('audit_logs', 'ix_audit_logs_created_at_id'),
+)
+
+
+def run_migration():
+    """Create the keyset pagination indexes missing from an existing database"""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+
+    for table_name, index_name in KEYSET_INDEXES:
+        if table_name not in tables:
+            print(f"ℹ️  {table_name} table does not exist, skipping {index_name}")
+            continue
+        if index_name in {index['name'] for index in inspector.get_indexes(table_name)}:
+            print(f"ℹ️  {index_name} index already exists")
+            continue
+        index = next(index for index in db.metadata.tables[table_name].indexes if index.name == index_name)
+        print(f"📋 Creating {index_name} on {table_name}...")
+        index.create(db.engine)
+        print(f"✅ {index_name} index created")
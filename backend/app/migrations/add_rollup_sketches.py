@@ -0,0 +1,29 @@
+"""
+Database migration to add HyperLogLog sketches to the analytics rollups
+"""
+from sqlalchemy import inspect, text
+
+from ..extensions import db
+
+
+def run_migration():
+    """Add analytics_rollups.sketch, then drop the rollups so they are rebuilt with sketches"""
+    inspector = inspect(db.engine)
+    if not inspector.has_table('analytics_rollups'):
+        print("ℹ️  analytics_rollups does not exist yet; db.create_all() will create it with sketches")
+        return
+
+    columns = [column['name'] for column in inspector.get_columns('analytics_rollups')]
+    with db.engine.begin() as connection:
+        if 'sketch' not in columns:
+            print("📋 Adding sketch column to analytics_rollups...")
+            binary_type = 'BYTEA' if db.engine.name == 'postgresql' else 'BLOB'
+            connection.execute(text(f"ALTER TABLE analytics_rollups ADD COLUMN sketch {binary_type}"))
+            print("✅ sketch column added")
+        else:
+            print("ℹ️  analytics_rollups.sketch column already exists")
+
+        # Existing rows have no sketches; resetting the watermarks rebuilds them from raw and archived rows
+        connection.execute(text("DELETE FROM analytics_rollups"))
+        connection.execute(text("DELETE FROM analytics_rollup_watermarks"))
+        print("✅ Rollups cleared; the next analytics.rollup run rebuilds them")
@@ -0,0 +1,30 @@
+"""
+Database migration to add the translation link between stories
+"""
+from sqlalchemy import inspect, text
+
+from ..extensions import db
+
+
+def run_migration():
+    """Add stories.translation_of_id and its index if they're missing"""
+    inspector = inspect(db.engine)
+    columns = [column['name'] for column in inspector.get_columns('stories')]
+    indexes = [index['name'] for index in inspector.get_indexes('stories')]
+
+    with db.engine.begin() as connection:
+        if 'translation_of_id' not in columns:
+            print("📋 Adding translation_of_id column to stories...")
+            connection.execute(text(
+                "ALTER TABLE stories ADD COLUMN translation_of_id INTEGER "
+                "REFERENCES stories(id) ON DELETE SET NULL"
+            ))
+            print("✅ translation_of_id column added")
+        else:
+            print("ℹ️  translation_of_id column already exists")
+
+        if 'ix_stories_translation_of_id' not in indexes:
+            connection.execute(text(
+                "CREATE INDEX ix_stories_translation_of_id ON stories (translation_of_id)"
+            ))
+            print("✅ ix_stories_translation_of_id index created")
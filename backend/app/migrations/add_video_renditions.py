@@ -0,0 +1,50 @@
+"""
+Database migration to add the transcoded video renditions column
+"""
+import os
+import json
+
+from flask import current_app
+from sqlalchemy import inspect, text
+
+from ..extensions import db
+
+
+def run_migration():
+    """Add gallery_items.video_renditions, then queue transcoding for existing videos"""
+    from ..models import GalleryItem, Story
+    from ..utils.video_transcode import schedule_transcode
+
+    columns = [column['name'] for column in inspect(db.engine).get_columns('gallery_items')]
+    with db.engine.begin() as connection:
+        if 'video_renditions' not in columns:
+            print("📋 Adding video_renditions column to gallery_items...")
+            connection.execute(text("ALTER TABLE gallery_items ADD COLUMN video_renditions TEXT"))
+            print("✅ video_renditions column added")
+        else:
+            print("ℹ️  gallery_items.video_renditions column already exists")
+
+    upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+
+    def on_disk(rel_path):
+        return os.path.join(upload_root, rel_path.split('uploads/', 1)[1] if rel_path.startswith('uploads/')
+                            else rel_path)
+
+    queued = 0
+    for item_id, path in db.session.query(GalleryItem.id, GalleryItem.file_path).filter(
+            GalleryItem.file_type == 'video', GalleryItem.video_renditions.is_(None)).all():
+        if os.path.exists(on_disk(path)) and schedule_transcode('gallery', item_id, on_disk(path), path):
+            queued += 1
+    for story_id, media_files in db.session.query(Story.id, Story.media_files).filter(
+            Story.media_files.isnot(None)).all():
+        try:
+            media_files = json.loads(media_files)
+        except (json.JSONDecodeError, TypeError):
+            continue
+        for media in media_files:
+            if media.get('file_type') != 'video' or media.get('video_renditions') or not media.get('file_path'):
+                continue
+            file_path = os.path.join(upload_root, 'stories', str(story_id), media.get('filename', ''))
+            if os.path.exists(file_path) and schedule_transcode('story', story_id, file_path, media['file_path']):
+                queued += 1
+    print(f"✅ {queued} videos queued for transcoding")
@@ -0,0 +1,49 @@
+"""
+Move existing gallery files into the content-addressed media store
+"""
+import os
+
+from flask import current_app
+
+from ..extensions import db
+
+
+def run_migration():
+    """Hash each legacy gallery file into uploads/media/, merging duplicates, then re-render derivatives"""
+    from ..models import GalleryItem
+    from ..utils.media_store import MediaStore, is_media_path
+    from ..utils.image_derivatives import image_derivatives, remove_derivatives
+
+    db.create_all()  # media_blobs
+    upload_root = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+    moved = {}
+    counts = {'moved': 0, 'duplicates': 0, 'missing': 0}
+
+    for item in GalleryItem.query.order_by(GalleryItem.id).all():
+        if not item.file_path or is_media_path(item.file_path):
+            continue
+        relative = item.file_path.split('uploads/', 1)[1] if 'uploads/' in item.file_path else item.file_path
+        source = os.path.join(upload_root, relative)
+
+        if source in moved:
+            stored = moved[source]
+            MediaStore.retain(stored)
+            duplicate = True
+        elif os.path.exists(source):
+            ext = source.rsplit('.', 1)[-1] if '.' in source else 'bin'
+            stored = moved[source] = MediaStore.adopt(source, ext, item.mime_type)
+            remove_derivatives(item.image_variants, os.path.dirname(source))
+            duplicate = stored.existing
+        else:
+            counts['missing'] += 1
+            print(f"⚠️  Gallery item {item.id}: {item.file_path} not found, left as is")
+            continue
+
+        counts['duplicates' if duplicate else 'moved'] += 1
+        item.file_path = stored.path
+        item.image_variants = None
+        db.session.commit()
+
+    print(f"✅ {counts['moved']} files moved, {counts['duplicates']} duplicates merged, {counts['missing']} missing")
+    totals = image_derivatives.backfill()
+    print(f"✅ {totals.get('gallery', 0)} gallery images resized")
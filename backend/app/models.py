@@ -8,9 +8,12 @@ import json
 from .extensions import db
 from enum import Enum
 
-def generate_upload_url(filename):
-    """Generate HTTPS URL for uploaded files using the production domain"""
-    from flask import current_app
+def upload_base_url():
+    """Base URL for uploaded files, resolved once per app context (i.e. per request)"""
+    from flask import current_app, g
+    
+    if 'upload_base_url' in g:
+        return g.upload_base_url
     
     # Check if we're in production mode
     if current_app.config.get('PREFERRED_URL_SCHEME') == 'https':
@@ -20,7 +23,67 @@ def generate_upload_url(filename):
         # Use development URL
         base_url = current_app.config.get('BASE_URL', 'http://localhost:5000')
     
-    return f"{base_url}/uploads/{filename}"
+    g.upload_base_url = base_url
+    return base_url
+
+def generate_upload_url(filename):
+    """Generate HTTPS URL for uploaded files using the production domain"""
+    return f"{upload_base_url()}/uploads/{filename}"
+
+def serialize_image_variants(value):
+    """
+    Public form of a stored ``image_variants`` value (see
+    ``app.utils.image_derivatives``): intrinsic size, blur placeholder and a
+    srcset string per format, or None until the derivatives exist.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except (json.JSONDecodeError, TypeError):
+            return None
+    if not value:
+        return None
+    srcset = {}
+    for variant in value.get('variants', []):
+        rel = variant['path'].split('uploads/', 1)[1] if variant['path'].startswith('uploads/') else variant['path']
+        srcset.setdefault(variant['format'], []).append(f"{generate_upload_url(rel)} {variant['width']}w")
+    return {
+        'width': value.get('width'),
+        'height': value.get('height'),
+        'placeholder': value.get('placeholder'),
+        'srcset': {fmt: ', '.join(candidates) for fmt, candidates in srcset.items()}
+    }
+
+def serialize_video_renditions(value):
+    """
+    Public form of a stored ``video_renditions`` value (see
+    ``app.utils.video_transcode``): HLS master playlist and MP4 URLs plus
+    the ladder, or None until transcoding has finished.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except (json.JSONDecodeError, TypeError):
+            return None
+    if not value:
+        return None
+    def url(path):
+        return generate_upload_url(path.split('uploads/', 1)[1] if path.startswith('uploads/') else path)
+    return {
+        'hls_url': url(value['hls']),
+        'mp4_url': url(value['mp4']),
+        'renditions': value.get('renditions', [])
+    }
+
+def serialize_user(user, cache=None):
+    """Serialize a related user, reusing earlier results from ``cache`` when given"""
+    if user is None:
+        return None
+    if cache is None:
+        return user.to_dict()
+    if user.id not in cache:
+        cache[user.id] = user.to_dict()
+    return cache[user.id]
 
 class PermissionLevel(Enum):
     """Admin permission levels"""
@@ -69,6 +132,7 @@ class User(UserMixin, db.Model):
     # Profile fields
     bio = db.Column(db.Text, nullable=True)
     avatar_path = db.Column(db.String(500), nullable=True)
+    avatar_variants = db.Column(db.Text, nullable=True)  # JSON: resized copies of the avatar
     preferences = db.Column(db.Text, nullable=True)  # JSON string
     
     # Timestamps
@@ -192,6 +256,7 @@ class User(UserMixin, db.Model):
             'email': self.email,
             'bio': self.bio,
             'avatar_url': self.avatar_url,
+            'avatar_variants': serialize_image_variants(self.avatar_variants),
             'admin_level': self.admin_level,
             'is_active': self.is_active,
             'email_verified': self.email_verified,
@@ -249,6 +314,7 @@ class Story(db.Model):
     thumbnail = db.Column(db.String(255), nullable=True)
     category = db.Column(db.String(50), nullable=False, default='general')
     language = db.Column(db.String(5), nullable=False, default='en')  # en, it
+    translation_of_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='SET NULL'), nullable=True, index=True)  # Story this one translates
     status = db.Column(db.String(20), default='draft')  # draft, pending, published, rejected, archived
     is_featured = db.Column(db.Boolean, default=False)
     views = db.Column(db.Integer, default=0)
@@ -271,13 +337,16 @@ class Story(db.Model):
     # Media files information (JSON string)
     media_files = db.Column(db.Text, nullable=True)       # JSON string of media files info
     
+    # Keyset pagination order for listings
+    __table_args__ = (db.Index('ix_stories_created_at_id', 'created_at', 'id'),)
+    
     # Relationships
     author = db.relationship('User', backref=db.backref('stories', lazy=True), foreign_keys=[user_id])
     reviewer = db.relationship('User', backref=db.backref('reviewed_stories', lazy=True), foreign_keys=[reviewed_by])
     likes = db.relationship('StoryLike', backref='story', lazy=True, cascade='all, delete-orphan')
     comments = db.relationship('Comment', backref='story', lazy=True, cascade='all, delete-orphan')
 
-    def to_dict(self, include_content=False):
+    def to_dict(self, include_content=False, user_cache=None):
         from flask import url_for
         
         # Generate thumbnail URL if thumbnail exists
@@ -316,14 +385,28 @@ class Story(db.Model):
             except (json.JSONDecodeError, TypeError):
                 media_files_data = []
         
+        # Stored derivative paths become srcset URLs
+        thumbnail_variants = None
+        for media in media_files_data:
+            if 'variants' in media:
+                media['image_variants'] = serialize_image_variants(media)
+                for key in ('variants', 'placeholder', 'orientation'):
+                    media.pop(key, None)
+                if media.get('file_path') == self.thumbnail:
+                    thumbnail_variants = media['image_variants']
+            if 'video_renditions' in media:
+                media['streaming'] = serialize_video_renditions(media.pop('video_renditions'))
+        
         data = {
             'id': self.id,
             'title': self.title,
             'preview': self.preview,
             'thumbnail': self.thumbnail,
             'thumbnail_url': thumbnail_url,
+            'thumbnail_variants': thumbnail_variants,
             'category': self.category,
             'language': self.language,
+            'translation_of_id': self.translation_of_id,
             'status': self.status,
             'is_featured': self.is_featured,
             'views': self.views,
@@ -331,8 +414,8 @@ class Story(db.Model):
             'comments_count': self.comments_count,
             'reading_time': self.reading_time,
             'tags': self.tags.split(',') if self.tags else [],
-            'author': self.author.to_dict() if self.author else None,
-            'reviewer': self.reviewer.to_dict() if self.reviewer else None,
+            'author': serialize_user(self.author, user_cache),
+            'reviewer': serialize_user(self.reviewer, user_cache),
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat(),
             'published_at': self.published_at.isoformat() if self.published_at else None,
@@ -364,10 +447,22 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     story_id = db.Column(db.Integer, db.ForeignKey('stories.id'), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey('comments.id'), nullable=True)  # For nested comments
+    # Materialized path maintained by utils.comment_tree: zero-padded ancestor ids, root first
+    path = db.Column(db.String(255), nullable=True)
+    thread_id = db.Column(db.Integer, nullable=True)  # id of the top-level comment of this thread
+    depth = db.Column(db.Integer, nullable=False, default=0)  # 0 for top-level comments
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
+    __table_args__ = (
+        # Keyset pagination order for a story's thread
+        db.Index('ix_comments_story_created_at_id', 'story_id', 'created_at', 'id'),
+        # Descendants of a page of threads, in tree order
+        db.Index('ix_comments_thread_path', 'thread_id', 'path'),
+        db.Index('ix_comments_path', 'path'),
+    )
+    
     # Relationships
     author = db.relationship('User', backref=db.backref('comments', lazy=True), foreign_keys=[user_id])
     # Self-referencing relationship for nested comments
@@ -422,31 +517,31 @@ class GalleryItem(db.Model):
     likes = db.Column(db.Integer, default=0)
     width = db.Column(db.Integer, nullable=True)  # for images/videos
     height = db.Column(db.Integer, nullable=True)  # for images/videos
+    image_variants = db.Column(db.Text, nullable=True)  # JSON: resized copies and blur placeholder
     duration = db.Column(db.Integer, nullable=True)  # for videos in seconds
+    video_renditions = db.Column(db.Text, nullable=True)  # JSON: transcoded MP4 and HLS ladder
     location = db.Column(db.String(255), nullable=True)  # photo location
     photographer = db.Column(db.String(100), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
+    # Keyset pagination order for listings
+    __table_args__ = (db.Index('ix_gallery_items_created_at_id', 'created_at', 'id'),)
+    
     # Relationships
     uploader = db.relationship('User', backref=db.backref('gallery_items', lazy=True), foreign_keys=[user_id])
     likes_rel = db.relationship('GalleryLike', backref='gallery_item', lazy=True, cascade='all, delete-orphan')
 
-    def to_dict(self):
+    def to_dict(self, user_cache=None):
         from flask import url_for
         # Build file URL served via main blueprint
         path = self.file_path or ''
         # Expect stored like 'uploads/gallery/filename' -> need 'gallery/filename'
         rel = path.split('uploads/', 1)[1] if 'uploads/' in path else path
         
-        print(f"🔍 to_dict() for item {self.id}:")
-        print(f"  📁 file_path: {path}")
-        print(f"  📁 rel: {rel}")
-        
         try:
             file_url = generate_upload_url(rel) if rel else None
-            print(f"  🔗 Generated URL: {file_url}")
         except Exception as e:
             print(f"  ❌ URL generation failed: {e}")
             # Fallback: construct URL manually
@@ -489,10 +584,12 @@ class GalleryItem(db.Model):
             'likes': self.likes,
             'width': self.width,
             'height': self.height,
+            'image_variants': serialize_image_variants(self.image_variants),
             'duration': self.duration,
+            'streaming': serialize_video_renditions(self.video_renditions),
             'location': self.location,
             'photographer': self.photographer,
-            'uploader': self.uploader.to_dict() if self.uploader else None,
+            'uploader': serialize_user(self.uploader, user_cache),
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -706,6 +803,9 @@ class SecurityLog(db.Model):
     details = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Keyset pagination order for event listings
+    __table_args__ = (db.Index('ix_security_logs_timestamp_id', 'timestamp', 'id'),)
+    
     # Relationships
     user = db.relationship('User', backref='security_logs')
     
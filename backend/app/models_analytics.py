@@ -2,6 +2,7 @@
 Enhanced Analytics Models for comprehensive data tracking and analysis
 """
 from datetime import datetime, timedelta
+from flask import current_app
 from .extensions import db
 from .models import User
 import json
@@ -249,9 +250,42 @@ class HeatmapData(db.Model):
     device_type = db.Column(db.String(20), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+class AnalyticsRollup(db.Model):
+    """Page view and session counts pre-aggregated per hour or day and dimension"""
+    __tablename__ = 'analytics_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)  # hour, day
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    dimension = db.Column(db.String(20), nullable=False)  # views, page, sessions, source, device, country
+    value = db.Column(db.String(500), nullable=False, default='')  # Page URL, source, etc.; '' for site totals
+    total = db.Column(db.Integer, nullable=False, default=0)  # Page views or sessions
+    bounces = db.Column(db.Integer, nullable=False, default=0)  # Bounced sessions (session dimensions)
+    sketch = db.Column(db.LargeBinary, nullable=True)  # HyperLogLog of session ids (page dimensions) or user ids (session dimensions)
+    
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'dimension', 'bucket_start', 'value', name='uq_analytics_rollup_bucket'),
+    )
+
+class AnalyticsRollupWatermark(db.Model):
+    """How far each raw table has been rolled up; hours before this are closed"""
+    __tablename__ = 'analytics_rollup_watermarks'
+    
+    source = db.Column(db.String(20), primary_key=True)  # pageviews, sessions
+    rolled_up_to = db.Column(db.DateTime, nullable=False)  # Exclusive; always on the hour
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
 # Analytics calculation functions
 class AnalyticsCalculator:
-    """Utility class for calculating analytics metrics"""
+    """
+    Utility class for calculating analytics metrics.
+    
+    Page view and session breakdowns read the hourly/daily rollups
+    (``utils.analytics_rollups``) for closed hours and the raw tables only
+    after the rollup watermark; their windows start on the hour. Unique
+    users and views are HyperLogLog estimates (about 1.6% standard error)
+    unless ``ANALYTICS_EXACT_UNIQUES`` is set.
+    """
     
     @staticmethod
     def get_total_users(days=30):
@@ -261,9 +295,13 @@ class AnalyticsCalculator:
             User.created_at >= cutoff_date
         ).scalar() or 0
     
-    @staticmethod
-    def get_active_users(days=30):
+    @classmethod
+    def get_active_users(cls, days=30):
         """Get active users (with sessions) in the last N days"""
+        if not cls._exact_uniques():
+            from .utils.analytics_rollups import AnalyticsRollups
+            return AnalyticsRollups.uniques('sessions', cls._window_start(days)).get('', 0)
+        
         cutoff_date = datetime.utcnow() - timedelta(days=days)
         return db.session.query(func.count(func.distinct(UserSession.user_id))).filter(
             UserSession.started_at >= cutoff_date,
@@ -279,21 +317,52 @@ class AnalyticsCalculator:
         ).scalar() or 0
     
     @staticmethod
-    def get_bounce_rate(days=30):
+    def _window_start(days):
+        """Start of a rollup-backed window: N days ago, on the hour"""
+        from .utils.analytics_rollups import floor_hour
+        return floor_hour(datetime.utcnow() - timedelta(days=days))
+    
+    @staticmethod
+    def _exact_uniques():
+        """Count unique users/views exactly instead of from HyperLogLog sketches"""
+        return current_app.config.get('ANALYTICS_EXACT_UNIQUES', False)
+    
+    @classmethod
+    def _unique_users(cls, dimension, column, values, cutoff_date):
+        """Distinct users per session dimension value"""
+        if not values:
+            return {}
+        if not cls._exact_uniques():
+            from .utils.analytics_rollups import AnalyticsRollups
+            return AnalyticsRollups.uniques(dimension, cutoff_date, values=values)
+        return dict(db.session.query(
+            column, func.count(func.distinct(UserSession.user_id))
+        ).filter(
+            UserSession.started_at >= cutoff_date,
+            column.in_(values)
+        ).group_by(column).all())
+    
+    @classmethod
+    def _session_breakdown(cls, dimension, column, days, limit=None):
+        """(value, sessions, unique_users) rows for a session dimension, busiest first"""
+        from .utils.analytics_rollups import AnalyticsRollups
+        cutoff_date = cls._window_start(days)
+        totals = AnalyticsRollups.totals(dimension, cutoff_date)
+        ranked = sorted(totals.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+        unique_users = cls._unique_users(dimension, column, [value for value, _ in ranked], cutoff_date)
+        return [(value, sessions, unique_users.get(value, 0)) for value, (sessions, _) in ranked]
+    
+    @classmethod
+    def get_bounce_rate(cls, days=30):
         """Calculate bounce rate percentage"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        total_sessions = db.session.query(func.count(UserSession.id)).filter(
-            UserSession.started_at >= cutoff_date
-        ).scalar() or 0
+        from .utils.analytics_rollups import AnalyticsRollups
+        total_sessions, bounce_sessions = AnalyticsRollups.totals(
+            'sessions', cls._window_start(days)
+        ).get('', (0, 0))
         
         if total_sessions == 0:
             return 0
         
-        bounce_sessions = db.session.query(func.count(UserSession.id)).filter(
-            UserSession.started_at >= cutoff_date,
-            UserSession.is_bounce == True
-        ).scalar() or 0
-        
         return round((bounce_sessions / total_sessions) * 100, 2)
     
     @staticmethod
@@ -307,80 +376,46 @@ class AnalyticsCalculator:
         
         return round(avg_duration / 60, 2)  # Convert to minutes
     
-    @staticmethod
-    def get_page_views_by_day(days=30):
-        """Get daily page view counts"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        
-        # PostgreSQL/MySQL compatible date grouping
-        if db.engine.name == 'postgresql':
-            date_func = func.date_trunc('day', PageView.created_at)
-        else:
-            date_func = func.date(PageView.created_at)
-        
-        return db.session.query(
-            date_func.label('date'),
-            func.count(PageView.id).label('views')
-        ).filter(
-            PageView.created_at >= cutoff_date
-        ).group_by(date_func).order_by(date_func).all()
+    @classmethod
+    def get_page_views_by_day(cls, days=30):
+        """Get daily page view counts as (date, views)"""
+        from .utils.analytics_rollups import AnalyticsRollups
+        return AnalyticsRollups.by_day('views', cls._window_start(days))
     
-    @staticmethod
-    def get_top_pages(days=30, limit=10):
-        """Get most viewed pages"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        return db.session.query(
-            PageView.page_url,
-            func.count(PageView.id).label('views'),
-            func.count(func.distinct(PageView.session_id)).label('unique_views')
-        ).filter(
-            PageView.created_at >= cutoff_date
-        ).group_by(PageView.page_url).order_by(
-            func.count(PageView.id).desc()
-        ).limit(limit).all()
+    @classmethod
+    def get_top_pages(cls, days=30, limit=10):
+        """Get most viewed pages as (page_url, views, unique_views)"""
+        from .utils.analytics_rollups import AnalyticsRollups
+        cutoff_date = cls._window_start(days)
+        totals = AnalyticsRollups.totals('page', cutoff_date)
+        ranked = sorted(totals.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+        
+        unique_views = {}
+        if ranked and not cls._exact_uniques():
+            unique_views = AnalyticsRollups.uniques('page', cutoff_date, values=[url for url, _ in ranked])
+        elif ranked:
+            unique_views = dict(db.session.query(
+                PageView.page_url, func.count(func.distinct(PageView.session_id))
+            ).filter(
+                PageView.created_at >= cutoff_date,
+                PageView.page_url.in_([url for url, _ in ranked])
+            ).group_by(PageView.page_url).all())
+        return [(url, views, unique_views.get(url, 0)) for url, (views, _) in ranked]
     
-    @staticmethod
-    def get_traffic_sources(days=30, limit=10):
-        """Get top traffic sources"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        return db.session.query(
-            UserSession.utm_source,
-            func.count(UserSession.id).label('sessions'),
-            func.count(func.distinct(UserSession.user_id)).label('unique_users')
-        ).filter(
-            UserSession.started_at >= cutoff_date,
-            UserSession.utm_source.isnot(None)
-        ).group_by(UserSession.utm_source).order_by(
-            func.count(UserSession.id).desc()
-        ).limit(limit).all()
+    @classmethod
+    def get_traffic_sources(cls, days=30, limit=10):
+        """Get top traffic sources as (utm_source, sessions, unique_users)"""
+        return cls._session_breakdown('source', UserSession.utm_source, days, limit)
     
-    @staticmethod
-    def get_device_breakdown(days=30):
-        """Get device type breakdown"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        return db.session.query(
-            UserSession.device_type,
-            func.count(UserSession.id).label('sessions'),
-            func.count(func.distinct(UserSession.user_id)).label('unique_users')
-        ).filter(
-            UserSession.started_at >= cutoff_date,
-            UserSession.device_type.isnot(None)
-        ).group_by(UserSession.device_type).all()
+    @classmethod
+    def get_device_breakdown(cls, days=30):
+        """Get device type breakdown as (device_type, sessions, unique_users)"""
+        return cls._session_breakdown('device', UserSession.device_type, days)
     
-    @staticmethod
-    def get_geographic_breakdown(days=30, limit=10):
-        """Get geographic breakdown by country"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        return db.session.query(
-            UserSession.country,
-            func.count(UserSession.id).label('sessions'),
-            func.count(func.distinct(UserSession.user_id)).label('unique_users')
-        ).filter(
-            UserSession.started_at >= cutoff_date,
-            UserSession.country.isnot(None)
-        ).group_by(UserSession.country).order_by(
-            func.count(UserSession.id).desc()
-        ).limit(limit).all()
+    @classmethod
+    def get_geographic_breakdown(cls, days=30, limit=10):
+        """Get geographic breakdown by country as (country, sessions, unique_users)"""
+        return cls._session_breakdown('country', UserSession.country, days, limit)
     
     @staticmethod
     def get_conversion_rate(conversion_type=None, days=30):
@@ -5,6 +5,7 @@ Book management models for the application.
 
 from datetime import datetime
 from app import db
+from .models import serialize_image_variants
 
 class Book(db.Model):
     """Book model for managing book content and metadata."""
@@ -30,6 +31,7 @@ class Book(db.Model):
     
     # Common fields (not language-specific)
     image = db.Column(db.String(500), nullable=True)
+    image_variants = db.Column(db.Text, nullable=True)  # JSON: resized copies and blur placeholder
     price = db.Column(db.String(50), nullable=True)
     original_price = db.Column(db.String(50), nullable=True)  # Original price before discount
     currency = db.Column(db.String(10), default='USD')
@@ -88,6 +90,7 @@ class Book(db.Model):
             'preview': preview,
             'image': self.image,
             'image_url': image_url,
+            'image_variants': serialize_image_variants(self.image_variants),
             'price': self.price,
             'original_price': self.original_price,
             'currency': self.currency,
@@ -135,6 +138,7 @@ class Author(db.Model):
     
     # Common fields (not language-specific)
     image = db.Column(db.String(500), nullable=True)
+    image_variants = db.Column(db.Text, nullable=True)  # JSON: resized copies and blur placeholder
     social_links = db.Column(db.Text, nullable=True)  # JSON string for social links
     contact_email = db.Column(db.String(255), nullable=True)
     contact_link = db.Column(db.String(500), nullable=True)
@@ -230,6 +234,7 @@ class Author(db.Model):
             'title': title,
             'image': self.image,
             'image_url': image_url,
+            'image_variants': serialize_image_variants(self.image_variants),
             'bio': bio,
             'credentials': credentials_data,
             'achievements': achievements_data,
@@ -0,0 +1,16 @@
+"""
+Shared state for the public response cache
+"""
+from datetime import datetime
+from .extensions import db
+
+class CacheTagVersion(db.Model):
+    """Invalidation counter for one cache dependency tag, e.g. 'gallery' or 'tour:12'"""
+    __tablename__ = 'cache_tag_versions'
+
+    tag = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<CacheTagVersion {self.tag}={self.version}>'
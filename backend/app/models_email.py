@@ -0,0 +1,76 @@
+"""
+Outgoing email: the outbox and bulk campaigns
+"""
+from datetime import datetime
+from .extensions import db
+
+class EmailCampaign(db.Model):
+    """A bulk email; its body is rendered once and personalized per recipient"""
+    __tablename__ = 'email_campaigns'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    template = db.Column(db.String(100), nullable=True)  # Template name under templates/email
+    html = db.Column(db.Text, nullable=True)  # Rendered once, with a recipient name placeholder
+    body = db.Column(db.Text, nullable=True)
+    recipient_count = db.Column(db.Integer, nullable=False, default=0)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self, status_counts=None):
+        return {
+            'id': self.id,
+            'subject': self.subject,
+            'template': self.template,
+            'recipient_count': self.recipient_count,
+            'status_counts': status_counts or {},
+            'created_by': self.created_by,
+            'created_at': self.created_at.isoformat()
+        }
+
+    def __repr__(self):
+        return f'<EmailCampaign {self.id} {self.subject}>'
+
+
+class OutboxEmail(db.Model):
+    """One message to one recipient, waiting for or past delivery"""
+    __tablename__ = 'email_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('email_campaigns.id', ondelete='CASCADE'), nullable=True,
+                            index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    recipient_name = db.Column(db.String(100), nullable=True)  # Fills the campaign's placeholder
+    subject = db.Column(db.String(255), nullable=True)  # Campaign messages use the campaign's
+    html = db.Column(db.Text, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    priority = db.Column(db.Integer, nullable=False, default=0)  # Higher goes first; account mail beats campaigns
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    leased_until = db.Column(db.DateTime, nullable=True)  # A 'sending' message past this is picked up again
+    claim_token = db.Column(db.String(32), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Delivery order: due messages by priority, then age
+        db.Index('ix_email_outbox_delivery', 'status', 'priority', 'next_attempt_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'campaign_id': self.campaign_id,
+            'recipient': self.recipient,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat(),
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
+
+    def __repr__(self):
+        return f'<OutboxEmail {self.id} {self.recipient} {self.status}>'
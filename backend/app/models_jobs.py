@@ -0,0 +1,55 @@
+"""
+Background job queue
+"""
+import json
+from datetime import datetime
+from .extensions import db
+
+class Job(db.Model):
+    """One unit of background work; see ``app.utils.job_queue``"""
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # Registered task name, e.g. 'bulk.gallery'
+    queue = db.Column(db.String(50), nullable=False, default='default')
+    payload = db.Column(db.Text, nullable=True)  # JSON keyword arguments for the task
+    priority = db.Column(db.Integer, nullable=False, default=0)  # Higher runs first
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Claims so far, including the current one
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    lease_seconds = db.Column(db.Integer, nullable=False, default=300)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Not claimed before this
+    leased_until = db.Column(db.DateTime, nullable=True)  # A running job past this is reclaimed
+    worker_id = db.Column(db.String(100), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)  # JSON return value of the task
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Claim order: ready jobs by priority, then age
+        db.Index('ix_jobs_claim', 'status', 'queue', 'priority', 'run_at'),
+        db.Index('ix_jobs_finished_at', 'finished_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'queue': self.queue,
+            'priority': self.priority,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'run_at': self.run_at.isoformat() if self.run_at else None,
+            'last_error': self.last_error,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
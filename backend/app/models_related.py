@@ -0,0 +1,23 @@
+"""
+Precomputed related-content graph for story detail pages
+"""
+from datetime import datetime
+from .extensions import db
+
+class StoryRelation(db.Model):
+    """A scored edge from a story to one of its top related stories"""
+    __tablename__ = 'story_relations'
+
+    story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'), primary_key=True)
+    related_story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    # Serves the detail page lookup: neighbours of one story, best first
+    __table_args__ = (
+        db.Index('ix_story_relations_story_score', 'story_id', 'score'),
+        db.Index('ix_story_relations_related_story_id', 'related_story_id'),
+    )
+
+    def __repr__(self):
+        return f'<StoryRelation {self.story_id} -> {self.related_story_id} ({self.score:.2f})>'
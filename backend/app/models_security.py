@@ -31,6 +31,9 @@ class SecurityLog(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Keyset pagination order for log listings
+    __table_args__ = (db.Index('ix_enhanced_security_logs_created_at_id', 'created_at', 'id'),)
+    
     # Relationships
     user = db.relationship('User', backref='enhanced_security_logs')
     
@@ -417,6 +420,9 @@ class AuditLog(db.Model):
     details = db.Column(db.Text, nullable=True)  # Additional details
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     
+    # Keyset pagination order for log listings
+    __table_args__ = (db.Index('ix_audit_logs_created_at_id', 'created_at', 'id'),)
+    
     # Relationships
     user = db.relationship('User', backref='audit_logs')
     
@@ -0,0 +1,54 @@
+"""
+Normalized tag models shared by stories, gallery items, albums and books
+"""
+from datetime import datetime
+from .extensions import db
+
+class Tag(db.Model):
+    """A single normalized tag"""
+    __tablename__ = 'tags'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # Display form, e.g. 'Dog Park'
+    slug = db.Column(db.String(100), nullable=False, unique=True, index=True)  # Lookup key, e.g. 'dog park'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'slug': self.slug
+        }
+
+    def __repr__(self):
+        return f'<Tag {self.slug}>'
+
+# Association tables. The primary key serves lookups by object, the
+# secondary (tag_id, object_id) index serves tag filters and tag counts.
+story_tags = db.Table(
+    'story_tags',
+    db.Column('story_id', db.Integer, db.ForeignKey('stories.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_story_tags_tag_id', 'tag_id', 'story_id')
+)
+
+gallery_item_tags = db.Table(
+    'gallery_item_tags',
+    db.Column('gallery_item_id', db.Integer, db.ForeignKey('gallery_items.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_gallery_item_tags_tag_id', 'tag_id', 'gallery_item_id')
+)
+
+gallery_album_tags = db.Table(
+    'gallery_album_tags',
+    db.Column('album_id', db.Integer, db.ForeignKey('gallery_albums.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_gallery_album_tags_tag_id', 'tag_id', 'album_id')
+)
+
+book_tags = db.Table(
+    'book_tags',
+    db.Column('book_id', db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_book_tags_tag_id', 'tag_id', 'book_id')
+)
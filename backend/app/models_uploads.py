@@ -0,0 +1,60 @@
+"""
+Resumable (chunked) upload sessions and content-addressed media files
+"""
+from datetime import datetime
+from .extensions import db
+
+class UploadSession(db.Model):
+    """A file being uploaded in chunks; the bytes live in a partial file until finalized"""
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, used in the upload URL
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    purpose = db.Column(db.String(20), nullable=False)  # gallery, story
+    filename = db.Column(db.String(255), nullable=False)  # Client's original file name
+    file_ext = db.Column(db.String(10), nullable=False)
+    file_type = db.Column(db.String(10), nullable=False)  # image, video, document
+    mime_type = db.Column(db.String(100), nullable=True)
+    length = db.Column(db.BigInteger, nullable=False)  # Declared total size in bytes
+    offset = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes received so far
+    status = db.Column(db.String(20), nullable=False, default='uploading')  # uploading, complete, finalizing
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    user = db.relationship('User')
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.length
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'purpose': self.purpose,
+            'filename': self.filename,
+            'file_type': self.file_type,
+            'length': self.length,
+            'offset': self.offset,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'expires_at': self.expires_at.isoformat()
+        }
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.offset}/{self.length}>'
+
+
+class MediaBlob(db.Model):
+    """A stored file, named by the SHA-256 of its content; see ``app.utils.media_store``"""
+    __tablename__ = 'media_blobs'
+
+    digest = db.Column(db.String(64), primary_key=True)  # Hex SHA-256
+    ext = db.Column(db.String(10), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    mime_type = db.Column(db.String(100), nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=1)  # Records using the file; deleted at 0
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<MediaBlob {self.digest[:12]} refs={self.ref_count}>'
@@ -1 +1,230 @@
-# Background tasks (Celery) will go here 
\ No newline at end of file
+"""
+Background tasks.
+
+Each task is registered with ``@task`` from ``app.utils.job_queue`` and runs
+in a ``manage.py worker`` process. Routes call ``<task>.enqueue(...)``. The
+bulk actions are also called inline for small batches; queued ones get the
+admin's ``client`` (ip_address, user_agent) for the audit log, since a worker
+has no request to read it from.
+"""
+import logging
+from datetime import datetime
+
+from flask import current_app
+
+from .extensions import db
+from .models import User, GalleryItem, Tour
+from .models_jobs import Job
+from .utils.job_queue import task, JobQueue, PermanentJobError
+from .utils.media_store import delete_gallery_item
+
+logger = logging.getLogger(__name__)
+
+
+def _log_bulk_action(actor_id, event, message, client):
+    from .auth.utils import TokenManager
+    client = client or {}
+    TokenManager.log_security_event(actor_id, event, message,
+                                    ip_address=client.get('ip_address'), user_agent=client.get('user_agent'))
+
+
+@task('bulk.gallery', queue='bulk')
+def bulk_gallery_action(action, item_ids, actor_id, client=None):
+    """Apply an admin bulk action to gallery items; returns the number affected"""
+    success_count = 0
+    for item in GalleryItem.query.filter(GalleryItem.id.in_(item_ids)).all():
+        try:
+            if action == 'activate':
+                item.status = 'active'
+            elif action == 'deactivate':
+                item.status = 'inactive'
+            elif action == 'delete':
+                delete_gallery_item(item)
+            elif action == 'feature':
+                # If GalleryItem model has featured field
+                if hasattr(item, 'featured'):
+                    item.featured = True
+            elif action == 'unfeature':
+                if hasattr(item, 'featured'):
+                    item.featured = False
+            else:
+                continue
+
+            success_count += 1
+        except Exception as e:
+            logger.error(f"Bulk action error for gallery item {item.id}: {str(e)}")
+            continue
+
+    db.session.commit()
+    _log_bulk_action(actor_id, 'bulk_gallery_action', f'Performed "{action}" on {success_count} gallery items',
+                     client)
+    return {'affected_count': success_count}
+
+
+@task('bulk.tours', queue='bulk')
+def bulk_tour_action(action, item_ids, actor_id, client=None):
+    """Apply an admin bulk action to tours; returns the number affected"""
+    success_count = 0
+    for tour in Tour.query.filter(Tour.id.in_(item_ids)).all():
+        try:
+            if action == 'activate':
+                tour.status = 'active'
+            elif action == 'deactivate':
+                tour.status = 'inactive'
+            elif action == 'delete':
+                db.session.delete(tour)
+            elif action == 'feature':
+                # If Tour model has featured field
+                if hasattr(tour, 'featured'):
+                    tour.featured = True
+            elif action == 'unfeature':
+                if hasattr(tour, 'featured'):
+                    tour.featured = False
+            else:
+                continue
+
+            success_count += 1
+        except Exception as e:
+            logger.error(f"Bulk action error for tour {tour.id}: {str(e)}")
+            continue
+
+    db.session.commit()
+    _log_bulk_action(actor_id, 'bulk_tour_action', f'Performed "{action}" on {success_count} tours',
+                     client)
+    return {'affected_count': success_count}
+
+
+@task('bulk.users', queue='bulk')
+def bulk_user_action(action, item_ids, actor_id, client=None):
+    """Apply a super-admin bulk action to users; returns the number affected"""
+    success_count = 0
+    for target_user in User.query.filter(User.id.in_(item_ids)).all():
+        try:
+            # Prevent actions on super admins by other admins
+            if target_user.admin_level == 'super_admin' and target_user.id != actor_id:
+                continue
+
+            if action == 'activate':
+                target_user.is_active = True
+            elif action == 'deactivate':
+                target_user.is_active = False
+            elif action == 'verify':
+                target_user.email_verified = True
+            elif action == 'unverify':
+                target_user.email_verified = False
+            else:
+                continue
+
+            success_count += 1
+        except Exception as e:
+            logger.error(f"Bulk action error for user {target_user.id}: {str(e)}")
+            continue
+
+    db.session.commit()
+    _log_bulk_action(actor_id, 'bulk_user_action', f'Performed "{action}" on {success_count} users',
+                     client)
+    return {'affected_count': success_count}
+
+
+@task('related.refresh')
+def refresh_related_stories(story_ids):
+    """Recompute the related-stories graph around stories that changed"""
+    from .utils.related_content import RelatedContent
+    RelatedContent.refresh(story_ids)
+    return {'stories': len(story_ids)}
+
+
+@task('email.deliver', queue='email', priority=5)
+def deliver_outbox():
+    """Send everything due in the email outbox, then schedule the next retry"""
+    from .utils.mail_outbox import MailOutbox
+    totals = MailOutbox.deliver_pending()
+    retry_at = MailOutbox.next_retry_at()
+    already_queued = Job.query.filter_by(name=deliver_outbox.name, status='queued').first()
+    if retry_at is not None and already_queued is None:
+        delay = max(0, (retry_at - datetime.utcnow()).total_seconds())
+        deliver_outbox.enqueue(delay=delay)
+    return totals
+
+
+@task('video.probe', queue='video', priority=5, max_attempts=3)
+def probe_stored_video(target, object_id, file_path, rel_path):
+    """Read a stored video's metadata and poster frame, then release it from processing"""
+    from .utils.video_processing import video_processor
+    video_processor.process(target, object_id, file_path, rel_path)
+
+
+@task('video.transcode', queue='video', max_attempts=2, lease_seconds=900)
+def transcode_video(target, object_id, file_path, rel_path):
+    """Encode the MP4 and HLS ladder of a stored video"""
+    from .utils.video_processing import VideoProcessingError
+    from .utils.video_transcode import run_transcode
+    try:
+        result = run_transcode(target, object_id, file_path, rel_path)
+    except VideoProcessingError as e:
+        # ffmpeg fails the same way on the same file
+        raise PermanentJobError(str(e)) from e
+    return {'renditions': len(result['renditions'])} if result else None
+
+
+@task('analytics.rollup', queue='maintenance', priority=-5)
+def rollup_analytics():
+    """Fold closed hours into the analytics rollups, then schedule the next run"""
+    from .utils.analytics_rollups import AnalyticsRollups
+    rolled = AnalyticsRollups.refresh()
+    already_queued = Job.query.filter_by(name=rollup_analytics.name, status='queued').first()
+    if already_queued is None:
+        rollup_analytics.enqueue(delay=AnalyticsRollups.next_run_delay())
+    return rolled
+
+
+@task('maintenance.reconcile_counters', queue='maintenance', priority=-10, lease_seconds=1800)
+def reconcile_counters(batch_size=500):
+    """Repair drifted like and comment counters, then schedule the next run"""
+    from .utils.like_counters import CounterReconciler
+    totals = CounterReconciler.run(batch_size=batch_size)
+    already_queued = Job.query.filter_by(name=reconcile_counters.name, status='queued').first()
+    if already_queued is None:
+        reconcile_counters.enqueue(delay=current_app.config.get('COUNTER_RECONCILE_INTERVAL', 86400),
+                                   batch_size=batch_size)
+    return totals
+
+
+@task('maintenance.archive_analytics', queue='maintenance', priority=-10, lease_seconds=1800)
+def archive_analytics(older_than_days=None):
+    """Move raw analytics rows past retention into the archive"""
+    from datetime import timedelta
+    from .utils.analytics_archive import archive_all
+    older_than = datetime.utcnow() - timedelta(days=older_than_days) if older_than_days else None
+    return archive_all(older_than)
+
+
+@task('maintenance.purge_uploads', queue='maintenance', priority=-10)
+def purge_expired_uploads():
+    """Delete expired resumable uploads"""
+    from .utils.resumable_upload import ResumableUploads
+    return {'removed': ResumableUploads.purge_expired()}
+
+
+@task('maintenance.purge_jobs', queue='maintenance', priority=-10)
+def purge_finished_jobs(older_than_days=7):
+    """Delete old succeeded jobs"""
+    return {'removed': JobQueue.purge(older_than_days)}
+
+
+@task('maintenance.purge_email', queue='maintenance', priority=-10)
+def purge_sent_email(older_than_days=30):
+    """Delete old sent messages from the email outbox"""
+    from .utils.mail_outbox import MailOutbox
+    return {'removed': MailOutbox.purge(older_than_days)}
+
+
+@task('maintenance.release_stuck_videos', queue='maintenance', priority=-5)
+def release_stuck_videos():
+    """Show gallery videos whose processing never finished; repeats while any are processing"""
+    from .utils.video_processing import video_processor
+    released, remaining = video_processor.release_stuck()
+    already_queued = Job.query.filter_by(name=release_stuck_videos.name, status='queued').first()
+    if remaining and already_queued is None:
+        release_stuck_videos.enqueue(delay=video_processor.app.config.get('VIDEO_PROCESSING_STUCK_AFTER', 3600))
+    return {'released': released, 'processing': remaining}
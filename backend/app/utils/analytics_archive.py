@@ -0,0 +1,265 @@
+"""
+Cold storage for aged analytics rows.
+
+Raw events, page views, content interactions, heatmap samples and
+performance metrics used to stay in the primary database forever. Every
+scan paid for the history, and SQLite files kept growing. ``archive()``
+moves rows older than ``ANALYTICS_RETENTION_DAYS`` into compressed
+per-month files under ``ANALYTICS_ARCHIVE_DIR``::
+
+    <table>/<YYYY-MM>/part-<timestamp>.parquet   (pyarrow installed)
+    <table>/<YYYY-MM>/part-<timestamp>.csv.gz    (otherwise)
+
+Rows go in batches of ``ANALYTICS_ARCHIVE_BATCH_SIZE``. A part file is
+written under a temporary name, the batch is deleted, and the file is moved
+into place just before the delete commits. A crash in that short window can
+leave a batch both archived and in the database, but rows are never lost.
+
+``iter_archived`` streams archived rows back for a date range; the export and
+the rollups read archived months through it, so they look the same as live
+rows to callers.
+"""
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, delete
+
+from ..extensions import db
+from ..models_analytics import AnalyticsEvent, PageView, ContentInteraction, HeatmapData, PerformanceMetric
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# archive name -> (model, time column)
+ARCHIVED_TABLES = {
+    'events': (AnalyticsEvent, 'created_at'),
+    'pageviews': (PageView, 'created_at'),
+    'interactions': (ContentInteraction, 'created_at'),
+    'heatmap': (HeatmapData, 'created_at'),
+    'performance': (PerformanceMetric, 'created_at'),
+}
+
+_EXTENSIONS = ('.parquet', '.csv.gz')
+
+
+def archive_root():
+    return (current_app.config.get('ANALYTICS_ARCHIVE_DIR')
+            or os.path.join(current_app.instance_path, 'analytics_archive'))
+
+
+def _month(moment):
+    return moment.strftime('%Y-%m')
+
+
+def _months_between(start, end):
+    """``YYYY-MM`` names of the months overlapping ``[start, end)``"""
+    year, month = start.year, start.month
+    while datetime(year, month, 1) < end:
+        yield f"{year:04d}-{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _kind(column):
+    """How a column is stored in an archive file and converted back"""
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        pass
+    if isinstance(column.type, db.JSON) or python_type in (dict, list):
+        return 'json'
+    if python_type is datetime:
+        return 'datetime'
+    if python_type is bool:
+        return 'bool'
+    if python_type is int:
+        return 'int'
+    if python_type is float:
+        return 'float'
+    return 'str'
+
+
+# ----------------------------------------------------------------------
+# Writing
+# ----------------------------------------------------------------------
+
+def _write_parquet(path, table, rows):
+    types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'bool': pyarrow.bool_(),
+             'datetime': pyarrow.timestamp('us'), 'json': pyarrow.string(), 'str': pyarrow.string()}
+    kinds = {column.name: _kind(column) for column in table.columns}
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in kinds.items()])
+    columns = {name: [json.dumps(row[name]) if kind == 'json' and row[name] is not None else row[name]
+                      for row in rows]
+               for name, kind in kinds.items()}
+    parquet.write_table(pyarrow.Table.from_pydict(columns, schema=schema), path, compression='zstd')
+
+
+def _write_csv(path, table, rows):
+    kinds = {column.name: _kind(column) for column in table.columns}
+    with gzip.open(path, 'wt', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(kinds)
+        for row in rows:
+            writer.writerow([_to_text(row[name], kind) for name, kind in kinds.items()])
+
+
+def _to_text(value, kind):
+    if value is None:
+        return ''  # Archived strings can't tell '' from NULL; NULL is by far the common case
+    if kind == 'json':
+        return json.dumps(value)
+    if kind == 'datetime':
+        return value.isoformat()
+    if kind == 'bool':
+        return '1' if value else '0'
+    return value
+
+
+def _write_part(directory, table, rows):
+    """Write rows to a new part file under a temporary name; returns (temp, final) paths"""
+    os.makedirs(directory, exist_ok=True)
+    extension = '.parquet' if PYARROW_AVAILABLE else '.csv.gz'
+    final = os.path.join(directory, f"part-{time.time_ns()}-{os.getpid()}{extension}")
+    temp = f"{final}.part"
+    if PYARROW_AVAILABLE:
+        _write_parquet(temp, table, rows)
+    else:
+        _write_csv(temp, table, rows)
+    return temp, final
+
+
+def archive(name, older_than=None, batch_size=None):
+    """
+    Move one table's rows older than ``older_than`` (default: the retention
+    cutoff) into the archive. Returns the number of rows archived.
+    """
+    model, time_name = ARCHIVED_TABLES[name]
+    config = current_app.config
+    if older_than is None:
+        older_than = datetime.utcnow() - timedelta(days=config.get('ANALYTICS_RETENTION_DAYS', 180))
+    batch_size = batch_size or config.get('ANALYTICS_ARCHIVE_BATCH_SIZE', 5000)
+    table = model.__table__
+    time_column = table.c[time_name]
+    root = os.path.join(archive_root(), name)
+
+    archived = 0
+    while True:
+        rows = [dict(row._mapping) for row in db.session.execute(
+            select(table).where(time_column < older_than).order_by(time_column, table.c.id).limit(batch_size))]
+        if not rows:
+            break
+
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(_month(row[time_name]), []).append(row)
+        parts = []
+        try:
+            for month, month_rows in by_month.items():
+                parts.append(_write_part(os.path.join(root, month), table, month_rows))
+            ids = [row['id'] for row in rows]
+            db.session.execute(delete(table).where(table.c.id.in_(ids)))
+            for temp, final in parts:
+                os.replace(temp, final)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for temp, final in parts:
+                for path in (temp, final):
+                    if os.path.exists(path):
+                        os.remove(path)
+            raise
+        archived += len(rows)
+        logger.info(f"Archived {len(rows)} {name} rows up to {rows[-1][time_name]}")
+    return archived
+
+
+def archive_all(older_than=None):
+    """Archive every table; returns rows archived per table"""
+    return {name: archive(name, older_than) for name in ARCHIVED_TABLES}
+
+
+# ----------------------------------------------------------------------
+# Reading
+# ----------------------------------------------------------------------
+
+def archived_months(name):
+    directory = os.path.join(archive_root(), name)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(month for month in os.listdir(directory) if len(month) == 7)
+
+
+def archive_start(name):
+    """Start of the earliest archived month of a table, or None"""
+    months = archived_months(name)
+    return datetime.strptime(months[0], '%Y-%m') if months else None
+
+
+def _part_files(name, month):
+    directory = os.path.join(archive_root(), name, month)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, part) for part in os.listdir(directory) if part.endswith(_EXTENSIONS))
+
+
+def _from_text(value, kind):
+    if value == '':
+        return None
+    if kind == 'json':
+        return json.loads(value)
+    if kind == 'datetime':
+        return datetime.fromisoformat(value)
+    if kind == 'bool':
+        return value == '1'
+    if kind == 'int':
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    return value
+
+
+def _read_part(path, table, columns, batch_size):
+    """Yield ``{column: value}`` dicts from one part file"""
+    kinds = {column.name: _kind(column) for column in table.columns}
+    if path.endswith('.parquet'):
+        if not PYARROW_AVAILABLE:
+            raise RuntimeError(f"pyarrow is needed to read {path}")
+        for batch in parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+            for row in batch.to_pylist():
+                yield {name: json.loads(value) if kinds[name] == 'json' and value is not None else value
+                       for name, value in row.items()}
+        return
+    with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield {name: _from_text(row.get(name, ''), kinds[name]) for name in columns}
+
+
+def iter_archived(name, columns, start, end=None, batch_size=1000):
+    """
+    Yield ``[column values]`` for archived rows of a table in ``[start, end)``,
+    month by month in archive order. ``columns`` are database column names.
+    """
+    model, time_name = ARCHIVED_TABLES[name]
+    table = model.__table__
+    end = end or datetime.utcnow()
+    wanted = list(dict.fromkeys(list(columns) + [time_name]))
+    available = set(archived_months(name))
+    for month in _months_between(start, end):
+        if month not in available:
+            continue
+        for path in _part_files(name, month):
+            for row in _read_part(path, table, wanted, batch_size):
+                if start <= row[time_name] < end:
+                    yield [row[column] for column in columns]
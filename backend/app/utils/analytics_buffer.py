@@ -0,0 +1,434 @@
+"""
+Write-behind buffer for analytics beacons.
+
+Every tracked event, page view, content interaction and performance sample
+used to be its own INSERT and COMMIT, and a page view also loaded and
+committed its ``UserSession`` row, so a single page load cost four or more
+write transactions. ``analytics_buffer.add`` instead appends the rows to an
+in-process buffer, and a background thread writes everything buffered as one
+transaction: a multi-row INSERT per table plus one batched upsert of the
+touched sessions. A flush happens every ``ANALYTICS_FLUSH_INTERVAL_MS`` or as
+soon as ``ANALYTICS_FLUSH_THRESHOLD`` rows are waiting.
+
+The buffer is bounded by ``ANALYTICS_BUFFER_MAX``. When it is full new rows
+are refused rather than queued, so a burst of beacons or a slow database sheds
+analytics instead of memory or request time. Analytics are lossy by nature:
+rows that can't be written when a worker shuts down are logged and dropped.
+
+The row builders coerce every field to its column's type and raise
+ValueError for values that don't fit, so the tracking routes can reject a bad
+beacon before it is buffered. If a batch insert still fails for anything but
+an unavailable database, the flush writes the batch row by row and drops the
+rows the database refuses, so one bad row can't block the rows behind it.
+"""
+import os
+import json
+import math
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.exc import OperationalError
+
+from ..extensions import db
+from ..models_analytics import AnalyticsEvent, PageView, ContentInteraction, PerformanceMetric, UserSession
+
+logger = logging.getLogger(__name__)
+
+# record kind -> table
+TABLES = {
+    'event': AnalyticsEvent.__table__,
+    'pageview': PageView.__table__,
+    'interaction': ContentInteraction.__table__,
+    'performance': PerformanceMetric.__table__,
+}
+
+# Session columns taken from the first page view of a session in a flush
+SESSION_FIELDS = ('user_id', 'ip_address', 'user_agent', 'device_type', 'browser', 'os', 'landing_page')
+
+
+class AnalyticsBuffer:
+    """Collects analytics rows and bulk-inserts them in batches"""
+
+    def __init__(self):
+        self.app = None
+        self._rows = {kind: [] for kind in TABLES}
+        self._sessions = {}  # session_id -> {'fields', 'page_views', 'first_activity', 'last_activity'}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        self.app = app
+        app.extensions['analytics_buffer'] = self
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('ANALYTICS_BUFFER_ENABLED', True)
+
+    def add(self, records):
+        """
+        Buffer ``(kind, row)`` records; a ``('session', {...})`` record counts
+        a page view against its ``UserSession``. All of them are accepted or,
+        if the buffer is full, none are. Returns True if accepted.
+        """
+        records = list(records)
+        for kind, _ in records:
+            if kind not in TABLES and kind != 'session':
+                raise KeyError(f"Unknown analytics record: {kind}")
+        if not self.enabled:
+            rows, sessions = self._empty_batch()
+            self._merge(rows, sessions, records)
+            self._apply(rows, sessions)
+            return True
+
+        self._ensure_flusher()
+        with self._lock:
+            if self._size + len(records) > self.app.config.get('ANALYTICS_BUFFER_MAX', 10000):
+                return False
+            self._merge(self._rows, self._sessions, records)
+            self._size += len(records)
+            size = self._size
+        if size >= self.app.config.get('ANALYTICS_FLUSH_THRESHOLD', 500):
+            self._wake.set()
+        return True
+
+    def pending(self):
+        with self._lock:
+            return self._size
+
+    @staticmethod
+    def _empty_batch():
+        return {kind: [] for kind in TABLES}, {}
+
+    @staticmethod
+    def _merge(rows, sessions, records):
+        for kind, row in records:
+            if kind != 'session':
+                rows[kind].append(row)
+                continue
+            touch = sessions.get(row['session_id'])
+            if touch is None:
+                sessions[row['session_id']] = {
+                    'fields': {field: row.get(field) for field in SESSION_FIELDS},
+                    'page_views': 1,
+                    'first_activity': row['last_activity'],
+                    'last_activity': row['last_activity'],
+                }
+            else:
+                touch['page_views'] += 1
+                touch['first_activity'] = min(touch['first_activity'], row['last_activity'])
+                touch['last_activity'] = max(touch['last_activity'], row['last_activity'])
+
+    # ------------------------------------------------------------------
+    # Flushing
+    # ------------------------------------------------------------------
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of records written"""
+        with self._lock:
+            rows, sessions, size = self._rows, self._sessions, self._size
+            self._rows, self._sessions = self._empty_batch()
+            self._size = 0
+        if not size:
+            return 0
+        with self.app.app_context():
+            try:
+                self._apply(rows, sessions)
+            except OperationalError as e:
+                # The database is unreachable or locked: try the whole batch again later
+                logger.error(f"Analytics flush failed, keeping {size} records buffered: {str(e)}")
+                self._requeue(rows, sessions, size)
+                return 0
+            except Exception as e:
+                logger.error(f"Analytics batch insert failed, writing {size} records one by one: {str(e)}")
+                return self._apply_each(rows, sessions, size)
+        return size
+
+    def shutdown(self):
+        """Stop the flusher and write out what is buffered"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.app is None:
+            return
+        self.flush()
+        with self._lock:
+            dropped, self._size = self._size, 0
+            self._rows, self._sessions = self._empty_batch()
+        if dropped:
+            logger.warning(f"Dropped {dropped} unwritten analytics records at shutdown")
+
+    def _apply(self, rows, sessions):
+        with db.engine.begin() as connection:
+            for kind, batch in rows.items():
+                if batch:
+                    # executemany: one statement, one round trip per table
+                    connection.execute(TABLES[kind].insert(), batch)
+            if sessions:
+                self._apply_sessions(connection, sessions)
+
+    def _apply_each(self, rows, sessions, size):
+        """Write a failed batch one record at a time, dropping the records the database refuses"""
+        singles = [({kind: [row]}, {}, 1) for kind, batch in rows.items() for row in batch]
+        singles += [({}, {session_id: touch}, touch['page_views']) for session_id, touch in sessions.items()]
+        written = 0
+        for single_rows, single_sessions, count in singles:
+            try:
+                self._apply(single_rows, single_sessions)
+                written += count
+            except Exception as e:
+                logger.warning(f"Dropping analytics record the database refused: {str(e)}")
+        if written < size:
+            logger.error(f"Dropped {size - written} analytics records that could not be written")
+        return written
+
+    @staticmethod
+    def _apply_sessions(connection, sessions):
+        table = UserSession.__table__
+        session_ids = sorted(sessions)
+        new_rows = [dict(sessions[session_id]['fields'], session_id=session_id, page_views=0,
+                         total_duration=0, is_bounce=False, is_conversion=False,
+                         started_at=sessions[session_id]['first_activity'],
+                         last_activity=sessions[session_id]['last_activity'])
+                    for session_id in session_ids]
+
+        # Create missing sessions; another worker may create the same one first
+        insert = _insert_ignoring_duplicates(connection, table)
+        if insert is not None:
+            connection.execute(insert, new_rows)
+        else:
+            existing = set(connection.execute(
+                select(table.c.session_id).where(table.c.session_id.in_(session_ids))).scalars())
+            missing = [row for row in new_rows if row['session_id'] not in existing]
+            if missing:
+                connection.execute(table.insert(), missing)
+
+        started = dict(connection.execute(
+            select(table.c.session_id, table.c.started_at).where(table.c.session_id.in_(session_ids))).all())
+        updates = []
+        for session_id in session_ids:
+            touch = sessions[session_id]
+            started_at = started.get(session_id) or touch['first_activity']
+            updates.append({
+                'b_session_id': session_id,
+                'b_page_views': touch['page_views'],
+                'b_last_activity': touch['last_activity'],
+                'b_total_duration': max(0, int((touch['last_activity'] - started_at).total_seconds())),
+            })
+        statement = (table.update()
+                     .where(table.c.session_id == bindparam('b_session_id'))
+                     .values(page_views=func.coalesce(table.c.page_views, 0) + bindparam('b_page_views'),
+                             last_activity=bindparam('b_last_activity'),
+                             total_duration=bindparam('b_total_duration')))
+        # Consistent row order keeps concurrent flushes from deadlocking
+        connection.execute(statement, updates)
+
+    def _requeue(self, rows, sessions, size):
+        limit = self.app.config.get('ANALYTICS_BUFFER_MAX', 10000)
+        with self._lock:
+            if self._size + size > limit:
+                logger.error(f"Analytics buffer full, dropping {size} records from a failed flush")
+                return
+            for kind, batch in rows.items():
+                self._rows[kind][:0] = batch
+            for session_id, touch in sessions.items():
+                current = self._sessions.get(session_id)
+                if current is None:
+                    self._sessions[session_id] = touch
+                else:
+                    current['fields'] = touch['fields']
+                    current['page_views'] += touch['page_views']
+                    current['first_activity'] = min(current['first_activity'], touch['first_activity'])
+                    current['last_activity'] = max(current['last_activity'], touch['last_activity'])
+            self._size += size
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: the parent's rows are the parent's to write
+                self._rows, self._sessions = self._empty_batch()
+                self._size = 0
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='analytics-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        interval = self.app.config.get('ANALYTICS_FLUSH_INTERVAL_MS', 1000) / 1000
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.flush()
+
+
+def _insert_ignoring_duplicates(connection, table):
+    """An INSERT that skips rows whose session_id already exists, where the dialect has one"""
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing(index_elements=['session_id'])
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing(index_elements=['session_id'])
+    if dialect in ('mysql', 'mariadb'):
+        return table.insert().prefix_with('IGNORE')
+    return None
+
+
+def _clean_value(column, value):
+    """``value`` coerced to ``column``'s type; raises ValueError if it can't be"""
+    if value is None:
+        if not column.nullable:
+            raise ValueError(f"{column.name} is required")
+        return None
+    kind = column.type
+    if isinstance(kind, db.JSON):
+        try:
+            json.dumps(value, allow_nan=False)
+        except (TypeError, ValueError):
+            raise ValueError(f"{column.name} must be JSON")
+        return value
+    if isinstance(kind, db.DateTime):
+        if not isinstance(value, datetime):
+            raise ValueError(f"{column.name} must be a datetime")
+        return value
+    if isinstance(kind, db.Boolean):
+        if not isinstance(value, bool):
+            raise ValueError(f"{column.name} must be a boolean")
+        return value
+    if isinstance(kind, (db.Integer, db.Float)):
+        number = None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            number = value
+        elif isinstance(value, str):
+            try:
+                number = float(value.strip())
+            except ValueError:
+                pass
+        if number is None or not math.isfinite(number):
+            raise ValueError(f"{column.name} must be a number")
+        if isinstance(kind, db.Float):
+            return float(number)
+        if abs(number) >= 2 ** 31:
+            raise ValueError(f"{column.name} is out of range")
+        return int(number)
+    if isinstance(kind, db.String):
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ValueError(f"{column.name} must be a string")
+        value = str(value)
+        return value[:kind.length] if kind.length else value
+    return value
+
+
+def _clean(table, row):
+    """``row`` with every value coerced to its column's type"""
+    return {name: _clean_value(table.c[name], value) for name, value in row.items()}
+
+
+def event_row(data, user_id, ip_address, user_agent, created_at=None):
+    """An ``enhanced_analytics_events`` row from a tracked event"""
+    return _clean(TABLES['event'], {
+        'user_id': user_id,
+        'session_id': data.get('session_id') or 'anonymous',
+        'event_type': data['event_type'],
+        'event_category': data['event_category'],
+        'event_action': data['event_action'],
+        'event_label': data.get('event_label'),
+        'page_url': data.get('page_url'),
+        'referrer_url': data.get('referrer_url'),
+        'user_agent': user_agent,
+        'ip_address': ip_address,
+        'device_type': data.get('device_type'),
+        'browser': data.get('browser'),
+        'os': data.get('os'),
+        'screen_resolution': data.get('screen_resolution'),
+        'country': data.get('country'),
+        'city': data.get('city'),
+        'duration': data.get('duration'),
+        'event_metadata': data.get('metadata'),
+        'created_at': created_at or datetime.utcnow(),
+    })
+
+
+def pageview_records(data, user_id, ip_address, user_agent, created_at=None):
+    """The page view row and the session touch for a tracked page view"""
+    created_at = created_at or datetime.utcnow()
+    session_id = data.get('session_id') or 'anonymous'
+    device_info = data.get('device_info') if isinstance(data.get('device_info'), dict) else {}
+    return [
+        ('pageview', _clean(TABLES['pageview'], {
+            'user_id': user_id,
+            'session_id': session_id,
+            'page_url': data['page_url'],
+            'page_title': data.get('page_title'),
+            'referrer_url': data.get('referrer_url'),
+            'time_on_page': data.get('time_on_page'),
+            'bounce': False,
+            'exit_page': False,
+            'device_info': data.get('device_info'),
+            'location_info': data.get('location_info'),
+            'created_at': created_at,
+        })),
+        ('session', _clean(UserSession.__table__, {
+            'session_id': session_id,
+            'user_id': user_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'device_type': device_info.get('type'),
+            'browser': device_info.get('browser'),
+            'os': device_info.get('os'),
+            'landing_page': data['page_url'],
+            'last_activity': created_at,
+        })),
+    ]
+
+
+def interaction_row(data, user_id, created_at=None):
+    """An ``enhanced_content_interactions`` row from a tracked interaction"""
+    return _clean(TABLES['interaction'], {
+        'user_id': user_id,
+        'content_type': data['content_type'],
+        'content_id': data['content_id'],
+        'interaction_type': data['interaction_type'],
+        'session_id': data.get('session_id') or 'anonymous',
+        'duration': data.get('duration'),
+        'scroll_depth': data.get('scroll_depth'),
+        'click_coordinates': data.get('click_coordinates'),
+        'session_metadata': data.get('metadata'),
+        'created_at': created_at or datetime.utcnow(),
+    })
+
+
+def performance_row(data, created_at=None):
+    """A ``performance_metrics`` row from a performance sample"""
+    return _clean(TABLES['performance'], {
+        'session_id': data.get('session_id') or 'anonymous',
+        'page_url': data['page_url'],
+        'load_time': data.get('load_time'),
+        'dom_content_loaded': data.get('dom_content_loaded'),
+        'first_contentful_paint': data.get('first_contentful_paint'),
+        'largest_contentful_paint': data.get('largest_contentful_paint'),
+        'first_input_delay': data.get('first_input_delay'),
+        'cumulative_layout_shift': data.get('cumulative_layout_shift'),
+        'connection_type': data.get('connection_type'),
+        'server_response_time': data.get('server_response_time'),
+        'created_at': created_at or datetime.utcnow(),
+    })
+
+
+analytics_buffer = AnalyticsBuffer()
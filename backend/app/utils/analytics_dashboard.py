@@ -0,0 +1,167 @@
+"""
+Snapshot assembly for the enhanced analytics dashboard.
+
+The dashboard is about a dozen independent aggregates: user, session, bounce
+and conversion totals, real-time stats, traffic/device/geo breakdowns and
+three popular-content scans. Running them one after another made the page as
+slow as the sum of its queries. ``dashboard_snapshots.get(days)`` instead
+runs each part on a small shared thread pool. Every thread has its own app
+context and so its own session and pooled connection, and
+``ANALYTICS_DASHBOARD_WORKERS`` caps how many connections the dashboard can
+hold at once. The parts are merged into one snapshot.
+
+Snapshots are kept per ``days`` window for ``ANALYTICS_DASHBOARD_TTL``
+seconds. Admins who ask for a window that is already being built wait for
+that build instead of starting their own.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from ..models import Story, GalleryItem, Tour
+from ..models_analytics import ContentInteraction, ConversionEvent, AnalyticsCalculator
+
+logger = logging.getLogger(__name__)
+
+
+def _created_since(model, days):
+    return model.query.filter(model.created_at >= datetime.utcnow() - timedelta(days=days)).count()
+
+
+def _popular(content_type, days):
+    return [{'content_id': row[0], 'interactions': row[1], 'unique_users': row[2]}
+            for row in ContentInteraction.get_popular_content(content_type, days, 5)]
+
+
+def _breakdown(rows, label):
+    return [{label: row[0], 'sessions': row[1], 'users': row[2]} for row in rows]
+
+
+# part name -> function of ``days``; each runs on its own connection
+PARTS = {
+    'total_users': AnalyticsCalculator.get_total_users,
+    'active_users': AnalyticsCalculator.get_active_users,
+    'total_sessions': AnalyticsCalculator.get_total_sessions,
+    'bounce_rate': AnalyticsCalculator.get_bounce_rate,
+    'avg_session_duration': AnalyticsCalculator.get_average_session_duration,
+    'total_stories': lambda days: _created_since(Story, days),
+    'total_gallery_items': lambda days: _created_since(GalleryItem, days),
+    'total_tours': lambda days: _created_since(Tour, days),
+    'total_conversions': lambda days: _created_since(ConversionEvent, days),
+    'conversion_rate': lambda days: AnalyticsCalculator.get_conversion_rate(days=days),
+    'real_time': lambda days: AnalyticsCalculator.get_real_time_stats(),
+    'traffic_sources': lambda days: _breakdown(AnalyticsCalculator.get_traffic_sources(days, 10), 'source'),
+    'device_breakdown': lambda days: _breakdown(AnalyticsCalculator.get_device_breakdown(days), 'device'),
+    'geographic_data': lambda days: _breakdown(AnalyticsCalculator.get_geographic_breakdown(days, 10), 'country'),
+    'popular_stories': lambda days: _popular('story', days),
+    'popular_gallery': lambda days: _popular('gallery_item', days),
+    'popular_tours': lambda days: _popular('tour', days),
+}
+
+OVERVIEW = ('total_users', 'active_users', 'total_sessions', 'bounce_rate', 'avg_session_duration',
+            'total_stories', 'total_gallery_items', 'total_tours', 'total_conversions', 'conversion_rate')
+
+
+class DashboardSnapshots:
+    """Builds dashboard snapshots in parallel and shares them between requests"""
+
+    def __init__(self):
+        self.app = None
+        self._snapshots = {}  # days -> (expires, snapshot)
+        self._building = {}  # days -> Future of the snapshot being built
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        self.app = app
+        app.extensions['dashboard_snapshots'] = self
+
+    def get(self, days):
+        """The dashboard data for the last ``days`` days"""
+        with self._lock:
+            cached = self._snapshots.get(days)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            building = self._building.get(days)
+            leader = building is None
+            if leader:
+                building = self._building[days] = Future()
+
+        if not leader:
+            return building.result(timeout=self.app.config.get('ANALYTICS_DASHBOARD_TIMEOUT', 60))
+
+        try:
+            snapshot = self._build(days)
+        except Exception as e:
+            building.set_exception(e)
+            raise
+        else:
+            building.set_result(snapshot)
+            ttl = self.app.config.get('ANALYTICS_DASHBOARD_TTL', 60)
+            if ttl > 0:
+                with self._lock:
+                    self._snapshots[days] = (time.monotonic() + ttl, snapshot)
+            return snapshot
+        finally:
+            with self._lock:
+                self._building.pop(days, None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def _build(self, days):
+        started = time.monotonic()
+        executor = self._pool()
+        if executor is None:
+            results = {name: part(days) for name, part in PARTS.items()}
+        else:
+            futures = {name: executor.submit(self._run_part, part, days) for name, part in PARTS.items()}
+            timeout = self.app.config.get('ANALYTICS_DASHBOARD_TIMEOUT', 60)
+            results = {name: future.result(timeout=timeout) for name, future in futures.items()}
+        logger.info(f"Built {days}-day analytics dashboard in {time.monotonic() - started:.2f}s")
+
+        return {
+            'overview': {name: results[name] for name in OVERVIEW},
+            'popular_content': {
+                'stories': results['popular_stories'],
+                'gallery': results['popular_gallery'],
+                'tours': results['popular_tours']
+            },
+            'real_time': results['real_time'],
+            'traffic_sources': results['traffic_sources'],
+            'device_breakdown': results['device_breakdown'],
+            'geographic_data': results['geographic_data'],
+            'generated_at': datetime.utcnow().isoformat()
+        }
+
+    def _run_part(self, part, days):
+        # A fresh app context gives this thread its own session and connection
+        with self.app.app_context():
+            return part(days)
+
+    def _pool(self):
+        workers = self.app.config.get('ANALYTICS_DASHBOARD_WORKERS', 3)
+        if workers < 2:
+            return None
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analytics-dashboard')
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait)
+
+
+dashboard_snapshots = DashboardSnapshots()
@@ -0,0 +1,155 @@
+"""
+Streaming export of raw analytics rows.
+
+``/api/analytics/export`` used to load the whole window with ``.all()`` and
+build one JSON list in memory. The export now reads rows in
+``ANALYTICS_EXPORT_BATCH_SIZE`` batches (``yield_per``, a server-side cursor
+where the driver has one) and writes them straight into a streamed response
+as CSV, NDJSON or the legacy JSON envelope, optionally gzipped on the fly.
+Memory use stays flat however many rows are exported. Ranges that reach
+back into archived months (``analytics_archive``) include the archived rows.
+"""
+import io
+import csv
+import json
+import zlib
+from datetime import datetime, date
+
+from sqlalchemy import select
+
+from ..extensions import db
+from ..models_analytics import AnalyticsEvent, PageView, UserSession, ContentInteraction
+from .analytics_archive import ARCHIVED_TABLES, iter_archived
+
+# export type -> (model, time column, default columns)
+EXPORTS = {
+    'events': (AnalyticsEvent, 'created_at',
+               ('id', 'user_id', 'session_id', 'event_type', 'event_category', 'event_action', 'event_label',
+                'page_url', 'referrer_url', 'device_type', 'browser', 'os', 'country', 'city', 'duration',
+                'metadata', 'created_at')),
+    'pageviews': (PageView, 'created_at',
+                  ('id', 'user_id', 'page_url', 'time_on_page', 'created_at')),
+    'sessions': (UserSession, 'started_at',
+                 ('session_id', 'user_id', 'device_type', 'total_duration', 'page_views', 'is_bounce', 'started_at')),
+    'interactions': (ContentInteraction, 'created_at',
+                     ('user_id', 'content_type', 'content_id', 'interaction_type', 'duration', 'created_at')),
+}
+
+# Exported names that differ from the column attribute
+COLUMN_ALIASES = {
+    'events': {'metadata': 'event_metadata'},
+    'interactions': {'metadata': 'session_metadata'},
+}
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'json': ('application/json', 'json'),
+}
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def available_columns(export_type):
+    """Every column name an export type can include"""
+    model, _, _ = EXPORTS[export_type]
+    aliases = COLUMN_ALIASES.get(export_type, {})
+    hidden = set(aliases.values())
+    return [name for name in model.__table__.columns.keys() if name not in hidden] + list(aliases)
+
+
+def resolve_columns(export_type, requested=None):
+    """
+    The columns to export, in order: ``requested`` (a comma-separated string)
+    or the type's defaults. Raises ValueError naming unknown columns.
+    """
+    if not requested:
+        return list(EXPORTS[export_type][2])
+    columns = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in columns if name not in available_columns(export_type)]
+    if unknown:
+        raise ValueError(f"Unknown columns for {export_type}: {', '.join(unknown)}")
+    return columns
+
+
+def iter_rows(export_type, columns, start, end=None, batch_size=1000):
+    """
+    Yield one tuple per row in ``[start, end)``, ``batch_size`` rows per
+    fetch: archived months first, then the live table oldest first.
+    """
+    model, time_name, _ = EXPORTS[export_type]
+    aliases = COLUMN_ALIASES.get(export_type, {})
+    if export_type in ARCHIVED_TABLES:
+        for row in iter_archived(export_type, [aliases.get(name, name) for name in columns], start, end, batch_size):
+            yield tuple(row)
+
+    table = model.__table__
+    time_column = table.c[time_name]
+    statement = select(*[table.c[aliases.get(name, name)] for name in columns]).where(time_column >= start)
+    if end is not None:
+        statement = statement.where(time_column < end)
+    statement = statement.order_by(time_column, *table.primary_key.columns)
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+    for row in result:
+        yield tuple(row)
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _buffered(pieces):
+    """Join small strings into response-sized chunks"""
+    buffer = io.StringIO()
+    for piece in pieces:
+        buffer.write(piece)
+        if buffer.tell() >= _CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def csv_chunks(columns, rows):
+    def lines():
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(columns)
+        yield line.getvalue()
+        for row in rows:
+            line.seek(0)
+            line.truncate()
+            writer.writerow([json.dumps(value) if isinstance(value, (dict, list)) else _plain(value)
+                             for value in row])
+            yield line.getvalue()
+    return _buffered(lines())
+
+
+def ndjson_chunks(columns, rows):
+    return _buffered(json.dumps(dict(zip(columns, map(_plain, row)))) + '\n' for row in rows)
+
+
+def json_chunks(columns, rows, envelope):
+    """The legacy ``{"success": true, ..., "data": [...], "total_records": n}`` body, streamed"""
+    def pieces():
+        head = json.dumps(dict(envelope, success=True))
+        yield head[:-1] + ', "data": ['
+        count = 0
+        for row in rows:
+            yield (', ' if count else '') + json.dumps(dict(zip(columns, map(_plain, row))))
+            count += 1
+        yield f'], "total_records": {count}}}'
+    return _buffered(pieces())
+
+
+def gzip_chunks(chunks):
+    """gzip a stream of text chunks as it goes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
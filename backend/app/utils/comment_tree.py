@@ -0,0 +1,206 @@
+"""
+Threaded comment loading.
+
+Every comment stores a materialized path (its ancestors' zero-padded ids,
+root first, ending with its own), the id of its top-level comment
+(``thread_id``) and its ``depth``. A page of threads is then two queries: the
+top-level comments, and every visible descendant of those threads in path
+order. The nested structure is assembled in memory. Replies are capped per
+thread. ``CommentTree.replies`` continues a thread or subtree from a given
+reply.
+"""
+import logging
+
+from flask import current_app
+from sqlalchemy import event, select, update, func
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ..extensions import db
+from ..models import Comment, User
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_WIDTH = 10
+
+comments = Comment.__table__
+
+
+def path_segment(comment_id):
+    return f"{comment_id:0{SEGMENT_WIDTH}d}/"
+
+
+class CommentTree:
+    """Builds nested comment payloads from the materialized paths"""
+
+    @staticmethod
+    def max_depth():
+        return current_app.config.get('COMMENT_MAX_DEPTH', 8)
+
+    @staticmethod
+    def replies_per_thread():
+        return current_app.config.get('COMMENT_REPLIES_PER_THREAD', 20)
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _serialize(rows):
+        """Serialize comments with their authors loaded in one query"""
+        user_ids = {row.user_id for row in rows}
+        if user_ids:
+            # Populates the identity map so each row's author resolves without SQL
+            User.query.filter(User.id.in_(user_ids)).all()
+        return {row.id: dict(row.to_dict(), depth=row.depth, replies=[]) for row in rows}
+
+    @staticmethod
+    def _nest(nodes, rows, root_ids):
+        """Attach rows (in path order) beneath their parents; returns the top nodes"""
+        for row in rows:
+            if row.id in root_ids:
+                continue
+            parent = nodes.get(row.parent_id)
+            if parent is not None:
+                parent['replies'].append(nodes[row.id])
+            # A reply under a hidden or cut-off comment has nowhere to go and is dropped
+        return [nodes[root_id] for root_id in root_ids if root_id in nodes]
+
+    @staticmethod
+    def threads(roots, max_depth=None, replies_per_thread=None):
+        """
+        Serialize a page of top-level comments with their replies.
+
+        Loads the visible descendants of every thread on the page in one query,
+        at most ``max_depth`` levels deep and ``replies_per_thread`` per thread
+        (in tree order). Each thread reports ``replies_total`` and, when cut
+        short, ``next_replies_after`` for ``CommentTree.replies``.
+        """
+        if not roots:
+            return []
+        max_depth = CommentTree.max_depth() if max_depth is None else max_depth
+        limit = CommentTree.replies_per_thread() if replies_per_thread is None else replies_per_thread
+        root_ids = [root.id for root in roots]
+
+        descendants = []
+        totals = {}
+        if max_depth > 0 and limit > 0:
+            ranked = (select(
+                comments.c.id,
+                func.row_number().over(partition_by=comments.c.thread_id, order_by=comments.c.path).label('position'),
+                func.count().over(partition_by=comments.c.thread_id).label('thread_total'),
+            ).where(
+                comments.c.thread_id.in_(root_ids),
+                comments.c.depth.between(1, max_depth),
+                comments.c.is_active == True
+            ).subquery())
+            rows = (db.session.query(Comment, ranked.c.thread_total)
+                    .join(ranked, ranked.c.id == Comment.id)
+                    .filter(ranked.c.position <= limit)
+                    .order_by(Comment.path)
+                    .all())
+            descendants = [row for row, _ in rows]
+            totals = {row.thread_id: total for row, total in rows}
+
+        nodes = CommentTree._serialize(list(roots) + descendants)
+        shown = {}
+        last_reply = {}
+        for reply in descendants:
+            shown[reply.thread_id] = shown.get(reply.thread_id, 0) + 1
+            last_reply[reply.thread_id] = reply.id
+        for root_id in root_ids:
+            total = totals.get(root_id, 0)
+            nodes[root_id]['replies_total'] = total
+            nodes[root_id]['next_replies_after'] = last_reply[root_id] if shown.get(root_id, 0) < total else None
+
+        return CommentTree._nest(nodes, list(roots) + descendants, root_ids)
+
+    @staticmethod
+    def replies(comment, after=None, limit=None, max_depth=None):
+        """
+        Page through the replies beneath ``comment`` in tree order.
+
+        ``after`` is the id of the last reply already shown. Replies whose
+        parent is on an earlier page start their own subtree in the result.
+        """
+        max_depth = CommentTree.max_depth() if max_depth is None else max_depth
+        limit = CommentTree.replies_per_thread() if limit is None else limit
+        query = Comment.query.filter(
+            Comment.path.startswith(comment.path, autoescape=True),
+            Comment.id != comment.id,
+            Comment.depth <= comment.depth + max_depth,
+            Comment.is_active == True
+        )
+        if after:
+            after_path = db.session.query(Comment.path).filter(Comment.id == after).scalar()
+            if after_path:
+                query = query.filter(Comment.path > after_path)
+        rows = query.order_by(Comment.path).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        nodes = CommentTree._serialize(rows)
+        top_ids = [row.id for row in rows if row.parent_id not in nodes]
+        return {
+            'replies': CommentTree._nest(nodes, rows, top_ids),
+            'next_after': rows[-1].id if has_more else None
+        }
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _lineage(connection, comment_id):
+        """Return ``(path, depth, thread_id)`` for a comment, deriving it if missing"""
+        row = connection.execute(
+            select(comments.c.parent_id, comments.c.path, comments.c.depth, comments.c.thread_id)
+            .where(comments.c.id == comment_id)
+        ).first()
+        if row is None:
+            return None
+        if row.path:
+            return row.path, row.depth, row.thread_id
+        return CommentTree._place(connection, comment_id, row.parent_id)
+
+    @staticmethod
+    def _place(connection, comment_id, parent_id):
+        """Compute and store a comment's path from its parent"""
+        parent = CommentTree._lineage(connection, parent_id) if parent_id else None
+        if parent:
+            parent_path, parent_depth, thread_id = parent
+            lineage = (parent_path + path_segment(comment_id), parent_depth + 1, thread_id)
+        else:
+            lineage = (path_segment(comment_id), 0, comment_id)
+        connection.execute(
+            update(comments).where(comments.c.id == comment_id)
+            .values(path=lineage[0], depth=lineage[1], thread_id=lineage[2])
+        )
+        return lineage
+
+    @staticmethod
+    def backfill(batch_size=500):
+        """Assign paths to comments created before paths were maintained"""
+        total = 0
+        while True:
+            with db.engine.begin() as connection:
+                pending = connection.execute(
+                    select(comments.c.id, comments.c.parent_id)
+                    .where(comments.c.path.is_(None))
+                    .order_by(comments.c.id)
+                    .limit(batch_size)
+                ).all()
+                for comment_id, parent_id in pending:
+                    CommentTree._place(connection, comment_id, parent_id)
+            total += len(pending)
+            if len(pending) < batch_size:
+                break
+        logger.info(f"Comment path backfill: {total} comments placed")
+        return total
+
+
+@event.listens_for(Comment, 'after_insert')
+def _place_inserted(mapper, connection, target):
+    path, depth, thread_id = CommentTree._place(connection, target.id, target.parent_id)
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+    set_committed_value(target, 'thread_id', thread_id)
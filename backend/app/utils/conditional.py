@@ -0,0 +1,88 @@
+"""
+Conditional GET (ETag / Last-Modified) for public catalog endpoints.
+
+``@conditional_get((GalleryItem, GalleryItem.status == 'active'))`` answers
+``If-None-Match`` and ``If-Modified-Since`` with a 304 before the view runs.
+The validator comes from one aggregate query per request: ``max(updated_at)``
+and ``count(*)`` over each source's matching rows, together with the
+``cache_tag_versions`` row for the model's collection tag (see
+``response_cache.MODEL_TAGS``). The tag row moves on every ORM write to the
+model, deletes included, so removing a row can't leave an old validator
+standing. The ETag also covers the path, query arguments and language.
+
+Counters written by Core statements (views, likes) don't change
+``updated_at``, so a 304 can carry counts that are slightly behind.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import request, make_response
+from sqlalchemy import select, func
+
+from ..extensions import db
+from .response_cache import MODEL_TAGS, SUPPORTED_LANGUAGES, tag_versions, is_available
+
+
+def _validator_state(sources):
+    """Return the aggregate state of every source from a single query"""
+    connection = db.session.connection()
+    with_tags = is_available(connection)
+    columns = []
+    for model, *criteria in sources:
+        columns.append(select(func.max(model.updated_at)).where(*criteria).scalar_subquery())
+        columns.append(select(func.count()).select_from(model).where(*criteria).scalar_subquery())
+        if with_tags and model in MODEL_TAGS:
+            tag = MODEL_TAGS[model][0]
+            columns.append(select(tag_versions.c.version).where(tag_versions.c.tag == tag).scalar_subquery())
+            columns.append(select(tag_versions.c.updated_at).where(tag_versions.c.tag == tag).scalar_subquery())
+    return list(connection.execute(select(*columns)).one())
+
+
+def _request_signature():
+    args = sorted((name, value) for name, value in request.args.items(multi=True) if name != 'lang')
+    language = request.args.get('lang', 'en').strip()
+    if language not in SUPPORTED_LANGUAGES:
+        language = 'en'
+    return f"{request.path}?{args!r}|lang={language}"
+
+
+def conditional_get(*sources):
+    """
+    Serve 304 Not Modified when the client's copy is still current.
+
+    Each source is ``(model, *criteria)``; the criteria should select the rows
+    the view can return. On a 200 the response gets ``ETag``,
+    ``Last-Modified`` and ``Cache-Control: no-cache`` so clients revalidate.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+
+            state = _validator_state(sources)
+            fingerprint = '|'.join('' if value is None else str(value) for value in state)
+            etag = hashlib.sha1(f"{_request_signature()}|{fingerprint}".encode()).hexdigest()[:32]
+            timestamps = [value for value in state if hasattr(value, 'isoformat')]
+            last_modified = max(timestamps).replace(tzinfo=timezone.utc, microsecond=0) if timestamps else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and last_modified and last_modified <= since)
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
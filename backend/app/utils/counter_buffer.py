@@ -0,0 +1,209 @@
+"""
+Write-behind buffer for hot counters (views, downloads).
+
+Public view and download endpoints used to load the row, add one in Python
+and commit, which serializes every hit on a single writer and loses updates
+when two requests race. ``counter_buffer.increment`` instead adds to an
+in-process tally, and a background thread periodically applies the tallies
+as batched ``UPDATE ... SET views = views + n`` statements. Increments from
+different gunicorn workers commute, so each worker keeps its own buffer.
+
+Pending increments are flushed when a worker shuts down gracefully; if the
+database can't be reached at that point they are spooled to disk and picked
+up by the next flush in any worker.
+"""
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from sqlalchemy import bindparam, func
+
+from ..extensions import db
+from ..models import Story, GalleryItem
+
+logger = logging.getLogger(__name__)
+
+# counter name -> (table, column)
+COUNTERS = {
+    'story_views': (Story.__table__, 'views'),
+    'gallery_views': (GalleryItem.__table__, 'views'),
+    'gallery_downloads': (GalleryItem.__table__, 'downloads'),
+}
+
+
+class CounterBuffer:
+    """Accumulates counter increments and applies them in batches"""
+
+    def __init__(self):
+        self.app = None
+        self._pending = defaultdict(int)  # (counter, object_id) -> delta
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        self.app = app
+        app.extensions['counter_buffer'] = self
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('COUNTER_BUFFER_ENABLED', True)
+
+    def increment(self, counter, object_id, amount=1):
+        """
+        Add ``amount`` to a counter.
+
+        Returns how far this process has moved the counter past the value
+        currently stored in the database, so callers can report
+        ``stored value + increment(...)``.
+        """
+        if counter not in COUNTERS:
+            raise KeyError(f"Unknown counter: {counter}")
+        key = (counter, object_id)
+        if not self.enabled:
+            self._apply({key: amount})
+            return amount
+
+        self._ensure_flusher()
+        with self._lock:
+            self._pending[key] += amount
+            pending = self._pending[key]
+            backlog = len(self._pending)
+        if backlog >= self.app.config.get('COUNTER_FLUSH_THRESHOLD', 500):
+            self._wake.set()
+        return pending
+
+    def pending(self, counter, object_id):
+        with self._lock:
+            return self._pending.get((counter, object_id), 0)
+
+    # ------------------------------------------------------------------
+    # Flushing
+    # ------------------------------------------------------------------
+
+    def flush(self):
+        """Apply everything buffered so far; returns the number of rows updated"""
+        self._load_spool()
+        with self._lock:
+            batch, self._pending = self._pending, defaultdict(int)
+        if not batch:
+            return 0
+        try:
+            with self.app.app_context():
+                self._apply(batch)
+        except Exception as e:
+            logger.error(f"Counter flush failed, keeping {len(batch)} increments buffered: {str(e)}")
+            self._requeue(batch)
+            return 0
+        return len(batch)
+
+    def shutdown(self):
+        """Stop the flusher and write out pending increments (spooling them on failure)"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._wake.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.app is None:
+            return
+        self.flush()
+        with self._lock:
+            batch, self._pending = self._pending, defaultdict(int)
+        if batch:
+            self._spool(batch)
+
+    def _apply(self, batch):
+        grouped = defaultdict(list)
+        for (counter, object_id), delta in batch.items():
+            if delta:
+                grouped[counter].append({'object_id': object_id, 'delta': delta})
+
+        with db.engine.begin() as connection:
+            for counter, rows in grouped.items():
+                table, column = COUNTERS[counter]
+                statement = (table.update()
+                             .where(table.c.id == bindparam('object_id'))
+                             .values({column: func.coalesce(table.c[column], 0) + bindparam('delta')}))
+                # Consistent row order keeps concurrent flushes from deadlocking
+                connection.execute(statement, sorted(rows, key=lambda row: row['object_id']))
+
+    def _requeue(self, batch):
+        with self._lock:
+            for key, delta in batch.items():
+                self._pending[key] += delta
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: the parent's tally is the parent's to flush
+                self._pending = defaultdict(int)
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='counter-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        interval = self.app.config.get('COUNTER_FLUSH_INTERVAL', 5)
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.flush()
+
+    # ------------------------------------------------------------------
+    # Spool (increments that couldn't be written at shutdown)
+    # ------------------------------------------------------------------
+
+    def _spool_dir(self):
+        return self.app.config.get('COUNTER_SPOOL_DIR') or os.path.join(self.app.instance_path, 'counter_spool')
+
+    def _spool(self, batch):
+        try:
+            spool_dir = self._spool_dir()
+            os.makedirs(spool_dir, exist_ok=True)
+            path = os.path.join(spool_dir, f"{os.getpid()}-{time.time_ns()}.json")
+            with open(path + '.tmp', 'w') as f:
+                json.dump([[counter, object_id, delta] for (counter, object_id), delta in batch.items()], f)
+            os.replace(path + '.tmp', path)
+            logger.warning(f"Spooled {len(batch)} unflushed counter increments to {path}")
+        except Exception as e:
+            logger.error(f"Could not spool {len(batch)} counter increments: {str(e)}")
+
+    def _load_spool(self):
+        if self.app is None:
+            return
+        spool_dir = self._spool_dir()
+        if not os.path.isdir(spool_dir):
+            return
+        for name in sorted(os.listdir(spool_dir)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(spool_dir, name)
+            claimed = f"{path}.{os.getpid()}.claimed"
+            try:
+                os.rename(path, claimed)  # Another worker may claim it first
+            except OSError:
+                continue
+            try:
+                with open(claimed) as f:
+                    entries = json.load(f)
+                self._requeue({(counter, object_id): delta for counter, object_id, delta in entries
+                               if counter in COUNTERS})
+                os.remove(claimed)
+            except Exception as e:
+                logger.error(f"Could not load counter spool {claimed}: {str(e)}")
+
+
+counter_buffer = CounterBuffer()
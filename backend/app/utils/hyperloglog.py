@@ -0,0 +1,77 @@
+"""
+HyperLogLog sketches for approximate distinct counts.
+
+A sketch of precision ``p`` keeps ``m = 2**p`` one-byte registers. Its
+estimate has a relative standard error of about ``1.04 / sqrt(m)``:
+
+    p = 10  ->  1 KiB,  ~3.3%
+    p = 12  ->  4 KiB,  ~1.6%   (ANALYTICS_HLL_PRECISION default)
+    p = 14  -> 16 KiB,  ~0.8%
+
+Roughly 95% of estimates land within twice that. Small cardinalities (up to
+about ``2.5 * m``) use linear counting and are very close to exact. Sketches
+merge losslessly: the union of two sketches is their register-wise maximum,
+so a month of unique visitors is the merge of its daily sketches. Only
+sketches of the same precision can be merged.
+"""
+import math
+import zlib
+import hashlib
+
+_HEADER = b'H'
+
+
+class HyperLogLog:
+    """A mergeable distinct-count sketch"""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 18, got {precision}")
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in the remaining bits
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        """Fold ``other`` into this sketch (the union of both sets)"""
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.precision} and {other.precision}")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        m = len(self.registers)
+        zeros = self.registers.count(0)
+        if zeros == m:
+            return 0
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is far more accurate while most registers are empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return _HEADER + bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:1] != _HEADER:
+            raise ValueError("Not a HyperLogLog sketch")
+        return cls(data[1], zlib.decompress(data[2:]))
@@ -0,0 +1,338 @@
+"""
+Responsive image derivatives.
+
+Uploaded images used to be stored and served only at their original size.
+Once an upload is saved, ``image_derivatives.schedule`` hands it to a process
+pool. There Pillow reads the dimensions and EXIF orientation and writes
+upright WebP and JPEG copies at each configured width next to the original
+(``photo.jpg`` -> ``photo_640w.webp``, ``photo_640w.jpg``). It also renders a
+tiny JPEG for the blur-up placeholder. The result is stored as JSON on the
+record that owns the image. ``serialize_image_variants`` in ``app.models``
+then turns that JSON into srcset strings.
+
+Decoding and resizing are CPU-bound, so they run in child processes rather
+than in the (gevent) request workers. The pool uses the ``spawn`` start
+method because forking a monkey-patched worker is not safe. The pool is
+created lazily in each worker process. Results are written back from the
+pool's callback under a fresh app context. With ``IMAGE_DERIVATIVES_ASYNC``
+off (tests, management commands) the work runs inline instead.
+"""
+import os
+import io
+import json
+import base64
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import has_app_context
+
+from ..extensions import db
+
+logger = logging.getLogger(__name__)
+
+# Extensions Pillow can resize; SVG and documents are left alone
+RASTER_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif'}
+
+EXIF_ORIENTATION = 0x0112
+
+# Orientations that swap width and height once applied
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+FORMAT_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def render_derivatives(source_path, widths, formats=('webp', 'jpeg'), quality=82, placeholder_width=16):
+    """
+    Write the resized copies of one image and describe them.
+
+    Runs in a pool process, so it takes and returns plain values only.
+    Derivative paths in the result are file names relative to the
+    original's directory.
+    """
+    from PIL import Image, ImageOps
+
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    directory = os.path.dirname(source_path)
+
+    with Image.open(source_path) as image:
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1) or 1
+        width, height = image.size
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        animated = getattr(image, 'is_animated', False)
+
+        targets = sorted({min(w, width) for w in widths})
+        if image.format == 'JPEG':
+            # Let the decoder downscale by a power of two; much cheaper than decoding every pixel
+            needed = (max(targets), max(targets) * height // width + 1)
+            if orientation in TRANSPOSED_ORIENTATIONS:
+                needed = needed[::-1]
+            image.draft('RGB', needed)
+        upright = ImageOps.exif_transpose(image)
+
+    has_alpha = upright.mode in ('RGBA', 'LA') or (upright.mode == 'P' and 'transparency' in upright.info)
+    upright = upright.convert('RGBA' if has_alpha else 'RGB')
+    if has_alpha:
+        flat = Image.new('RGB', upright.size, (255, 255, 255))
+        flat.paste(upright, mask=upright.getchannel('A'))
+    else:
+        flat = upright
+
+    variants = []
+    # Resizing the first frame of an animation would silently drop the animation
+    for target in ([] if animated else targets):
+        target_height = max(1, round(height * target / width))
+        for fmt in formats:
+            source = upright if fmt == 'webp' else flat
+            resized = source if source.size == (target, target_height) else source.resize(
+                (target, target_height), Image.LANCZOS)
+            name = f"{stem}_{target}w.{FORMAT_EXTENSIONS[fmt]}"
+            path = os.path.join(directory, name)
+            options = {'quality': quality}
+            if fmt == 'jpeg':
+                options.update(optimize=True, progressive=True)
+            else:
+                options['method'] = 4
+            resized.save(path + '.tmp', fmt.upper(), **options)
+            os.replace(path + '.tmp', path)
+            variants.append({'width': target, 'height': target_height, 'format': fmt, 'file': name})
+
+    tiny = flat.copy()
+    tiny.thumbnail((placeholder_width, placeholder_width))
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'JPEG', quality=50)
+    placeholder = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    return {
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        'placeholder': placeholder,
+        'variants': variants
+    }
+
+
+def derivative_files(variants_data):
+    """File names of the derivatives recorded in an ``image_variants`` value"""
+    if isinstance(variants_data, str):
+        try:
+            variants_data = json.loads(variants_data)
+        except (json.JSONDecodeError, TypeError):
+            return []
+    if not variants_data:
+        return []
+    return [variant['path'].rsplit('/', 1)[-1] for variant in variants_data.get('variants', [])]
+
+
+def remove_derivatives(variants_data, directory):
+    """Delete the derivative files of an image stored in ``directory``"""
+    for name in derivative_files(variants_data):
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete image derivative {name}: {e}")
+
+
+# ----------------------------------------------------------------------
+# Writing results back. Each target takes (object id, upload-relative path
+# of the original, stored value) and updates its record in the session
+# (stories merge and commit their own update, see ``merge_story_media``).
+# ----------------------------------------------------------------------
+
+def _store_gallery(object_id, rel_path, stored):
+    from ..models import GalleryItem
+    item = db.session.get(GalleryItem, object_id)
+    if item is None or not item.file_path.endswith(rel_path):
+        return  # Deleted, or the file was replaced while rendering
+    item.width = stored['width']
+    item.height = stored['height']
+    item.image_variants = json.dumps(stored)
+
+
+def _store_story(object_id, rel_path, stored):
+    from .media_store import merge_story_media
+    merge_story_media(object_id, rel_path, lambda media: media.update(stored))
+
+
+def _store_avatar(object_id, rel_path, stored):
+    from ..models import User
+    user = db.session.get(User, object_id)
+    if user is not None and (user.avatar_path or '').endswith(rel_path):
+        user.avatar_variants = json.dumps(stored)
+
+
+def _store_book(object_id, rel_path, stored):
+    from ..models_book import Book
+    book = db.session.get(Book, object_id)
+    if book is not None and book.image == rel_path:
+        book.image_variants = json.dumps(stored)
+
+
+def _store_author(object_id, rel_path, stored):
+    from ..models_book import Author
+    author = db.session.get(Author, object_id)
+    if author is not None and author.image == rel_path:
+        author.image_variants = json.dumps(stored)
+
+
+TARGETS = {
+    'gallery': _store_gallery,
+    'story': _store_story,
+    'avatar': _store_avatar,
+    'book': _store_book,
+    'author': _store_author,
+}
+
+
+class ImageDerivativePipeline:
+    """Schedules derivative rendering and stores the results"""
+
+    def __init__(self):
+        self.app = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        self.app = app
+        app.extensions['image_derivatives'] = self
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('IMAGE_DERIVATIVES_ENABLED', True)
+
+    def schedule(self, target, object_id, file_path, rel_path, wait=False):
+        """
+        Queue derivatives for the image at ``file_path``.
+
+        ``rel_path`` is the original's path under the uploads folder (as the
+        record stores it) and ``target`` names the record kind in ``TARGETS``.
+        Call after the record is committed. Non-images are ignored. ``wait``
+        renders inline. Returns False if nothing was scheduled or rendering
+        failed inline.
+        """
+        if target not in TARGETS:
+            raise KeyError(f"Unknown derivative target: {target}")
+        if not self.enabled or rel_path.rsplit('.', 1)[-1].lower() not in RASTER_EXTENSIONS:
+            return False
+
+        config = self.app.config
+        args = (os.path.abspath(file_path), tuple(config.get('IMAGE_DERIVATIVE_WIDTHS', (320, 640, 1280))),
+                tuple(config.get('IMAGE_DERIVATIVE_FORMATS', ('webp', 'jpeg'))),
+                config.get('IMAGE_DERIVATIVE_QUALITY', 82), config.get('IMAGE_PLACEHOLDER_WIDTH', 16))
+
+        if wait or not config.get('IMAGE_DERIVATIVES_ASYNC', True):
+            try:
+                result = render_derivatives(*args)
+            except Exception as e:
+                logger.error(f"Image derivatives failed for {rel_path}: {str(e)}")
+                return False
+            self.store(target, object_id, rel_path, result)
+            return True
+
+        future = self._pool().submit(render_derivatives, *args)
+        future.add_done_callback(lambda done: self._finished(done, target, object_id, rel_path))
+        return True
+
+    def schedule_story_media(self, story_id, media_files, media_dir):
+        """Queue derivatives for the images among a story's newly saved ``media_files`` entries"""
+        for media in media_files:
+            if media.get('file_type') == 'image':
+                self.schedule('story', story_id, os.path.join(media_dir, media['filename']), media['file_path'])
+
+    def store(self, target, object_id, rel_path, result):
+        """Record a rendering result on its owner and commit"""
+        directory = rel_path.rsplit('/', 1)[0] + '/' if '/' in rel_path else ''
+        stored = dict(result)
+        stored['variants'] = [
+            {'width': v['width'], 'height': v['height'], 'format': v['format'], 'path': directory + v['file']}
+            for v in result['variants']
+        ]
+        if has_app_context():
+            self._store(target, object_id, rel_path, stored)
+        else:
+            with self.app.app_context():
+                self._store(target, object_id, rel_path, stored)
+
+    def _store(self, target, object_id, rel_path, stored):
+        try:
+            TARGETS[target](object_id, rel_path, stored)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not store image derivatives for {target} {object_id}: {str(e)}")
+
+    def _finished(self, future, target, object_id, rel_path):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Image derivatives failed for {rel_path}: {str(e)}")
+            return
+        self.store(target, object_id, rel_path, result)
+
+    def backfill(self):
+        """
+        Render derivatives, inline, for stored images that have none yet.
+        Returns the number of images processed per target.
+        """
+        from ..models import GalleryItem, Story, User
+        from ..models_book import Book, Author
+
+        upload_root = self.app.config.get('UPLOAD_FOLDER', 'uploads')
+        totals = dict.fromkeys(TARGETS, 0)
+
+        def run(target, object_id, rel_path):
+            file_path = os.path.join(upload_root, rel_path.split('uploads/', 1)[1]
+                                     if rel_path.startswith('uploads/') else rel_path)
+            if os.path.exists(file_path) and self.schedule(target, object_id, file_path, rel_path, wait=True):
+                totals[target] += 1
+
+        for item_id, path in db.session.query(GalleryItem.id, GalleryItem.file_path).filter(
+                GalleryItem.file_type == 'image', GalleryItem.image_variants.is_(None)).all():
+            run('gallery', item_id, path)
+        for user_id, path in db.session.query(User.id, User.avatar_path).filter(
+                User.avatar_path.isnot(None), User.avatar_variants.is_(None)).all():
+            run('avatar', user_id, path)
+        for model, target in ((Book, 'book'), (Author, 'author')):
+            for record_id, path in db.session.query(model.id, model.image).filter(
+                    model.image.isnot(None), model.image_variants.is_(None)).all():
+                run(target, record_id, path)
+        for story_id, media_files in db.session.query(Story.id, Story.media_files).filter(
+                Story.media_files.isnot(None)).all():
+            try:
+                media_files = json.loads(media_files)
+            except (json.JSONDecodeError, TypeError):
+                continue
+            for media in media_files:
+                if media.get('file_type') == 'image' and 'variants' not in media:
+                    run('story', story_id, media['file_path'])
+        return totals
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # A forked worker can't use the parent's pool. Spawned children
+                # re-import the entry script, which must not schedule work on import.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.app.config.get('IMAGE_DERIVATIVE_WORKERS', 2),
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self, wait=True):
+        """Finish queued renders and stop the pool"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait)
+
+
+image_derivatives = ImageDerivativePipeline()
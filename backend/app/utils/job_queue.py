@@ -0,0 +1,423 @@
+"""
+Database-backed background job queue.
+
+Jobs are rows in the ``jobs`` table, so the queue works on SQLite and
+Postgres without a separate broker. Its parts:
+
+* ``@task('name')`` registers a function. ``some_task.enqueue(**kwargs)``
+  stores a job, and routes can answer ``job_accepted(job)`` (202 + job id).
+* A worker claims the highest-priority ready job by leasing it. The claim is
+  an ``UPDATE ... WHERE status = 'queued'`` that only one worker can win; on
+  Postgres the candidate rows are read with ``FOR UPDATE SKIP LOCKED``, so
+  workers don't queue up behind each other's locks. While the job runs, the
+  worker keeps extending the lease. If the worker dies, the lease expires
+  and another worker takes the job again.
+* A failed job is retried with exponential backoff and jitter. After
+  ``max_attempts`` claims, or when it raises ``PermanentJobError``, it is
+  marked ``dead``. Dead jobs stay in the table (the dead-letter state) until
+  an admin retries them.
+
+``manage.py worker`` runs one or more worker processes; see ``run_workers``.
+"""
+import os
+import json
+import time
+import random
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+
+from flask import current_app, jsonify, url_for
+from sqlalchemy import select, insert, update, delete, func, case, or_, and_
+
+from ..extensions import db
+from ..models_jobs import Job
+
+logger = logging.getLogger(__name__)
+
+# name -> Task
+TASKS = {}
+
+
+class PermanentJobError(Exception):
+    """Raised by a task when retrying can't help; the job goes straight to dead"""
+
+
+class Task:
+    """A registered job handler"""
+
+    def __init__(self, fn, name, queue='default', priority=0, max_attempts=None, lease_seconds=None):
+        self.fn = fn
+        self.name = name
+        self.queue = queue
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def enqueue(self, priority=None, delay=0, created_by=None, **kwargs):
+        """Store a job that runs this task with ``kwargs`` (JSON-serializable); commits"""
+        return JobQueue.enqueue(self.name, kwargs, queue=self.queue,
+                                priority=self.priority if priority is None else priority,
+                                delay=delay, max_attempts=self.max_attempts,
+                                lease_seconds=self.lease_seconds, created_by=created_by)
+
+    def enqueue_on(self, connection, delay=0, **kwargs):
+        """
+        Store a job through ``connection`` instead of the session, for hooks
+        such as ``after_commit`` where the session can't be used; doesn't commit
+        """
+        connection.execute(insert(Job.__table__), JobQueue._values(
+            self.name, kwargs, queue=self.queue, priority=self.priority, delay=delay,
+            max_attempts=self.max_attempts, lease_seconds=self.lease_seconds))
+
+
+def task(name, **options):
+    """Register a function as a background task under ``name``"""
+    def decorator(fn):
+        registered = Task(fn, name, **options)
+        TASKS[name] = registered
+        return registered
+    return decorator
+
+
+def job_accepted(job, message='Job queued'):
+    """202 response for a route that handed its work to the queue"""
+    response = jsonify({
+        'success': True,
+        'message': message,
+        'job_id': job.id,
+        'status_url': url_for('admin.get_job', job_id=job.id)
+    })
+    response.status_code = 202
+    response.headers['Location'] = url_for('admin.get_job', job_id=job.id)
+    return response
+
+
+def _backoff(attempts):
+    config = current_app.config
+    delay = min(config.get('JOB_BACKOFF_MAX', 3600), config.get('JOB_BACKOFF_BASE', 10) * 2 ** (attempts - 1))
+    return delay * random.uniform(0.75, 1.25)  # Jitter keeps failed jobs from retrying in lockstep
+
+
+class JobQueue:
+    """Queue operations; each method commits the current session"""
+
+    @staticmethod
+    def enqueue(name, kwargs=None, queue='default', priority=0, delay=0, max_attempts=None,
+                lease_seconds=None, created_by=None):
+        job = Job(**JobQueue._values(name, kwargs, queue, priority, delay, max_attempts, lease_seconds, created_by))
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @staticmethod
+    def _values(name, kwargs=None, queue='default', priority=0, delay=0, max_attempts=None,
+                lease_seconds=None, created_by=None):
+        if name not in TASKS:
+            raise KeyError(f"Unknown task: {name}")
+        return {
+            'name': name,
+            'queue': queue,
+            'payload': json.dumps(kwargs or {}),
+            'priority': priority,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': max_attempts or current_app.config.get('JOB_MAX_ATTEMPTS', 5),
+            'lease_seconds': lease_seconds or current_app.config.get('JOB_LEASE_SECONDS', 300),
+            'run_at': datetime.utcnow() + timedelta(seconds=delay),
+            'created_by': created_by,
+        }
+
+    @staticmethod
+    def claim(worker_id, queues=None, batch=5):
+        """
+        Lease the next ready job for ``worker_id``; returns the Job or None.
+
+        Ready means queued and due, or running with an expired lease (its
+        worker died). Jobs reclaimed after their last attempt go to dead.
+        """
+        jobs = Job.__table__
+        now = datetime.utcnow()
+        ready = or_(and_(jobs.c.status == 'queued', jobs.c.run_at <= now),
+                    and_(jobs.c.status == 'running', jobs.c.leased_until < now))
+
+        while True:
+            candidates = (select(jobs.c.id, jobs.c.lease_seconds, jobs.c.attempts, jobs.c.max_attempts)
+                          .where(ready)
+                          .order_by(jobs.c.priority.desc(), jobs.c.run_at, jobs.c.id)
+                          .limit(batch))
+            if queues:
+                candidates = candidates.where(jobs.c.queue.in_(queues))
+            if db.engine.dialect.name == 'postgresql':
+                candidates = candidates.with_for_update(skip_locked=True)
+            rows = db.session.execute(candidates).all()
+            if not rows:
+                db.session.commit()
+                return None
+
+            for job_id, lease_seconds, attempts, max_attempts in rows:
+                if attempts >= max_attempts:
+                    # Its worker died on the last attempt
+                    won = db.session.execute(
+                        update(jobs).where(jobs.c.id == job_id, ready)
+                        .values(status='dead', finished_at=now, leased_until=None,
+                                last_error=func.coalesce(jobs.c.last_error, 'Lease expired on the final attempt'))
+                    ).rowcount
+                    if won:
+                        logger.error(f"Job {job_id} is dead: lease expired on attempt {attempts}")
+                    continue
+                won = db.session.execute(
+                    update(jobs).where(jobs.c.id == job_id, ready)
+                    .values(status='running', worker_id=worker_id, attempts=jobs.c.attempts + 1,
+                            started_at=now, leased_until=now + timedelta(seconds=lease_seconds))
+                ).rowcount
+                if won:
+                    db.session.commit()
+                    return db.session.get(Job, job_id, populate_existing=True)
+            # Every candidate went to another worker (or to dead); look again
+            db.session.commit()
+
+    @staticmethod
+    def heartbeat(job_id, worker_id, lease_seconds):
+        """Extend a running job's lease; False if this worker no longer holds it"""
+        jobs = Job.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(
+                update(jobs).where(jobs.c.id == job_id, jobs.c.worker_id == worker_id, jobs.c.status == 'running')
+                .values(leased_until=datetime.utcnow() + timedelta(seconds=lease_seconds))
+            ).rowcount == 1
+
+    @staticmethod
+    def complete(job, result=None):
+        JobQueue._finish(job, status='succeeded', result=json.dumps(result, default=str) if result is not None else None,
+                         last_error=None, finished_at=datetime.utcnow(), leased_until=None)
+
+    @staticmethod
+    def fail(job, error, permanent=False):
+        """Record a failed attempt: retry after a backoff, or dead-letter the job"""
+        message = str(error)[:2000] or error.__class__.__name__
+        if permanent or job.attempts >= job.max_attempts:
+            JobQueue._finish(job, status='dead', last_error=message, finished_at=datetime.utcnow(), leased_until=None)
+            logger.error(f"Job {job.id} ({job.name}) is dead after {job.attempts} attempts: {message}")
+        else:
+            JobQueue._finish(job, status='queued', last_error=message, leased_until=None, worker_id=None,
+                             run_at=datetime.utcnow() + timedelta(seconds=_backoff(job.attempts)))
+            logger.warning(f"Job {job.id} ({job.name}) failed attempt {job.attempts}, retrying: {message}")
+
+    @staticmethod
+    def _finish(job, **values):
+        # Only the lease holder may finish the job; after a lost lease another worker owns it
+        jobs = Job.__table__
+        db.session.rollback()
+        won = db.session.execute(
+            update(jobs).where(jobs.c.id == job.id, jobs.c.status == 'running', jobs.c.worker_id == job.worker_id)
+            .values(**values)
+        ).rowcount
+        db.session.commit()
+        if not won:
+            logger.warning(f"Job {job.id} lost its lease before finishing; result discarded")
+
+    @staticmethod
+    def retry(job):
+        """Requeue a dead job with a fresh set of attempts"""
+        if job.status != 'dead':
+            return False
+        job.status = 'queued'
+        job.attempts = 0
+        job.run_at = datetime.utcnow()
+        job.finished_at = None
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def purge(older_than_days=7):
+        """Delete succeeded jobs finished more than ``older_than_days`` ago"""
+        jobs = Job.__table__
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        removed = db.session.execute(
+            delete(jobs).where(jobs.c.status == 'succeeded', jobs.c.finished_at < cutoff)
+        ).rowcount
+        db.session.commit()
+        return removed
+
+    @staticmethod
+    def stats():
+        """Queue depth per queue and status, plus recent throughput"""
+        jobs = Job.__table__
+        now = datetime.utcnow()
+        hour_ago, minute_ago = now - timedelta(hours=1), now - timedelta(minutes=1)
+
+        depth = {}
+        for queue, status, due, count, oldest in db.session.execute(
+            select(jobs.c.queue, jobs.c.status, jobs.c.run_at <= now, func.count(), func.min(jobs.c.run_at))
+            .where(jobs.c.status.in_(('queued', 'running', 'dead')))
+            .group_by(jobs.c.queue, jobs.c.status, jobs.c.run_at <= now)
+        ):
+            entry = depth.setdefault(queue, {'ready': 0, 'scheduled': 0, 'running': 0, 'dead': 0,
+                                             'oldest_ready_seconds': None})
+            if status == 'queued' and due:
+                entry['ready'] += count
+                entry['oldest_ready_seconds'] = round((now - oldest).total_seconds())
+            elif status == 'queued':
+                entry['scheduled'] += count
+            else:
+                entry[status] += count
+
+        finished = db.session.execute(
+            select(
+                func.sum(case((jobs.c.finished_at >= minute_ago, 1), else_=0)),
+                func.count(),
+                func.sum(case((jobs.c.status == 'dead', 1), else_=0)),
+            ).where(jobs.c.finished_at >= hour_ago, jobs.c.status.in_(('succeeded', 'dead')))
+        ).one()
+        durations = [
+            (finished_at - started_at).total_seconds()
+            for started_at, finished_at in db.session.execute(
+                select(jobs.c.started_at, jobs.c.finished_at)
+                .where(jobs.c.finished_at >= hour_ago, jobs.c.status == 'succeeded',
+                       jobs.c.started_at.isnot(None))
+            )
+        ]
+        db.session.commit()
+
+        return {
+            'queues': depth,
+            'throughput': {
+                'finished_last_minute': finished[0] or 0,
+                'finished_last_hour': finished[1] or 0,
+                'dead_last_hour': finished[2] or 0,
+                'avg_run_seconds': round(sum(durations) / len(durations), 3) if durations else None
+            }
+        }
+
+
+class Worker:
+    """Claims and runs jobs until stopped"""
+
+    def __init__(self, app, queues=None, worker_id=None):
+        self.app = app
+        self.queues = queues
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def run(self, burst=False, max_jobs=None):
+        """
+        Process jobs until ``stop`` is called. ``burst`` returns as soon as
+        no job is ready. Returns the number of jobs run.
+        """
+        poll = self.app.config.get('JOB_POLL_INTERVAL', 1)
+        idle = poll
+        processed = 0
+        while not self._stop.is_set() and (max_jobs is None or processed < max_jobs):
+            with self.app.app_context():
+                job = JobQueue.claim(self.worker_id, self.queues)
+                if job is not None:
+                    self.execute(job)
+                db.session.remove()
+            if job is not None:
+                processed += 1
+                idle = poll
+                continue
+            if burst:
+                break
+            # Back off while the queue is empty
+            self._stop.wait(idle)
+            idle = min(idle * 2, self.app.config.get('JOB_POLL_MAX_INTERVAL', 10))
+        return processed
+
+    def execute(self, job):
+        # Detach the claimed row so commits made by the task don't expire it
+        db.session.expunge(job)
+        task_ = TASKS.get(job.name)
+        if task_ is None:
+            JobQueue.fail(job, f"Unknown task: {job.name}", permanent=True)
+            return
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job.id, job.lease_seconds, stop_heartbeat),
+                                     name=f'job-{job.id}-heartbeat', daemon=True)
+        heartbeat.start()
+        started = time.monotonic()
+        try:
+            result = task_.fn(**json.loads(job.payload or '{}'))
+        except PermanentJobError as e:
+            JobQueue.fail(job, e, permanent=True)
+        except Exception as e:
+            logger.exception(f"Job {job.id} ({job.name}) raised")
+            JobQueue.fail(job, e)
+        else:
+            JobQueue.complete(job, result)
+            logger.info(f"Job {job.id} ({job.name}) succeeded in {time.monotonic() - started:.2f}s")
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join(timeout=5)
+
+    def _heartbeat(self, job_id, lease_seconds, stop):
+        while not stop.wait(max(1, lease_seconds / 3)):
+            try:
+                with self.app.app_context():
+                    if not JobQueue.heartbeat(job_id, self.worker_id, lease_seconds):
+                        return
+            except Exception as e:
+                logger.warning(f"Could not extend lease of job {job_id}: {str(e)}")
+
+
+def _worker_process(app, queues):
+    # Connections inherited across fork must not be shared with the parent
+    with app.app_context():
+        db.engine.dispose(close=False)
+    worker = Worker(app, queues)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+def run_workers(app, processes=1, queues=None):
+    """
+    Run ``processes`` workers until SIGTERM/SIGINT. Each worker finishes its
+    current job before exiting; a worker that crashes is restarted.
+    """
+    if processes <= 1:
+        worker = Worker(app, queues)
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        worker.run()
+        return
+
+    context = multiprocessing.get_context('fork')
+    stopping = threading.Event()
+
+    def start():
+        process = context.Process(target=_worker_process, args=(app, queues), name='job-worker')
+        process.start()
+        return process
+
+    def shutdown(*args):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    children = [start() for _ in range(processes)]
+    logger.info(f"Started {processes} job workers: {[child.pid for child in children]}")
+
+    while not stopping.is_set():
+        stopping.wait(1)
+        for index, child in enumerate(children):
+            if not child.is_alive() and not stopping.is_set():
+                logger.warning(f"Job worker {child.pid} exited with {child.exitcode}; restarting")
+                children[index] = start()
+
+    for child in children:
+        if child.is_alive():
+            os.kill(child.pid, signal.SIGTERM)
+    for child in children:
+        child.join()
@@ -0,0 +1,178 @@
+"""
+Atomic like toggles and like/comment counter reconciliation.
+
+A like is stored twice: as a row in ``story_likes``/``gallery_likes`` and as the
+denormalized ``likes_count``/``likes`` column the listings read. Toggles write
+both in one transaction with two statements: an insert-if-absent (or delete)
+of the like row, then a counter delta applied in SQL only when that statement
+actually changed a row. Concurrent clicks can't double count, and no Python
+read-modify-write is involved.
+
+``CounterReconciler.run`` recomputes the denormalized columns from the like and
+comment tables in id-range batches, repairing any drift from older code paths
+or manual edits. It runs as the self-rescheduling
+``maintenance.reconcile_counters`` job (queue it with ``manage.py
+reconcile-counters --schedule``) every ``COUNTER_RECONCILE_INTERVAL`` seconds.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, insert, delete, update, func, case, and_, or_
+
+from ..extensions import db
+from ..models import Story, StoryLike, GalleryItem, GalleryLike, Comment
+
+logger = logging.getLogger(__name__)
+
+stories = Story.__table__
+story_likes = StoryLike.__table__
+gallery_items = GalleryItem.__table__
+gallery_likes = GalleryLike.__table__
+comments = Comment.__table__
+
+
+def _insert_if_absent(connection, table, values):
+    """Insert a row unless it violates a unique constraint; returns True if inserted"""
+    if connection.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        dialect_insert = None
+
+    if dialect_insert is not None:
+        result = connection.execute(dialect_insert(table).values(**values).on_conflict_do_nothing())
+        return result.rowcount > 0
+
+    # Other databases: let the unique constraint arbitrate inside a savepoint
+    from sqlalchemy.exc import IntegrityError
+    try:
+        with connection.begin_nested():
+            connection.execute(insert(table).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+def _apply_delta(connection, table, column, object_id, delta):
+    """Add ``delta`` to a counter column in SQL (never below zero) and return the new value"""
+    current = func.coalesce(table.c[column], 0)
+    new_value = case((current + delta < 0, 0), else_=current + delta)
+    statement = update(table).where(table.c.id == object_id).values({column: new_value})
+    if connection.dialect.update_returning:
+        return connection.execute(statement.returning(table.c[column])).scalar() or 0
+    connection.execute(statement)
+    return connection.execute(select(table.c[column]).where(table.c.id == object_id)).scalar() or 0
+
+
+def _read_counter(connection, table, column, object_id):
+    return connection.execute(select(table.c[column]).where(table.c.id == object_id)).scalar() or 0
+
+
+class LikeCounters:
+    """Atomic like/unlike operations; each commits the current session"""
+
+    @staticmethod
+    def like_story(story_id, user_id):
+        """Like a story; returns the story's like count"""
+        connection = db.session.connection()
+        if _insert_if_absent(connection, story_likes,
+                             {'story_id': story_id, 'user_id': user_id, 'created_at': datetime.utcnow()}):
+            likes = _apply_delta(connection, stories, 'likes_count', story_id, 1)
+        else:
+            likes = _read_counter(connection, stories, 'likes_count', story_id)
+        db.session.commit()
+        return likes
+
+    @staticmethod
+    def unlike_story(story_id, user_id):
+        """Remove a story like; returns the story's like count"""
+        connection = db.session.connection()
+        removed = connection.execute(delete(story_likes).where(
+            story_likes.c.story_id == story_id, story_likes.c.user_id == user_id
+        )).rowcount
+        if removed:
+            likes = _apply_delta(connection, stories, 'likes_count', story_id, -removed)
+        else:
+            likes = _read_counter(connection, stories, 'likes_count', story_id)
+        db.session.commit()
+        return likes
+
+    @staticmethod
+    def toggle_gallery_like(item_id, ip_address, user_id=None):
+        """Toggle an anonymous (per-IP) gallery like; returns ``(liked, likes)``"""
+        connection = db.session.connection()
+        removed = connection.execute(delete(gallery_likes).where(
+            gallery_likes.c.gallery_item_id == item_id, gallery_likes.c.ip_address == ip_address
+        )).rowcount
+        if removed:
+            liked = False
+            likes = _apply_delta(connection, gallery_items, 'likes', item_id, -removed)
+        else:
+            liked = True
+            if _insert_if_absent(connection, gallery_likes, {
+                'gallery_item_id': item_id, 'ip_address': ip_address,
+                'user_id': user_id, 'created_at': datetime.utcnow()
+            }):
+                likes = _apply_delta(connection, gallery_items, 'likes', item_id, 1)
+            else:
+                # A concurrent request from the same IP liked it first
+                likes = _read_counter(connection, gallery_items, 'likes', item_id)
+        db.session.commit()
+        return liked, likes
+
+    @staticmethod
+    def add_story_comment(story_id):
+        """Count a new comment on a story (call within the comment's transaction)"""
+        return _apply_delta(db.session.connection(), stories, 'comments_count', story_id, 1)
+
+
+class CounterReconciler:
+    """Recomputes denormalized like and comment counters from their source tables"""
+
+    @staticmethod
+    def _reconcile_table(table, corrections, batch_size):
+        """
+        Bring ``column = (count subquery)`` pairs up to date for every row of
+        ``table``, one id range per transaction. Returns the rows changed.
+        """
+        fixed = 0
+        last_id = 0
+        while True:
+            with db.engine.begin() as connection:
+                ids = connection.execute(
+                    select(table.c.id).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                in_range = and_(table.c.id >= ids[0], table.c.id <= ids[-1])
+                drifted = [func.coalesce(table.c[column], -1) != actual for column, actual in corrections.items()]
+                result = connection.execute(
+                    update(table)
+                    .where(in_range)
+                    .where(or_(*drifted))
+                    .values(dict(corrections))
+                )
+                fixed += result.rowcount
+            last_id = ids[-1]
+        return fixed
+
+    @staticmethod
+    def run(batch_size=500):
+        """Reconcile story and gallery counters; returns ``{counter: rows fixed}``"""
+        story_likes_actual = (select(func.count()).select_from(story_likes)
+                              .where(story_likes.c.story_id == stories.c.id).scalar_subquery())
+        story_comments_actual = (select(func.count()).select_from(comments)
+                                 .where(comments.c.story_id == stories.c.id).scalar_subquery())
+        gallery_likes_actual = (select(func.count()).select_from(gallery_likes)
+                                .where(gallery_likes.c.gallery_item_id == gallery_items.c.id).scalar_subquery())
+
+        totals = {
+            'stories': CounterReconciler._reconcile_table(
+                stories, {'likes_count': story_likes_actual, 'comments_count': story_comments_actual}, batch_size),
+            'gallery_items': CounterReconciler._reconcile_table(
+                gallery_items, {'likes': gallery_likes_actual}, batch_size),
+        }
+        logger.info(f"Counter reconciliation fixed {totals['stories']} stories, "
+                    f"{totals['gallery_items']} gallery items")
+        return totals
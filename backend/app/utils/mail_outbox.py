@@ -0,0 +1,327 @@
+"""
+Email outbox and pooled SMTP delivery.
+
+Nothing talks to SMTP during a request. ``send_email`` and campaigns only
+insert rows into ``email_outbox``, and a delivery pass sends them later:
+
+* A pass claims a batch of due messages, highest priority first, by leasing
+  them with a claim token, like the job queue does. Account mail
+  (verification, password reset) therefore never waits behind a campaign.
+* The whole batch goes over one authenticated SMTP connection, which is
+  reopened if the server drops it. Sends are throttled to
+  ``MAIL_RATE_LIMIT`` messages per second per delivery process.
+* A campaign's template is rendered once, when the campaign is created,
+  with a placeholder for the recipient's name. Delivery only substitutes
+  the name, so 10,000 recipients mean one render instead of 10,000.
+* 4xx replies, timeouts and dropped connections are retried with backoff,
+  up to ``MAIL_MAX_ATTEMPTS``. 5xx replies fail the recipient at once. Each
+  row keeps its own status, attempts and last error.
+
+With ``MAIL_OUTBOX_ASYNC`` delivery runs in the ``email.deliver`` job
+(``manage.py worker``); otherwise it runs right after queueing. To watch
+real SMTP traffic locally, run a debugging server such as
+``python -m aiosmtpd -n -l localhost:1025`` and set ``MAIL_SERVER=localhost``,
+``MAIL_PORT=1025``, ``MAIL_USE_TLS=False``.
+"""
+import time
+import uuid
+import random
+import smtplib
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+from flask import current_app, render_template
+from flask_mail import Message
+from jinja2 import TemplateNotFound
+from markupsafe import escape
+from sqlalchemy import select, update, delete, insert, func, or_, and_
+
+from ..extensions import db, mail
+from ..models_email import EmailCampaign, OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+SUBJECT_PREFIX = '[DoggoDaily] '
+RECIPIENT_NAME = '%%recipient_name%%'  # Substituted per recipient in campaign bodies
+ACCOUNT_PRIORITY = 10
+CAMPAIGN_PRIORITY = 0
+
+
+def render_email(template, **context):
+    """Render ``email/<template>.html`` and ``.txt``; returns ``(html, body)``, either may be None"""
+    rendered = []
+    for extension in ('html', 'txt'):
+        try:
+            rendered.append(render_template(f'email/{template}.{extension}', **context))
+        except TemplateNotFound:
+            rendered.append(None)
+    if rendered == [None, None]:
+        raise TemplateNotFound(f'email/{template}')
+    return tuple(rendered)
+
+
+class _Throttle:
+    """Spaces sends at most ``rate`` per second; 0 disables it"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + self.interval
+
+
+def _is_permanent(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return False
+
+
+def _retry_delay(attempts):
+    config = current_app.config
+    delay = min(config.get('MAIL_RETRY_MAX', 3600), config.get('MAIL_RETRY_BASE', 60) * 2 ** (attempts - 1))
+    return delay * random.uniform(0.75, 1.25)
+
+
+class MailOutbox:
+    """Outbox operations; each method commits the current session"""
+
+    @staticmethod
+    def queue(subject, recipients, html=None, body=None, priority=ACCOUNT_PRIORITY, user_id=None):
+        """Queue one message per recipient, then start delivery"""
+        now = datetime.utcnow()
+        for recipient in recipients:
+            db.session.add(OutboxEmail(recipient=recipient, user_id=user_id, subject=subject, html=html, body=body,
+                                       priority=priority, status='pending', attempts=0, next_attempt_at=now))
+        db.session.commit()
+        MailOutbox.dispatch()
+
+    @staticmethod
+    def create_campaign(subject, template, recipients, created_by=None, **context):
+        """
+        Queue a campaign to ``recipients``, an iterable of ``(user_id, email, name)``.
+
+        The template is rendered once with ``recipient_name`` set to a
+        placeholder, so it must not branch on the name.
+        """
+        html, body = render_email(template, subject=subject, recipient_name=RECIPIENT_NAME, **context)
+        campaign = EmailCampaign(subject=subject, template=template, html=html, body=body, created_by=created_by)
+        db.session.add(campaign)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        rows = [
+            {'campaign_id': campaign.id, 'user_id': user_id, 'recipient': email, 'recipient_name': name,
+             'priority': CAMPAIGN_PRIORITY, 'status': 'pending', 'attempts': 0, 'next_attempt_at': now,
+             'created_at': now}
+            for user_id, email, name in recipients
+            if email
+        ]
+        for start in range(0, len(rows), 1000):
+            db.session.execute(insert(OutboxEmail), rows[start:start + 1000])
+        campaign.recipient_count = len(rows)
+        db.session.commit()
+        MailOutbox.dispatch()
+        return campaign
+
+    @staticmethod
+    def dispatch():
+        """Deliver now (``MAIL_OUTBOX_ASYNC`` off) or make sure a delivery job is queued"""
+        if not current_app.config.get('MAIL_OUTBOX_ASYNC', True):
+            MailOutbox.deliver_pending()
+            return
+        from ..models_jobs import Job
+        from ..tasks import deliver_outbox
+        # One due delivery job is enough; a running one may already have finished its last claim
+        if not Job.query.filter(Job.name == deliver_outbox.name, Job.status == 'queued',
+                                Job.run_at <= datetime.utcnow()).with_entities(Job.id).first():
+            deliver_outbox.enqueue()
+
+    @staticmethod
+    def claim(batch_size):
+        """Lease up to ``batch_size`` due messages; returns ``(token, messages)``"""
+        outbox = OutboxEmail.__table__
+        now = datetime.utcnow()
+        ready = or_(and_(outbox.c.status == 'pending', outbox.c.next_attempt_at <= now),
+                    and_(outbox.c.status == 'sending', outbox.c.leased_until < now))
+        candidates = (select(outbox.c.id).where(ready)
+                      .order_by(outbox.c.priority.desc(), outbox.c.next_attempt_at, outbox.c.id)
+                      .limit(batch_size))
+        if db.engine.dialect.name == 'postgresql':
+            candidates = candidates.with_for_update(skip_locked=True)
+        ids = db.session.execute(candidates).scalars().all()
+        if not ids:
+            db.session.commit()
+            return None, []
+
+        # Rows another process claimed in the meantime no longer match ``ready``
+        token = uuid.uuid4().hex
+        lease = timedelta(seconds=current_app.config.get('MAIL_LEASE_SECONDS', 600))
+        db.session.execute(
+            update(outbox).where(outbox.c.id.in_(ids), ready)
+            .values(status='sending', claim_token=token, leased_until=now + lease, attempts=outbox.c.attempts + 1)
+        )
+        db.session.commit()
+        messages = OutboxEmail.query.filter_by(claim_token=token).order_by(
+            OutboxEmail.priority.desc(), OutboxEmail.next_attempt_at, OutboxEmail.id).all()
+        # Detached, so committing outcomes mid-batch doesn't reload each row
+        for message in messages:
+            db.session.expunge(message)
+        return token, messages
+
+    @staticmethod
+    def deliver_batch(batch_size=None, throttle=None):
+        """Send one claimed batch over a single SMTP connection; returns counts by outcome"""
+        config = current_app.config
+        token, messages = MailOutbox.claim(batch_size or config.get('MAIL_BATCH_SIZE', 100))
+        totals = {'sent': 0, 'retrying': 0, 'failed': 0}
+        if not messages:
+            return totals
+
+        throttle = throttle or _Throttle(config.get('MAIL_RATE_LIMIT', 0))
+        campaign_ids = {message.campaign_id for message in messages if message.campaign_id}
+        campaigns = {}
+        if campaign_ids:
+            for campaign in EmailCampaign.query.filter(EmailCampaign.id.in_(campaign_ids)):
+                db.session.expunge(campaign)
+                campaigns[campaign.id] = campaign
+        results = _Results(token, totals)
+        pending = deque(messages)
+        try:
+            with mail.connect() as connection:
+                while pending:
+                    message = pending[0]
+                    throttle.wait()
+                    try:
+                        connection.send(MailOutbox._build(message, campaigns.get(message.campaign_id)))
+                        results.sent(message)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                        results.failed(message, e, permanent=_is_permanent(e))
+                    except (smtplib.SMTPServerDisconnected, OSError) as e:
+                        results.failed(message, e)
+                        pending.popleft()
+                        # Reconnect for the rest of the batch; if that fails too they are released below
+                        connection.host = None
+                        if pending:
+                            connection.host = connection.configure_host()
+                        continue
+                    except Exception as e:
+                        # A malformed message (bad header, no recipient) will never send
+                        results.failed(message, e, permanent=True)
+                    pending.popleft()
+        except Exception as e:
+            logger.error(f"SMTP connection failed, {len(pending)} messages will be retried: {str(e)}")
+            for message in pending:
+                results.failed(message, e)
+        results.flush()
+        return totals
+
+    @staticmethod
+    def deliver_pending(max_batches=None):
+        """Deliver batches until nothing is due; returns counts by outcome"""
+        throttle = _Throttle(current_app.config.get('MAIL_RATE_LIMIT', 0))
+        totals = {'sent': 0, 'retrying': 0, 'failed': 0}
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batch = MailOutbox.deliver_batch(throttle=throttle)
+            if not any(batch.values()):
+                break
+            for outcome, count in batch.items():
+                totals[outcome] += count
+            batches += 1
+        return totals
+
+    @staticmethod
+    def next_retry_at():
+        """When the earliest message waiting for a retry becomes due, or None"""
+        return db.session.query(func.min(OutboxEmail.next_attempt_at)).filter(
+            OutboxEmail.status == 'pending').scalar()
+
+    @staticmethod
+    def campaign_status(campaign_id):
+        """Recipient counts by delivery status"""
+        return dict(db.session.query(OutboxEmail.status, func.count()).filter(
+            OutboxEmail.campaign_id == campaign_id).group_by(OutboxEmail.status).all())
+
+    @staticmethod
+    def purge(older_than_days=30):
+        """Delete sent messages older than ``older_than_days``"""
+        outbox = OutboxEmail.__table__
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        removed = db.session.execute(
+            delete(outbox).where(outbox.c.status == 'sent', outbox.c.sent_at < cutoff)
+        ).rowcount
+        db.session.commit()
+        return removed
+
+    @staticmethod
+    def _build(message, campaign):
+        config = current_app.config
+        if campaign is None:
+            subject, html, body = message.subject, message.html, message.body
+        else:
+            name = message.recipient_name or 'there'
+            subject = campaign.subject
+            html = campaign.html.replace(RECIPIENT_NAME, str(escape(name))) if campaign.html else None
+            body = campaign.body.replace(RECIPIENT_NAME, name) if campaign.body else None
+        return Message(
+            subject=f"{SUBJECT_PREFIX}{subject}",
+            sender=config.get('MAIL_DEFAULT_SENDER', 'noreply@doggodaily.com'),
+            recipients=[message.recipient],
+            html=html,
+            body=body
+        )
+
+
+class _Results:
+    """Writes per-recipient outcomes back, guarded by the batch's claim token"""
+
+    FLUSH_EVERY = 50
+
+    def __init__(self, token, totals):
+        self.token = token
+        self.totals = totals
+        self.sent_ids = []
+
+    def sent(self, message):
+        self.sent_ids.append(message.id)
+        self.totals['sent'] += 1
+        if len(self.sent_ids) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def failed(self, message, error, permanent=False):
+        error_message = str(error)[:1000] or error.__class__.__name__
+        if permanent or message.attempts >= current_app.config.get('MAIL_MAX_ATTEMPTS', 5):
+            values = {'status': 'failed'}
+            self.totals['failed'] += 1
+            logger.error(f"Email {message.id} to {message.recipient} failed after {message.attempts} attempts: "
+                         f"{error_message}")
+        else:
+            values = {'status': 'pending',
+                      'next_attempt_at': datetime.utcnow() + timedelta(seconds=_retry_delay(message.attempts))}
+            self.totals['retrying'] += 1
+            logger.warning(f"Email {message.id} to {message.recipient} will be retried: {error_message}")
+        self._update([message.id], last_error=error_message, **values)
+        db.session.commit()
+
+    def flush(self):
+        # Outcomes are written in short transactions so SQLite isn't locked while SMTP talks
+        if self.sent_ids:
+            self._update(self.sent_ids, status='sent', sent_at=datetime.utcnow(), last_error=None)
+            self.sent_ids = []
+        db.session.commit()
+
+    def _update(self, ids, **values):
+        outbox = OutboxEmail.__table__
+        db.session.execute(
+            update(outbox).where(outbox.c.id.in_(ids), outbox.c.claim_token == self.token)
+            .values(claim_token=None, leased_until=None, **values)
+        )
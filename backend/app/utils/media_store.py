@@ -0,0 +1,277 @@
+"""
+Content-addressed media storage.
+
+A file is stored once, under the SHA-256 of its bytes:
+``uploads/media/ab/cd/abcd...ef.jpg``. The digest is computed while the
+upload streams to a temporary file, so the content is read only once. If a
+blob with that digest already exists, the temporary file is dropped and the
+blob's reference count goes up instead, so the same photo uploaded twice
+takes the space of one.
+
+Because a name always maps to the same bytes, these URLs never need to be
+revalidated. ``serve_uploads`` marks everything under ``media/`` as
+``Cache-Control: immutable``. Files derived from a blob (resized copies,
+video thumbnails) are written next to it, named after the digest.
+
+Reference counts change in the caller's transaction. A file is deleted only
+after the commit that drops its last reference. Gallery items are deleted
+through ``delete_gallery_item`` so that every deletion releases its blob and,
+with the last reference, the files derived from it.
+
+Background writers that record results on a story's ``media_files`` entries
+(derivatives, video metadata, renditions) go through ``merge_story_media`` so
+they can't overwrite each other.
+"""
+import os
+import json
+import uuid
+import hashlib
+import logging
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import event, select, update, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from ..extensions import db
+from ..models_uploads import MediaBlob
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = 'media'
+CHUNK_SIZE = 1024 * 1024
+SESSION_KEY = 'media_store_unlink'
+CLEANUP_KEY = 'media_store_cleanup'
+
+# Retries when another writer changes a story's media_files mid-merge
+STORY_MERGE_ATTEMPTS = 5
+
+# ``path`` is the stored form ('uploads/media/...'), ``file_path`` the location on disk
+StoredMedia = namedtuple('StoredMedia', 'digest path file_path size existing')
+
+
+def _relative(digest, ext):
+    return f"{MEDIA_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+
+def is_media_path(path):
+    """Whether a stored path ('uploads/...' or upload-relative) is in the media store"""
+    if path and path.startswith('uploads/'):
+        path = path[len('uploads/'):]
+    return bool(path) and path.startswith(f'{MEDIA_DIR}/')
+
+
+class MediaStore:
+    """Saves and releases content-addressed files; changes are committed by the caller"""
+
+    @staticmethod
+    def upload_root():
+        return os.path.abspath(current_app.config.get('UPLOAD_FOLDER', 'uploads'))
+
+    @staticmethod
+    def save(stream, ext, mime_type=None):
+        """Store a file-like object's content, hashing it as it is written"""
+        staging = os.path.join(MediaStore.upload_root(), MEDIA_DIR, 'tmp')
+        os.makedirs(staging, exist_ok=True)
+        temp_path = os.path.join(staging, uuid.uuid4().hex)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            return MediaStore._place(temp_path, sha256.hexdigest(), ext, size, mime_type)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def adopt(source_path, ext, mime_type=None):
+        """
+        Store a file already on disk (a finished resumable upload). It is
+        moved into place, or deleted if the same content is already stored.
+        """
+        sha256 = hashlib.sha256()
+        with open(source_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        stored = MediaStore._place(source_path, sha256.hexdigest(), ext, os.path.getsize(source_path), mime_type)
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        return stored
+
+    @staticmethod
+    def _place(temp_path, digest, ext, size, mime_type):
+        ext = ext.lower().lstrip('.')
+        relative = _relative(digest, ext)
+        file_path = os.path.join(MediaStore.upload_root(), *relative.split('/'))
+        existing = MediaStore._add_reference(digest, ext, size, mime_type)
+        if not existing or not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(temp_path, file_path)
+        return StoredMedia(digest, f'uploads/{relative}', file_path, size, existing)
+
+    @staticmethod
+    def _add_reference(digest, ext, size, mime_type):
+        """Count one more user of ``digest``; returns whether the blob already existed"""
+        blobs = MediaBlob.__table__
+        if db.session.execute(
+            update(blobs).where(blobs.c.digest == digest).values(ref_count=blobs.c.ref_count + 1)
+        ).rowcount:
+            return True
+        try:
+            with db.session.begin_nested():
+                db.session.add(MediaBlob(digest=digest, ext=ext, size=size, mime_type=mime_type, ref_count=1))
+            return False
+        except IntegrityError:
+            # Stored by a concurrent upload a moment ago
+            db.session.execute(
+                update(blobs).where(blobs.c.digest == digest).values(ref_count=blobs.c.ref_count + 1))
+            return True
+
+    @staticmethod
+    def retain(stored):
+        """Add a reference to an already stored file"""
+        MediaStore._add_reference(stored.digest, stored.path.rsplit('.', 1)[-1], stored.size, None)
+
+    @staticmethod
+    def release(path):
+        """
+        Drop one reference to a stored path. Returns True if it was the last
+        one; the file is then deleted once the session commits. Paths outside
+        the media store are ignored (False).
+        """
+        if not is_media_path(path):
+            return False
+        digest = path.rsplit('/', 1)[-1].split('.', 1)[0]
+        blobs = MediaBlob.__table__
+        db.session.execute(
+            update(blobs).where(blobs.c.digest == digest).values(ref_count=blobs.c.ref_count - 1))
+        if not db.session.execute(
+            delete(blobs).where(blobs.c.digest == digest, blobs.c.ref_count <= 0)
+        ).rowcount:
+            return False
+        relative = path[len('uploads/'):] if path.startswith('uploads/') else path
+        db.session.info.setdefault(SESSION_KEY, []).append(
+            os.path.join(MediaStore.upload_root(), *relative.split('/')))
+        return True
+
+    @staticmethod
+    def discard(stored):
+        """
+        Clean up after a ``save``/``adopt`` whose transaction was rolled back.
+        The rollback already undid the reference; the file is deleted unless a
+        committed blob still uses it.
+        """
+        if db.session.get(MediaBlob, stored.digest) is None and os.path.exists(stored.file_path):
+            os.remove(stored.file_path)
+
+
+def delete_gallery_item(item):
+    """
+    Delete a gallery item in the current session and release its file. After
+    the commit, the file and its variants, thumbnail and renditions are
+    deleted if no other item shares the file.
+    """
+    from .image_derivatives import remove_derivatives
+    from .video_transcode import remove_renditions
+
+    file_path = None
+    if item.file_path and is_media_path(item.file_path):
+        if MediaStore.release(item.file_path):
+            file_path = os.path.join(MediaStore.upload_root(), *item.file_path.split('/')[1:])
+    elif item.file_path:
+        file_path = os.path.join(current_app.root_path, item.file_path.lstrip('/'))
+    db.session.delete(item)
+    if file_path is None:
+        return
+
+    directory = os.path.dirname(file_path)
+    legacy = not is_media_path(item.file_path)
+    variants, renditions, thumbnail = item.image_variants, item.video_renditions, item.thumbnail
+
+    def cleanup():
+        if legacy and os.path.exists(file_path):
+            os.remove(file_path)
+        remove_derivatives(variants, directory)
+        remove_renditions(renditions, directory)
+        if thumbnail and is_media_path(thumbnail):
+            thumbnail_path = os.path.join(directory, thumbnail.rsplit('/', 1)[-1])
+            if os.path.exists(thumbnail_path):
+                os.remove(thumbnail_path)
+
+    db.session.info.setdefault(CLEANUP_KEY, []).append(cleanup)
+
+
+def merge_story_media(story_id, rel_path, apply):
+    """
+    Update a story's ``media_files`` entries for ``rel_path`` and commit.
+
+    Image derivatives, the video probe and the transcode worker write into the
+    same JSON column from different processes, and row locks aren't available
+    on SQLite, so the write is a compare-and-swap: it only applies while the
+    column still holds what was read, otherwise the column is re-read and
+    merged again. ``apply(entry)`` changes an entry in place and may return
+    other story columns to set in the same update. Returns False if the story
+    or the entry is gone.
+    """
+    from ..models import Story
+    from .response_cache import response_cache
+
+    for _ in range(STORY_MERGE_ATTEMPTS):
+        current = db.session.execute(
+            select(Story.media_files).where(Story.id == story_id)
+        ).scalar()
+        if not current:
+            return False
+        try:
+            media_files = json.loads(current)
+        except (json.JSONDecodeError, TypeError):
+            return False
+        matched = [media for media in media_files if media.get('file_path') == rel_path]
+        if not matched:
+            return False
+        values = {}
+        for media in matched:
+            values.update(apply(media) or {})
+        result = db.session.execute(
+            update(Story)
+            .where(Story.id == story_id, Story.media_files == current)
+            .values(media_files=json.dumps(media_files), **values)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            db.session.commit()
+            # A Core update skips the flush hooks that bump the story's cache tags
+            response_cache.invalidate('stories', f'story:{story_id}')
+            return True
+        db.session.rollback()
+    raise RuntimeError(f"media_files of story {story_id} kept changing after {STORY_MERGE_ATTEMPTS} attempts")
+
+
+@event.listens_for(Session, 'after_commit')
+def _unlink_after_commit(session):
+    for file_path in session.info.pop(SESSION_KEY, ()):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete media file {file_path}: {e}")
+    for cleanup in session.info.pop(CLEANUP_KEY, ()):
+        try:
+            cleanup()
+        except OSError as e:
+            logger.warning(f"Could not delete derived media files: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_after_rollback(session):
+    session.info.pop(SESSION_KEY, None)
+    session.info.pop(CLEANUP_KEY, None)
@@ -0,0 +1,224 @@
+"""
+Listing pagination helpers.
+
+``paginate_listing`` serves both pagination modes the list endpoints accept:
+
+* ``?page=N`` keeps the classic OFFSET pages. The ``COUNT(*)`` behind
+  ``total``/``pages`` is cached per filter set for ``LISTING_TOTAL_CACHE_TTL``
+  seconds, so turning pages doesn't re-run it.
+* ``?cursor=`` (an empty value starts at the first row) switches to keyset
+  pagination. The keyset is the query's own ORDER BY (search rank, language
+  preference, an admin's sort column) followed by ``(created_at, id)``, so
+  cursor pages come in the same order as numbered pages. For plain
+  newest-first listings each page is an indexed range scan however deep the
+  client has scrolled. The response carries ``next_cursor`` for the
+  following page.
+
+Both modes order by the full keyset, so ties never straddle two pages.
+NULLs in a custom sort column always sort last. Rows with no ``created_at``
+have no place in the keyset and are left out of cursor pages; they are still
+listed in numbered pages.
+"""
+import json
+import base64
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from ..extensions import db
+
+# Upper bound on distinct filter sets whose totals are kept
+MAX_CACHED_TOTALS = 1024
+
+_totals = OrderedDict()
+_totals_lock = threading.Lock()
+
+
+class InvalidCursor(ValueError):
+    """Raised when a ``cursor`` parameter can't be decoded"""
+
+
+def _encode_value(value):
+    if isinstance(value, (datetime, date)):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value['dt'])
+    if isinstance(value, list):
+        raise ValueError('not a scalar')
+    return value
+
+
+def encode_cursor(values):
+    """An opaque token for the keyset values of the last row on a page"""
+    raw = json.dumps([_encode_value(value) for value in values], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, length=None):
+    """Return the keyset values in a cursor produced by ``encode_cursor``"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        values = [_decode_value(value) for value in json.loads(raw)]
+    except (ValueError, TypeError, KeyError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {token!r}") from e
+    if length is not None and len(values) != length:
+        raise InvalidCursor(f"Cursor does not match this listing: {token!r}")
+    return values
+
+
+def cached_total(query):
+    """``COUNT(*)`` for a query, reused for identical filters within the TTL"""
+    count_query = query.order_by(None)
+    ttl = current_app.config.get('LISTING_TOTAL_CACHE_TTL', 60)
+    if ttl <= 0:
+        return count_query.count()
+
+    compiled = count_query.statement.compile(dialect=db.engine.dialect)
+    params = sorted(compiled.params.items(), key=itemgetter(0))
+    key = (str(db.engine.url), str(compiled), repr(params))
+    now = time.monotonic()
+    with _totals_lock:
+        entry = _totals.get(key)
+        if entry and entry[1] > now:
+            _totals.move_to_end(key)
+            return entry[0]
+
+    total = count_query.count()
+    with _totals_lock:
+        _totals[key] = (total, now + ttl)
+        _totals.move_to_end(key)
+        while len(_totals) > MAX_CACHED_TOTALS:
+            _totals.popitem(last=False)
+    return total
+
+
+def clear_cached_totals():
+    with _totals_lock:
+        _totals.clear()
+
+
+class ListingPage:
+    """One page of a listing in either offset or cursor mode"""
+
+    def __init__(self, items, per_page, total, page=None, cursor=None, next_cursor=None, has_next=False):
+        self.items = items
+        self.per_page = per_page
+        self.total = total
+        self.page = page
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.has_next = has_next
+
+    @property
+    def is_cursor(self):
+        return self.cursor is not None
+
+    @property
+    def pages(self):
+        return -(-self.total // self.per_page) if self.total else 0
+
+    @property
+    def has_prev(self):
+        return bool(self.cursor) if self.is_cursor else self.page > 1
+
+    def meta(self):
+        if self.is_cursor:
+            return {
+                'per_page': self.per_page,
+                'total': self.total,
+                'cursor': self.cursor or None,
+                'next_cursor': self.next_cursor,
+                'has_next': self.has_next
+            }
+        return {
+            'page': self.page,
+            'per_page': self.per_page,
+            'total': self.total,
+            'pages': self.pages,
+            'has_next': self.has_next,
+            'has_prev': self.has_prev
+        }
+
+
+def _keyset(query, created_column, id_column, descending):
+    """
+    ``(expression, descending)`` terms ordering a listing: the query's own
+    ORDER BY, then ``created_column`` and ``id_column`` unless it already
+    sorts by them. A nullable custom column is preceded by an IS NULL flag so
+    its NULLs sort last on every database.
+    """
+    created, row_id = created_column.expression, id_column.expression
+    keys = []
+    created_descending = has_id = None
+    for clause in query._order_by_clauses:
+        term_descending = False
+        if isinstance(clause, UnaryExpression) and clause.modifier in (operators.desc_op, operators.asc_op):
+            term_descending = clause.modifier is operators.desc_op
+            clause = clause.element
+        if clause.compare(created):
+            created_descending = term_descending
+        elif clause.compare(row_id):
+            has_id = True
+        elif getattr(clause, 'nullable', False):
+            keys.append((clause.is_(None), False))
+        keys.append((clause, term_descending))
+    if created_descending is None:
+        created_descending = descending
+        keys.append((created, descending))
+    if not has_id:
+        keys.append((row_id, created_descending))
+    return keys
+
+
+def _after(keys, values):
+    """Rows strictly after ``values`` in keyset order"""
+    terms = []
+    for index, (expression, descending) in enumerate(keys):
+        value = values[index]
+        ties = [key == tied for (key, _), tied in zip(keys[:index], values[:index])]
+        terms.append(and_(*ties, expression < value if descending else expression > value))
+    return or_(*terms)
+
+
+def paginate_listing(query, created_column, id_column, page=1, per_page=20, cursor=None, descending=True):
+    """
+    Paginate a listing query.
+
+    The query keeps its own ordering, with ``(created_column, id_column)``
+    appended as tie-breakers (newest first unless ``descending`` is False).
+    With ``cursor`` (``''`` for the first page) pages are fetched by keyset
+    on that ordering; otherwise by OFFSET.
+    """
+    per_page = max(per_page or 1, 1)
+    total = cached_total(query)
+    keys = _keyset(query, created_column, id_column, descending)
+    ordered = query.order_by(None).order_by(*[key.desc() if key_descending else key.asc()
+                                              for key, key_descending in keys])
+
+    if cursor is None:
+        page = max(page or 1, 1)
+        items = ordered.limit(per_page).offset((page - 1) * per_page).all()
+        return ListingPage(items, per_page, total, page=page,
+                           has_next=page * per_page < total)
+
+    keyset = ordered.filter(created_column.isnot(None))
+    if cursor:
+        keyset = keyset.filter(_after(keys, decode_cursor(cursor, len(keys))))
+    rows = keyset.add_columns(*[key.label(f'keyset_{index}') for index, (key, _) in enumerate(keys)]) \
+        .limit(per_page + 1).all()
+    items = [row[0] for row in rows[:per_page]]
+    has_next = len(rows) > per_page
+    next_cursor = encode_cursor(list(rows[per_page - 1])[1:]) if has_next else None
+    return ListingPage(items, per_page, total, cursor=cursor,
+                       next_cursor=next_cursor, has_next=has_next)
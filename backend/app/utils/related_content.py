@@ -0,0 +1,272 @@
+"""
+Related-content graph for stories.
+
+Each published story keeps its top-N most similar published stories in
+``story_relations``. Similarity combines shared tags, category, language and
+co-likes (users who liked both stories). Publishing, editing, unpublishing or
+deleting a story marks it dirty; once the transaction commits, a
+``related.refresh`` job recomputes its neighbour list and refreshes the edges
+pointing back at it, so the detail endpoint only needs one indexed lookup.
+Refreshing scores up to ``MAX_CANDIDATES`` stories, so it runs in a worker
+rather than on the request that saved the story (``RELATED_REFRESH_ASYNC``
+off refreshes right after the commit instead).
+"""
+import logging
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import event, select, delete, insert, func, and_
+from sqlalchemy.orm import Session
+
+from ..extensions import db
+from ..models import Story, StoryLike
+from ..models_tags import story_tags
+from ..models_related import StoryRelation
+
+logger = logging.getLogger(__name__)
+
+# Score weights
+TAG_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+LANGUAGE_WEIGHT = 1.0
+CO_LIKE_WEIGHT = 1.0
+MAX_CO_LIKES = 5  # Cap so one very popular pair doesn't swamp topical similarity
+
+# Upper bound on candidates scored per story
+MAX_CANDIDATES = 200
+
+# Story fields that change a story's similarity to others
+RELATED_FIELDS = ('status', 'category', 'language', 'tags')
+
+SESSION_KEY = 'related_content_dirty'
+
+stories = Story.__table__
+likes = StoryLike.__table__
+relations = StoryRelation.__table__
+
+
+class RelatedContent:
+    """Computes and reads the story similarity graph"""
+
+    @staticmethod
+    def neighbours_count():
+        return current_app.config.get('RELATED_STORIES_COUNT', 6)
+
+    @staticmethod
+    def related_stories(story_id, limit=None):
+        """Return the precomputed related stories for a story, best first"""
+        return (Story.query
+                .join(StoryRelation, StoryRelation.related_story_id == Story.id)
+                .filter(StoryRelation.story_id == story_id, Story.status == 'published')
+                .order_by(StoryRelation.score.desc())
+                .limit(limit or RelatedContent.neighbours_count())
+                .all())
+
+    # ------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def score_candidates(connection, story):
+        """Return ``{candidate_id: score}`` for published stories similar to ``story``"""
+        shared_tags = dict(connection.execute(
+            select(story_tags.c.story_id, func.count())
+            .where(story_tags.c.tag_id.in_(
+                select(story_tags.c.tag_id).where(story_tags.c.story_id == story.id)
+            ))
+            .where(story_tags.c.story_id != story.id)
+            .group_by(story_tags.c.story_id)
+            .order_by(func.count().desc())
+            .limit(MAX_CANDIDATES)
+        ).all())
+
+        other_likes = likes.alias('other_likes')
+        co_likes = dict(connection.execute(
+            select(other_likes.c.story_id, func.count())
+            .select_from(likes.join(other_likes, likes.c.user_id == other_likes.c.user_id))
+            .where(likes.c.story_id == story.id, other_likes.c.story_id != story.id)
+            .group_by(other_likes.c.story_id)
+            .order_by(func.count().desc())
+            .limit(MAX_CANDIDATES)
+        ).all())
+
+        candidate_ids = set(shared_tags) | set(co_likes)
+        if story.category:
+            # Stories sharing only the category still make reasonable neighbours
+            candidate_ids.update(connection.execute(
+                select(stories.c.id)
+                .where(stories.c.category == story.category,
+                       stories.c.status == 'published',
+                       stories.c.id != story.id)
+                .order_by(stories.c.created_at.desc())
+                .limit(MAX_CANDIDATES)
+            ).scalars())
+        if not candidate_ids:
+            return {}
+
+        scores = {}
+        rows = connection.execute(
+            select(stories.c.id, stories.c.category, stories.c.language)
+            .where(stories.c.id.in_(candidate_ids), stories.c.status == 'published')
+        )
+        for candidate_id, category, language in rows:
+            score = TAG_WEIGHT * shared_tags.get(candidate_id, 0)
+            score += CO_LIKE_WEIGHT * min(co_likes.get(candidate_id, 0), MAX_CO_LIKES)
+            if story.category and category == story.category:
+                score += CATEGORY_WEIGHT
+            if score <= 0:
+                continue
+            if language == story.language:
+                score += LANGUAGE_WEIGHT
+            scores[candidate_id] = score
+        return scores
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _write_neighbours(connection, story_id, scores, limit):
+        top = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+        connection.execute(delete(relations).where(relations.c.story_id == story_id))
+        if top:
+            now = datetime.utcnow()
+            connection.execute(insert(relations), [
+                {'story_id': story_id, 'related_story_id': related_id, 'score': score, 'updated_at': now}
+                for related_id, score in top
+            ])
+
+    @staticmethod
+    def _offer_edge(connection, story_id, related_id, score, limit):
+        """Add ``story_id -> related_id`` if it makes story_id's top-N, then trim"""
+        existing = connection.execute(
+            select(relations.c.related_story_id, relations.c.score)
+            .where(relations.c.story_id == story_id)
+        ).all()
+        scores = {row.related_story_id: row.score for row in existing}
+        if len(scores) >= limit and related_id not in scores and score <= min(scores.values()):
+            return
+        scores[related_id] = score
+        RelatedContent._write_neighbours(connection, story_id, scores, limit)
+
+    @staticmethod
+    def recompute(connection, story_id, cascade=True):
+        """Recompute one story's neighbours (and, with cascade, the edges pointing at it)"""
+        limit = RelatedContent.neighbours_count()
+        story = connection.execute(
+            select(stories.c.id, stories.c.status, stories.c.category, stories.c.language)
+            .where(stories.c.id == story_id)
+        ).first()
+
+        if story is None or story.status != 'published':
+            # Drop the story from the graph and refill the lists it was part of
+            referrers = connection.execute(
+                select(relations.c.story_id).where(relations.c.related_story_id == story_id)
+            ).scalars().all()
+            connection.execute(delete(relations).where(
+                (relations.c.story_id == story_id) | (relations.c.related_story_id == story_id)
+            ))
+            if cascade:
+                for referrer_id in referrers:
+                    RelatedContent.recompute(connection, referrer_id, cascade=False)
+            return
+
+        scores = RelatedContent.score_candidates(connection, story)
+        RelatedContent._write_neighbours(connection, story_id, scores, limit)
+        if not cascade:
+            return
+
+        # Scores are symmetric, so each candidate may now want this story back
+        stale = set(connection.execute(
+            select(relations.c.story_id).where(relations.c.related_story_id == story_id)
+        ).scalars()) - set(scores)
+        if stale:
+            connection.execute(delete(relations).where(and_(
+                relations.c.related_story_id == story_id, relations.c.story_id.in_(stale)
+            )))
+        for candidate_id, score in scores.items():
+            RelatedContent._offer_edge(connection, candidate_id, story_id, score, limit)
+
+    @staticmethod
+    def schedule(story_ids):
+        """Queue a refresh of the graph around stories changed in a committed transaction"""
+        if not current_app.config.get('RELATED_REFRESH_ASYNC', True):
+            RelatedContent.refresh(story_ids)
+            return
+        from ..tasks import refresh_related_stories
+        try:
+            with db.engine.begin() as connection:
+                refresh_related_stories.enqueue_on(connection, story_ids=list(story_ids))
+        except Exception as e:
+            logger.error(f"Could not queue related content refresh for stories {list(story_ids)}: {str(e)}")
+
+    @staticmethod
+    def refresh(story_ids):
+        """Recompute the graph around stories changed in a committed transaction"""
+        for story_id in story_ids:
+            try:
+                with db.engine.begin() as connection:
+                    RelatedContent.recompute(connection, story_id)
+            except Exception as e:
+                logger.error(f"Related content refresh failed for story {story_id}: {str(e)}")
+
+    @staticmethod
+    def rebuild(batch_size=200):
+        """Recompute every published story's neighbour list from scratch"""
+        with db.engine.begin() as connection:
+            connection.execute(delete(relations))
+        last_id = 0
+        total = 0
+        while True:
+            ids = db.session.execute(
+                select(stories.c.id)
+                .where(stories.c.status == 'published', stories.c.id > last_id)
+                .order_by(stories.c.id)
+                .limit(batch_size)
+            ).scalars().all()
+            db.session.commit()
+            if not ids:
+                break
+            with db.engine.begin() as connection:
+                for story_id in ids:
+                    RelatedContent.recompute(connection, story_id, cascade=False)
+            last_id = ids[-1]
+            total += len(ids)
+        logger.info(f"Rebuilt related-content graph for {total} stories")
+        return total
+
+
+def _mark_dirty(target):
+    session = db.inspect(target).session
+    if session is not None:
+        session.info.setdefault(SESSION_KEY, set()).add(target.id)
+
+
+@event.listens_for(Story, 'after_insert')
+def _story_inserted(mapper, connection, target):
+    if target.status == 'published':
+        _mark_dirty(target)
+
+
+@event.listens_for(Story, 'after_update')
+def _story_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in RELATED_FIELDS):
+        _mark_dirty(target)
+
+
+@event.listens_for(Story, 'after_delete')
+def _story_deleted(mapper, connection, target):
+    _mark_dirty(target)
+
+
+@event.listens_for(Session, 'after_commit')
+def _refresh_after_commit(session):
+    story_ids = session.info.pop(SESSION_KEY, None)
+    if story_ids:
+        RelatedContent.schedule(sorted(story_ids))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop(SESSION_KEY, None)
@@ -0,0 +1,352 @@
+"""
+Tag-invalidated cache for public GET endpoints.
+
+``@response_cache.cached('gallery')`` keeps a view's 200 responses in process
+memory. The key is built from the path, the sorted query arguments and the
+normalized ``lang``. Each entry records the version of every dependency tag it
+was built against. Flushing a change to a model in ``MODEL_TAGS`` bumps the
+matching versions in ``cache_tag_versions`` inside the same transaction, so the
+admin, bulk and story bulk write routes invalidate without calling into the
+cache. The worker that committed the change drops its own copies immediately.
+Other workers re-read the versions they depend on at most every
+``RESPONSE_CACHE_TAG_CHECK_INTERVAL`` seconds.
+
+Concurrent misses for one key are coalesced: a single request rebuilds the
+entry while the others wait for it instead of running the same queries.
+``response_cache.stats()`` reports hits and misses per endpoint.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, request, make_response
+from sqlalchemy import event, select, update, insert
+from sqlalchemy.orm import Session
+
+from ..extensions import db
+from ..models import Story, GalleryItem, Tour
+from ..models_book import Book, Author
+from ..models_page_content import PageContent
+from ..models_cache import CacheTagVersion
+from .table_availability import TableAvailability
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_LANGUAGES = ('en', 'it')
+
+OUTCOMES = ('hits', 'misses', 'coalesced', 'stale')
+
+tag_versions = CacheTagVersion.__table__
+
+# model -> (collection tag, per-object tag prefix); a change to tour 12 bumps 'tours' and 'tour:12'
+MODEL_TAGS = {
+    Story: ('stories', 'story'),
+    GalleryItem: ('gallery', 'gallery'),
+    Tour: ('tours', 'tour'),
+    Book: ('books', 'book'),
+    Author: ('authors', 'author'),
+    PageContent: ('page_content', 'page_content'),
+}
+
+_availability = TableAvailability()
+
+
+def is_available(connection):
+    """Check whether the tag version table has been created (memoized per engine, see ``TableAvailability``)"""
+    return _availability.check(
+        connection, lambda conn: db.inspect(conn).has_table(CacheTagVersion.__tablename__))
+
+
+def bump_tags(connection, tags):
+    """Increment the version of each tag, creating missing tags at version 1"""
+    now = datetime.utcnow()
+    tags = sorted(tags)  # Consistent lock order across concurrent writers
+    if connection.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        dialect_insert = None
+
+    if dialect_insert is not None:
+        statement = dialect_insert(tag_versions).values(
+            [{'tag': tag, 'version': 1, 'updated_at': now} for tag in tags]
+        )
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[tag_versions.c.tag],
+            set_={'version': tag_versions.c.version + 1, 'updated_at': now}
+        ))
+        return
+
+    for tag in tags:
+        result = connection.execute(
+            update(tag_versions).where(tag_versions.c.tag == tag)
+            .values(version=tag_versions.c.version + 1, updated_at=now)
+        )
+        if not result.rowcount:
+            connection.execute(insert(tag_versions).values(tag=tag, version=1, updated_at=now))
+
+
+class _Entry:
+    __slots__ = ('body', 'status', 'mimetype', 'versions', 'expires')
+
+    def __init__(self, body, status, mimetype, versions, expires):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.versions = versions
+        self.expires = expires
+
+
+class ResponseCache:
+    """In-process response store validated against shared tag versions"""
+
+    def __init__(self):
+        self.app = None
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._fills = {}  # key -> Event set when the in-flight rebuild finishes
+        self._versions = {}  # tag -> last version read from the database
+        self._versions_read_at = 0.0
+        self._stats = defaultdict(lambda: dict.fromkeys(OUTCOMES, 0))
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['response_cache'] = self
+
+    @property
+    def enabled(self):
+        config = current_app.config
+        return (config.get('RESPONSE_CACHE_ENABLED', True)
+                and str(config.get('CACHE_TYPE', 'simple')).lower() not in ('null', 'nullcache'))
+
+    def cached(self, *tags, timeout=None):
+        """
+        Cache a GET view's 200 responses until one of ``tags`` is invalidated.
+
+        Tags may reference the view's arguments, e.g. ``'tour:{tour_id}'``.
+        ``timeout`` defaults to ``CACHE_DEFAULT_TIMEOUT``.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method != 'GET' or not self.enabled:
+                    return view(*args, **kwargs)
+                resolved = [tag.format(**kwargs) for tag in tags]
+                return self._serve(view, args, kwargs, resolved, timeout)
+            return wrapper
+        return decorator
+
+    # ------------------------------------------------------------------
+    # Serving
+    # ------------------------------------------------------------------
+
+    def _key(self):
+        args = sorted((name, value) for name, value in request.args.items(multi=True) if name != 'lang')
+        language = request.args.get('lang', 'en').strip()
+        if language not in SUPPORTED_LANGUAGES:
+            language = 'en'
+        prefix = current_app.config.get('CACHE_KEY_PREFIX', '')
+        return f"{prefix}{request.path}?{urlencode(args)}|lang={language}"
+
+    def _serve(self, view, args, kwargs, tags, timeout):
+        endpoint = request.endpoint
+        try:
+            versions = self._current_versions(tags)
+        except Exception as e:
+            logger.warning(f"Response cache bypassed, tag versions unavailable: {str(e)}")
+            return view(*args, **kwargs)
+        if versions is None:
+            return view(*args, **kwargs)
+
+        key = self._key()
+        with self._lock:
+            entry = self._lookup(key, versions, endpoint)
+            if entry is not None:
+                self._stats[endpoint]['hits'] += 1
+                return self._respond(entry, 'HIT')
+            fill = self._fills.get(key)
+            leader = fill is None
+            if leader:
+                fill = self._fills[key] = threading.Event()
+
+        if not leader:
+            # Another request is already rebuilding this entry
+            fill.wait(current_app.config.get('RESPONSE_CACHE_FILL_TIMEOUT', 10))
+            with self._lock:
+                entry = self._lookup(key, versions, endpoint)
+                self._stats[endpoint]['coalesced' if entry is not None else 'misses'] += 1
+            if entry is not None:
+                return self._respond(entry, 'HIT')
+            return view(*args, **kwargs)
+
+        try:
+            with self._lock:
+                self._stats[endpoint]['misses'] += 1
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                self._store(key, response, versions, timeout)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        finally:
+            with self._lock:
+                self._fills.pop(key, None)
+            fill.set()
+
+    def _lookup(self, key, versions, endpoint):
+        """Return a usable entry for ``key`` (call with the lock held)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic() or entry.versions != versions:
+            del self._entries[key]
+            self._stats[endpoint]['stale'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, response, versions, timeout):
+        if timeout is None:
+            timeout = current_app.config.get('CACHE_DEFAULT_TIMEOUT', 300)
+        entry = _Entry(response.get_data(), response.status_code, response.mimetype,
+                       versions, time.monotonic() + timeout)
+        max_entries = current_app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 2048)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _respond(entry, outcome):
+        response = current_app.response_class(entry.body, status=entry.status, mimetype=entry.mimetype)
+        response.headers['X-Cache'] = outcome
+        return response
+
+    # ------------------------------------------------------------------
+    # Tag versions
+    # ------------------------------------------------------------------
+
+    def _current_versions(self, tags):
+        """Return ``{tag: version}`` for ``tags``, or None before the table exists"""
+        connection = db.session.connection()
+        if not is_available(connection):
+            return None
+        now = time.monotonic()
+        interval = current_app.config.get('RESPONSE_CACHE_TAG_CHECK_INTERVAL', 1.0)
+        with self._lock:
+            expired = now - self._versions_read_at >= interval
+            wanted = set(tags) | set(self._versions) if expired else {
+                tag for tag in tags if tag not in self._versions
+            }
+        if wanted:
+            rows = connection.execute(
+                select(tag_versions.c.tag, tag_versions.c.version).where(tag_versions.c.tag.in_(sorted(wanted)))
+            ).all()
+            loaded = dict.fromkeys(wanted, 0)
+            loaded.update({tag: version for tag, version in rows})
+            with self._lock:
+                self._versions.update(loaded)
+                if expired:
+                    self._versions_read_at = now
+        with self._lock:
+            return {tag: self._versions.get(tag) for tag in tags}
+
+    def expire_local(self, tags):
+        """Forget this process's versions of ``tags`` so the next lookup re-reads them"""
+        with self._lock:
+            for tag in tags:
+                self._versions.pop(tag, None)
+
+    def invalidate(self, *tags):
+        """Invalidate tags outside an ORM flush (e.g. after a Core bulk statement)"""
+        if not tags:
+            return
+        with db.engine.begin() as connection:
+            if not is_available(connection):
+                return
+            bump_tags(connection, tags)
+        self.expire_local(tags)
+
+    # ------------------------------------------------------------------
+    # Introspection
+    # ------------------------------------------------------------------
+
+    def stats(self):
+        with self._lock:
+            endpoints = {endpoint: dict(counts) for endpoint, counts in self._stats.items()}
+            entries = len(self._entries)
+        totals = {outcome: sum(counts[outcome] for counts in endpoints.values()) for outcome in OUTCOMES}
+        served = totals['hits'] + totals['coalesced'] + totals['misses']
+        return {
+            'entries': entries,
+            'hit_ratio': round((totals['hits'] + totals['coalesced']) / served, 4) if served else None,
+            'totals': totals,
+            'endpoints': endpoints
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._versions_read_at = 0.0
+            self._stats.clear()
+
+
+response_cache = ResponseCache()
+
+
+def _flushed_tags(session):
+    tags = set()
+    for obj in session.new:
+        if type(obj) in MODEL_TAGS:
+            tags.add(MODEL_TAGS[type(obj)][0])
+    for obj in session.dirty:
+        if type(obj) in MODEL_TAGS and session.is_modified(obj, include_collections=False):
+            collection, prefix = MODEL_TAGS[type(obj)]
+            tags.update((collection, f"{prefix}:{obj.id}"))
+    for obj in session.deleted:
+        if type(obj) in MODEL_TAGS:
+            collection, prefix = MODEL_TAGS[type(obj)]
+            tags.update((collection, f"{prefix}:{obj.id}"))
+    return tags
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_flushed_tags(session, flush_context):
+    tags = _flushed_tags(session)
+    bumped = session.info.setdefault('response_cache_tags', set())
+    tags -= bumped
+    if not tags:
+        return
+    connection = session.connection()
+    if is_available(connection):
+        bump_tags(connection, tags)
+        bumped.update(tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def _expire_committed_tags(session):
+    tags = session.info.pop('response_cache_tags', None)
+    if tags:
+        response_cache.expire_local(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back_tags(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('response_cache_tags', None)
+
+
+@event.listens_for(tag_versions, 'after_create')
+def _tag_versions_created(table, connection, **kwargs):
+    _availability.mark(connection)
+
+
+@event.listens_for(tag_versions, 'before_drop')
+def _tag_versions_dropped(table, connection, **kwargs):
+    _availability.forget(connection)
@@ -0,0 +1,262 @@
+"""
+Resumable chunked uploads (the core of the tus 1.0 protocol).
+
+A client creates an upload by sending its total size and file name. It then
+PATCHes chunks at increasing offsets. Each chunk is streamed straight into a
+partial file under the instance folder, outside the publicly served uploads
+folder. The extension and declared size are checked when the upload is
+created. The content is checked against the extension's magic bytes once the
+first bytes arrive. After a dropped connection the client asks for the current
+offset (HEAD) and carries on from there. When every byte has arrived,
+``claim`` hands the file to the gallery or story record creation.
+"""
+import os
+import fcntl
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+
+from ..extensions import db
+from ..models_uploads import UploadSession
+
+logger = logging.getLogger(__name__)
+
+TUS_VERSION = '1.0.0'
+
+CHUNK_READ_SIZE = 64 * 1024
+
+# Bytes needed before the content type can be checked
+SNIFF_BYTES = 16
+
+# purpose -> {extension: file type}
+UPLOAD_TYPES = {
+    'gallery': {
+        **dict.fromkeys(('png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp', 'svg'), 'image'),
+        **dict.fromkeys(('mp4', 'webm', 'avi', 'mov', 'mkv', 'flv', 'wmv'), 'video'),
+        **dict.fromkeys(('pdf', 'doc', 'docx', 'txt'), 'document'),
+    },
+    'story': {
+        **dict.fromkeys(('png', 'jpg', 'jpeg', 'gif', 'webp'), 'image'),
+        **dict.fromkeys(('mp4', 'mov', 'avi', 'webm'), 'video'),
+    },
+}
+
+_ISO_BMFF_BOXES = (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip')
+
+# extension -> check on the first SNIFF_BYTES of the file
+SIGNATURES = {
+    'jpg': lambda head: head.startswith(b'\xff\xd8\xff'),
+    'jpeg': lambda head: head.startswith(b'\xff\xd8\xff'),
+    'png': lambda head: head.startswith(b'\x89PNG\r\n\x1a\n'),
+    'gif': lambda head: head[:6] in (b'GIF87a', b'GIF89a'),
+    'webp': lambda head: head[:4] == b'RIFF' and head[8:12] == b'WEBP',
+    'bmp': lambda head: head.startswith(b'BM'),
+    'svg': lambda head: head.lstrip().startswith((b'<?xml', b'<svg', b'<!--', b'<!DOCTYPE')),
+    'mp4': lambda head: head[4:8] in _ISO_BMFF_BOXES,
+    'mov': lambda head: head[4:8] in _ISO_BMFF_BOXES,
+    'webm': lambda head: head.startswith(b'\x1a\x45\xdf\xa3'),
+    'mkv': lambda head: head.startswith(b'\x1a\x45\xdf\xa3'),
+    'avi': lambda head: head[:4] == b'RIFF' and head[8:11] == b'AVI',
+    'flv': lambda head: head.startswith(b'FLV'),
+    'wmv': lambda head: head.startswith(b'\x30\x26\xb2\x75'),
+    'pdf': lambda head: head.startswith(b'%PDF'),
+    'doc': lambda head: head.startswith(b'\xd0\xcf\x11\xe0'),
+    'docx': lambda head: head.startswith(b'PK\x03\x04'),
+}
+
+
+class UploadError(Exception):
+    """A request the upload protocol rejects; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, code='UPLOAD_ERROR', offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+        self.offset = offset
+
+
+class ResumableUploads:
+    """Upload session lifecycle; every method commits the current session"""
+
+    @staticmethod
+    def storage_dir():
+        return (current_app.config.get('RESUMABLE_UPLOAD_DIR')
+                or os.path.join(current_app.instance_path, 'upload_partials'))
+
+    @staticmethod
+    def partial_path(upload):
+        return os.path.join(ResumableUploads.storage_dir(), f"{upload.id}.part")
+
+    @staticmethod
+    def max_size(purpose):
+        if purpose == 'story':
+            return current_app.config.get('STORY_UPLOAD_MAX_SIZE', 50 * 1024 * 1024)
+        return current_app.config.get('GALLERY_UPLOAD_MAX_SIZE', 512 * 1024 * 1024)
+
+    @staticmethod
+    def _expiry():
+        return datetime.utcnow() + timedelta(hours=current_app.config.get('RESUMABLE_UPLOAD_EXPIRY_HOURS', 24))
+
+    @staticmethod
+    def create(user, purpose, filename, length, mime_type=None):
+        """Validate the declared file and open an upload session for it"""
+        if purpose not in UPLOAD_TYPES:
+            raise UploadError(f"Unknown upload purpose: {purpose}", code='INVALID_PURPOSE')
+        if purpose == 'gallery' and not user.is_admin_user():
+            raise UploadError('Admin access required', 403, 'ACCESS_DENIED')
+        if not filename or '.' not in filename:
+            raise UploadError('Invalid file format', code='INVALID_FORMAT')
+        file_ext = filename.rsplit('.', 1)[1].lower()
+        if file_ext not in UPLOAD_TYPES[purpose]:
+            raise UploadError(f"File type .{file_ext} not supported", 415, 'UNSUPPORTED_TYPE')
+        if length is None or length <= 0:
+            raise UploadError('Upload-Length must be a positive integer', code='INVALID_LENGTH')
+        if length > ResumableUploads.max_size(purpose):
+            raise UploadError('File is too large', 413, 'FILE_TOO_LARGE')
+
+        upload = UploadSession(
+            id=uuid.uuid4().hex,
+            user_id=user.id,
+            purpose=purpose,
+            filename=filename[:255],
+            file_ext=file_ext,
+            file_type=UPLOAD_TYPES[purpose][file_ext],
+            mime_type=(mime_type or '')[:100] or None,
+            length=length,
+            offset=0,
+            status='uploading',
+            expires_at=ResumableUploads._expiry()
+        )
+        os.makedirs(ResumableUploads.storage_dir(), exist_ok=True)
+        open(ResumableUploads.partial_path(upload), 'wb').close()
+        db.session.add(upload)
+        db.session.commit()
+        return upload
+
+    @staticmethod
+    def get(upload_id, user):
+        """Return the caller's live upload session or raise a 404"""
+        upload = db.session.get(UploadSession, upload_id)
+        if (upload is None or upload.user_id != user.id
+                or upload.expires_at < datetime.utcnow()):
+            raise UploadError('Upload not found', 404, 'NOT_FOUND')
+        return upload
+
+    @staticmethod
+    def append(upload, offset, stream, content_length=None):
+        """
+        Write one chunk at ``offset`` and return the new offset.
+
+        A second writer on the same upload is turned away (423) while the
+        partial file is locked. Bytes that arrive before a dropped connection
+        are kept, so the client can resume from the offset it reads back.
+        """
+        path = ResumableUploads.partial_path(upload)
+        try:
+            handle = open(path, 'r+b')
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404, 'NOT_FOUND')
+
+        with handle:
+            try:
+                # Non-blocking: a blocked flock would stall every greenlet in the worker
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another chunk is being written to this upload', 423, 'UPLOAD_LOCKED')
+            db.session.refresh(upload)  # Another request may have moved it on
+            if upload.status != 'uploading' or offset != upload.offset:
+                raise UploadError('Upload-Offset does not match the upload', 409, 'OFFSET_MISMATCH',
+                                  offset=upload.offset)
+            remaining = upload.length - offset
+            if content_length is not None and content_length > remaining:
+                raise UploadError('Chunk exceeds the declared upload length', 413, 'CHUNK_TOO_LARGE',
+                                  offset=upload.offset)
+
+            handle.seek(offset)
+            handle.truncate()
+            written = 0
+            try:
+                while written < remaining:
+                    block = stream.read(min(CHUNK_READ_SIZE, remaining - written))
+                    if not block:
+                        break
+                    handle.write(block)
+                    written += len(block)
+                if stream.read(1):
+                    handle.seek(offset)
+                    handle.truncate()
+                    written = 0
+                    raise UploadError('Chunk exceeds the declared upload length', 413, 'CHUNK_TOO_LARGE',
+                                      offset=upload.offset)
+            finally:
+                handle.flush()
+                if written:
+                    ResumableUploads._advance(upload, handle, offset, written)
+
+        return upload.offset
+
+    @staticmethod
+    def _advance(upload, handle, offset, written):
+        new_offset = offset + written
+        if offset < SNIFF_BYTES and (new_offset >= SNIFF_BYTES or new_offset == upload.length):
+            handle.seek(0)
+            check = SIGNATURES.get(upload.file_ext)
+            if check is not None and not check(handle.read(SNIFF_BYTES)):
+                ResumableUploads.delete(upload)
+                raise UploadError(f"File content does not match .{upload.file_ext}", 415, 'CONTENT_MISMATCH')
+
+        upload.offset = new_offset
+        if upload.is_complete:
+            upload.status = 'complete'
+        upload.expires_at = ResumableUploads._expiry()
+        db.session.commit()
+
+    @staticmethod
+    def claim(upload):
+        """Take a complete upload for finalizing; returns the partial file's path"""
+        result = db.session.execute(
+            update(UploadSession)
+            .where(UploadSession.id == upload.id, UploadSession.status == 'complete')
+            .values(status='finalizing')
+        )
+        db.session.commit()
+        if result.rowcount != 1:
+            raise UploadError('Upload is not complete', 409, 'UPLOAD_INCOMPLETE', offset=upload.offset)
+        return ResumableUploads.partial_path(upload)
+
+    @staticmethod
+    def release(upload, finalized):
+        """End a claim: drop the session once its file has been moved, or reopen it for a retry"""
+        if finalized:
+            db.session.delete(upload)
+        else:
+            db.session.rollback()
+            upload.status = 'complete'
+        db.session.commit()
+
+    @staticmethod
+    def delete(upload):
+        try:
+            os.remove(ResumableUploads.partial_path(upload))
+        except FileNotFoundError:
+            pass
+        db.session.delete(upload)
+        db.session.commit()
+
+    @staticmethod
+    def purge_expired():
+        """Delete expired sessions and their partial files; returns the number removed"""
+        expired = UploadSession.query.filter(UploadSession.expires_at < datetime.utcnow()).all()
+        for upload in expired:
+            try:
+                os.remove(ResumableUploads.partial_path(upload))
+            except FileNotFoundError:
+                pass
+            db.session.delete(upload)
+        db.session.commit()
+        logger.info(f"Purged {len(expired)} expired upload sessions")
+        return len(expired)
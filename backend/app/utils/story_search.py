@@ -0,0 +1,265 @@
+"""
+Full-text search index for published stories.
+
+SQLite databases use an FTS5 virtual table (``story_search``) keyed by the
+story id; PostgreSQL databases use a ``story_search_documents`` table holding a
+weighted tsvector behind a GIN index. Both are kept in sync by mapper events on
+``Story`` so every write path (routes, bulk actions, submission approval) is
+covered without extra calls in the handlers.
+"""
+import re
+import logging
+
+from sqlalchemy import event, text, bindparam, Integer, Float
+
+from ..extensions import db
+from ..models import Story
+from .table_availability import TableAvailability
+
+logger = logging.getLogger(__name__)
+
+# Fields whose changes require the search document to be rewritten
+INDEXED_FIELDS = ('title', 'content', 'tags', 'status')
+
+# Cap the number of terms so a pasted paragraph can't build a huge MATCH query
+MAX_QUERY_TERMS = 8
+
+SQLITE_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS story_search USING fts5(
+        title, content, tags,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """
+]
+
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS story_search_documents (
+        story_id INTEGER PRIMARY KEY REFERENCES stories (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_story_search_documents_document
+        ON story_search_documents USING GIN (document)
+    """
+]
+
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', coalesce(:title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(:tags, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(:content, '')), 'C')"
+)
+
+_availability = TableAvailability()
+
+
+class StorySearchIndex:
+    """Maintains and queries the story full-text index"""
+
+    @staticmethod
+    def _table_name(dialect_name):
+        if dialect_name == 'sqlite':
+            return 'story_search'
+        if dialect_name == 'postgresql':
+            return 'story_search_documents'
+        return None
+
+    @staticmethod
+    def is_available(connection=None):
+        """Check whether the index table exists (memoized per engine, see ``TableAvailability``)"""
+        connection = connection or db.session.connection()
+        table_name = StorySearchIndex._table_name(connection.dialect.name)
+        if not table_name:
+            return False
+        return _availability.check(connection, lambda conn: db.inspect(conn).has_table(table_name))
+
+    @staticmethod
+    def ensure_schema(connection):
+        """Create the index table for the connection's dialect"""
+        dialect_name = connection.dialect.name
+        statements = {'sqlite': SQLITE_SCHEMA, 'postgresql': POSTGRES_SCHEMA}.get(dialect_name)
+        if not statements:
+            logger.info(f"Story search index not supported on {dialect_name}, using LIKE search")
+            return False
+        for statement in statements:
+            connection.execute(text(statement))
+        _availability.mark(connection)
+        return True
+
+    @staticmethod
+    def parse_terms(search):
+        """Split raw user input into safe, lower-cased search terms"""
+        return re.findall(r'\w+', (search or '').lower(), re.UNICODE)[:MAX_QUERY_TERMS]
+
+    @staticmethod
+    def _match_expression(dialect_name, terms):
+        # Every term is prefix-matched so results update while the user types
+        if dialect_name == 'sqlite':
+            return ' '.join(f'"{term}"*' for term in terms)
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def index_story(connection, story):
+        """Write (or remove) the search document for a single story"""
+        if not StorySearchIndex.is_available(connection):
+            return
+        StorySearchIndex.remove_story(connection, story.id)
+        if story.status != 'published':
+            return
+
+        params = {
+            'story_id': story.id,
+            'title': story.title or '',
+            'content': story.content or '',
+            'tags': (story.tags or '').replace(',', ' ')
+        }
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text(
+                "INSERT INTO story_search (rowid, title, content, tags) "
+                "VALUES (:story_id, :title, :content, :tags)"
+            ), params)
+        else:
+            connection.execute(text(
+                f"INSERT INTO story_search_documents (story_id, document) "
+                f"VALUES (:story_id, {POSTGRES_DOCUMENT})"
+            ), params)
+
+    @staticmethod
+    def remove_story(connection, story_id):
+        """Drop a story from the index"""
+        if not StorySearchIndex.is_available(connection):
+            return
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text("DELETE FROM story_search WHERE rowid = :story_id"),
+                               {'story_id': story_id})
+        else:
+            connection.execute(text("DELETE FROM story_search_documents WHERE story_id = :story_id"),
+                               {'story_id': story_id})
+
+    @staticmethod
+    def rebuild():
+        """Create the index if needed and repopulate it from published stories"""
+        connection = db.session.connection()
+        if not StorySearchIndex.ensure_schema(connection):
+            return 0
+
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text("DELETE FROM story_search"))
+            result = connection.execute(text(
+                "INSERT INTO story_search (rowid, title, content, tags) "
+                "SELECT id, title, content, replace(coalesce(tags, ''), ',', ' ') "
+                "FROM stories WHERE status = 'published'"
+            ))
+        else:
+            connection.execute(text("DELETE FROM story_search_documents"))
+            document = (POSTGRES_DOCUMENT
+                        .replace(':title', 'title')
+                        .replace(':tags', "replace(tags, ',', ' ')")
+                        .replace(':content', 'content'))
+            result = connection.execute(text(
+                f"INSERT INTO story_search_documents (story_id, document) "
+                f"SELECT id, {document} FROM stories WHERE status = 'published'"
+            ))
+        db.session.commit()
+        logger.info(f"Rebuilt story search index with {result.rowcount} stories")
+        return result.rowcount
+
+    # ------------------------------------------------------------------
+    # Querying
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def search_subquery(search):
+        """
+        Return a subquery of ``(story_id, rank)`` for matching stories, ordered
+        best-first by ascending ``rank``. Returns None when the index is not
+        available so callers can fall back to LIKE filtering.
+        """
+        terms = StorySearchIndex.parse_terms(search)
+        connection = db.session.connection()
+        if not terms or not StorySearchIndex.is_available(connection):
+            return None
+
+        match = StorySearchIndex._match_expression(connection.dialect.name, terms)
+        if connection.dialect.name == 'sqlite':
+            # bm25() is lower-is-better; weight title over tags over body
+            statement = text(
+                "SELECT rowid AS story_id, bm25(story_search, 10.0, 1.0, 4.0) AS rank "
+                "FROM story_search WHERE story_search MATCH :match"
+            )
+        else:
+            statement = text(
+                "SELECT story_id, -ts_rank_cd(document, to_tsquery('simple', :match)) AS rank "
+                "FROM story_search_documents WHERE document @@ to_tsquery('simple', :match)"
+            )
+        return (statement
+                .bindparams(match=match)
+                .columns(story_id=Integer, rank=Float)
+                .subquery('story_search_hits'))
+
+    @staticmethod
+    def snippets(story_ids, search):
+        """Return highlighted content snippets for a page of matched stories"""
+        terms = StorySearchIndex.parse_terms(search)
+        if not story_ids or not terms:
+            return {}
+        connection = db.session.connection()
+        if not StorySearchIndex.is_available(connection):
+            return {}
+
+        match = StorySearchIndex._match_expression(connection.dialect.name, terms)
+        if connection.dialect.name == 'sqlite':
+            statement = text(
+                "SELECT rowid, snippet(story_search, 1, '<mark>', '</mark>', '…', 24) "
+                "FROM story_search WHERE story_search MATCH :match AND rowid IN :story_ids"
+            )
+        else:
+            statement = text(
+                "SELECT id, ts_headline('simple', content, to_tsquery('simple', :match), "
+                "'StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8') "
+                "FROM stories WHERE id IN :story_ids"
+            )
+        statement = statement.bindparams(bindparam('story_ids', expanding=True))
+        rows = connection.execute(statement, {'match': match, 'story_ids': list(story_ids)})
+        return {row[0]: row[1] for row in rows}
+
+
+def _story_changed(target):
+    state = db.inspect(target)
+    return any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS)
+
+
+@event.listens_for(Story, 'after_insert')
+def _index_inserted_story(mapper, connection, target):
+    StorySearchIndex.index_story(connection, target)
+
+
+@event.listens_for(Story, 'after_update')
+def _index_updated_story(mapper, connection, target):
+    # View/like counter updates don't touch the document, so skip them
+    if _story_changed(target):
+        StorySearchIndex.index_story(connection, target)
+
+
+@event.listens_for(Story, 'after_delete')
+def _unindex_deleted_story(mapper, connection, target):
+    StorySearchIndex.remove_story(connection, target.id)
+
+
+@event.listens_for(Story.__table__, 'after_create')
+def _create_search_schema(table, connection, **kwargs):
+    StorySearchIndex.ensure_schema(connection)
+
+
+@event.listens_for(Story.__table__, 'before_drop')
+def _drop_search_schema(table, connection, **kwargs):
+    table_name = StorySearchIndex._table_name(connection.dialect.name)
+    if table_name:
+        connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+    _availability.forget(connection)
@@ -0,0 +1,51 @@
+"""
+Per-engine memo of whether an optional table exists.
+
+Story search, the tag index and the response cache each depend on a table
+that ``db.create_all()`` or a migration adds, and fall back to a slower path
+without it. Checking the schema on every request would cost a query, so the
+answer is memoized per engine. A positive answer is kept for the life of the
+process. A negative one is re-checked after ``retry_seconds``, so a process
+that started before the migration ran (or probed during a transient failure)
+picks the table up without a restart.
+"""
+import time
+
+# Seconds before a "table missing" answer is probed again
+RETRY_SECONDS = 60
+
+
+class TableAvailability:
+    """Memoizes ``probe(connection)`` per engine, re-probing negative answers"""
+
+    def __init__(self, retry_seconds=RETRY_SECONDS):
+        self.retry_seconds = retry_seconds
+        # engine url -> True, or the monotonic time a negative answer expires
+        self._known = {}
+
+    @staticmethod
+    def _key(connection):
+        return str(connection.engine.url)
+
+    def check(self, connection, probe):
+        """Return whether the table is available, probing when unknown or due for a re-check"""
+        key = self._key(connection)
+        known = self._known.get(key)
+        if known is True:
+            return True
+        if known is not None and time.monotonic() < known:
+            return False
+        available = bool(probe(connection))
+        self._known[key] = True if available else time.monotonic() + self.retry_seconds
+        return available
+
+    def mark(self, connection):
+        """Record that the table was just created on ``connection``'s engine"""
+        self._known[self._key(connection)] = True
+
+    def forget(self, connection=None):
+        """Drop the memo for one engine (e.g. after the table is dropped), or for all"""
+        if connection is None:
+            self._known.clear()
+        else:
+            self._known.pop(self._key(connection), None)
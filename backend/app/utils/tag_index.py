@@ -0,0 +1,197 @@
+"""
+Normalized tag index.
+
+The comma-separated ``tags`` columns stay the source the routes write to; mapper
+events mirror them into the shared ``tags`` table and the per-type association
+tables so tag filters, tag clouds and related-content lookups are indexed joins
+instead of LIKE scans. ``TagIndex.backfill`` migrates rows that existed before
+the index in small keyset batches, so it can run against a live database.
+"""
+import re
+import logging
+from datetime import datetime
+
+from sqlalchemy import event, select, insert, delete, func
+
+from ..extensions import db
+from ..models import Story, GalleryItem
+from ..models_gallery_extended import GalleryAlbum
+from ..models_book import Book
+from ..models_tags import Tag, story_tags, gallery_item_tags, gallery_album_tags, book_tags
+from .table_availability import TableAvailability
+
+logger = logging.getLogger(__name__)
+
+MAX_TAG_LENGTH = 100
+
+_availability = TableAvailability()
+
+# kind -> (model, association table, object id column, tag source columns)
+TAGGED_MODELS = {
+    'story': (Story, story_tags, 'story_id', ('tags',)),
+    'gallery_item': (GalleryItem, gallery_item_tags, 'gallery_item_id', ('tags',)),
+    'gallery_album': (GalleryAlbum, gallery_album_tags, 'album_id', ('tags',)),
+    'book': (Book, book_tags, 'book_id', ('tags', 'tags_it')),
+}
+
+
+class TagIndex:
+    """Maintains and queries the normalized tag tables"""
+
+    @staticmethod
+    def slugify(name):
+        """Normalize a tag for lookups: lower-case, no leading '#', single spaces"""
+        return re.sub(r'\s+', ' ', str(name or '').strip().lstrip('#')).lower()[:MAX_TAG_LENGTH]
+
+    @staticmethod
+    def parse(*raw_values):
+        """Return ``{slug: display name}`` for one or more raw tag values"""
+        tags = {}
+        for raw in raw_values:
+            if not raw:
+                continue
+            names = raw if isinstance(raw, (list, tuple)) else str(raw).split(',')
+            for name in names:
+                slug = TagIndex.slugify(name)
+                if slug and slug not in tags:
+                    tags[slug] = re.sub(r'\s+', ' ', str(name).strip().lstrip('#'))[:MAX_TAG_LENGTH]
+        return tags
+
+    @staticmethod
+    def is_available(connection):
+        """Check whether the tag tables have been created (memoized per engine, see ``TableAvailability``)"""
+        return _availability.check(connection, lambda conn: db.inspect(conn).has_table(Tag.__tablename__))
+
+    @staticmethod
+    def _tag_ids(connection, tags):
+        """Resolve slugs to tag ids, creating any tags that don't exist yet"""
+        if not tags:
+            return []
+        tag_table = Tag.__table__
+        lookup = select(tag_table.c.slug, tag_table.c.id).where(tag_table.c.slug.in_(list(tags)))
+        ids = dict(connection.execute(lookup).all())
+
+        missing = [{'slug': slug, 'name': name} for slug, name in tags.items() if slug not in ids]
+        if missing:
+            if connection.dialect.name in ('sqlite', 'postgresql'):
+                # Concurrent writers may create the same tag; let the unique index arbitrate
+                if connection.dialect.name == 'sqlite':
+                    from sqlalchemy.dialects.sqlite import insert as dialect_insert
+                else:
+                    from sqlalchemy.dialects.postgresql import insert as dialect_insert
+                statement = dialect_insert(tag_table).on_conflict_do_nothing(index_elements=['slug'])
+            else:
+                statement = insert(tag_table)
+            connection.execute(statement, [dict(row, created_at=datetime.utcnow()) for row in missing])
+            ids = dict(connection.execute(lookup).all())
+        return list(ids.values())
+
+    @staticmethod
+    def sync(connection, kind, object_id, *raw_values):
+        """Replace the association rows for one object"""
+        model, table, column, _ = TAGGED_MODELS[kind]
+        tag_ids = TagIndex._tag_ids(connection, TagIndex.parse(*raw_values))
+        connection.execute(delete(table).where(table.c[column] == object_id))
+        if tag_ids:
+            connection.execute(insert(table), [{column: object_id, 'tag_id': tag_id} for tag_id in tag_ids])
+
+    @staticmethod
+    def backfill(kinds=None, batch_size=500):
+        """Populate the association tables from the existing tag strings"""
+        db.create_all()
+        _availability.forget()
+        totals = {}
+        for kind in kinds or TAGGED_MODELS:
+            model, _, _, source_columns = TAGGED_MODELS[kind]
+            columns = [getattr(model, name) for name in source_columns]
+            last_id = 0
+            totals[kind] = 0
+            while True:
+                rows = (db.session.query(model.id, *columns)
+                        .filter(model.id > last_id)
+                        .order_by(model.id)
+                        .limit(batch_size)
+                        .all())
+                if not rows:
+                    break
+                connection = db.session.connection()
+                for row in rows:
+                    TagIndex.sync(connection, kind, row[0], *row[1:])
+                # Commit per batch to keep write locks short on a live database
+                db.session.commit()
+                last_id = rows[-1][0]
+                totals[kind] += len(rows)
+            logger.info(f"Tag backfill: {totals[kind]} {kind} rows indexed")
+        return totals
+
+    # ------------------------------------------------------------------
+    # Querying
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def ids_with_tag(kind, tag):
+        """Select object ids carrying a tag (usable with ``Model.id.in_``)"""
+        _, table, column, _ = TAGGED_MODELS[kind]
+        return (select(table.c[column])
+                .join(Tag, Tag.id == table.c.tag_id)
+                .where(Tag.slug == TagIndex.slugify(tag)))
+
+    @staticmethod
+    def filter_by_tag(query, kind, tag):
+        """Restrict a model query to objects carrying a tag"""
+        model = TAGGED_MODELS[kind][0]
+        return query.filter(model.id.in_(TagIndex.ids_with_tag(kind, tag)))
+
+    @staticmethod
+    def tag_counts(kind, *filters, limit=50):
+        """Return the most used tags for a kind as ``[{name, slug, count}]``"""
+        model, table, column, _ = TAGGED_MODELS[kind]
+        count = func.count(table.c[column]).label('count')
+        query = (db.session.query(Tag.name, Tag.slug, count)
+                 .join(table, table.c.tag_id == Tag.id))
+        if filters:
+            query = query.join(model, model.id == table.c[column]).filter(*filters)
+        rows = (query.group_by(Tag.id, Tag.name, Tag.slug)
+                .order_by(count.desc(), Tag.slug)
+                .limit(limit)
+                .all())
+        return [{'name': name, 'slug': slug, 'count': total} for name, slug, total in rows]
+
+
+def _register(kind):
+    model, table, column, source_columns = TAGGED_MODELS[kind]
+
+    def _source_values(target):
+        return [getattr(target, name) for name in source_columns]
+
+    @event.listens_for(model, 'after_insert')
+    def _index_inserted(mapper, connection, target):
+        if any(_source_values(target)) and TagIndex.is_available(connection):
+            TagIndex.sync(connection, kind, target.id, *_source_values(target))
+
+    @event.listens_for(model, 'after_update')
+    def _index_updated(mapper, connection, target):
+        state = db.inspect(target)
+        changed = any(state.attrs[name].history.has_changes() for name in source_columns)
+        if changed and TagIndex.is_available(connection):
+            TagIndex.sync(connection, kind, target.id, *_source_values(target))
+
+    @event.listens_for(model, 'after_delete')
+    def _unindex_deleted(mapper, connection, target):
+        # SQLite doesn't enforce ON DELETE CASCADE unless foreign keys are enabled
+        if TagIndex.is_available(connection):
+            connection.execute(delete(table).where(table.c[column] == target.id))
+
+
+for _kind in TAGGED_MODELS:
+    _register(_kind)
+
+
+@event.listens_for(Tag.__table__, 'after_create')
+def _tag_tables_created(table, connection, **kwargs):
+    _availability.mark(connection)
+
+
+@event.listens_for(Tag.__table__, 'before_drop')
+def _tag_tables_dropped(table, connection, **kwargs):
+    _availability.forget(connection)
@@ -0,0 +1,258 @@
+"""
+Background video probing and thumbnailing.
+
+Video uploads used to run ffmpeg inside the request, which could hold a
+gevent worker for up to 30 seconds. Now ``video_processor.schedule`` only
+queues a ``video.probe`` job, and the record is marked as processing: gallery
+items get ``status='processing'`` (public listings only show ``'active'``
+items) and story media entries get ``processing: true``. A ``manage.py
+worker`` then runs ffprobe for the duration and dimensions and ffmpeg for a
+poster frame, and stores the results on the record. The record is marked
+ready even if ffmpeg fails, so a broken or unsupported file never stays
+hidden forever. The job lives in the database, so restarting a web worker
+can't lose it. If the job itself goes dead, the
+``maintenance.release_stuck_videos`` sweep shows the item anyway once
+``VIDEO_PROCESSING_STUCK_AFTER`` has passed.
+
+The number of worker processes bounds how many videos are processed at once.
+Each ffmpeg runs with a capped thread count and, where ``nice`` is available,
+at a lower CPU priority, so it can't starve the web workers.
+"""
+import os
+import json
+import shutil
+import logging
+import subprocess
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+from sqlalchemy import func
+
+from ..extensions import db
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = {'mp4', 'webm', 'avi', 'mov', 'mkv', 'flv', 'wmv'}
+
+
+class VideoProcessingError(Exception):
+    """ffprobe/ffmpeg failed or is not installed"""
+
+
+def _command(args, config):
+    niceness = config.get('VIDEO_PROCESSING_NICE', 10)
+    if niceness and shutil.which('nice'):
+        return ['nice', '-n', str(niceness)] + args
+    return args
+
+
+def _run(args, config):
+    try:
+        result = subprocess.run(_command(args, config), capture_output=True, text=True,
+                                timeout=config.get('VIDEO_PROCESSING_TIMEOUT', 120))
+    except FileNotFoundError:
+        raise VideoProcessingError(f"{args[0]} is not installed")
+    except subprocess.TimeoutExpired:
+        raise VideoProcessingError(f"{args[0]} timed out - video might be corrupted")
+    if result.returncode != 0:
+        raise VideoProcessingError(f"{args[0]} failed: {result.stderr.strip()[-500:]}")
+    return result.stdout
+
+
+def probe_video(video_path, config):
+    """Return ``{'duration', 'width', 'height', 'has_audio'}`` for a video (display orientation)"""
+    output = _run(['ffprobe', '-v', 'error', '-print_format', 'json',
+                   '-show_format', '-show_streams', video_path], config)
+    try:
+        info = json.loads(output)
+    except json.JSONDecodeError:
+        raise VideoProcessingError('ffprobe returned invalid JSON')
+
+    stream = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
+    if stream is None:
+        raise VideoProcessingError('No video stream found')
+
+    width, height = stream.get('width'), stream.get('height')
+    rotation = stream.get('tags', {}).get('rotate') or next(
+        (side.get('rotation') for side in stream.get('side_data_list', []) if 'rotation' in side), 0)
+    try:
+        if int(float(rotation)) % 180:
+            width, height = height, width
+    except (TypeError, ValueError):
+        pass
+
+    duration = info.get('format', {}).get('duration') or stream.get('duration')
+    try:
+        duration = round(float(duration))
+    except (TypeError, ValueError):
+        duration = None
+    has_audio = any(s.get('codec_type') == 'audio' for s in info.get('streams', []))
+    return {'duration': duration, 'width': width, 'height': height, 'has_audio': has_audio}
+
+
+def extract_thumbnail(video_path, thumbnail_path, config, duration=None):
+    """Write a JPEG poster frame, taken at one second in (or mid-way through a shorter clip)"""
+    offset = 1 if duration is None or duration >= 2 else (duration or 0) / 2
+    _run(['ffmpeg', '-nostdin', '-v', 'error',
+          '-ss', f'{offset:.2f}',  # Seeking before -i skips decoding up to the frame
+          '-i', video_path,
+          '-frames:v', '1', '-q:v', '2',
+          '-threads', str(config.get('VIDEO_FFMPEG_THREADS', 1)),
+          '-y', thumbnail_path], config)
+    if not os.path.exists(thumbnail_path):
+        raise VideoProcessingError('ffmpeg produced no thumbnail')
+
+
+def process_video(video_path, config):
+    """Probe a video and extract its thumbnail; failures leave fields as None"""
+    result = {'duration': None, 'width': None, 'height': None, 'thumbnail': None}
+    try:
+        result.update(probe_video(video_path, config))
+    except VideoProcessingError as e:
+        logger.error(f"Video probe failed for {video_path}: {e}")
+    thumbnail_path = f"{os.path.splitext(video_path)[0]}_thumb.jpg"
+    try:
+        extract_thumbnail(video_path, thumbnail_path, config, result['duration'])
+        result['thumbnail'] = os.path.basename(thumbnail_path)
+    except VideoProcessingError as e:
+        logger.error(f"Video thumbnail failed for {video_path}: {e}")
+    return result
+
+
+# ----------------------------------------------------------------------
+# Writing results back. Each target takes (object id, stored path of the
+# video, result with ``thumbnail`` as a stored path) and updates its record
+# (stories merge and commit their own update, see ``merge_story_media``).
+# ----------------------------------------------------------------------
+
+def _store_gallery(object_id, rel_path, result):
+    from ..models import GalleryItem
+    item = db.session.get(GalleryItem, object_id)
+    if item is None or item.file_path != rel_path:
+        return
+    item.duration = result['duration']
+    item.width = result['width']
+    item.height = result['height']
+    if result['thumbnail'] and not item.thumbnail:
+        item.thumbnail = result['thumbnail']
+    if item.status == 'processing':
+        item.status = 'active'
+
+
+def _store_story(object_id, rel_path, result):
+    from ..models import Story
+    from .media_store import merge_story_media
+
+    def apply(media):
+        media.update(duration=result['duration'], width=result['width'], height=result['height'])
+        media.pop('processing', None)
+        if result['thumbnail'] and not media.get('thumbnail_path'):
+            media['thumbnail_path'] = result['thumbnail']
+            # Only fills an empty story thumbnail, checked in the same update
+            return {'thumbnail': func.coalesce(func.nullif(Story.thumbnail, ''), result['thumbnail'])}
+
+    merge_story_media(object_id, rel_path, apply)
+
+
+TARGETS = {
+    'gallery': _store_gallery,
+    'story': _store_story,
+}
+
+
+class VideoProcessor:
+    """Queues video processing as jobs and stores the results"""
+
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['video_processor'] = self
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config.get('VIDEO_PROCESSING_ENABLED', True)
+
+    def schedule(self, target, object_id, file_path, rel_path):
+        """
+        Queue probing and thumbnailing for the video at ``file_path``.
+
+        ``rel_path`` is the path the record stores for the video; the
+        thumbnail is stored next to it. Call after the record, already marked
+        as processing, is committed. Returns False if nothing was queued.
+        """
+        if target not in TARGETS:
+            raise KeyError(f"Unknown video target: {target}")
+        if not self.enabled:
+            return False
+
+        args = (target, object_id, os.path.abspath(file_path), rel_path)
+        if not self.app.config.get('VIDEO_PROCESSING_ASYNC', True):
+            try:
+                self.process(*args)
+            except Exception as e:
+                logger.error(f"Video processing failed for {target} {object_id}: {str(e)}")
+            return True
+
+        from ..tasks import probe_stored_video
+        probe_stored_video.enqueue(target=target, object_id=object_id, file_path=args[2], rel_path=rel_path)
+        if target == 'gallery':
+            self._schedule_sweep()
+        return True
+
+    def schedule_story_media(self, story_id, media_files, media_dir):
+        """Queue the videos among a story's newly saved ``media_files`` entries"""
+        for media in media_files:
+            if media.get('processing'):
+                self.schedule('story', story_id, os.path.join(media_dir, media['filename']), media['file_path'])
+
+    def process(self, target, object_id, file_path, rel_path):
+        """Probe and thumbnail a stored video and record the result (the ``video.probe`` job)"""
+        config = {key: value for key, value in self.app.config.items() if key.startswith('VIDEO_')}
+        result = dict(process_video(file_path, config), file_path=file_path)
+        if result['thumbnail']:
+            directory = rel_path.rsplit('/', 1)[0] + '/' if '/' in rel_path else ''
+            result['thumbnail'] = directory + result['thumbnail']
+        if has_app_context():
+            self._store(target, object_id, rel_path, result)
+        else:
+            with self.app.app_context():
+                self._store(target, object_id, rel_path, result)
+
+    def _store(self, target, object_id, rel_path, result):
+        try:
+            TARGETS[target](object_id, rel_path, result)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # The poster is ready; the streamable renditions follow in a worker
+        if result['height']:
+            from .video_transcode import schedule_transcode
+            schedule_transcode(target, object_id, result['file_path'], rel_path)
+
+    def release_stuck(self):
+        """
+        Show gallery videos still processing ``VIDEO_PROCESSING_STUCK_AFTER``
+        seconds after upload, e.g. because their probe job went dead. Returns
+        ``(released, still processing)``.
+        """
+        from ..models import GalleryItem
+        stuck_after = timedelta(seconds=self.app.config.get('VIDEO_PROCESSING_STUCK_AFTER', 3600))
+        processing = GalleryItem.query.filter(GalleryItem.status == 'processing')
+        stuck = processing.filter(GalleryItem.created_at < datetime.utcnow() - stuck_after).all()
+        for item in stuck:
+            logger.warning(f"Video gallery item {item.id} was still processing; showing it without metadata")
+            item.status = 'active'
+        db.session.commit()
+        return len(stuck), processing.count()
+
+    def _schedule_sweep(self):
+        from ..models_jobs import Job
+        from ..tasks import release_stuck_videos
+        if Job.query.filter_by(name=release_stuck_videos.name, status='queued').first() is None:
+            release_stuck_videos.enqueue(delay=self.app.config.get('VIDEO_PROCESSING_STUCK_AFTER', 3600))
+
+
+video_processor = VideoProcessor()
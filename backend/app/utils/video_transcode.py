@@ -0,0 +1,215 @@
+"""
+Adaptive-bitrate transcoding for gallery and story videos.
+
+Uploaded videos are served as uploaded, so a large ``.mov`` has to download
+progressively and often won't play in a browser at all. After a video has
+been probed (``video_processing``), a ``video.transcode`` job produces, next
+to the original:
+
+* ``<stem>_h264.mp4``: H.264/AAC with ``+faststart``, for players without
+  HLS support.
+* ``<stem>_hls/``: an HLS ladder (``master.m3u8`` plus one ``v<N>/index.m3u8``
+  and its 6-second segments per rendition). Every rendition is encoded in a
+  single ffmpeg run, so the source is decoded only once. Renditions taller
+  than the source are skipped.
+
+The job runs in ``manage.py worker`` processes on the ``video`` queue, so
+encoding never competes with the web workers. ffmpeg runs at the same
+lowered CPU priority as the probe. The output is written under a temporary
+name and moved into place at the end, so players never see half of a
+ladder. For content-addressed media the names come from the digest, so a
+re-uploaded video reuses the existing ladder.
+"""
+import os
+import json
+import shutil
+import logging
+
+from flask import current_app
+
+from ..extensions import db
+from .video_processing import VideoProcessingError, probe_video, _run
+
+logger = logging.getLogger(__name__)
+
+# (height, video bitrate kbps, audio bitrate kbps)
+DEFAULT_LADDER = ((360, 800, 96), (720, 2800, 128), (1080, 5000, 160))
+SEGMENT_SECONDS = 6
+
+
+def rendition_paths(file_path):
+    """On-disk ``(mp4, hls_dir)`` for a video"""
+    stem = os.path.splitext(file_path)[0]
+    return f"{stem}_h264.mp4", f"{stem}_hls"
+
+
+def select_ladder(ladder, source_height):
+    """Renditions no taller than the source; always at least the smallest"""
+    ladder = sorted(ladder)
+    if not source_height:
+        return ladder
+    chosen = [rung for rung in ladder if rung[0] <= source_height]
+    return chosen or ladder[:1]
+
+
+def _transcode_config(config):
+    # ffmpeg helpers read the timeout from VIDEO_PROCESSING_TIMEOUT
+    return dict(config, VIDEO_PROCESSING_TIMEOUT=config.get('VIDEO_TRANSCODE_TIMEOUT', 3600))
+
+
+def encode_mp4(video_path, output_path, height, video_kbps, audio_kbps, config):
+    """Write a web-friendly H.264/AAC MP4 no taller than ``height``"""
+    temp_path = f"{output_path}.part.mp4"
+    _run(['ffmpeg', '-nostdin', '-v', 'error', '-i', video_path,
+          '-vf', f"scale=-2:'min({height},ih)'",
+          '-c:v', 'libx264', '-preset', config.get('VIDEO_TRANSCODE_PRESET', 'veryfast'),
+          '-b:v', f'{video_kbps}k', '-maxrate', f'{int(video_kbps * 1.07)}k', '-bufsize', f'{video_kbps * 2}k',
+          '-profile:v', 'high', '-pix_fmt', 'yuv420p',
+          '-c:a', 'aac', '-b:a', f'{audio_kbps}k',
+          '-movflags', '+faststart',
+          '-threads', str(config.get('VIDEO_TRANSCODE_THREADS', 0)),
+          '-y', temp_path], config)
+    os.replace(temp_path, output_path)
+
+
+def encode_hls(video_path, output_dir, ladder, has_audio, config):
+    """Write an HLS ladder with a master playlist into ``output_dir``"""
+    temp_dir = f"{output_dir}.part"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    for index in range(len(ladder)):
+        os.makedirs(os.path.join(temp_dir, f'v{index}'))
+
+    # Decode once, scale once per rendition
+    split = f"[0:v]split={len(ladder)}" + ''.join(f'[s{index}]' for index in range(len(ladder)))
+    scales = [f"[s{index}]scale=-2:{height}[v{index}]" for index, (height, _, _) in enumerate(ladder)]
+    args = ['ffmpeg', '-nostdin', '-v', 'error', '-i', video_path,
+            '-filter_complex', ';'.join([split] + scales)]
+    for index, (height, video_kbps, audio_kbps) in enumerate(ladder):
+        args += ['-map', f'[v{index}]',
+                 f'-c:v:{index}', 'libx264', f'-b:v:{index}', f'{video_kbps}k',
+                 f'-maxrate:v:{index}', f'{int(video_kbps * 1.07)}k', f'-bufsize:v:{index}', f'{video_kbps * 2}k']
+        if has_audio:
+            args += ['-map', 'a:0', f'-c:a:{index}', 'aac', f'-b:a:{index}', f'{audio_kbps}k']
+    stream_map = ' '.join(f'v:{index},a:{index}' if has_audio else f'v:{index}' for index in range(len(ladder)))
+    args += ['-preset', config.get('VIDEO_TRANSCODE_PRESET', 'veryfast'), '-pix_fmt', 'yuv420p',
+             # Keyframes on segment boundaries so renditions can switch cleanly
+             '-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_SECONDS})', '-sc_threshold', '0',
+             '-threads', str(config.get('VIDEO_TRANSCODE_THREADS', 0)),
+             '-f', 'hls', '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+             '-hls_flags', 'independent_segments',
+             '-hls_segment_filename', os.path.join(temp_dir, 'v%v', 'seg_%03d.ts'),
+             '-master_pl_name', 'master.m3u8',
+             '-var_stream_map', stream_map,
+             os.path.join(temp_dir, 'v%v', 'index.m3u8')]
+    try:
+        _run(args, config)
+        if not os.path.exists(os.path.join(temp_dir, 'master.m3u8')):
+            raise VideoProcessingError('ffmpeg produced no master playlist')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(temp_dir, output_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def transcode(video_path, config):
+    """
+    Produce the MP4 and HLS ladder for a video, reusing outputs that already
+    exist. Returns ``{'mp4', 'hls', 'renditions'}`` with names relative to
+    the video's directory.
+    """
+    config = _transcode_config(config)
+    info = probe_video(video_path, config)
+    ladder = select_ladder(config.get('VIDEO_TRANSCODE_LADDER') or DEFAULT_LADDER, info['height'])
+    mp4_path, hls_dir = rendition_paths(video_path)
+
+    if not os.path.exists(mp4_path):
+        encode_mp4(video_path, mp4_path, *ladder[-1], config)
+    if not os.path.exists(os.path.join(hls_dir, 'master.m3u8')):
+        encode_hls(video_path, hls_dir, ladder, info['has_audio'], config)
+    return {
+        'mp4': os.path.basename(mp4_path),
+        'hls': f"{os.path.basename(hls_dir)}/master.m3u8",
+        'renditions': [{'height': height, 'bandwidth': (video_kbps + audio_kbps) * 1000}
+                       for height, video_kbps, audio_kbps in ladder]
+    }
+
+
+def remove_renditions(renditions_data, directory):
+    """Delete the MP4 and HLS ladder recorded in a ``video_renditions`` value"""
+    if isinstance(renditions_data, str):
+        try:
+            renditions_data = json.loads(renditions_data)
+        except (json.JSONDecodeError, TypeError):
+            return
+    if not renditions_data:
+        return
+    if renditions_data.get('mp4'):
+        try:
+            os.remove(os.path.join(directory, renditions_data['mp4'].rsplit('/', 1)[-1]))
+        except FileNotFoundError:
+            pass
+    if renditions_data.get('hls'):
+        # '<dir>/<stem>_hls/master.m3u8' -> '<stem>_hls'
+        hls_dir = renditions_data['hls'].rsplit('/', 1)[0].rsplit('/', 1)[-1]
+        shutil.rmtree(os.path.join(directory, hls_dir), ignore_errors=True)
+
+
+# ----------------------------------------------------------------------
+# Writing results back. Each target takes (object id, stored path of the
+# video, result with stored paths) and updates its record (stories merge and
+# commit their own update, see ``merge_story_media``).
+# ----------------------------------------------------------------------
+
+def _store_gallery(object_id, rel_path, result):
+    from ..models import GalleryItem
+    item = db.session.get(GalleryItem, object_id)
+    if item is None or item.file_path != rel_path:
+        return
+    item.video_renditions = json.dumps(result)
+
+
+def _store_story(object_id, rel_path, result):
+    from .media_store import merge_story_media
+    merge_story_media(object_id, rel_path, lambda media: media.update(video_renditions=result))
+
+
+TARGETS = {
+    'gallery': _store_gallery,
+    'story': _store_story,
+}
+
+
+def schedule_transcode(target, object_id, file_path, rel_path):
+    """
+    Queue transcoding for a stored video. Runs inline when
+    ``VIDEO_TRANSCODE_ASYNC`` is off. Returns False if disabled.
+    """
+    if target not in TARGETS:
+        raise KeyError(f"Unknown video target: {target}")
+    if not current_app.config.get('VIDEO_TRANSCODE_ENABLED', True):
+        return False
+    if not current_app.config.get('VIDEO_TRANSCODE_ASYNC', True):
+        run_transcode(target, object_id, os.path.abspath(file_path), rel_path)
+    else:
+        from ..tasks import transcode_video
+        transcode_video.enqueue(target=target, object_id=object_id,
+                                file_path=os.path.abspath(file_path), rel_path=rel_path)
+    return True
+
+
+def run_transcode(target, object_id, file_path, rel_path):
+    """Transcode a video and store the stored-path result on its record"""
+    if not os.path.exists(file_path):
+        return None
+    config = {key: value for key, value in current_app.config.items() if key.startswith('VIDEO_')}
+    result = transcode(file_path, config)
+    directory = rel_path.rsplit('/', 1)[0] + '/' if '/' in rel_path else ''
+    result['mp4'] = directory + result['mp4']
+    result['hls'] = directory + result['hls']
+    try:
+        TARGETS[target](object_id, rel_path, result)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
@@ -42,10 +42,23 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@doggodaily.com')
     MAIL_SUPPRESS_SEND = os.environ.get('MAIL_SUPPRESS_SEND', 'False').lower() == 'true'
+    MAIL_OUTBOX_ASYNC = os.environ.get('MAIL_OUTBOX_ASYNC', 'True').lower() == 'true'  # Needs 'manage.py worker' running; False sends right after queueing
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 100))  # Messages sent per SMTP connection
+    MAIL_RATE_LIMIT = float(os.environ.get('MAIL_RATE_LIMIT', 10))  # Messages per second per delivery process; 0 = unlimited
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+    MAIL_RETRY_BASE = float(os.environ.get('MAIL_RETRY_BASE', 60))  # Seconds before the first retry; doubles each attempt
+    MAIL_RETRY_MAX = float(os.environ.get('MAIL_RETRY_MAX', 3600))
+    MAIL_LEASE_SECONDS = int(os.environ.get('MAIL_LEASE_SECONDS', 600))  # A crashed sender's batch is retried after this
     
     # Enhanced File upload config
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 50 * 1024 * 1024))  # 50MB
+    
+    # Resumable uploads: per-file limits apply to the whole file, MAX_CONTENT_LENGTH to each chunk
+    GALLERY_UPLOAD_MAX_SIZE = int(os.environ.get('GALLERY_UPLOAD_MAX_SIZE', 512 * 1024 * 1024))  # 512MB
+    STORY_UPLOAD_MAX_SIZE = int(os.environ.get('STORY_UPLOAD_MAX_SIZE', 50 * 1024 * 1024))  # 50MB
+    RESUMABLE_UPLOAD_EXPIRY_HOURS = int(os.environ.get('RESUMABLE_UPLOAD_EXPIRY_HOURS', 24))
+    RESUMABLE_UPLOAD_DIR = os.environ.get('RESUMABLE_UPLOAD_DIR')  # defaults to <instance>/upload_partials
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'mp4', 'mov', 'avi', 'webm'}
     
     # Enhanced Security config
@@ -87,6 +100,87 @@ class Config:
     STORIES_PER_PAGE = int(os.environ.get('STORIES_PER_PAGE', 12))
     GALLERY_ITEMS_PER_PAGE = int(os.environ.get('GALLERY_ITEMS_PER_PAGE', 20))
     USERS_PER_PAGE = int(os.environ.get('USERS_PER_PAGE', 20))
+    RELATED_STORIES_COUNT = int(os.environ.get('RELATED_STORIES_COUNT', 6))
+    RELATED_REFRESH_ASYNC = os.environ.get('RELATED_REFRESH_ASYNC', 'True').lower() == 'true'  # False refreshes related stories right after commit
+    LISTING_TOTAL_CACHE_TTL = int(os.environ.get('LISTING_TOTAL_CACHE_TTL', 60))  # seconds a listing's COUNT(*) is reused
+    COMMENT_MAX_DEPTH = int(os.environ.get('COMMENT_MAX_DEPTH', 8))  # deepest reply level accepted and returned
+    COMMENT_REPLIES_PER_THREAD = int(os.environ.get('COMMENT_REPLIES_PER_THREAD', 20))  # replies loaded per thread
+    
+    # View/download counter write-behind buffer
+    COUNTER_BUFFER_ENABLED = os.environ.get('COUNTER_BUFFER_ENABLED', 'True').lower() == 'true'
+    COUNTER_FLUSH_INTERVAL = float(os.environ.get('COUNTER_FLUSH_INTERVAL', 5))  # seconds between flushes
+    COUNTER_FLUSH_THRESHOLD = int(os.environ.get('COUNTER_FLUSH_THRESHOLD', 500))  # distinct rows that trigger an early flush
+    COUNTER_SPOOL_DIR = os.environ.get('COUNTER_SPOOL_DIR')  # defaults to <instance>/counter_spool
+    COUNTER_RECONCILE_INTERVAL = int(os.environ.get('COUNTER_RECONCILE_INTERVAL', 86400))  # seconds between maintenance.reconcile_counters runs
+    
+    # Analytics tracking write-behind buffer
+    ANALYTICS_BUFFER_ENABLED = os.environ.get('ANALYTICS_BUFFER_ENABLED', 'True').lower() == 'true'
+    ANALYTICS_FLUSH_INTERVAL_MS = int(os.environ.get('ANALYTICS_FLUSH_INTERVAL_MS', 1000))  # milliseconds between flushes
+    ANALYTICS_FLUSH_THRESHOLD = int(os.environ.get('ANALYTICS_FLUSH_THRESHOLD', 500))  # buffered records that trigger an early flush
+    ANALYTICS_BUFFER_MAX = int(os.environ.get('ANALYTICS_BUFFER_MAX', 10000))  # records per worker; beyond this tracking gets 503
+    ANALYTICS_BATCH_MAX = int(os.environ.get('ANALYTICS_BATCH_MAX', 100))  # records per beacon
+    ANALYTICS_RETRY_AFTER = int(os.environ.get('ANALYTICS_RETRY_AFTER', 5))  # seconds, sent with 503
+    
+    # Analytics rollups (hourly/daily aggregates maintained by the analytics.rollup job)
+    ANALYTICS_ROLLUPS_ENABLED = os.environ.get('ANALYTICS_ROLLUPS_ENABLED', 'True').lower() == 'true'  # False reads raw rows only
+    ANALYTICS_ROLLUP_RESTATE_HOURS = int(os.environ.get('ANALYTICS_ROLLUP_RESTATE_HOURS', 2))  # closed hours recomputed each run
+    ANALYTICS_ROLLUP_MAX_HOURS = int(os.environ.get('ANALYTICS_ROLLUP_MAX_HOURS', 168))  # hours rolled up per run when catching up
+    ANALYTICS_ROLLUP_GRACE_SECONDS = int(os.environ.get('ANALYTICS_ROLLUP_GRACE_SECONDS', 120))  # wait after the hour before rolling it up
+    ANALYTICS_HLL_PRECISION = int(os.environ.get('ANALYTICS_HLL_PRECISION', 12))  # unique-count sketches: 2**p bytes, ~1.04/sqrt(2**p) error; rebuild rollups after changing
+    ANALYTICS_EXACT_UNIQUES = os.environ.get('ANALYTICS_EXACT_UNIQUES', 'False').lower() == 'true'  # COUNT(DISTINCT) on live rows instead of sketches
+    
+    # Analytics dashboard snapshots
+    ANALYTICS_DASHBOARD_WORKERS = int(os.environ.get('ANALYTICS_DASHBOARD_WORKERS', 3))  # parallel queries (and connections) per app worker; <2 runs them in turn
+    ANALYTICS_DASHBOARD_TTL = int(os.environ.get('ANALYTICS_DASHBOARD_TTL', 60))  # seconds a snapshot is reused; 0 rebuilds every time
+    ANALYTICS_DASHBOARD_TIMEOUT = int(os.environ.get('ANALYTICS_DASHBOARD_TIMEOUT', 60))  # seconds to wait for a snapshot being built
+    ANALYTICS_EXPORT_BATCH_SIZE = int(os.environ.get('ANALYTICS_EXPORT_BATCH_SIZE', 1000))  # rows fetched per round trip while streaming an export
+    
+    # Analytics archive (raw rows past retention moved to per-month Parquet/CSV.gz files)
+    ANALYTICS_RETENTION_DAYS = int(os.environ.get('ANALYTICS_RETENTION_DAYS', 180))  # raw rows older than this are archived
+    ANALYTICS_ARCHIVE_DIR = os.environ.get('ANALYTICS_ARCHIVE_DIR')  # defaults to <instance>/analytics_archive
+    ANALYTICS_ARCHIVE_BATCH_SIZE = int(os.environ.get('ANALYTICS_ARCHIVE_BATCH_SIZE', 5000))  # rows per file and delete transaction
+    
+    # Let the front server stream uploads: 'x-accel' (nginx, internal location at
+    # UPLOADS_ACCEL_PREFIX aliased to UPLOAD_FOLDER) or 'x-sendfile'; empty streams from Python
+    UPLOADS_OFFLOAD = os.environ.get('UPLOADS_OFFLOAD', '').lower()
+    UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX', '/internal-uploads/')
+    
+    # Content-addressed media store (uploads/media/, named by SHA-256)
+    MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', 31536000))  # seconds; served as immutable
+    
+    # Responsive image derivatives (resized WebP/JPEG copies of uploaded images)
+    IMAGE_DERIVATIVES_ENABLED = os.environ.get('IMAGE_DERIVATIVES_ENABLED', 'True').lower() == 'true'
+    IMAGE_DERIVATIVES_ASYNC = os.environ.get('IMAGE_DERIVATIVES_ASYNC', 'True').lower() == 'true'  # False renders inside the request
+    IMAGE_DERIVATIVE_WIDTHS = tuple(int(w) for w in os.environ.get('IMAGE_DERIVATIVE_WIDTHS', '320,640,1280').split(','))
+    IMAGE_DERIVATIVE_FORMATS = ('webp', 'jpeg')
+    IMAGE_DERIVATIVE_QUALITY = int(os.environ.get('IMAGE_DERIVATIVE_QUALITY', 82))
+    IMAGE_DERIVATIVE_WORKERS = int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', 2))  # pool processes per app worker
+    IMAGE_PLACEHOLDER_WIDTH = int(os.environ.get('IMAGE_PLACEHOLDER_WIDTH', 16))  # pixels; the client blurs it up
+    
+    # Video probing and thumbnailing (ffprobe/ffmpeg), run by 'manage.py worker' on the 'video' queue
+    VIDEO_PROCESSING_ENABLED = os.environ.get('VIDEO_PROCESSING_ENABLED', 'True').lower() == 'true'
+    VIDEO_PROCESSING_ASYNC = os.environ.get('VIDEO_PROCESSING_ASYNC', 'True').lower() == 'true'  # False processes inside the request
+    VIDEO_PROCESSING_STUCK_AFTER = int(os.environ.get('VIDEO_PROCESSING_STUCK_AFTER', 3600))  # seconds before an unprocessed gallery video is shown anyway
+    VIDEO_PROCESSING_TIMEOUT = int(os.environ.get('VIDEO_PROCESSING_TIMEOUT', 120))  # seconds per ffmpeg/ffprobe run
+    VIDEO_PROCESSING_NICE = int(os.environ.get('VIDEO_PROCESSING_NICE', 10))  # CPU priority offset for ffmpeg; 0 disables
+    VIDEO_FFMPEG_THREADS = int(os.environ.get('VIDEO_FFMPEG_THREADS', 1))
+    
+    # HLS/MP4 transcoding, run by 'manage.py worker' on the 'video' queue
+    VIDEO_TRANSCODE_ENABLED = os.environ.get('VIDEO_TRANSCODE_ENABLED', 'True').lower() == 'true'
+    VIDEO_TRANSCODE_ASYNC = os.environ.get('VIDEO_TRANSCODE_ASYNC', 'True').lower() == 'true'  # False encodes inline
+    VIDEO_TRANSCODE_TIMEOUT = int(os.environ.get('VIDEO_TRANSCODE_TIMEOUT', 3600))  # seconds per ffmpeg run
+    VIDEO_TRANSCODE_PRESET = os.environ.get('VIDEO_TRANSCODE_PRESET', 'veryfast')  # x264 speed/size trade-off
+    VIDEO_TRANSCODE_THREADS = int(os.environ.get('VIDEO_TRANSCODE_THREADS', 0))  # 0 lets ffmpeg choose
+    VIDEO_TRANSCODE_LADDER = None  # (height, video kbps, audio kbps) tuples; None uses the default 360p/720p/1080p
+    
+    # Background job queue (manage.py worker)
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))  # claims before a job is dead-lettered
+    JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))  # extended by a heartbeat while the job runs
+    JOB_BACKOFF_BASE = float(os.environ.get('JOB_BACKOFF_BASE', 10))  # seconds before the first retry; doubles each attempt
+    JOB_BACKOFF_MAX = float(os.environ.get('JOB_BACKOFF_MAX', 3600))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))  # idle polling starts here...
+    JOB_POLL_MAX_INTERVAL = float(os.environ.get('JOB_POLL_MAX_INTERVAL', 10))  # ...and backs off to this
+    BULK_INLINE_LIMIT = int(os.environ.get('BULK_INLINE_LIMIT', 100))  # larger bulk actions are queued (202)
     
     # Logging config
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
@@ -98,6 +192,10 @@ class Config:
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
     CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 300))
     CACHE_KEY_PREFIX = 'doggo_'
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'True').lower() == 'true'
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 2048))
+    RESPONSE_CACHE_TAG_CHECK_INTERVAL = float(os.environ.get('RESPONSE_CACHE_TAG_CHECK_INTERVAL', 1))  # seconds before other workers' invalidations are seen
+    RESPONSE_CACHE_FILL_TIMEOUT = float(os.environ.get('RESPONSE_CACHE_FILL_TIMEOUT', 10))  # seconds to wait on another request's rebuild
     
     # Email verification
     EMAIL_VERIFICATION_REQUIRED = os.environ.get('EMAIL_VERIFICATION_REQUIRED', 'True').lower() == 'true'
@@ -149,10 +247,22 @@ class TestingConfig(Config):
     DEBUG = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_ENGINE_OPTIONS = {}  # Pool sizing options don't apply to in-memory SQLite
     MAIL_SUPPRESS_SEND = True
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=1)  # Short expiry for testing
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(minutes=5)
     RATELIMIT_ENABLED = False
+    LISTING_TOTAL_CACHE_TTL = 0  # Always count, so tests see fresh totals
+    COUNTER_BUFFER_ENABLED = False  # Write counters straight through
+    ANALYTICS_BUFFER_ENABLED = False  # Write tracked analytics straight through
+    ANALYTICS_DASHBOARD_WORKERS = 0  # In-memory SQLite has one connection; run dashboard queries in turn
+    ANALYTICS_DASHBOARD_TTL = 0
+    RESPONSE_CACHE_ENABLED = False  # Tests that exercise the cache switch it on
+    IMAGE_DERIVATIVES_ASYNC = False  # Render inline so tests see the result
+    VIDEO_PROCESSING_ASYNC = False
+    VIDEO_TRANSCODE_ENABLED = False  # Tests that exercise transcoding switch it on
+    MAIL_OUTBOX_ASYNC = False
+    RELATED_REFRESH_ASYNC = False
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -159,12 +159,14 @@ setup_environment() {
 setup_systemd() {
     log "Setting up systemd service..."
     
-    # Copy service file
+    # Copy service files: the web app and the background job workers
     cp "$BACKEND_DIR/doggodaily.service" "/etc/systemd/system/"
+    cp "$BACKEND_DIR/doggodaily-worker.service" "/etc/systemd/system/"
     
-    # Reload systemd and enable service
+    # Reload systemd and enable services
     systemctl daemon-reload
     systemctl enable doggodaily
+    systemctl enable doggodaily-worker
     
     log "Systemd service configured"
 }
@@ -213,8 +215,14 @@ start_services() {
     systemctl start redis-server
     systemctl enable redis-server
     
-    # Start DoggoDaily backend
+    # Start DoggoDaily backend and its job workers (email, bulk actions, video, analytics)
     systemctl start doggodaily
+    systemctl start doggodaily-worker
+    
+    # Queue the self-rescheduling analytics rollup and counter reconciliation jobs
+    cd $BACKEND_DIR
+    sudo -u $APP_USER $VENV_DIR/bin/python manage.py rollup-analytics --schedule || warn "Could not schedule analytics rollups"
+    sudo -u $APP_USER $VENV_DIR/bin/python manage.py reconcile-counters --schedule || warn "Could not schedule counter reconciliation"
     
     # Restart Nginx
     systemctl restart nginx
@@ -239,8 +247,8 @@ deploy() {
     
     log "Deployment complete!"
     log "Your DoggoDaily backend is now running with Gunicorn"
-    log "Check status with: systemctl status doggodaily"
-    log "View logs with: journalctl -u doggodaily -f"
+    log "Check status with: systemctl status doggodaily doggodaily-worker"
+    log "View logs with: journalctl -u doggodaily -u doggodaily-worker -f"
 }
 
 # Help function
@@ -265,24 +273,24 @@ case "${1:-deploy}" in
         deploy
         ;;
     start)
-        systemctl start doggodaily
+        systemctl start doggodaily doggodaily-worker
         systemctl start nginx
         log "Services started"
         ;;
     stop)
-        systemctl stop doggodaily
+        systemctl stop doggodaily doggodaily-worker
         log "Application stopped"
         ;;
     restart)
-        systemctl restart doggodaily
+        systemctl restart doggodaily doggodaily-worker
         systemctl reload nginx
         log "Application restarted"
         ;;
     status)
-        systemctl status doggodaily
+        systemctl status doggodaily doggodaily-worker
         ;;
     logs)
-        journalctl -u doggodaily -f
+        journalctl -u doggodaily -u doggodaily-worker -f
         ;;
     help)
         show_help
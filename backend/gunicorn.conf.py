@@ -90,6 +90,19 @@ def post_worker_init(worker):
     """Called just after a worker has initialized the application."""
     worker.log.info("Worker initialized (pid: %s)", worker.pid)
 
+def worker_exit(server, worker):
+    """Called just after a worker has been exited, in the worker process."""
+    # Write out buffered view/download counters before the worker goes away
+    from app.utils.counter_buffer import counter_buffer
+    counter_buffer.shutdown()
+    from app.utils.analytics_buffer import analytics_buffer
+    analytics_buffer.shutdown()
+    # Let in-flight image processing finish and be recorded
+    from app.utils.image_derivatives import image_derivatives
+    image_derivatives.shutdown()
+    from app.utils.analytics_dashboard import dashboard_snapshots
+    dashboard_snapshots.shutdown(wait=False)
+
 def worker_abort(worker):
     """Called when a worker received the SIGABRT signal."""
     worker.log.info("Worker received SIGABRT signal")
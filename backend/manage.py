@@ -2,6 +2,7 @@
 
 import os
 import sys
+import click
 from flask.cli import FlaskGroup
 from app import create_app
 from app.models import db, User, Story, GalleryItem, Tour
@@ -103,6 +104,201 @@ def create_admin():
     print("Email: admin@test.com")
     print("Password: TestAdmin123!")
 
+@cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Create and repopulate the story full-text search index."""
+    from app.utils.story_search import StorySearchIndex
+    
+    app.logger.info("SEARCH_INDEX: Rebuilding story search index...")
+    indexed = StorySearchIndex.rebuild()
+    app.logger.info(f"SEARCH_INDEX: Indexed {indexed} published stories")
+    print(f"Story search index rebuilt ({indexed} published stories).")
+
+@cli.command('backfill-tags')
+@click.option('--batch-size', default=500, show_default=True, help='Rows per transaction.')
+def backfill_tags(batch_size):
+    """Migrate comma-separated tags into the normalized tag tables."""
+    from app.utils.tag_index import TagIndex
+    
+    app.logger.info("TAG_BACKFILL: Indexing existing tags...")
+    totals = TagIndex.backfill(batch_size=batch_size)
+    for kind, count in totals.items():
+        app.logger.info(f"TAG_BACKFILL: {kind} - {count} rows")
+        print(f"{kind}: {count} rows indexed")
+
+@cli.command('rebuild-related-stories')
+def rebuild_related_stories():
+    """Recompute the related-stories graph for every published story."""
+    from app.utils.related_content import RelatedContent
+    
+    app.logger.info("RELATED_CONTENT: Rebuilding related-stories graph...")
+    total = RelatedContent.rebuild()
+    app.logger.info(f"RELATED_CONTENT: Rebuilt neighbours for {total} stories")
+    print(f"Related-stories graph rebuilt ({total} published stories).")
+
+@cli.command('reconcile-counters')
+@click.option('--batch-size', default=500, show_default=True, help='Rows per transaction.')
+@click.option('--schedule', is_flag=True, help='Queue the self-rescheduling daily job instead of running now.')
+def reconcile_counters(batch_size, schedule):
+    """Recompute like and comment counters from the like and comment tables."""
+    from app.tasks import reconcile_counters as reconcile_task
+    from app.utils.like_counters import CounterReconciler
+    
+    if schedule:
+        job = reconcile_task.enqueue(batch_size=batch_size)
+        app.logger.info(f"COUNTERS: Queued reconciliation job {job.id}")
+        print(f"Queued counter reconciliation job {job.id}.")
+        return
+    app.logger.info("COUNTERS: Reconciling like and comment counters...")
+    totals = CounterReconciler.run(batch_size=batch_size)
+    for table, fixed in totals.items():
+        app.logger.info(f"COUNTERS: {table} - {fixed} rows corrected")
+        print(f"{table}: {fixed} rows corrected")
+
+@cli.command('purge-uploads')
+def purge_uploads():
+    """Delete expired resumable uploads and their partial files."""
+    from app.utils.resumable_upload import ResumableUploads
+
+    removed = ResumableUploads.purge_expired()
+    app.logger.info(f"UPLOADS: Purged {removed} expired upload sessions")
+    print(f"Purged {removed} expired uploads.")
+
+@cli.command('worker')
+@click.option('--processes', '-n', default=1, show_default=True, help='Worker processes to run.')
+@click.option('--queue', '-q', 'queues', multiple=True, help='Only take jobs from these queues (repeatable).')
+def worker(processes, queues):
+    """Run background job workers until interrupted."""
+    from app.utils.job_queue import run_workers
+    
+    app.logger.info(f"JOBS: Starting {processes} worker(s) for queues {list(queues) or 'all'}")
+    print(f"Starting {processes} job worker(s). Press Ctrl+C to stop.")
+    run_workers(app, processes=processes, queues=list(queues) or None)
+    print("Job workers stopped.")
+
+@cli.command('purge-jobs')
+@click.option('--days', default=7, show_default=True, help='Keep succeeded jobs this many days.')
+def purge_jobs(days):
+    """Delete old succeeded jobs."""
+    from app.utils.job_queue import JobQueue
+    
+    removed = JobQueue.purge(older_than_days=days)
+    app.logger.info(f"JOBS: Purged {removed} finished jobs")
+    print(f"Purged {removed} finished jobs.")
+
+@cli.command('deliver-email')
+@click.option('--batches', default=None, type=int, help='Stop after this many batches.')
+def deliver_email(batches):
+    """Send everything due in the email outbox."""
+    from app.utils.mail_outbox import MailOutbox
+    
+    totals = MailOutbox.deliver_pending(max_batches=batches)
+    app.logger.info(f"EMAIL: Outbox delivery finished: {totals}")
+    print(f"Sent {totals['sent']}, retrying {totals['retrying']}, failed {totals['failed']}.")
+
+@cli.command('rollup-analytics')
+@click.option('--schedule', is_flag=True, help='Queue the self-rescheduling hourly job instead of running now.')
+def rollup_analytics(schedule):
+    """Fold closed hours of page views and sessions into the analytics rollups."""
+    from app.tasks import rollup_analytics as rollup_task
+    from app.utils.analytics_rollups import AnalyticsRollups
+    
+    if schedule:
+        job = rollup_task.enqueue()
+        app.logger.info(f"ANALYTICS: Queued rollup job {job.id}")
+        print(f"Queued analytics rollup job {job.id}.")
+        return
+    rolled = AnalyticsRollups.refresh()
+    app.logger.info(f"ANALYTICS: Rolled up {rolled}")
+    print(', '.join(f"{source}: {hours} hours" for source, hours in rolled.items()))
+
+@cli.command('archive-analytics')
+@click.option('--days', default=None, type=int, help='Archive rows older than this many days (default: ANALYTICS_RETENTION_DAYS).')
+def archive_analytics(days):
+    """Move aged raw analytics rows into compressed per-month archive files."""
+    from datetime import datetime, timedelta
+    from app.utils.analytics_archive import archive_all, archive_root, PYARROW_AVAILABLE
+    
+    older_than = datetime.utcnow() - timedelta(days=days) if days else None
+    app.logger.info(f"ANALYTICS: Archiving to {archive_root()} ({'parquet' if PYARROW_AVAILABLE else 'csv.gz'})")
+    totals = archive_all(older_than)
+    app.logger.info(f"ANALYTICS: Archived {totals}")
+    print(', '.join(f"{name}: {count} rows" for name, count in totals.items()))
+
+@cli.command('add-keyset-indexes')
+def add_keyset_indexes():
+    """Add the composite indexes behind cursor pagination to an existing database."""
+    from app.migrations.add_keyset_indexes import run_migration
+    
+    app.logger.info("DATABASE: Adding keyset pagination indexes...")
+    run_migration()
+    print("Keyset index migration complete.")
+
+@cli.command('add-story-translation-link')
+def add_story_translation_link():
+    """Add the story translation link column to an existing database."""
+    from app.migrations.add_story_translation_link import run_migration
+    
+    app.logger.info("DATABASE: Adding story translation link...")
+    run_migration()
+    print("Story translation link migration complete.")
+
+@cli.command('add-comment-paths')
+def add_comment_paths():
+    """Add materialized paths to comments in an existing database."""
+    from app.migrations.add_comment_paths import run_migration
+    
+    app.logger.info("DATABASE: Adding comment paths...")
+    run_migration()
+    print("Comment path migration complete.")
+
+@cli.command('add-image-variants')
+def add_image_variants():
+    """Add the responsive image columns and resize existing images."""
+    from app.migrations.add_image_variants import run_migration
+    
+    app.logger.info("DATABASE: Adding image variant columns...")
+    run_migration()
+    print("Image variant migration complete.")
+
+@cli.command('add-video-renditions')
+def add_video_renditions():
+    """Add the video renditions column and queue transcoding for existing videos."""
+    from app.migrations.add_video_renditions import run_migration
+    
+    app.logger.info("DATABASE: Adding video renditions column...")
+    run_migration()
+    print("Video renditions migration complete. Run 'python manage.py worker -q video' to transcode.")
+
+@cli.command('add-rollup-sketches')
+def add_rollup_sketches():
+    """Add unique-count sketches to the analytics rollups and reset them for a rebuild."""
+    from app.migrations.add_rollup_sketches import run_migration
+    
+    app.logger.info("DATABASE: Adding analytics rollup sketches...")
+    run_migration()
+    print("Rollup sketch migration complete. Run 'python manage.py rollup-analytics --schedule' with a maintenance worker to rebuild.")
+
+@cli.command('move-gallery-to-media-store')
+def move_gallery_to_media_store():
+    """Move existing gallery files into the deduplicated media store."""
+    from app.migrations.move_gallery_to_media_store import run_migration
+    
+    app.logger.info("DATABASE: Moving gallery files into the media store...")
+    run_migration()
+    print("Gallery media migration complete.")
+
+@cli.command('backfill-image-derivatives')
+def backfill_image_derivatives():
+    """Render resized copies of stored images that have none yet."""
+    from app.utils.image_derivatives import image_derivatives
+    
+    app.logger.info("IMAGES: Rendering missing image derivatives...")
+    totals = image_derivatives.backfill()
+    for target, count in totals.items():
+        app.logger.info(f"IMAGES: {target} - {count} images resized")
+        print(f"{target}: {count} images resized")
+
 @cli.command()
 def run_debug():
     """Run comprehensive debug tests"""
@@ -1 +1,82 @@
-# Pytest fixtures and config go here 
\ No newline at end of file
+# Pytest fixtures and config go here
+import pytest
+from flask import g
+from flask_login.utils import _create_identifier
+from sqlalchemy import event
+
+from app import create_app
+from app.extensions import db as _db
+from app.models import User
+
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+        _db.drop_all()
+
+
+@pytest.fixture
+def db(app):
+    return _db
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(db):
+    def _make_user(email='user@example.com', admin_level='user'):
+        user = User(name=email.split('@')[0], email=email, admin_level=admin_level)
+        user.set_password('Password123!')
+        db.session.add(user)
+        db.session.commit()
+        return user
+    return _make_user
+
+
+@pytest.fixture
+def login(app, client):
+    def _login(user):
+        # Match the identifier Flask-Login's strong session protection expects
+        with app.test_request_context(environ_base=client.environ_base):
+            identifier = _create_identifier()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+            session['_id'] = identifier
+    return _login
+
+
+@pytest.fixture
+def count_queries(db):
+    """Return a context manager that records the SQL statements issued inside it"""
+    class QueryCounter:
+        def __init__(self):
+            self.statements = []
+
+        def _record(self, conn, cursor, statement, parameters, context, executemany):
+            self.statements.append(statement)
+
+        def __enter__(self):
+            # Requests share the fixture's app context, so start from a cold
+            # identity map and drop per-request values cached on g
+            db.session.expunge_all()
+            for key in list(g):
+                g.pop(key)
+            event.listen(db.engine, 'before_cursor_execute', self._record)
+            return self
+
+        def __exit__(self, *exc):
+            event.remove(db.engine, 'before_cursor_execute', self._record)
+
+        @property
+        def count(self):
+            return len(self.statements)
+
+    return QueryCounter
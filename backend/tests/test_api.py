@@ -1 +1,1513 @@
-# Tests for API routes 
\ No newline at end of file
+# Tests for API routes
+import json
+import pytest
+from contextlib import contextmanager
+from itertools import count as counter
+
+from sqlalchemy import event
+
+from app.models import User, Story, GalleryItem
+
+_seq = counter()
+
+
+def seed_stories(db, make_user, count, **fields):
+    stories = []
+    for _ in range(count):
+        i = next(_seq)
+        author = make_user(f'author{i}@example.com')
+        reviewer = make_user(f'reviewer{i}@example.com', admin_level='moderator')
+        fields.setdefault('status', 'published')
+        story = Story(title=f'Story {i}', content='Walkies', user_id=author.id,
+                      reviewed_by=reviewer.id, **fields)
+        db.session.add(story)
+        stories.append(story)
+    db.session.commit()
+    return stories
+
+
+def seed_gallery(db, make_user, count):
+    for _ in range(count):
+        i = next(_seq)
+        uploader = make_user(f'uploader{i}@example.com')
+        db.session.add(GalleryItem(
+            title=f'Item {i}', file_path=f'uploads/gallery/item{i}.jpg', file_name=f'item{i}.jpg',
+            file_size=1024, file_type='image', mime_type='image/jpeg', user_id=uploader.id
+        ))
+    db.session.commit()
+
+
+def seed_story_media(db, make_user, *names):
+    story = seed_stories(db, make_user, 1)[0]
+    story.media_files = json.dumps([
+        {'file_path': f'uploads/media/{name}', 'file_type': 'video' if name.endswith('.mp4') else 'image'}
+        for name in names
+    ])
+    db.session.commit()
+    return story
+
+
+@contextmanager
+def concurrent_media_write(db, story_id, index, **fields):
+    """Commit a change to one ``media_files`` entry just before the next write to the column, as another process would"""
+    raced = []
+
+    def other_process(conn, cursor, statement, parameters, context, executemany):
+        if not raced and statement.startswith('UPDATE stories SET') and 'media_files=' in statement:
+            raced.append(statement)
+            media_files = json.loads(cursor.connection.execute(
+                'SELECT media_files FROM stories WHERE id = ?', (story_id,)).fetchone()[0])
+            media_files[index].update(fields)
+            cursor.connection.execute('UPDATE stories SET media_files = ? WHERE id = ?',
+                                      (json.dumps(media_files), story_id))
+            cursor.connection.commit()
+
+    event.listen(db.engine, 'before_cursor_execute', other_process)
+    try:
+        yield
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', other_process)
+    assert raced
+
+
+def queries_for(client, count_queries, url):
+    with count_queries() as counter:
+        response = client.get(url)
+    assert response.status_code == 200, response.get_json()
+    return counter.count
+
+
+class TestStorySearch:
+    """Story search is ranked through the full-text index, which follows story writes"""
+
+    @staticmethod
+    def search(client, terms):
+        response = client.get(f'/api/stories?search={terms}')
+        assert response.status_code == 200
+        return [story['id'] for story in response.get_json()['data']]
+
+    @staticmethod
+    def indexed_ids(db):
+        from sqlalchemy import text
+        return {row[0] for row in db.session.execute(text('SELECT rowid FROM story_search'))}
+
+    def test_title_matches_rank_above_body_matches(self, client, db, make_user):
+        from datetime import datetime, timedelta
+        in_title, in_body, unrelated = seed_stories(db, make_user, 3)
+        in_title.title = 'Beagle on the beach'
+        in_title.created_at = datetime.utcnow() - timedelta(days=2)
+        in_body.content = 'A long afternoon walk with a beagle and two terriers along the river.'
+        in_body.created_at = datetime.utcnow()
+        db.session.commit()
+
+        assert self.search(client, 'beagle') == [in_title.id, in_body.id]
+        # Terms are prefix-matched and punctuation can't break the MATCH syntax
+        assert self.search(client, 'beag"') == [in_title.id, in_body.id]
+
+        response = client.get('/api/stories?search=terriers')
+        story = response.get_json()['data'][0]
+        assert story['id'] == in_body.id and '<mark>terriers</mark>' in story['search_snippet']
+
+    def test_index_follows_updates_and_deletes(self, client, db, make_user):
+        first, second = seed_stories(db, make_user, 2)
+        draft = seed_stories(db, make_user, 1, status='draft')[0]
+        assert self.indexed_ids(db) == {first.id, second.id}
+
+        first.title = 'Corgi picnic'
+        db.session.commit()
+        assert self.search(client, 'corgi') == [first.id]
+        first.title = 'Dachshund parade'
+        db.session.commit()
+        assert self.search(client, 'dachshund') == [first.id]
+        assert self.search(client, 'corgi') == []
+
+        draft.status = 'published'
+        second.status = 'draft'
+        db.session.commit()
+        assert self.indexed_ids(db) == {first.id, draft.id}
+
+        db.session.delete(first)
+        db.session.commit()
+        assert self.indexed_ids(db) == {draft.id}
+        assert self.search(client, 'dachshund') == []
+
+    def test_index_created_after_startup_is_picked_up(self, client, db, make_user, monkeypatch):
+        from sqlalchemy import text
+        from app.utils import story_search
+        db.session.execute(text('DROP TABLE story_search'))
+        db.session.commit()
+        story_search._availability.forget()
+        monkeypatch.setattr(story_search._availability, 'retry_seconds', 0)
+        story = seed_stories(db, make_user, 1)[0]
+        story.title = 'Greyhound sprint'
+        db.session.commit()
+
+        # Without the index the LIKE fallback answers
+        assert not story_search.StorySearchIndex.is_available()
+        assert self.search(client, 'greyhound') == [story.id]
+
+        # The migration runs while this process is up
+        db.session.execute(text(story_search.SQLITE_SCHEMA[0]))
+        db.session.execute(text("INSERT INTO story_search (rowid, title, content, tags) "
+                                "SELECT id, title, content, '' FROM stories"))
+        db.session.commit()
+        assert story_search.StorySearchIndex.is_available()
+        assert self.search(client, 'greyh') == [story.id]
+
+
+class TestTagIndex:
+    """Tag filters and tag clouds read the normalized tag tables kept in sync with the tag strings"""
+
+    @staticmethod
+    def tagged(client, tag):
+        response = client.get(f'/api/stories?tag={tag}')
+        assert response.status_code == 200
+        return {story['id'] for story in response.get_json()['data']}
+
+    @staticmethod
+    def story_tag_rows(db):
+        from app.models_tags import story_tags
+        return db.session.execute(story_tags.select()).all()
+
+    def test_tag_filter_is_normalized_and_follows_edits(self, client, db, make_user):
+        parks, beaches, untagged = seed_stories(db, make_user, 3)
+        parks.tags = 'Dog  Park, #Fetch'
+        beaches.tags = 'dog park,beach'
+        db.session.commit()
+
+        assert self.tagged(client, 'dog park') == {parks.id, beaches.id}
+        assert self.tagged(client, '%23DOG%20PARK') == {parks.id, beaches.id}
+        assert self.tagged(client, 'fetch') == {parks.id}
+
+        beaches.tags = 'beach'
+        db.session.commit()
+        assert self.tagged(client, 'dog park') == {parks.id}
+
+        db.session.delete(parks)
+        db.session.commit()
+        assert self.tagged(client, 'dog park') == set()
+        assert all(row.story_id == beaches.id for row in self.story_tag_rows(db))
+
+    def test_tag_counts_only_cover_published_stories(self, client, db, make_user):
+        published = seed_stories(db, make_user, 2, tags='walks,Parks')
+        seed_stories(db, make_user, 1, tags='walks,drafts', status='draft')
+        published[1].tags = 'walks'
+        db.session.commit()
+
+        response = client.get('/api/stories/tags')
+        assert response.get_json()['data'] == [
+            {'name': 'walks', 'slug': 'walks', 'count': 2},
+            {'name': 'Parks', 'slug': 'parks', 'count': 1},
+        ]
+
+    def test_book_filter_matches_either_language(self, client, db):
+        from app.models_book import Book
+        english = Book(title='Walkies', description='Puppy walks', tags='puppies')
+        italian = Book(title='Passeggiate', description='Passeggiate', tags_it='cuccioli')
+        db.session.add_all([english, italian])
+        db.session.commit()
+
+        for tag, expected in (('puppies', english.id), ('cuccioli', italian.id)):
+            response = client.get(f'/api/books/public/books?tag={tag}')
+            assert [book['id'] for book in response.get_json()['books']] == [expected]
+
+    def test_backfill_indexes_existing_rows(self, db, make_user):
+        from app.utils.tag_index import TagIndex
+        from app.models_tags import story_tags
+        stories = seed_stories(db, make_user, 3, tags='walks')
+        db.session.execute(story_tags.delete())
+        db.session.commit()
+
+        assert TagIndex.backfill(kinds=['story'], batch_size=2) == {'story': 3}
+        assert {row.story_id for row in self.story_tag_rows(db)} == {story.id for story in stories}
+
+    def test_a_missed_probe_is_retried(self, db, make_user, monkeypatch):
+        from app.utils import tag_index
+        monkeypatch.setattr(tag_index._availability, 'retry_seconds', 0)
+        tag_index._availability.forget()
+        # e.g. the process probed before the tag tables were migrated
+        assert not tag_index._availability.check(db.session.connection(), lambda conn: False)
+        db.session.rollback()
+
+        story = seed_stories(db, make_user, 1, tags='walks')[0]
+        assert [row.story_id for row in self.story_tag_rows(db)] == [story.id]
+
+
+class TestRelatedStories:
+    """Story changes refresh a symmetric related-stories graph, in a worker by default"""
+
+    @staticmethod
+    def edges():
+        from app.models_related import StoryRelation
+        return {(edge.story_id, edge.related_story_id) for edge in StoryRelation.query.all()}
+
+    def test_publish_unpublish_and_delete_keep_neighbours_symmetric(self, db, make_user):
+        first, second, third = seed_stories(db, make_user, 3, category='walks')
+        draft = seed_stories(db, make_user, 1, category='walks', status='draft')[0]
+        published = [first.id, second.id, third.id]
+        assert self.edges() == {(a, b) for a in published for b in published if a != b}
+
+        draft.status = 'published'
+        db.session.commit()
+        published.append(draft.id)
+        assert self.edges() == {(a, b) for a in published for b in published if a != b}
+
+        second.status = 'draft'
+        db.session.commit()
+        published.remove(second.id)
+        assert self.edges() == {(a, b) for a in published for b in published if a != b}
+
+        db.session.delete(third)
+        db.session.commit()
+        published.remove(third.id)
+        assert self.edges() == {(first.id, draft.id), (draft.id, first.id)}
+
+    def test_refresh_is_queued_after_commit(self, app, db, make_user):
+        import json
+        from app.models_jobs import Job
+        from app.utils.job_queue import Worker
+        first = seed_stories(db, make_user, 1, category='walks')[0]
+        app.config['RELATED_REFRESH_ASYNC'] = True
+        second = seed_stories(db, make_user, 1, category='walks')[0]
+        assert self.edges() == set()
+        job = Job.query.filter_by(name='related.refresh').one()
+        assert job.status == 'queued' and json.loads(job.payload) == {'story_ids': [second.id]}
+
+        Worker(app).run(burst=True)
+        assert self.edges() == {(first.id, second.id), (second.id, first.id)}
+
+
+class TestListEndpointQueryCounts:
+    """List endpoints must not issue per-row queries for related users"""
+
+    def test_public_stories(self, client, db, make_user, count_queries):
+        seed_stories(db, make_user, 2)
+        small = queries_for(client, count_queries, '/api/stories')
+        seed_stories(db, make_user, 8)
+        large = queries_for(client, count_queries, '/api/stories')
+        assert small == large == 5  # Including the conditional GET validator
+
+    def test_public_gallery(self, client, db, make_user, count_queries):
+        seed_gallery(db, make_user, 2)
+        small = queries_for(client, count_queries, '/api/admin/public/gallery')
+        seed_gallery(db, make_user, 8)
+        large = queries_for(client, count_queries, '/api/admin/public/gallery')
+        assert small == large == 4
+
+    def test_admin_stories(self, client, db, make_user, login, count_queries):
+        login(make_user('admin@example.com', admin_level='admin'))
+        seed_stories(db, make_user, 2)
+        small = queries_for(client, count_queries, '/api/admin/stories')
+        seed_stories(db, make_user, 8)
+        large = queries_for(client, count_queries, '/api/admin/stories')
+        assert small == large == 5
+
+    def test_my_submissions(self, client, db, make_user, login, count_queries):
+        author_id = make_user('writer@example.com').id
+        login(db.session.get(User, author_id))
+        for i in range(10):
+            reviewer = make_user(f'reviewer{i}@example.com', admin_level='moderator')
+            db.session.add(Story(title=f'Draft {i}', content='Walkies', user_id=author_id,
+                                 reviewed_by=reviewer.id if i % 2 else None, status='pending'))
+            db.session.commit()
+            if i == 1:
+                small = queries_for(client, count_queries, '/api/stories/my-submissions')
+        large = queries_for(client, count_queries, '/api/stories/my-submissions')
+        assert small == large == 5
+
+
+class TestCursorPagination:
+    """``?cursor=`` walks a listing by (created_at, id) instead of OFFSET"""
+
+    def test_walks_every_story_once(self, client, db, make_user):
+        seed_stories(db, make_user, 7)
+        seen, cursor = [], ''
+        while cursor is not None:
+            response = client.get(f'/api/stories?per_page=3&cursor={cursor}')
+            body = response.get_json()
+            assert response.status_code == 200
+            assert body['meta']['total'] == 7
+            seen.extend(story['id'] for story in body['data'])
+            cursor = body['meta']['next_cursor']
+        assert len(seen) == len(set(seen)) == 7
+
+    def test_invalid_cursor(self, client, db, make_user):
+        seed_stories(db, make_user, 1)
+        response = client.get('/api/stories?cursor=not-a-cursor')
+        assert response.status_code == 400
+
+    def test_total_is_cached_between_pages(self, app, client, db, make_user, count_queries):
+        from app.utils.pagination import clear_cached_totals
+        app.config['LISTING_TOTAL_CACHE_TTL'] = 60
+        clear_cached_totals()
+        seed_gallery(db, make_user, 5)
+        first = queries_for(client, count_queries, '/api/admin/public/gallery?per_page=2&page=1')
+        second = queries_for(client, count_queries, '/api/admin/public/gallery?per_page=2&page=2')
+        assert second == first - 1
+        clear_cached_totals()
+
+    @staticmethod
+    def walk(client, url, key='data', meta='meta'):
+        ids, cursor = [], ''
+        while cursor is not None:
+            response = client.get(f'{url}&cursor={cursor}')
+            assert response.status_code == 200, response.get_json()
+            ids.extend(row['id'] for row in response.get_json()[key])
+            cursor = response.get_json()[meta]['next_cursor']
+        return ids
+
+    def test_cursor_pages_keep_custom_orderings(self, client, db, make_user, login):
+        original, *_ = seed_stories(db, make_user, 3)
+        seed_stories(db, make_user, 2, language='it', translation_of_id=original.id)
+        favourite = seed_stories(db, make_user, 1)[0]
+        favourite.content = 'Walkies, walkies and more walkies'
+        db.session.commit()
+        for url in ('/api/stories?lang=it&per_page=10', '/api/stories?search=walkies&per_page=10'):
+            paged = [story['id'] for story in client.get(url).get_json()['data']]
+            assert self.walk(client, url.replace('per_page=10', 'per_page=1')) == paged
+        italian = [story['id'] for story in client.get('/api/stories?lang=it').get_json()['data']]
+        assert [Story.query.get(story_id).language for story_id in italian[:2]] == ['it', 'it']
+
+        login(make_user('admin@example.com', admin_level='admin'))
+        url = '/api/admin/users?sort_by=name&sort_order=asc&per_page=100'
+        paged = [user['id'] for user in client.get(url).get_json()['data']]
+        assert paged == [user.id for user in User.query.order_by(User.name, User.created_at, User.id)]
+        assert self.walk(client, url.replace('per_page=100', 'per_page=3')) == paged
+
+    def test_rows_without_a_timestamp_are_left_out_of_cursor_pages(self, client, db, make_user, login):
+        from app.models import SecurityLog
+        from app.utils.pagination import paginate_listing
+        db.session.add_all([SecurityLog(event_type=f'event{i}') for i in range(4)])
+        db.session.commit()
+        SecurityLog.query.filter(SecurityLog.event_type.in_(['event1', 'event2'])).update({'timestamp': None})
+        db.session.commit()
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        paged = client.get('/api/admin/security-events?per_page=10').get_json()['events']
+        assert len(paged) == 4 and [event['timestamp'] for event in paged].count(None) == 2
+        walked = self.walk(client, '/api/admin/security-events?per_page=1', key='events', meta='pagination')
+        assert sorted(walked) == sorted(event['id'] for event in paged if event['timestamp'])
+
+        # Ascending puts NULLs first on SQLite; they still stay out of the keyset
+        oldest = paginate_listing(SecurityLog.query, SecurityLog.timestamp, SecurityLog.id,
+                                  per_page=1, cursor='', descending=False)
+        assert oldest.items[0].timestamp is not None and oldest.next_cursor
+
+
+class TestStoryLanguageFallback:
+    """Non-English listings fall back to English stories within the same query"""
+
+    def test_translations_replace_their_source(self, client, db, make_user):
+        original, untranslated = seed_stories(db, make_user, 2)
+        translated = seed_stories(db, make_user, 1, language='it', translation_of_id=original.id)[0]
+        ids = (original.id, untranslated.id, translated.id)
+
+        body = client.get('/api/stories?lang=it').get_json()
+        assert [story['id'] for story in body['data']] == [ids[2], ids[1]]
+        assert [story['language_fallback'] for story in body['data']] == [False, True]
+        assert body['meta']['total'] == 2
+
+    def test_english_listing_is_unaffected(self, client, db, make_user):
+        original = seed_stories(db, make_user, 1)[0]
+        seed_stories(db, make_user, 1, language='it', translation_of_id=original.id)
+        body = client.get('/api/stories?lang=en').get_json()
+        assert [story['language'] for story in body['data']] == ['en']
+
+
+class TestCounterBuffer:
+    """View counters are buffered in memory and applied as batched increments"""
+
+    def test_views_are_applied_on_flush(self, app, client, db, make_user):
+        from app.utils.counter_buffer import counter_buffer
+        app.config.update(COUNTER_BUFFER_ENABLED=True, COUNTER_FLUSH_INTERVAL=3600)
+        seed_gallery(db, make_user, 1)
+        item_id = GalleryItem.query.one().id
+        try:
+            views = [client.post(f'/api/admin/public/gallery/{item_id}/view').get_json()['data']['views']
+                     for _ in range(3)]
+            assert views == [1, 2, 3]
+            assert db.session.query(GalleryItem.views).filter_by(id=item_id).scalar() == 0
+
+            assert counter_buffer.flush() == 1
+            assert db.session.query(GalleryItem.views).filter_by(id=item_id).scalar() == 3
+        finally:
+            counter_buffer.shutdown()
+
+    def test_write_through_when_disabled(self, client, db, make_user):
+        story_id = seed_stories(db, make_user, 1)[0].id
+        for expected in (1, 2):
+            response = client.post(f'/api/stories/{story_id}/view')
+            assert response.get_json()['data']['views'] == expected
+        assert db.session.query(Story.views).filter_by(id=story_id).scalar() == 2
+
+
+class TestLikeCounters:
+    """Like toggles keep the like rows and denormalized counters in step"""
+
+    def test_story_like_and_unlike(self, client, db, make_user, login):
+        story_id = seed_stories(db, make_user, 1)[0].id
+        login(make_user('fan@example.com'))
+        assert client.post(f'/api/stories/{story_id}/like').get_json()['likes_count'] == 1
+        assert client.post(f'/api/stories/{story_id}/like').get_json()['likes_count'] == 1
+        assert client.delete(f'/api/stories/{story_id}/unlike').get_json()['likes_count'] == 0
+        assert client.delete(f'/api/stories/{story_id}/unlike').get_json()['likes_count'] == 0
+
+    def test_gallery_like_toggles(self, client, db, make_user):
+        seed_gallery(db, make_user, 1)
+        item_id = GalleryItem.query.one().id
+        url = f'/api/admin/public/gallery/{item_id}/like'
+        assert client.post(url).get_json()['data'] == {'liked': True, 'likes': 1}
+        assert client.post(url).get_json()['data'] == {'liked': False, 'likes': 0}
+
+    def test_reconciler_repairs_drift(self, db, make_user):
+        from app.models import StoryLike
+        from app.utils.like_counters import CounterReconciler
+        story = seed_stories(db, make_user, 1)[0]
+        db.session.add(StoryLike(story_id=story.id, user_id=story.user_id))
+        story.likes_count = 7
+        story.comments_count = 3
+        db.session.commit()
+
+        assert CounterReconciler.run(batch_size=1) == {'stories': 1, 'gallery_items': 0}
+        db.session.refresh(story)
+        assert (story.likes_count, story.comments_count) == (1, 0)
+
+    def test_reconciliation_runs_as_a_scheduled_job(self, app, db, make_user):
+        from datetime import datetime
+        from app.models_jobs import Job
+        from app.tasks import reconcile_counters
+        from app.utils.job_queue import Worker
+        story = seed_stories(db, make_user, 1)[0]
+        story.likes_count = 4
+        db.session.commit()
+
+        reconcile_counters.enqueue(batch_size=50)
+        Worker(app, queues=['maintenance']).run(burst=True)
+        db.session.refresh(story)
+        assert story.likes_count == 0
+        # The next run is queued a day out
+        queued = Job.query.filter_by(name='maintenance.reconcile_counters', status='queued').one()
+        assert json.loads(queued.payload) == {'batch_size': 50}
+        assert (queued.run_at - datetime.utcnow()).total_seconds() > 86000
+
+
+class TestCommentTree:
+    """Comment threads load in a fixed number of queries, nested in memory"""
+
+    def post_comment(self, client, story_id, parent_id=None):
+        response = client.post(f'/api/stories/{story_id}/comments',
+                               json={'content': 'Good dog', 'parent_id': parent_id})
+        assert response.status_code == 201, response.get_json()
+        return response.get_json()['data']['id']
+
+    def build_thread(self, client, story_id, replies):
+        root = self.post_comment(client, story_id)
+        parent = root
+        for _ in range(replies):
+            parent = self.post_comment(client, story_id, parent)
+        return root
+
+    def test_threads_nest_and_respect_depth(self, client, db, make_user, login):
+        story_id = seed_stories(db, make_user, 1)[0].id
+        login(make_user('commenter@example.com'))
+        self.build_thread(client, story_id, 3)
+
+        thread = client.get(f'/api/stories/{story_id}/comments').get_json()['data'][0]
+        depths = []
+        node = thread
+        while node['replies']:
+            node = node['replies'][0]
+            depths.append(node['depth'])
+        assert depths == [1, 2, 3]
+        assert thread['replies_total'] == 3
+
+        shallow = client.get(f'/api/stories/{story_id}/comments?max_depth=1').get_json()['data'][0]
+        assert len(shallow['replies']) == 1 and shallow['replies'][0]['replies'] == []
+
+    def test_reply_pagination(self, client, db, make_user, login):
+        story_id = seed_stories(db, make_user, 1)[0].id
+        login(make_user('chatty@example.com'))
+        root = self.post_comment(client, story_id)
+        replies = [self.post_comment(client, story_id, root) for _ in range(5)]
+
+        thread = client.get(f'/api/stories/{story_id}/comments?replies_per_thread=2').get_json()['data'][0]
+        assert [reply['id'] for reply in thread['replies']] == replies[:2]
+        assert thread['next_replies_after'] == replies[1]
+
+        page = client.get(f'/api/stories/{story_id}/comments/{root}/replies'
+                          f'?after={replies[1]}&limit=2').get_json()
+        assert [reply['id'] for reply in page['data']] == replies[2:4]
+        assert page['meta']['next_after'] == replies[3]
+
+    def test_query_count_does_not_grow_with_replies(self, client, db, make_user, login, count_queries):
+        story_id = seed_stories(db, make_user, 1)[0].id
+        login(make_user('threads@example.com'))
+        self.build_thread(client, story_id, 2)
+        small = queries_for(client, count_queries, f'/api/stories/{story_id}/comments')
+        for _ in range(3):
+            self.build_thread(client, story_id, 4)
+        large = queries_for(client, count_queries, f'/api/stories/{story_id}/comments')
+        assert small == large
+
+
+class TestResponseCache:
+    """Public listings are served from the tag-invalidated response cache"""
+
+    @staticmethod
+    def enable(app):
+        from app.utils.response_cache import response_cache
+        app.config.update(RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_TAG_CHECK_INTERVAL=3600)
+        response_cache.clear()
+        return response_cache
+
+    def test_repeat_requests_are_hits(self, app, client, db, make_user, count_queries):
+        cache = self.enable(app)
+        seed_stories(db, make_user, 2)
+        assert client.get('/api/stories').headers['X-Cache'] == 'MISS'
+        with count_queries() as counter:
+            response = client.get('/api/stories?lang=xx')  # Unsupported languages share the English entry
+        assert response.headers['X-Cache'] == 'HIT'
+        assert counter.count == 1  # The conditional GET validator
+        assert len(response.get_json()['data']) == 2
+        assert client.get('/api/stories?lang=it').headers['X-Cache'] == 'MISS'
+        assert cache.stats()['totals']['hits'] == 1
+
+    def test_tag_table_is_found_after_a_missed_probe(self, app, client, db, make_user, monkeypatch):
+        from app.utils import response_cache
+        self.enable(app)
+        monkeypatch.setattr(response_cache._availability, 'retry_seconds', 0)
+        response_cache._availability.forget()
+        # e.g. the process probed before the cache table was migrated
+        assert not response_cache._availability.check(db.session.connection(), lambda conn: False)
+        db.session.rollback()
+
+        seed_stories(db, make_user, 1)
+        assert client.get('/api/stories').headers['X-Cache'] == 'MISS'
+        assert client.get('/api/stories').headers['X-Cache'] == 'HIT'
+
+    def test_admin_writes_invalidate(self, app, client, db, make_user, login):
+        self.enable(app)
+        seed_gallery(db, make_user, 2)
+        first = client.get('/api/admin/public/gallery').get_json()
+        assert len(first['data']) == 2
+        assert client.get('/api/admin/public/gallery').headers['X-Cache'] == 'HIT'
+
+        login(make_user('admin@example.com', admin_level='admin'))
+        response = client.post('/api/bulk/gallery', json={'action': 'deactivate',
+                                                          'item_ids': [first['data'][0]['id']]})
+        assert response.status_code == 200
+
+        response = client.get('/api/admin/public/gallery')
+        assert response.headers['X-Cache'] == 'MISS'
+        assert len(response.get_json()['data']) == 1
+
+    def test_other_workers_see_invalidations(self, app, client, db, make_user):
+        from app.utils.response_cache import bump_tags
+        cache = self.enable(app)
+        seed_gallery(db, make_user, 1)
+        client.get('/api/admin/public/gallery/categories')
+        # Another worker's commit only changes the shared version row
+        with db.engine.begin() as connection:
+            bump_tags(connection, ['gallery'])
+        assert client.get('/api/admin/public/gallery/categories').headers['X-Cache'] == 'HIT'
+        app.config['RESPONSE_CACHE_TAG_CHECK_INTERVAL'] = 0
+        assert client.get('/api/admin/public/gallery/categories').headers['X-Cache'] == 'MISS'
+        assert cache.stats()['totals']['stale'] == 1
+
+
+class TestConditionalGet:
+    """Public listings answer revalidation requests with 304s"""
+
+    def test_not_modified_skips_the_listing(self, client, db, make_user, count_queries):
+        seed_stories(db, make_user, 3)
+        etag = client.get('/api/stories').headers['ETag']
+        with count_queries() as counter:
+            response = client.get('/api/stories', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert counter.count == 1  # The validator aggregate only
+        assert client.get('/api/stories?page=2', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_changes_produce_a_new_validator(self, client, db, make_user):
+        stories = seed_stories(db, make_user, 2)
+        etag = client.get('/api/stories').headers['ETag']
+        db.session.delete(stories[0])
+        db.session.commit()
+        response = client.get('/api/stories', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert len(response.get_json()['data']) == 1
+
+    def test_if_modified_since(self, client, db, make_user):
+        seed_gallery(db, make_user, 1)
+        last_modified = client.get('/api/admin/public/gallery').headers['Last-Modified']
+        response = client.get('/api/admin/public/gallery', headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+
+
+class TestResumableUploads:
+    """Chunked uploads resume from the stored offset and finalize into content"""
+
+    JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 60
+
+    @staticmethod
+    def create(client, length, filename='photo.jpg', purpose='story'):
+        import base64
+        metadata = ','.join(f"{key} {base64.b64encode(value.encode()).decode()}"
+                            for key, value in (('filename', filename), ('purpose', purpose)))
+        return client.post('/api/uploads', headers={'Upload-Length': str(length), 'Upload-Metadata': metadata})
+
+    @staticmethod
+    def patch(client, location, offset, chunk):
+        return client.patch(location, data=chunk, headers={
+            'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream'})
+
+    def test_chunks_resume_and_attach_to_story(self, app, client, db, make_user, login, tmp_path):
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), RESUMABLE_UPLOAD_DIR=str(tmp_path / 'partial'))
+        author = make_user('writer@example.com')
+        login(author)
+        story = Story(title='Walk', content='Park', user_id=author.id, status='pending')
+        db.session.add(story)
+        db.session.commit()
+
+        created = self.create(client, len(self.JPEG))
+        assert created.status_code == 201
+        location = created.headers['Location']
+
+        assert self.patch(client, location, 0, self.JPEG[:20]).headers['Upload-Offset'] == '20'
+        stale = self.patch(client, location, 0, self.JPEG[:20])
+        assert stale.status_code == 409 and stale.headers['Upload-Offset'] == '20'
+        assert client.head(location).headers['Upload-Offset'] == '20'
+        assert self.patch(client, location, 20, self.JPEG[20:]).status_code == 204
+
+        response = client.post(f'{location}/finalize', json={'story_id': story.id})
+        assert response.status_code == 201
+        media = response.get_json()['data']['media_file']
+        assert media['file_size'] == len(self.JPEG)
+        assert (tmp_path / 'uploads' / media['file_path']).read_bytes() == self.JPEG
+        assert db.session.get(Story, story.id).thumbnail == media['file_path']
+        assert client.head(location).status_code == 404
+
+    def test_rejects_bad_type_size_and_content(self, app, client, db, make_user, login, tmp_path):
+        app.config.update(RESUMABLE_UPLOAD_DIR=str(tmp_path / 'partial'), STORY_UPLOAD_MAX_SIZE=1024)
+        login(make_user('writer@example.com'))
+        assert self.create(client, 10, filename='notes.exe').status_code == 415
+        assert self.create(client, 4096).status_code == 413
+        assert self.create(client, 10, purpose='gallery').status_code == 403
+
+        location = self.create(client, 64).headers['Location']
+        response = self.patch(client, location, 0, b'MZ' + b'\x00' * 62)
+        assert response.status_code == 415
+        assert client.head(location).status_code == 404
+
+
+class TestImageDerivatives:
+    """Uploaded images get resized WebP/JPEG copies, dimensions and a placeholder"""
+
+    @staticmethod
+    def jpeg(size, orientation=None):
+        import io
+        from PIL import Image
+        image = Image.new('RGB', size, (200, 120, 40))
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', exif=exif)
+        return buffer.getvalue()
+
+    def test_rotated_photo_is_measured_upright(self, tmp_path):
+        from app.utils.image_derivatives import render_derivatives
+        source = tmp_path / 'dog.jpg'
+        source.write_bytes(self.jpeg((800, 400), orientation=6))
+
+        result = render_derivatives(str(source), widths=(320, 640, 1280))
+        assert (result['width'], result['height'], result['orientation']) == (400, 800, 6)
+        assert {(v['width'], v['height'], v['format']) for v in result['variants']} == {
+            (320, 640, 'webp'), (320, 640, 'jpeg'), (400, 800, 'webp'), (400, 800, 'jpeg')}
+        assert (tmp_path / 'dog_320w.webp').exists() and (tmp_path / 'dog_400w.jpg').exists()
+        assert result['placeholder'].startswith('data:image/jpeg;base64,')
+
+    def test_gallery_upload_exposes_srcset(self, app, client, db, make_user, login, tmp_path):
+        import io
+        app.config.update(UPLOAD_FOLDER=str(tmp_path), IMAGE_DERIVATIVE_WIDTHS=(320, 640))
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        response = client.post('/api/admin/gallery/upload', data={
+            'file': (io.BytesIO(self.jpeg((1000, 500))), 'walk.jpg'), 'title': 'Walk'
+        }, content_type='multipart/form-data')
+        assert response.status_code == 201
+        data = response.get_json()['data']
+        assert (data['width'], data['height']) == (1000, 500)
+        srcset = data['image_variants']['srcset']
+        assert srcset['webp'].split(', ')[0].endswith('_320w.webp 320w')
+        assert '/uploads/media/' in srcset['jpeg'] and srcset['jpeg'].endswith('_640w.jpg 640w')
+        assert data['image_variants']['placeholder'].startswith('data:image/jpeg')
+
+    def test_concurrent_story_results_are_merged(self, db, make_user):
+        from app.utils.image_derivatives import image_derivatives
+        story = seed_story_media(db, make_user, 'front.jpg', 'back.jpg')
+        back_variants = [{'width': 40, 'height': 20, 'format': 'webp', 'path': 'uploads/media/back_40w.webp'}]
+
+        with concurrent_media_write(db, story.id, 1, variants=back_variants):
+            image_derivatives.store('story', story.id, 'uploads/media/front.jpg', {
+                'width': 40, 'height': 20, 'orientation': 1, 'placeholder': 'data:image/jpeg;base64,',
+                'variants': [{'width': 40, 'height': 20, 'format': 'webp', 'file': 'front_40w.webp'}]
+            })
+
+        stored = json.loads(db.session.get(Story, story.id).media_files)
+        assert [media['variants'][0]['path'] for media in stored] == [
+            'uploads/media/front_40w.webp', 'uploads/media/back_40w.webp']
+
+
+class TestVideoProcessing:
+    """Videos are probed and thumbnailed outside the upload, hidden until ready"""
+
+    FFPROBE = """#!/bin/sh
+echo '{"streams": [{"codec_type": "video", "width": 1280, "height": 720, "tags": {"rotate": "90"}}],
+       "format": {"duration": "12.4"}}'
+"""
+    FFMPEG = """#!/bin/sh
+for last; do :; done
+printf 'jpeg' > "$last"
+"""
+
+    @staticmethod
+    def upload(client):
+        import io
+        return client.post('/api/admin/gallery/upload', data={
+            'file': (io.BytesIO(b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 32), 'walk.mp4'), 'title': 'Walk'
+        }, content_type='multipart/form-data')
+
+    @staticmethod
+    def install(tmp_path, monkeypatch, **scripts):
+        bin_dir = tmp_path / 'bin'
+        bin_dir.mkdir()
+        for name, body in scripts.items():
+            script = bin_dir / name
+            script.write_text(body)
+            script.chmod(0o755)
+        monkeypatch.setenv('PATH', f"{bin_dir}:/usr/bin:/bin")
+
+    def test_probe_fills_metadata_and_thumbnail(self, app, client, make_user, login, tmp_path, monkeypatch):
+        self.install(tmp_path, monkeypatch, ffprobe=self.FFPROBE, ffmpeg=self.FFMPEG)
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'))
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        data = self.upload(client).get_json()['data']
+        assert data['status'] == 'active'
+        assert (data['duration'], data['width'], data['height']) == (12, 720, 1280)
+        assert data['thumbnail'] == data['file_path'].rsplit('.', 1)[0] + '_thumb.jpg'
+        assert (tmp_path / data['thumbnail']).read_bytes() == b'jpeg'
+
+    def test_transcodes_hls_ladder(self, app, client, make_user, login, tmp_path, monkeypatch):
+        ffmpeg = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/ffmpeg.log"
+for last; do :; done
+case "$last" in
+  *%v*) out=$(dirname "$(dirname "$last")")
+        printf '#EXTM3U' > "$out/master.m3u8"
+        for rendition in "$out"/v*; do printf '#EXTM3U' > "$rendition/index.m3u8"; done ;;
+  *) printf 'jpeg' > "$last" ;;
+esac
+"""
+        self.install(tmp_path, monkeypatch, ffprobe=self.FFPROBE, ffmpeg=ffmpeg)
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), VIDEO_TRANSCODE_ENABLED=True,
+                          VIDEO_TRANSCODE_ASYNC=False, VIDEO_TRANSCODE_LADDER=((360, 800, 96), (720, 2800, 128),
+                                                                                (1440, 8000, 160)))
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        data = self.upload(client).get_json()['data']
+        stem = data['file_path'].rsplit('.', 1)[0]
+        streaming = data['streaming']
+        assert streaming['hls_url'].endswith(f'/{stem}_hls/master.m3u8')
+        assert streaming['mp4_url'].endswith(f'/{stem}_h264.mp4')
+        # The 1280px-tall source gets no 1440p rendition
+        assert [r['height'] for r in streaming['renditions']] == [360, 720]
+        assert (tmp_path / f'{stem}_hls' / 'v1' / 'index.m3u8').exists()
+        ladder_run = [line for line in (tmp_path / 'bin' / 'ffmpeg.log').read_text().splitlines() if 'master.m3u8' in line]
+        assert len(ladder_run) == 1 and 'split=2' in ladder_run[0]
+
+        response = client.get(f"/{stem}_hls/master.m3u8")
+        assert response.headers['Content-Type'] == 'application/vnd.apple.mpegurl'
+        response.close()
+
+    def test_processing_items_stay_hidden(self, app, client, make_user, login, tmp_path, monkeypatch):
+        self.install(tmp_path, monkeypatch)  # No ffmpeg at all
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), VIDEO_PROCESSING_ENABLED=False)
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        item = self.upload(client).get_json()['data']
+        assert item['status'] == 'processing'
+        assert client.get('/api/admin/public/gallery').get_json()['data'] == []
+
+        # A failed probe still releases the item, just without a thumbnail
+        from app.utils.video_processing import video_processor
+        app.config['VIDEO_PROCESSING_ENABLED'] = True
+        video_processor.schedule('gallery', item['id'], str(tmp_path / item['file_path']),
+                                 item['file_path'])
+        items = client.get('/api/admin/public/gallery').get_json()['data']
+        assert [(i['id'], i['thumbnail']) for i in items] == [(item['id'], None)]
+
+    def test_probe_is_a_queued_job(self, app, client, make_user, login, tmp_path, monkeypatch):
+        from app.models_jobs import Job
+        from app.utils.job_queue import Worker
+        self.install(tmp_path, monkeypatch, ffprobe=self.FFPROBE, ffmpeg=self.FFMPEG)
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), VIDEO_PROCESSING_ASYNC=True)
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        item = self.upload(client).get_json()['data']
+        assert item['status'] == 'processing'
+        assert Job.query.filter_by(name='video.probe', status='queued').count() == 1
+        assert Job.query.filter_by(name='maintenance.release_stuck_videos', status='queued').count() == 1
+
+        Worker(app, queues=['video']).run(burst=True)
+        items = client.get('/api/admin/public/gallery').get_json()['data']
+        assert [(i['id'], i['duration']) for i in items] == [(item['id'], 12)]
+
+    def test_stuck_items_are_released(self, app, client, db, make_user, login, tmp_path, monkeypatch):
+        from datetime import datetime, timedelta
+        from app.models_jobs import Job
+        from app.tasks import release_stuck_videos
+        self.install(tmp_path, monkeypatch)
+        app.config.update(UPLOAD_FOLDER=str(tmp_path / 'uploads'), VIDEO_PROCESSING_ENABLED=False)
+        login(make_user('admin@example.com', admin_level='admin'))
+        stuck, recent = (self.upload(client).get_json()['data'] for _ in range(2))
+        db.session.get(GalleryItem, stuck['id']).created_at = datetime.utcnow() - timedelta(hours=2)
+        db.session.commit()
+
+        assert release_stuck_videos() == {'released': 1, 'processing': 1}
+        assert [i['id'] for i in client.get('/api/admin/public/gallery').get_json()['data']] == [stuck['id']]
+        # Checks again later while anything is still processing
+        assert Job.query.filter_by(name='maintenance.release_stuck_videos', status='queued').count() == 1
+
+    def test_probe_and_image_results_for_one_story_are_merged(self, db, make_user):
+        from app.utils.video_processing import video_processor
+        story = seed_story_media(db, make_user, 'clip.mp4', 'photo.jpg')
+        photo_variants = [{'width': 40, 'height': 20, 'format': 'webp', 'path': 'uploads/media/photo_40w.webp'}]
+
+        # An image derivative lands while the probe's result is being merged
+        with concurrent_media_write(db, story.id, 1, variants=photo_variants):
+            video_processor._store('story', story.id, 'uploads/media/clip.mp4', {
+                'duration': 12, 'width': 720, 'height': None, 'thumbnail': 'uploads/media/clip_thumb.jpg',
+                'file_path': 'clip.mp4'
+            })
+
+        story = db.session.get(Story, story.id)
+        clip, photo = json.loads(story.media_files)
+        assert (clip['duration'], clip['thumbnail_path']) == (12, 'uploads/media/clip_thumb.jpg')
+        assert 'processing' not in clip
+        assert photo['variants'] == photo_variants
+        assert story.thumbnail == 'uploads/media/clip_thumb.jpg'
+
+    def test_renditions_keep_concurrent_writes_to_the_same_story(self, db, make_user):
+        from app.utils.video_transcode import TARGETS
+        story = seed_story_media(db, make_user, 'clip.mp4', 'photo.jpg')
+        renditions = {'mp4': 'uploads/media/clip_h264.mp4', 'hls': 'uploads/media/clip_hls/master.m3u8',
+                      'renditions': [{'height': 360}]}
+
+        # The transcode worker's write races the web process's probe of the same entry
+        with concurrent_media_write(db, story.id, 0, duration=12):
+            TARGETS['story'](story.id, 'uploads/media/clip.mp4', renditions)
+            db.session.commit()
+
+        clip, photo = json.loads(db.session.get(Story, story.id).media_files)
+        assert (clip['duration'], clip['video_renditions']) == (12, renditions)
+
+
+class TestJobQueue:
+    """Jobs are leased by priority, retried with backoff and dead-lettered"""
+
+    @staticmethod
+    def register(monkeypatch, name, fn):
+        from app.utils.job_queue import TASKS, Task
+        monkeypatch.setitem(TASKS, name, Task(fn, name, queue='test'))
+
+    def test_jobs_run_in_priority_order(self, app, monkeypatch):
+        from app.utils.job_queue import JobQueue, Worker
+        from app.models_jobs import Job
+        ran = []
+        self.register(monkeypatch, 'test.record', lambda label: ran.append(label) or {'label': label})
+
+        low = JobQueue.enqueue('test.record', {'label': 'low'}, queue='test', priority=0)
+        JobQueue.enqueue('test.record', {'label': 'high'}, queue='test', priority=5)
+        JobQueue.enqueue('test.record', {'label': 'later'}, queue='test', priority=9, delay=3600)
+
+        assert Worker(app, queues=['test']).run(burst=True) == 2
+        assert ran == ['high', 'low']
+        job = Job.query.get(low.id)
+        assert (job.status, job.attempts, job.to_dict()['result']) == ('succeeded', 1, {'label': 'low'})
+
+    def test_failures_back_off_then_go_dead(self, app, client, db, make_user, login, monkeypatch):
+        from datetime import datetime
+        from app.utils.job_queue import JobQueue, Worker
+        from app.models_jobs import Job
+
+        def flaky():
+            raise RuntimeError('upstream down')
+        self.register(monkeypatch, 'test.flaky', flaky)
+
+        job_id = JobQueue.enqueue('test.flaky', queue='test', max_attempts=2).id
+        worker = Worker(app, queues=['test'])
+        assert worker.run(burst=True) == 1
+        job = Job.query.get(job_id)
+        assert (job.status, job.attempts, job.last_error) == ('queued', 1, 'upstream down')
+        assert job.run_at > datetime.utcnow()
+        assert worker.run(burst=True) == 0  # Still backing off
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        assert worker.run(burst=True) == 1
+        assert Job.query.get(job_id).status == 'dead'
+
+        login(make_user('admin@example.com', admin_level='admin'))
+        stats = client.get('/api/admin/jobs/stats').get_json()['data']
+        assert stats['queues']['test']['dead'] == 1
+        assert client.post(f'/api/admin/jobs/{job_id}/retry').status_code == 200
+        assert client.post(f'/api/admin/jobs/{job_id}/retry').status_code == 409
+        assert client.get(f'/api/admin/jobs/{job_id}').get_json()['data']['status'] == 'queued'
+
+    def test_large_bulk_action_is_queued(self, app, client, db, make_user, login):
+        from app.models import GalleryItem
+        from app.utils.job_queue import Worker
+        app.config['BULK_INLINE_LIMIT'] = 2
+        admin = make_user('admin@example.com', admin_level='admin')
+        items = [GalleryItem(title=f'Item {i}', file_path=f'uploads/gallery/{i}.jpg', file_name=f'{i}.jpg',
+                             file_size=1, file_type='image', mime_type='image/jpeg', status='inactive',
+                             user_id=admin.id) for i in range(3)]
+        db.session.add_all(items)
+        db.session.commit()
+        ids = [item.id for item in items]
+        login(admin)
+
+        response = client.post('/api/bulk/gallery', json={'action': 'activate', 'item_ids': ids})
+        assert response.status_code == 202
+        job_id = response.get_json()['job_id']
+        assert response.headers['Location'].endswith(f'/jobs/{job_id}')
+
+        Worker(app, queues=['bulk']).run(burst=True)
+        job = client.get(f'/api/admin/jobs/{job_id}').get_json()['data']
+        assert (job['status'], job['result']) == ('succeeded', {'affected_count': 3})
+        assert {item.status for item in GalleryItem.query.all()} == {'active'}
+
+        response = client.post('/api/bulk/gallery', json={'action': 'deactivate', 'item_ids': ids[:2]})
+        assert (response.status_code, response.get_json()['affected_count']) == (200, 2)
+
+    def test_queued_bulk_action_is_audited_outside_a_request(self, app, client, db, make_user, login):
+        from flask import has_request_context
+        from app.models import SecurityLog, Tour
+        from app.utils.job_queue import Worker
+        app.config['BULK_INLINE_LIMIT'] = 0
+        admin = make_user('admin@example.com', admin_level='admin')
+        client.environ_base.update(REMOTE_ADDR='203.0.113.9', HTTP_USER_AGENT='admin-browser')
+        login(admin)
+        response = client.post('/api/bulk/tours', json={'action': 'activate', 'item_ids': [1, 2]})
+        assert response.status_code == 202
+        assert SecurityLog.query.count() == 0
+
+        assert not has_request_context()
+        Worker(app, queues=['bulk']).run(burst=True)
+        log = SecurityLog.query.one()
+        assert (log.user_id, log.event_type, log.ip_address, log.user_agent) == \
+            (admin.id, 'bulk_tour_action', '203.0.113.9', 'admin-browser')
+        assert log.details == 'Performed "activate" on 0 tours'
+
+
+class TestEmailOutbox:
+    """Email is queued in the outbox and delivered over one pooled SMTP connection"""
+
+    @staticmethod
+    def smtp_server(reject=(), defer=()):
+        """A minimal debugging SMTP server; 550s ``reject`` and 451s ``defer`` recipients"""
+        import socketserver
+        import threading
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(f'{line}\r\n'.encode())
+
+            def handle(self):
+                server.connections += 1
+                self.reply('220 localhost debugging server')
+                recipients = []
+                for raw in self.rfile:
+                    command = raw.decode().strip()
+                    verb = command.split(' ', 1)[0].split(':', 1)[0].upper()
+                    if verb in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif verb == 'RCPT':
+                        address = command.split(':', 1)[1].strip('<> ')
+                        if address in reject:
+                            self.reply('550 No such user')
+                        elif address in defer:
+                            self.reply('451 Try again later')
+                        else:
+                            recipients.append(address)
+                            self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        lines = []
+                        for data in self.rfile:
+                            if data == b'.\r\n':
+                                break
+                            lines.append(data)
+                        server.messages.append((recipients, b''.join(lines).decode()))
+                        recipients = []
+                        self.reply('250 Queued')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:  # MAIL, RSET, NOOP
+                        recipients = [] if verb in ('MAIL', 'RSET') else recipients
+                        self.reply('250 OK')
+
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        server.connections, server.messages = 0, []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    @staticmethod
+    def use_server(app, port):
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USERNAME=None,
+                          MAIL_RATE_LIMIT=0)
+        mail = app.extensions['mail']
+        mail.server, mail.port, mail.use_tls, mail.username, mail.suppress = '127.0.0.1', port, False, None, False
+
+    def test_campaign_uses_one_connection(self, app, client, make_user, login):
+        server = self.smtp_server()
+        self.use_server(app, server.server_address[1])
+        admin = make_user('admin@example.com', admin_level='admin')
+        for name in ('rex', 'bella', 'max'):
+            make_user(f'{name}@example.com')
+        login(admin)
+
+        response = client.post('/api/communications/bulk-email', json={
+            'subject': 'Park day', 'message': 'See you at <noon>', 'recipients': 'all'})
+        server.shutdown()
+        assert response.status_code == 202
+        campaign_id = response.get_json()['campaign_id']
+
+        assert server.connections == 1
+        delivered = {recipients[0]: body for recipients, body in server.messages}
+        assert set(delivered) == {'admin@example.com', 'rex@example.com', 'bella@example.com', 'max@example.com'}
+        assert 'Subject: [DoggoDaily] Park day' in delivered['rex@example.com']
+        assert 'Hi rex,' in delivered['rex@example.com'] and 'Hi bella,' in delivered['bella@example.com']
+
+        status = client.get(f'/api/communications/bulk-email/{campaign_id}').get_json()['data']
+        assert (status['recipient_count'], status['status_counts']) == (4, {'sent': 4})
+
+    def test_failures_are_recorded_per_recipient(self, app, make_user):
+        from app.email import send_email
+        from app.models_email import OutboxEmail
+        server = self.smtp_server(reject={'gone@example.com'}, defer={'busy@example.com'})
+        self.use_server(app, server.server_address[1])
+
+        assert send_email('Hello', ['ok@example.com', 'gone@example.com', 'busy@example.com'], body='Woof')
+        server.shutdown()
+        outcomes = {email.recipient: (email.status, email.attempts) for email in OutboxEmail.query.all()}
+        assert outcomes == {'ok@example.com': ('sent', 1), 'gone@example.com': ('failed', 1),
+                            'busy@example.com': ('pending', 1)}
+        assert '451' in OutboxEmail.query.filter_by(recipient='busy@example.com').one().last_error
+
+    def test_unreachable_server_keeps_mail_queued(self, app):
+        import socket
+        from app.email import send_email
+        from app.models_email import OutboxEmail
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self.use_server(app, port)
+
+        assert send_email('Reset your password', 'owner@example.com', body='Link') is True
+        email = OutboxEmail.query.one()
+        assert (email.status, email.attempts, email.priority) == ('pending', 1, 10)
+        assert email.last_error
+
+
+class TestMediaStore:
+    """Uploads are stored once per content hash and served as immutable"""
+
+    @staticmethod
+    def upload(client, content, name='photo.pdf'):
+        import io
+        return client.post('/api/admin/gallery/upload', data={'file': (io.BytesIO(content), name), 'title': name},
+                           content_type='multipart/form-data').get_json()['data']
+
+    def test_duplicate_uploads_share_one_file(self, app, client, db, make_user, login, tmp_path):
+        import hashlib
+        from app.models_uploads import MediaBlob
+        app.config.update(UPLOAD_FOLDER=str(tmp_path))
+        login(make_user('admin@example.com', admin_level='admin'))
+
+        content = b'%PDF-1.4 walk schedule'
+        first, second = self.upload(client, content), self.upload(client, content, 'copy.pdf')
+        digest = hashlib.sha256(content).hexdigest()
+        assert first['file_path'] == second['file_path'] == f'uploads/media/{digest[:2]}/{digest[2:4]}/{digest}.pdf'
+        assert (first['file_name'], second['file_name']) == ('photo.pdf', 'copy.pdf')
+        assert db.session.get(MediaBlob, digest).ref_count == 2
+
+        response = client.get(f"/{first['file_path']}")
+        assert response.data == content
+        assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+        response.close()
+
+        # The file goes with its last reference
+        stored = tmp_path / first['file_path'].split('/', 1)[1]
+        assert client.delete(f"/api/admin/gallery/{first['id']}").status_code == 200
+        assert stored.exists() and db.session.get(MediaBlob, digest).ref_count == 1
+        assert client.delete(f"/api/admin/gallery/{second['id']}").status_code == 200
+        assert not stored.exists() and db.session.get(MediaBlob, digest) is None
+
+    def test_album_bulk_and_failed_uploads_release_blobs(self, app, client, db, make_user, login, tmp_path,
+                                                          monkeypatch):
+        import io
+        from app import tasks
+        from app.models_uploads import MediaBlob
+        from app.models_gallery_extended import GalleryAlbum
+        from app.api.routes import admin_routes
+        app.config.update(UPLOAD_FOLDER=str(tmp_path))
+        admin = make_user('admin@example.com', admin_level='admin')
+        login(admin)
+        album = GalleryAlbum(title='Walks', user_id=admin.id)
+        db.session.add(album)
+        db.session.commit()
+
+        def upload(content, album_id=''):
+            return client.post('/api/admin/gallery/upload', content_type='multipart/form-data', data={
+                'file': (io.BytesIO(content), 'walk.pdf'), 'title': 'Walk', 'album_id': album_id}).get_json()['data']
+
+        shared, in_album = upload(b'%PDF shared', album.id), upload(b'%PDF album only', album.id)
+        kept, other = upload(b'%PDF shared'), upload(b'%PDF other')
+        files = {item['id']: tmp_path / item['file_path'].split('/', 1)[1] for item in (shared, in_album, other)}
+
+        assert client.delete(f'/api/admin/albums/{album.id}').status_code == 200
+        assert files[shared['id']].exists() and not files[in_album['id']].exists()
+        assert sorted(blob.ref_count for blob in MediaBlob.query.all()) == [1, 1]
+
+        assert tasks.bulk_gallery_action('delete', [kept['id'], other['id']], admin.id)['affected_count'] == 2
+        assert MediaBlob.query.count() == 0 and not any(path.exists() for path in files.values())
+
+        def broken(*args, **kwargs):
+            raise RuntimeError('database went away')
+        monkeypatch.setattr(admin_routes, 'create_gallery_item', broken)
+        response = client.post('/api/admin/gallery/upload', content_type='multipart/form-data',
+                               data={'file': (io.BytesIO(b'%PDF lost'), 'lost.pdf'), 'title': 'Lost'})
+        assert response.status_code == 500
+        assert MediaBlob.query.count() == 0
+        assert not [path for path in (tmp_path / 'media').rglob('*.pdf')]
+
+
+class TestUploadServing:
+    """Uploads stream from Python with Range support, or are handed to nginx"""
+
+    def test_range_requests_without_offload(self, app, client, tmp_path):
+        app.config.update(UPLOAD_FOLDER=str(tmp_path))
+        (tmp_path / 'gallery').mkdir()
+        (tmp_path / 'gallery' / 'clip.mp4').write_bytes(b'0123456789')
+
+        response = client.get('/uploads/gallery/clip.mp4', headers={'Range': 'bytes=2-5'})
+        assert response.status_code == 206
+        assert (response.data, response.headers['Content-Range']) == (b'2345', 'bytes 2-5/10')
+        response.close()
+        assert client.get('/uploads/../config.py').status_code == 404
+        assert client.get('/uploads/gallery/missing.mp4').status_code == 404
+
+    def test_x_accel_redirect(self, app, client, tmp_path):
+        app.config.update(UPLOAD_FOLDER=str(tmp_path), UPLOADS_OFFLOAD='x-accel')
+        (tmp_path / 'gallery').mkdir()
+        (tmp_path / 'gallery' / 'walk in park.mp4').write_bytes(b'0123456789')
+
+        response = client.get('/uploads/gallery/walk in park.mp4', headers={'Range': 'bytes=2-5'})
+        assert response.status_code == 200 and response.data == b''
+        assert response.headers['X-Accel-Redirect'] == '/internal-uploads/gallery/walk%20in%20park.mp4'
+        assert response.headers['Content-Type'] == 'video/mp4'
+        assert client.get('/uploads/gallery/missing.mp4').status_code == 404
+
+
+class TestAnalyticsIngestion:
+    """Tracked analytics are buffered and bulk-inserted; a full buffer sheds load"""
+
+    def test_batch_beacon_writes_mixed_records(self, client, db):
+        from app.models_analytics import AnalyticsEvent, PageView, ContentInteraction, PerformanceMetric, UserSession
+        beacon = [
+            {'type': 'pageview', 'session_id': 's1', 'page_url': '/stories', 'device_info': {'type': 'mobile'}},
+            {'type': 'pageview', 'session_id': 's1', 'page_url': '/gallery'},
+            {'type': 'event', 'session_id': 's1', 'event_type': 'click', 'event_category': 'gallery',
+             'event_action': 'open', 'metadata': {'item': 3}},
+            {'type': 'interaction', 'session_id': 's1', 'content_type': 'story', 'content_id': 7,
+             'interaction_type': 'view', 'scroll_depth': 80},
+            {'type': 'performance', 'session_id': 's1', 'page_url': '/stories', 'load_time': 1.2},
+            {'type': 'event', 'event_type': 'click'},
+            {'type': 'unknown'},
+        ]
+        # sendBeacon posts text/plain
+        response = client.post('/api/analytics/batch', json={'events': beacon}, content_type='text/plain')
+        assert response.status_code == 202
+        assert response.get_json()['accepted'] == 5 and response.get_json()['rejected'] == 2
+
+        assert PageView.query.count() == 2
+        assert AnalyticsEvent.query.one().event_metadata == {'item': 3}
+        assert ContentInteraction.query.one().scroll_depth == 80
+        assert PerformanceMetric.query.one().load_time == 1.2
+        session = UserSession.query.filter_by(session_id='s1').one()
+        assert (session.page_views, session.landing_page, session.device_type) == (2, '/stories', 'mobile')
+
+        client.post('/api/analytics/track-pageview', json={'session_id': 's1', 'page_url': '/tours'})
+        db.session.expire_all()
+        assert UserSession.query.filter_by(session_id='s1').one().page_views == 3
+        assert client.post('/api/analytics/batch', json={'events': {}}).status_code == 400
+
+    def test_buffered_until_flush_and_sheds_when_full(self, app, client, db):
+        from app.models_analytics import AnalyticsEvent, PageView
+        from app.utils.analytics_buffer import analytics_buffer
+        app.config.update(ANALYTICS_BUFFER_ENABLED=True, ANALYTICS_FLUSH_INTERVAL_MS=3600000,
+                          ANALYTICS_BUFFER_MAX=3)
+        event = {'event_type': 'click', 'event_category': 'tours', 'event_action': 'book'}
+        try:
+            assert client.post('/api/analytics/track-event', json=event).status_code == 202
+            response = client.post('/api/analytics/batch', json=[
+                {'type': 'pageview', 'session_id': 's2', 'page_url': '/'},
+                {'type': 'event', **event},
+            ])
+            assert response.status_code == 503 and response.headers['Retry-After'] == '5'
+            assert client.post('/api/analytics/track-pageview', json={'page_url': '/'}).status_code == 202
+            assert AnalyticsEvent.query.count() == 0
+
+            assert analytics_buffer.flush() == 3
+            assert (AnalyticsEvent.query.count(), PageView.query.count()) == (1, 1)
+        finally:
+            analytics_buffer.shutdown()
+
+    def test_malformed_beacon_is_rejected_and_cannot_block_the_buffer(self, app, client, db):
+        from app.models_analytics import AnalyticsEvent, PerformanceMetric
+        from app.utils.analytics_buffer import analytics_buffer, event_row
+        event = {'event_type': 'click', 'event_category': 'tours', 'event_action': 'book'}
+        response = client.post('/api/analytics/batch', json=[
+            {'type': 'event', **event, 'duration': {'x': 1}},
+            {'type': 'interaction', 'content_type': 'story', 'content_id': 'seven', 'interaction_type': 'view'},
+            {'type': 'pageview', 'page_url': '/', 'device_info': {'type': ['mobile']}},
+            {'type': 'event', **event, 'duration': '12', 'metadata': {'ok': True}},
+            {'type': 'performance', 'page_url': '/', 'load_time': '1.5'},
+        ])
+        assert response.get_json()['accepted'] == 2 and response.get_json()['rejected'] == 3
+        assert AnalyticsEvent.query.one().duration == 12
+        assert PerformanceMetric.query.one().load_time == 1.5
+        response = client.post('/api/analytics/track-event', json={**event, 'duration': {'x': 1}})
+        assert response.status_code == 400 and 'duration' in response.get_json()['message']
+
+        # A row the database refuses is dropped without holding back the rest of the batch
+        app.config.update(ANALYTICS_BUFFER_ENABLED=True, ANALYTICS_FLUSH_INTERVAL_MS=3600000)
+        try:
+            bad = dict(event_row(event, None, None, None), duration={'x': 1})
+            good = event_row(event, None, None, None)
+            assert analytics_buffer.add([('event', bad), ('event', good)])
+            assert analytics_buffer.flush() == 1
+            assert analytics_buffer.pending() == 0 and AnalyticsEvent.query.count() == 2
+        finally:
+            analytics_buffer.shutdown()
+
+
+class TestAnalyticsRollups:
+    """Dashboards read hourly/daily rollups for closed hours and raw rows after the watermark"""
+
+    def seed(self, db, hours_ago, page_url, session_id, **session_fields):
+        from datetime import datetime, timedelta
+        from app.models_analytics import PageView, UserSession
+        when = datetime.utcnow() - timedelta(hours=hours_ago)
+        db.session.add(PageView(session_id=session_id, page_url=page_url, created_at=when))
+        if not UserSession.query.filter_by(session_id=session_id).first():
+            db.session.add(UserSession(session_id=session_id, started_at=when, last_activity=when,
+                                       **session_fields))
+        db.session.commit()
+
+    def test_rollups_match_raw_and_cover_the_open_hour(self, app, db):
+        from app.models_analytics import AnalyticsCalculator, AnalyticsRollup
+        from app.utils.analytics_rollups import AnalyticsRollups
+        self.seed(db, 70, '/stories', 'a', device_type='mobile', country='NZ', utm_source='news', is_bounce=True)
+        self.seed(db, 70, '/gallery', 'a')
+        self.seed(db, 30, '/stories', 'b', device_type='desktop', country='NZ')
+        self.seed(db, 3, '/stories', 'c', device_type='mobile', utm_source='news')
+
+        raw = (AnalyticsCalculator.get_top_pages(7), AnalyticsCalculator.get_device_breakdown(7),
+               AnalyticsCalculator.get_traffic_sources(7), AnalyticsCalculator.get_bounce_rate(7),
+               AnalyticsCalculator.get_page_views_by_day(7))
+        assert raw[0] == [('/stories', 3, 3), ('/gallery', 1, 1)]
+        assert raw[1] == [('mobile', 2, 0), ('desktop', 1, 0)]
+        assert raw[3] == 33.33
+
+        AnalyticsRollups.refresh()
+        assert AnalyticsRollup.query.filter_by(granularity='day').count() > 0
+        assert AnalyticsRollups.next_run_delay() > 0
+        rolled = (AnalyticsCalculator.get_top_pages(7), AnalyticsCalculator.get_device_breakdown(7),
+                  AnalyticsCalculator.get_traffic_sources(7), AnalyticsCalculator.get_bounce_rate(7),
+                  AnalyticsCalculator.get_page_views_by_day(7))
+        assert rolled == raw
+
+        # Closed hours come from the rollups, the open hour from raw rows
+        self.seed(db, 0, '/tours', 'd', device_type='tablet')
+        self.seed(db, 5, '/tours', 'e', device_type='tablet')
+        assert AnalyticsCalculator.get_top_pages(7)[-1][:2] == ('/tours', 1)
+        assert ('tablet', 1, 0) in AnalyticsCalculator.get_device_breakdown(7)
+
+        app.config.update(ANALYTICS_ROLLUP_RESTATE_HOURS=6)
+        AnalyticsRollups.refresh()
+        assert ('/tours', 2, 2) in AnalyticsCalculator.get_top_pages(7)
+
+
+class TestAnalyticsDashboard:
+    """The dashboard is assembled from parallel parts and shared as a cached snapshot"""
+
+    def test_dashboard_snapshot(self, app, client, make_user, login):
+        from app.utils.analytics_dashboard import dashboard_snapshots
+        login(make_user('admin@example.com', admin_level='admin'))
+        app.config.update(ANALYTICS_DASHBOARD_TTL=60)
+        try:
+            first = client.get('/api/analytics/dashboard?days=7').get_json()['data']
+            assert first['overview']['total_users'] == 1
+            assert set(first['popular_content']) == {'stories', 'gallery', 'tours'}
+            assert client.get('/api/analytics/dashboard?days=7').get_json()['data'] == first
+        finally:
+            dashboard_snapshots.clear()
+
+    def test_parts_run_in_parallel_and_builds_are_shared(self, app, monkeypatch):
+        import threading
+        import time
+        from app.utils import analytics_dashboard
+        from app.utils.analytics_dashboard import dashboard_snapshots
+
+        calls = []
+
+        def slow_part(days):
+            calls.append(threading.current_thread().name)
+            time.sleep(0.05)
+            return days
+
+        for name in analytics_dashboard.PARTS:
+            monkeypatch.setitem(analytics_dashboard.PARTS, name, slow_part)
+        app.config.update(ANALYTICS_DASHBOARD_WORKERS=6, ANALYTICS_DASHBOARD_TTL=0)
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(dashboard_snapshots.get(3)))
+                       for _ in range(4)]
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(calls) == len(analytics_dashboard.PARTS)
+            assert all(name.startswith('analytics-dashboard') for name in calls)
+            assert time.monotonic() - started < 0.05 * len(calls) / 2
+            assert len(results) == 4 and all(result is results[0] for result in results)
+            assert results[0]['overview']['total_users'] == 3
+        finally:
+            dashboard_snapshots.shutdown()
+
+
+class TestAnalyticsExport:
+    """Exports stream rows as CSV, NDJSON or JSON, optionally gzipped"""
+
+    def seed(self, db):
+        from datetime import datetime, timedelta
+        from app.models_analytics import PageView
+        now = datetime.utcnow()
+        for days_ago, url in ((40, '/old'), (5, '/stories'), (1, '/gallery')):
+            db.session.add(PageView(session_id='s', page_url=url, time_on_page=days_ago,
+                                    created_at=now - timedelta(days=days_ago)))
+        db.session.commit()
+
+    def test_csv_and_ndjson_exports(self, app, client, db, make_user, login):
+        import csv
+        import gzip
+        import io
+        import json
+        from datetime import datetime, timedelta
+        self.seed(db)
+        login(make_user('admin@example.com', admin_level='admin'))
+        app.config.update(ANALYTICS_EXPORT_BATCH_SIZE=1)
+
+        response = client.get('/api/analytics/export?type=pageviews&format=csv&columns=page_url,time_on_page')
+        assert response.is_streamed and response.mimetype == 'text/csv'
+        assert list(csv.reader(io.StringIO(response.get_data(as_text=True)))) == [
+            ['page_url', 'time_on_page'], ['/stories', '5'], ['/gallery', '1']]
+
+        since = (datetime.utcnow() - timedelta(days=50)).date().isoformat()
+        until = (datetime.utcnow() - timedelta(days=3)).date().isoformat()
+        response = client.get(f'/api/analytics/export?type=pageviews&format=ndjson&from={since}&to={until}&gzip=1')
+        assert response.headers['Content-Disposition'].endswith('.ndjson.gz"')
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert [json.loads(line)['page_url'] for line in lines] == ['/old', '/stories']
+
+        body = client.get('/api/analytics/export?type=pageviews&days=7').get_json()
+        assert body['success'] and body['total_records'] == 2
+        assert [row['page_url'] for row in body['data']] == ['/stories', '/gallery']
+
+        assert client.get('/api/analytics/export?type=pageviews&columns=password').status_code == 400
+        assert client.get('/api/analytics/export?type=pageviews&format=xml').status_code == 400
+
+
+class TestAnalyticsArchive:
+    """Aged analytics rows move to per-month files and stay visible to export and rollups"""
+
+    def test_archive_round_trip(self, app, client, db, make_user, login, tmp_path):
+        import json
+        from datetime import datetime, timedelta
+        from app.models_analytics import AnalyticsEvent, PageView, AnalyticsCalculator
+        from app.utils.analytics_archive import archive_all, archived_months
+        from app.utils.analytics_rollups import AnalyticsRollups
+        app.config.update(ANALYTICS_ARCHIVE_DIR=str(tmp_path), ANALYTICS_ARCHIVE_BATCH_SIZE=2)
+        now = datetime.utcnow()
+        for days_ago in (60, 45, 40, 2):
+            db.session.add(PageView(session_id='s', page_url=f'/page{days_ago}', created_at=now - timedelta(days=days_ago),
+                                    device_info={'type': 'mobile'}))
+        db.session.add(AnalyticsEvent(session_id='s', event_type='click', event_category='tours', event_action='book',
+                                      event_metadata={'tour': 4}, created_at=now - timedelta(days=50)))
+        db.session.commit()
+
+        totals = archive_all(now - timedelta(days=30))
+        assert (totals['pageviews'], totals['events'], totals['heatmap']) == (3, 1, 0)
+        assert PageView.query.count() == 1 and AnalyticsEvent.query.count() == 0
+        assert len(archived_months('pageviews')) in (2, 3)
+
+        login(make_user('admin@example.com', admin_level='admin'))
+        lines = client.get('/api/analytics/export?type=pageviews&format=ndjson&days=90').get_data(as_text=True)
+        assert [json.loads(line)['page_url'] for line in lines.splitlines()] == ['/page60', '/page45', '/page40', '/page2']
+        events = client.get('/api/analytics/export?type=events&days=90').get_json()['data']
+        assert events[0]['metadata'] == {'tour': 4} and events[0]['created_at'].startswith(
+            (now - timedelta(days=50)).date().isoformat())
+
+        AnalyticsRollups.refresh()
+        assert sum(views for _, views in AnalyticsCalculator.get_page_views_by_day(90)) == 4
+
+
+class TestUniqueSketches:
+    """Unique counts come from mergeable HyperLogLog sketches, with an exact fallback"""
+
+    def test_sketch_error_and_merge(self):
+        from app.utils.hyperloglog import HyperLogLog
+        first = HyperLogLog(12).update(range(0, 30000))
+        second = HyperLogLog(12).update(range(20000, 50000))
+        assert first.count() == pytest.approx(30000, rel=0.05)
+        merged = HyperLogLog.from_bytes(first.to_bytes()).merge(second)
+        assert merged.count() == pytest.approx(50000, rel=0.05)
+        assert HyperLogLog(12).update(['a', 'b', 'b', 'c']).count() == 3
+        with pytest.raises(ValueError):
+            first.merge(HyperLogLog(10))
+
+    def test_active_users_from_sketches_match_exact(self, app, db, make_user):
+        from datetime import datetime, timedelta
+        from app.models_analytics import UserSession, AnalyticsCalculator
+        from app.utils.analytics_rollups import AnalyticsRollups
+        users = [make_user(f'visitor{i}@example.com') for i in range(3)]
+        now = datetime.utcnow()
+        for i, (hours_ago, user) in enumerate([(50, 0), (26, 0), (26, 1), (3, 2), (0, 1), (0, None)]):
+            when = now - timedelta(hours=hours_ago)
+            db.session.add(UserSession(session_id=f'u{i}', user_id=users[user].id if user is not None else None,
+                                       device_type='mobile', started_at=when, last_activity=when))
+        db.session.commit()
+        AnalyticsRollups.refresh()
+
+        sketched = (AnalyticsCalculator.get_active_users(7), AnalyticsCalculator.get_device_breakdown(7))
+        app.config.update(ANALYTICS_EXACT_UNIQUES=True)
+        exact = (AnalyticsCalculator.get_active_users(7), AnalyticsCalculator.get_device_breakdown(7))
+        assert sketched == exact == (3, [('mobile', 6, 3)])
@@ -100,12 +100,15 @@ nginx -t
 # Setup systemd service
 print_status "Setting up systemd service..."
 cp $APP_DIR/deployment/naviddog.service /etc/systemd/system/
+cp $APP_DIR/deployment/naviddog-worker.service /etc/systemd/system/
 systemctl daemon-reload
 systemctl enable naviddog
+systemctl enable naviddog-worker
 
 # Start services
 print_status "Starting services..."
 systemctl restart naviddog
+systemctl restart naviddog-worker
 systemctl restart nginx
 
 # Check service status
@@ -119,6 +122,13 @@ else
     systemctl status naviddog --no-pager
 fi
 
+if systemctl is-active --quiet naviddog-worker; then
+    print_success "✅ NavidDoggy job workers are running"
+else
+    print_error "❌ NavidDoggy job workers failed to start"
+    systemctl status naviddog-worker --no-pager
+fi
+
 if systemctl is-active --quiet nginx; then
     print_success "✅ Nginx is running"
 else
@@ -139,6 +149,6 @@ print_warning "   4. Configure monitoring"
 
 print_status "📋 Useful commands:"
 print_status "   - Check app logs: sudo journalctl -u naviddog -f"
-print_status "   - Restart app: sudo systemctl restart naviddog"
+print_status "   - Restart app: sudo systemctl restart naviddog naviddog-worker"
 print_status "   - Check nginx logs: sudo tail -f /var/log/nginx/error.log"
-print_status "   - Update app: git pull && sudo systemctl restart naviddog"
\ No newline at end of file
+print_status "   - Update app: git pull && sudo systemctl restart naviddog naviddog-worker"
\ No newline at end of file
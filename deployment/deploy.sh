@@ -79,16 +79,20 @@ nginx -t
 
 print_status "Setting up systemd service..."
 cp /tmp/naviddog-deployment/naviddog.service /etc/systemd/system/
+cp /tmp/naviddog-deployment/naviddog-worker.service /etc/systemd/system/
 systemctl daemon-reload
 systemctl enable naviddog
+systemctl enable naviddog-worker
 
 print_status "Starting services..."
 systemctl restart naviddog
+systemctl restart naviddog-worker
 systemctl restart nginx
 
 print_success "Deployment completed!"
 print_status "Checking service status..."
 systemctl status naviddog --no-pager
+systemctl status naviddog-worker --no-pager
 systemctl status nginx --no-pager
 
 print_success "✅ NavidDoggy is now running!"